@@ -1,18 +1,74 @@
+import argparse
+import functools
 import json
+import os
+import sys
 import time
-import requests
 from tqdm import tqdm
 
+# 复用 user_simulator 的 API 客户端和限流器
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "user_simulator"))
+import config
+from scripts.api_client import CircuitOpenError
+from scripts.backends import create_client
+from scripts.batch_job import BatchJobWriter, load_batch_results
+from scripts.circuit_breaker import CircuitBreaker
+from scripts.concurrency import AdaptiveConcurrencyLimiter, ordered_parallel_map
+from scripts.key_pool import KeyPool
+from scripts.rate_limiter import RateLimiter
+from scripts.response_cache import ResponseCache
+
 # ================== 配置 ==================
-API_KEY = API_KEY
-API_URL = "https://dashscope.aliyuncs.com/api/v1/services/aigc/text-generation/generation"
+API_KEY = os.getenv("QWEN_API_KEY")
+API_URL = config.API_BASE_URL  # 设置环境变量 API_BASE_URL 可指向本地模拟服务
 
 MODEL_NAME = "qwen-plus"  # qwen-max / qwen-plus / qwen-turbo
+# 实时调用与批量任务共用的模型参数
+CALL_PARAMS = {"model": MODEL_NAME, "temperature": 0.0}
 
 INPUT_PATH = "/Users/ningjia/Downloads/chromeDownload/all_dialogues_assistant_thinking.jsonl"
 OUTPUT_PATH = "/Users/ningjia/desktop/jiu_an/output_with_class.jsonl"
 
-SLEEP_TIME = 3  # 防止限流
+# 分类调用 temperature=0，结果缓存到磁盘，崩溃后重跑不会重复计费
+CACHE_PATH = os.path.join(os.path.dirname(OUTPUT_PATH), "classify_cache.sqlite")
+# 调用延迟、token用量等指标（JSON 快照 + Prometheus 文本）
+METRICS_PATH = os.path.join(os.path.dirname(OUTPUT_PATH), "classify_api_metrics.json")
+METRICS_PROM_PATH = os.path.join(os.path.dirname(OUTPUT_PATH), "classify_api_metrics.prom")
+# 离线批量模式：导出的批量任务文件，以及服务商返回的结果文件
+BATCH_INPUT_PATH = os.path.join(os.path.dirname(OUTPUT_PATH), "classify_batch_input.jsonl")
+BATCH_RESULTS_PATH = os.path.join(os.path.dirname(OUTPUT_PATH), "classify_batch_output.jsonl")
+
+# 并行分类的线程数，默认与 AIMD 上限的上界相同：线程只是容量，实际在途请求数由 AIMD 控制器
+# 在 config.ADAPTIVE_CONCURRENCY 范围内自动调整（设置 CLASSIFY_WORKERS 时上界收紧到该线程数）
+WORKERS = int(os.getenv("CLASSIFY_WORKERS", str(config.ADAPTIVE_CONCURRENCY["max_limit"])))
+
+
+def build_client():
+    """
+    创建实时分类用的 API 客户端（导入本模块、导出/合并批量任务时不创建，也不打开缓存文件）
+
+    设置 QWEN_API_KEYS 时按多个 key 负载均衡，每个 key 独立计算配额；
+    设置 LLM_BACKEND=openai / mock 时改用本地 OpenAI 兼容服务或模拟后端（不限流）
+    """
+    if config.LLM_BACKEND == "dashscope":
+        # 按模型 RPM/TPM 配额排队，取代固定的 sleep（配额见 config.MODEL_RATE_LIMITS）
+        backend_options = dict(
+            api_key=API_KEY,
+            base_url=API_URL,
+            rate_limiter=RateLimiter(config.MODEL_RATE_LIMITS),
+            key_pool=KeyPool.from_specs(config.API_KEYS, API_URL, config.MODEL_RATE_LIMITS) if config.API_KEYS else None
+        )
+    elif config.LLM_BACKEND == "openai":
+        backend_options = dict(api_key=config.OPENAI_API_KEY, base_url=config.OPENAI_BASE_URL, model_override=config.OPENAI_MODEL)
+    else:
+        backend_options = {}
+    return create_client(
+        config.LLM_BACKEND,
+        **backend_options,
+        cache=ResponseCache(CACHE_PATH, max_bytes=config.RESPONSE_CACHE_MAX_BYTES),
+        concurrency=AdaptiveConcurrencyLimiter(**config.ADAPTIVE_CONCURRENCY).cap(WORKERS),
+        circuit_breaker=CircuitBreaker(**config.CIRCUIT_BREAKER)
+    )
 
 
 # ================== ENUM 定义 ==================
@@ -80,35 +136,24 @@ LOW / MEDIUM / HIGH
 
 
 # ================== DashScope 调用 ==================
-def call_dashscope(dialogue_json: dict) -> dict:
+def build_messages(dialogue_json: dict) -> list:
     prompt = USER_PROMPT_TEMPLATE.format(
         primary_classes=", ".join(PRIMARY_CLASSES),
         secondary_classes=", ".join(SECONDARY_CLASSES),
         dialogue=json.dumps(dialogue_json, ensure_ascii=False)
     )
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": prompt}
+    ]
+
 
-    payload = {
-        "model": MODEL_NAME,
-        "input": {
-            "messages": [
-                {"role": "system", "content": SYSTEM_PROMPT},
-                {"role": "user", "content": prompt}
-            ]
-        },
-        "parameters": {
-            "temperature": 0.0
-        }
-    }
-
-    headers = {
-        "Authorization": f"Bearer {API_KEY}",
-        "Content-Type": "application/json"
-    }
-
-    resp = requests.post(API_URL, headers=headers, json=payload, timeout=60)
-    resp.raise_for_status()
-
-    text = resp.json()["output"]["text"]
+def call_dashscope(api_client, dialogue_json: dict) -> dict:
+    text = api_client.call_with_messages(
+        messages=build_messages(dialogue_json),
+        caller="classify",
+        **CALL_PARAMS
+    )
     return json.loads(text)
 
 
@@ -129,39 +174,130 @@ def validate_annotation(ann: dict):
 
 
 # ================== 主流程 ==================
-def main():
+# 本轮连续熔断的开始时间（monotonic），有调用成功后清空
+_outage_started = None
+
+
+def classify_line(api_client, line: str):
+    """分类单条对话，返回 (原数据, 标注, 错误)"""
+    global _outage_started
+    data = json.loads(line)
+    while True:
+        try:
+            annotation = call_dashscope(api_client, data)
+            validate_annotation(annotation)
+        except CircuitOpenError as e:
+            # 接口熔断时等待恢复后重试，不把整批数据写成错误记录；
+            # 连续熔断超过 config.CIRCUIT_MAX_OUTAGE 秒后不再等待，剩余数据记为错误，重跑时命中缓存的部分不再计费
+            if _outage_started is None:
+                _outage_started = time.monotonic()
+            elif time.monotonic() - _outage_started >= config.CIRCUIT_MAX_OUTAGE:
+                return data, None, e
+            time.sleep(max(e.retry_after or 0.0, 1.0))
+            continue
+        except Exception as e:
+            return data, None, e
+        _outage_started = None
+        return data, annotation, None
+
+
+def write_record(fout, data: dict, annotation, error):
+    """写出一条分类结果"""
+    if error is not None:
+        # 出错时保留原数据，方便回溯
+        data["class_annotation_error"] = str(error)
+        fout.write(json.dumps(data, ensure_ascii=False) + "\n")
+        return
+
+    # 生成 system prepend（可选，训练时可以不喂）
+    system_tag = (
+        f"【CLASS={annotation['primary_class']} | "
+        f"SUB={annotation['secondary_class']} | "
+        f"RISK={annotation['risk_level']}】"
+    )
+
+    data["class_annotation"] = annotation
+    data["dialogue_history"] = [
+        {"role": "system", "content": system_tag}
+    ] + data.get("dialogue_history", [])
+
+    fout.write(json.dumps(data, ensure_ascii=False) + "\n")
+
+
+def batch_custom_id(index: int) -> str:
+    """批量任务中第 index 条（非空行）输入的 custom_id"""
+    return f"line-{index}"
+
+
+def run_live():
+    api_client = build_client()
     with open(INPUT_PATH, "r", encoding="utf-8") as fin, \
          open(OUTPUT_PATH, "w", encoding="utf-8") as fout:
 
-        for line in tqdm(fin, desc="Classifying"):
-            if not line.strip():
-                continue
+        # 多线程并行调用，结果按输入顺序写出
+        lines = (line for line in fin if line.strip())
+        classify = functools.partial(classify_line, api_client)
+        for data, annotation, error in tqdm(ordered_parallel_map(classify, lines, WORKERS), desc="Classifying"):
+            write_record(fout, data, annotation, error)
+
+    print(f"响应缓存统计: {api_client.cache.stats()}")
+    api_client.metrics.print_summary()
+    api_client.metrics.save(json_path=METRICS_PATH, prometheus_path=METRICS_PROM_PATH)
+
+
+def export_batch(batch_path: str):
+    """把全部分类请求写成批量任务文件，不调用接口"""
+    with open(INPUT_PATH, "r", encoding="utf-8") as fin, BatchJobWriter(batch_path) as writer:
+        lines = (line for line in fin if line.strip())
+        for index, line in enumerate(lines):
+            writer.add(batch_custom_id(index), build_messages(json.loads(line)), **CALL_PARAMS)
+    print(f"已导出 {writer.count} 条批量请求: {batch_path}")
 
+
+def ingest_batch(results_path: str):
+    """读取批量任务结果，按 custom_id 合并回原始对话，输出格式与实时模式一致"""
+    results = load_batch_results(results_path)
+    failed = 0
+    input_tokens = output_tokens = 0
+    with open(INPUT_PATH, "r", encoding="utf-8") as fin, \
+         open(OUTPUT_PATH, "w", encoding="utf-8") as fout:
+        lines = (line for line in fin if line.strip())
+        for index, line in enumerate(tqdm(lines, desc="Ingesting")):
             data = json.loads(line)
+            result = results.get(batch_custom_id(index))
+            annotation, error = None, None
+            if result is None:
+                error = "批量结果缺失"
+            elif result["error"] is not None:
+                error = result["error"]
+            else:
+                input_tokens += result["usage"]["input_tokens"]
+                output_tokens += result["usage"]["output_tokens"]
+                try:
+                    annotation = json.loads(result["text"])
+                    validate_annotation(annotation)
+                except Exception as e:
+                    annotation, error = None, e
+            if error is not None:
+                failed += 1
+            write_record(fout, data, annotation, error)
+    print(f"合并完成：{len(results)} 条结果，{failed} 条失败，token 用量 输入 {input_tokens} / 输出 {output_tokens}")
 
-            try:
-                annotation = call_dashscope(data)
-                validate_annotation(annotation)
-            except Exception as e:
-                # 出错时保留原数据，方便回溯
-                data["class_annotation_error"] = str(e)
-                fout.write(json.dumps(data, ensure_ascii=False) + "\n")
-                continue
-
-            # 生成 system prepend（可选，训练时可以不喂）
-            system_tag = (
-                f"【CLASS={annotation['primary_class']} | "
-                f"SUB={annotation['secondary_class']} | "
-                f"RISK={annotation['risk_level']}】"
-            )
-
-            data["class_annotation"] = annotation
-            data["dialogue_history"] = [
-                {"role": "system", "content": system_tag}
-            ] + data.get("dialogue_history", [])
-
-            fout.write(json.dumps(data, ensure_ascii=False) + "\n")
-            time.sleep(SLEEP_TIME)
+
+def main():
+    parser = argparse.ArgumentParser(description="对话主题分类")
+    parser.add_argument("--mode", choices=["live", "export", "ingest"], default="live",
+                        help="live: 实时调用接口；export: 导出批量任务文件；ingest: 合并批量任务结果")
+    parser.add_argument("--batch-file", type=str, default=BATCH_INPUT_PATH, help="导出的批量任务文件")
+    parser.add_argument("--results-file", type=str, default=BATCH_RESULTS_PATH, help="服务商返回的批量结果文件")
+    args = parser.parse_args()
+
+    if args.mode == "export":
+        export_batch(args.batch_file)
+    elif args.mode == "ingest":
+        ingest_batch(args.results_file)
+    else:
+        run_live()
 
 
 if __name__ == "__main__":
@@ -5,15 +5,78 @@ import os
 
 # API配置
 API_KEY = os.getenv("QWEN_API_KEY", )
-API_BASE_URL = "https://dashscope.aliyuncs.com/api/v1/services/aigc/text-generation/generation"
+# 可通过环境变量 API_BASE_URL 指向本地模拟服务（scripts/mock_dashscope_server.py）做离线压测
+API_BASE_URL = os.getenv("API_BASE_URL", "https://dashscope.aliyuncs.com/api/v1/services/aigc/text-generation/generation")
+# 多 key 负载均衡：逗号分隔，每项为 "key" 或 "key@接入点URL"（未指定接入点时使用 API_BASE_URL）
+# 每个 key 按 MODEL_RATE_LIMITS 独立计算配额，总吞吐随 key 数增加；为空时只使用 API_KEY
+API_KEYS = [spec.strip() for spec in os.getenv("QWEN_API_KEYS", "").split(",") if spec.strip()]
+
+# 大模型后端：dashscope（百炼，默认）/ openai（OpenAI 兼容接口，如本地 vLLM）/ mock（进程内模拟回复，不走网络）
+LLM_BACKEND = os.getenv("LLM_BACKEND", "dashscope")
+# OpenAI 兼容服务的根地址与密钥（本地服务通常不校验密钥）
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "http://127.0.0.1:8000/v1")
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "EMPTY")
+# 本地服务加载的模型名，为空时沿用调用方的模型名（qwen-plus 等）
+OPENAI_MODEL = os.getenv("OPENAI_MODEL") or None
 
 # 模型配置
 DEFAULT_MODEL = "qwen-plus"
 DEFAULT_TEMPERATURE = 0.7
 DEFAULT_MAX_TOKENS = 4000
 
+# 连接池配置（同一个 QwenAPIClient 在所有线程间共享 keep-alive 连接）
+API_POOL_CONNECTIONS = int(os.getenv("QWEN_API_POOL_CONNECTIONS", "10"))
+API_POOL_MAXSIZE = int(os.getenv("QWEN_API_POOL_MAXSIZE", "32"))
+
+# 按模型的限流配额（RPM: 每分钟请求数，TPM: 每分钟token数）
+# 请按百炼控制台中账号的实际配额修改，所有调用都会按此排队，不再依赖固定 sleep
+MODEL_RATE_LIMITS = {
+    "qwen-plus": {"rpm": 15000, "tpm": 1200000},
+    "qwen-turbo": {"rpm": 1200, "tpm": 1000000},
+}
+
+# 模型单价（元/千token），用于预算与费用估算
+MODEL_PRICES = {
+    "qwen-plus": {"input": 0.0008, "output": 0.002},
+    "qwen-turbo": {"input": 0.0003, "output": 0.0006},
+    "qwen-max": {"input": 0.0024, "output": 0.0096},
+}
+
+# 自适应并发（AIMD）：批量任务的在途请求上限在 [min_limit, max_limit] 内按 429 和延迟自动调整
+ADAPTIVE_CONCURRENCY = {"initial_limit": 4, "min_limit": 1, "max_limit": 64}
+
+# 熔断：接口连续失败 failure_threshold 次后熔断 recovery_timeout 秒，之后放行探测请求
+CIRCUIT_BREAKER = {"failure_threshold": 5, "recovery_timeout": 30.0}
+# 批量任务遇到熔断时暂停等待，连续熔断（期间没有对话成功生成）超过该秒数后停止调度新的对话
+CIRCUIT_MAX_OUTAGE = 600.0
+
+# 对冲请求：调用超过近期延迟 quantile 分位数（至少 min_delay 秒）未返回时补发一个，额外调用不超过 max_extra_ratio
+HEDGING = {"quantile": 0.95, "min_delay": 2.0, "max_extra_ratio": 0.05}
+
+# 滚动历史（main_random_topic.py --rolling-history）：最近 keep_last 条消息原样保留，
+# 更早的消息每 evict_batch 条折叠进摘要；历史部分不超过 max_tokens，摘要不超过 summary_max_tokens
+HISTORY_CONTEXT = {"keep_last": 6, "evict_batch": 4, "max_tokens": 1500, "summary_max_tokens": 300}
+
+# 提示词预算（main_random_topic.py --prompt-budget）：按角色的输入 token 上限（离线预估），
+# 超出时调用前依次裁剪故事背景、生活状态和较早的历史
+PROMPT_TOKEN_LIMITS = {"patient": 3000, "assistant": 2500}
+
+# 输出长度控制（main_random_topic.py --length-governor，基线脚本同名参数）：从 OUTPUT_LENGTH_CORPUS 中的对话
+# 学习各角色回复的长度，max_tokens 取 quantile 分位数 × headroom（不低于 min_tokens），并设置 stop 序列；
+# 回复被截断时翻倍重试，最多 max_escalations 次，不超过各调用原来的固定 max_tokens
+OUTPUT_LENGTH_CORPUS = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "by_topic_and_risk"))
+OUTPUT_LENGTH = {"quantile": 0.99, "headroom": 1.5, "min_tokens": 64, "max_escalations": 2}
+
+# 整段对话一次生成（main_random_topic.py --one-shot）：每段对话 min_turns~max_turns 轮，最多 max_calls 次调用
+ONE_SHOT_DIALOGUE = {"min_turns": 3, "max_turns": 8, "max_calls": 2}
+
+# 响应缓存（SQLite），确定性调用与重放命中磁盘，不再重复计费
+RESPONSE_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
 # 数据路径
 DATA_DIR = "data"
 PERSONA_DIR = os.path.join(DATA_DIR, "patient_structured")
 OUTPUT_DIR = "output"
 
+# main_random_topic.py 默认的响应缓存文件（--cache-file 指定其他路径，--no-cache 关闭）
+RESPONSE_CACHE_PATH = os.path.join(OUTPUT_DIR, "response_cache.sqlite")
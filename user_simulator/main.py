@@ -4,14 +4,19 @@
 import json
 import os
 import argparse
+import contextvars
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
 from pathlib import Path
+from typing import Any, Callable, Dict
 from scripts import (
     QwenAPIClient,
     PersonaGenerator,
     BackgroundGenerator,
     StoryGenerator,
     DialogueGenerator,
-    HealthAssistantGenerator)
+    HealthAssistantGenerator,
+    HealthAssistantGenerator_thinking,
+    RateLimiter)
 import config
 
 
@@ -26,14 +31,20 @@ class UserSimulator:
             api_key: API密钥，如果不提供则使用配置文件中的
         """
         self.api_key = api_key or config.API_KEY
-        self.api_client = QwenAPIClient(self.api_key, config.API_BASE_URL)
+        self.api_client = QwenAPIClient(
+            self.api_key,
+            config.API_BASE_URL,
+            pool_connections=config.API_POOL_CONNECTIONS,
+            pool_maxsize=config.API_POOL_MAXSIZE,
+            rate_limiter=RateLimiter(config.MODEL_RATE_LIMITS)
+        )
         
         # 初始化各个生成器
         self.persona_generator = PersonaGenerator(self.api_client)
         self.background_generator = BackgroundGenerator(self.api_client)
         self.story_generator = StoryGenerator(self.api_client)
         self.dialogue_generator = DialogueGenerator(self.api_client)
-        self.health_assistant_generator = HealthAssistantGenerator(self.api_client)
+        self.health_assistant_generator = (HealthAssistantGenerator or HealthAssistantGenerator_thinking)(self.api_client)
 
     
     def generate_persona(self, raw_persona: dict) -> dict:
@@ -132,6 +143,9 @@ class UserSimulator:
             story=story
         )
         print("健康助手回复生成完成！")
+        # HealthAssistantGenerator_thinking 返回 {"thinking", "response"}
+        if isinstance(reply, dict):
+            reply = reply["response"]
         return reply
                                       
    
@@ -153,9 +167,13 @@ class UserSimulator:
         Returns:
             如果return_full_data=True，返回包含metadata的字典；否则返回对话历史列表
         """
-        # 生成背景和故事
-        background = self.generate_background(persona, dialogue_topic)
-        story = self.generate_story(persona, dialogue_topic)
+        # 生成背景和故事（两者互不依赖，并行生成，准备耗时取两者中较慢的一个）
+        setup = self._run_concurrently({
+            "background": lambda: self.generate_background(persona, dialogue_topic),
+            "story": lambda: self.generate_story(persona, dialogue_topic)
+        })
+        background = setup["background"]
+        story = setup["story"]
         
         # 初始化对话历史
         dialogue_history = []
@@ -214,6 +232,34 @@ class UserSimulator:
         else:
             return dialogue_history
 
+    @staticmethod
+    def _run_concurrently(stages: Dict[str, Callable[[], Any]]) -> Dict[str, Any]:
+        """
+        并行执行互不依赖的准备步骤
+
+        每个步骤在独立线程中运行，并继承调用方的上下文（如 track_usage 的用量统计）。
+        任一步骤失败时立即抛出它的异常，不等待其余步骤（已发出的请求无法撤回，结果直接丢弃）。
+        
+        Args:
+            stages: 步骤名 -> 无参函数
+            
+        Returns:
+            步骤名 -> 返回值
+        """
+        executor = ThreadPoolExecutor(max_workers=len(stages))
+        try:
+            futures = {
+                name: executor.submit(contextvars.copy_context().run, stage)
+                for name, stage in stages.items()
+            }
+            done, _ = wait(futures.values(), return_when=FIRST_EXCEPTION)
+            for future in done:
+                if future.exception() is not None:
+                    future.result()
+            return {name: future.result() for name, future in futures.items()}
+        finally:
+            executor.shutdown(wait=False)
+
 
 
 
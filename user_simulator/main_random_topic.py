@@ -9,13 +9,28 @@ import time
 import random
 from pathlib import Path
 from datetime import datetime
-from typing import Dict, List, Any
+from typing import Dict, List, Any, Optional
 
 # 添加路径
 sys.path.append('/home/yjr/rl-health-dialogue/user_simulator')
 
+import config
+
 # 导入 API 客户端
-from scripts.api_client import QwenAPIClient
+from scripts.api_client import BudgetExceededError, CircuitOpenError
+from scripts.backends import create_client
+from scripts.budget import TokenBudget, estimate_cost, track_usage
+from scripts.circuit_breaker import CircuitBreaker
+from scripts.concurrency import AdaptiveConcurrencyLimiter, ordered_parallel_map
+from scripts.hedging import HedgePolicy
+from scripts.history_context import RollingHistory
+from scripts.key_pool import KeyPool
+from scripts.rate_limiter import RateLimiter
+from scripts.response_cache import ResponseCache
+from scripts.length_governor import OutputLengthGovernor, iter_corpus_records, render_output
+from scripts.one_shot_dialogue import OneShotDialogueGenerator
+from scripts.structured_output import StructuredOutputError
+from scripts.token_estimator import PromptBudgetEnforcer, TokenEstimator
 
 # 导入患者生成器（带 thinking）
 from scripts.dialogue_generator import DialogueGenerator
@@ -25,28 +40,92 @@ from scripts.health_assistant_generator_thinking import HealthAssistantGenerator
 
 # API Key
 QWEN_API_KEY = os.getenv("QWEN_API_KEY")
-if not QWEN_API_KEY:
-    print("错误：请设置环境变量 QWEN_API_KEY")
+if config.LLM_BACKEND == "dashscope" and not QWEN_API_KEY and not config.API_KEYS:
+    print("错误：请设置环境变量 QWEN_API_KEY（或 QWEN_API_KEYS）")
     sys.exit(1)
 
 class ConsolidatedDialogueGenerator:
     """批量对话生成器 - 患者无 Thinking 版本"""
+
+    # 结构化输出模式下，一段对话内最多允许几轮在修复、重新请求后仍不合法（每次重新生成该轮），
+    # 超过后结束这段对话，已生成的轮次照常保存
+    MAX_FAILED_TURNS = 2
     
     def __init__(self, 
                  output_file: str = "dialogues/all_dialogues_assistant_thinking.jsonl",
                  progress_file: str = "progress_assistant_thinking.json",
                  max_turns_per_convo: int = 25,
-                 delay_between_calls: float = 1.0,
-                 num_topics_to_generate: int = 300):
+                 delay_between_calls: float = 0.0,
+                 num_topics_to_generate: int = 300,
+                 cache_file: str = None,
+                 cache_mode: str = "deterministic",
+                 stream: bool = False,
+                 workers: int = 1,
+                 hedge: bool = False,
+                 budget: Optional[TokenBudget] = None,
+                 messages_mode: bool = False,
+                 rolling_history: bool = False,
+                 prompt_budget: bool = False,
+                 structured_output: bool = False,
+                 length_governor: bool = False,
+                 one_shot: bool = False,
+                 num_candidates: int = 1):
         self.output_file = Path(output_file)
         self.output_dir = self.output_file.parent
         self.progress_file = self.output_dir / progress_file
         self.max_turns = max_turns_per_convo
         self.delay = delay_between_calls
+        self.stream = stream
+        self.workers = workers
+        # 未指定上限时只做用量统计
+        self.budget = budget or TokenBudget(prices=config.MODEL_PRICES)
+        # 本轮连续熔断的开始时间（monotonic），有对话成功生成后清空
+        self._outage_started: Optional[float] = None
         
         self.output_dir.mkdir(exist_ok=True, parents=True)
         
-        self.api_client = QwenAPIClient(api_key=QWEN_API_KEY)
+        # 所有调用经过按模型的 RPM/TPM 限流器，delay 仅作为额外的人工降速
+        # 配置了多个 key 时，每个 key 独立限流，调用分摊到负载最低的健康 key 上
+        # 百炼之外的后端（本地 OpenAI 兼容服务、模拟后端）没有百炼的配额，不限流也不使用 key 池
+        if config.LLM_BACKEND == "dashscope":
+            key_pool = None
+            if config.API_KEYS:
+                key_pool = KeyPool.from_specs(config.API_KEYS, config.API_BASE_URL, config.MODEL_RATE_LIMITS)
+                print(f"使用 {len(key_pool.endpoints)} 个 API key 负载均衡")
+            backend_options = dict(
+                api_key=QWEN_API_KEY,
+                base_url=config.API_BASE_URL,
+                rate_limiter=RateLimiter(config.MODEL_RATE_LIMITS),
+                key_pool=key_pool
+            )
+        elif config.LLM_BACKEND == "openai":
+            backend_options = dict(
+                api_key=config.OPENAI_API_KEY,
+                base_url=config.OPENAI_BASE_URL,
+                model_override=config.OPENAI_MODEL
+            )
+        else:
+            backend_options = {}
+        print(f"使用 {config.LLM_BACKEND} 后端")
+        # 每次调用前离线预估输入 token 数，与真实用量一起记入调用统计，并按真实用量修正
+        self.token_estimator = TokenEstimator()
+        self.api_client = create_client(
+            config.LLM_BACKEND,
+            **backend_options,
+            pool_connections=config.API_POOL_CONNECTIONS,
+            pool_maxsize=config.API_POOL_MAXSIZE,
+            cache=ResponseCache(cache_file, max_bytes=config.RESPONSE_CACHE_MAX_BYTES) if cache_file else None,
+            cache_mode=cache_mode,
+            # 多个患者并行生成时，在途请求上限按 429 和延迟自动调整；每个患者的调用前后依赖，
+            # 同时在途的请求不超过 workers 个，上限的上界收紧到 workers
+            concurrency=AdaptiveConcurrencyLimiter(**config.ADAPTIVE_CONCURRENCY).cap(workers) if workers > 1 else None,
+            # 接口持续故障时熔断，批量任务暂停等待恢复，而不是把剩余患者都标记为失败
+            circuit_breaker=CircuitBreaker(**config.CIRCUIT_BREAKER),
+            # 对话是一串前后依赖的调用，对冲慢请求可以缩短整段对话的长尾耗时
+            hedge=HedgePolicy(**config.HEDGING) if hedge else None,
+            budget=self.budget,
+            token_estimator=self.token_estimator
+        )
         self.topics = self._generate_topics(num_topics_to_generate)
         print(f"已使用qwen生成 {len(self.topics)} 个动态主题。实际得到{len(self.topics)}个。")
         if self.topics:
@@ -60,15 +139,35 @@ class ConsolidatedDialogueGenerator:
         self.data_file = "/home/yjr/data/patient_structured_all_desensitize.json"
         self.all_dialogues = self._load_existing_dialogues()
 
-        self.patient_generator = DialogueGenerator(self.api_client)
-        self.assistant_generator = HealthAssistantGenerator_thinking(self.api_client)
+        # 流式模式下，Response 段一完整就断开连接，不等待模型生成多余内容
+        # 滚动历史：患者侧和助手侧共用，最近几条原样保留，更早的折叠成摘要，长对话的提示词不再越来越长
+        history = RollingHistory(**config.HISTORY_CONTEXT, count_tokens=self.token_estimator.count) if rolling_history else None
+        # 提示词预算：与客户端共用预估器，超出按角色的上限时调用前裁剪故事、生活状态和较早的历史
+        enforcer = PromptBudgetEnforcer(config.PROMPT_TOKEN_LIMITS, self.token_estimator) if prompt_budget else None
+        # 输出长度控制：按语料中各角色回复的真实长度设置 max_tokens 和 stop 序列，只在回复被截断时放宽重试
+        self.length_governor = (
+            OutputLengthGovernor.from_corpus(config.OUTPUT_LENGTH_CORPUS, **config.OUTPUT_LENGTH)
+            if length_governor else None
+        )
+        # 增量消息模式下，患者侧的规则和画像作为不变的 system 消息，每轮只追加新消息，可命中服务端前缀缓存
+        # 结构化输出：两侧都输出 JSON 并严格解析，不合法的轮次只修复该轮一次，不再用兜底文本写入对话
+        self.patient_generator = DialogueGenerator(
+            self.api_client, stream=stream, messages_mode=messages_mode, history=history, prompt_budget=enforcer,
+            structured_output=structured_output, length_governor=self.length_governor, num_candidates=num_candidates
+        )
+        self.assistant_generator = HealthAssistantGenerator_thinking(
+            self.api_client, stream=stream, history=history, prompt_budget=enforcer,
+            structured_output=structured_output, length_governor=self.length_governor
+        )
+        # 低成本档：整段对话（含照护师 thinking）一次生成，每段对话 1~2 次调用，不再逐轮调用两个生成器
+        self.one_shot_generator = OneShotDialogueGenerator(self.api_client, **config.ONE_SHOT_DIALOGUE) if one_shot else None
 
     def _load_progress(self) -> Dict[str, Any]:
         if self.progress_file.exists():
             try:
                 with open(self.progress_file, 'r', encoding='utf-8') as f:
                     return json.load(f)
-            except Exception as e:
+            except (OSError, ValueError) as e:
                 print(f"警告：无法加载进度文件，创建新进度: {e}")
         
         return {
@@ -110,7 +209,10 @@ class ConsolidatedDialogueGenerator:
                 prompt=prompt,
                 model="qwen-plus",
                 temperature=0.8,
-                max_tokens=20000
+                max_tokens=20000,
+                caller="topic_generation",
+                # 提示词是固定的，并发启动的多个生成器共享同一次主题生成
+                coalesce=True
             )
             print("\n=== qwen 原始返回开始（完整内容） ===")
             print(result)
@@ -128,6 +230,8 @@ class ConsolidatedDialogueGenerator:
             topics = list(dict.fromkeys(topics))
             print(f"解析后得到 {len(topics)} 个主题")
             return topics if topics else ["默认主题：最近血糖有点高，想了解原因。"]
+        except (CircuitOpenError, BudgetExceededError):
+            raise
         except Exception as e:
             print(f"生成主题失败：{str(e)}")
             return ["默认主题：血糖控制不好，想知道原因。"] * num_topics
@@ -137,7 +241,7 @@ class ConsolidatedDialogueGenerator:
         try:
             with open(self.progress_file, 'w', encoding='utf-8') as f:
                 json.dump(self.progress, f, ensure_ascii=False, indent=2)
-        except Exception as e:
+        except (OSError, TypeError, ValueError) as e:
             print(f"警告：无法保存进度文件: {e}")
 
     def _load_existing_dialogues(self) -> List[Dict]:
@@ -149,7 +253,7 @@ class ConsolidatedDialogueGenerator:
                         if line.strip():
                             dialogues.append(json.loads(line))
                 return dialogues
-            except Exception as e:
+            except (OSError, ValueError) as e:
                 print(f"警告：无法加载现有对话文件，创建新文件: {e}")
         return []
 
@@ -158,7 +262,7 @@ class ConsolidatedDialogueGenerator:
             with open(self.output_file, 'a', encoding='utf-8') as f:
                 json.dump(dialogue, f, ensure_ascii=False)
                 f.write('\n')
-        except Exception as e:
+        except (OSError, TypeError, ValueError) as e:
             print(f"错误：无法追加对话到文件: {e}")
             raise
 
@@ -257,18 +361,19 @@ class ConsolidatedDialogueGenerator:
 """
 
         try:
-            result = self.api_client.call(
-                prompt=prompt,
-                model="qwen-plus",
-                temperature=0.8,
-                max_tokens=150
-            )
+            call_params = dict(prompt=prompt, model="qwen-plus", temperature=0.8, max_tokens=150, caller="topic_selection")
+            if self.length_governor is not None:
+                result = self.length_governor.call("topic_query", self.api_client.call, **call_params)
+            else:
+                result = self.api_client.call(**call_params)
             query = result.strip()
             if 25 < len(query) < 80 and any(kw in query.lower() for kw in ["血糖", "mmol", "怎么办", "怎么", "担心", "原因", "调整"]):
                 forbidden = ["救命", "吓死", "要命", "发毛", "截肢", "昏迷"]
                 if not any(word in query for word in forbidden):
                     return query
             return f"最近{scene}，血糖{bg_value}，{emotion}，想知道怎么调整。"
+        except (CircuitOpenError, BudgetExceededError):
+            raise
         except Exception as e:
             print(f"生成个性化 query 失败：{e}")
             return f"最近血糖{bg_value}，有点{emotion}，想了解一下原因。"
@@ -359,27 +464,64 @@ class ConsolidatedDialogueGenerator:
             start_index = existing_count
         
         print(f"开始生成，从索引 {start_index} 开始...")
-        
-        # 遍历患者进行生成
-        for i in range(start_index, len(patients)):
-            patient = patients[i]
-            
-            print(f"\n--- 处理患者 {i+1}/{len(patients)} ---")
-            
+        if self.workers > 1:
+            print(f"并行生成：{self.workers} 个患者同时进行，API 在途上限自适应调整")
+        
+        # total_api_calls 按客户端实际发出的调用数累计（每轮对话有多次调用）
+        api_calls_base = self.progress["statistics"]["total_api_calls"]
+        api_calls_before = self.api_client.metrics.total_calls()
+        # token 与费用按本进程的预算统计累计到进度文件，断点续跑时接着累加
+        tokens_base = self.progress["statistics"].get("total_tokens", 0)
+        cost_base = self.progress["statistics"].get("estimated_cost", 0.0)
+        self._print_cost_estimate(len(patients) - start_index, patients[start_index] if start_index < len(patients) else None)
+        # 停止调度新对话的原因（"budget" / "outage"），None 表示正常进行
+        stopped = None
+        
+        def generate(i: int):
             patient_id = f"patient_{i:04d}"
-            
             # 跳过已完成的患者
             if patient_id in self.progress["completed"]:
-                print(f"  已跳过（已完成）")
-                self.progress["current_index"] = i + 1
-                continue
-            
+                return i, patient_id, None, 0.0
+            # 达到软/硬预算上限或接口停机超过上限后不再开始新的对话
+            if self.budget.soft_exceeded():
+                return i, patient_id, {"success": False, "stopped": "budget"}, 0.0
+            if self._outage_exceeded():
+                return i, patient_id, {"success": False, "stopped": "outage"}, 0.0
+            print(f"\n--- 处理患者 {i+1}/{len(patients)} ---")
             start_time = time.time()
+            while True:
+                try:
+                    result = self._generate_with_usage(patients[i], i, patient_id)
+                    self._outage_started = None
+                    return i, patient_id, result, time.time() - start_time
+                except BudgetExceededError:
+                    # 硬上限：进行中的对话中止，不记为失败，续跑时重新生成
+                    print(f"  ⏹ 预算已耗尽，患者 {i+1} 的对话中止")
+                    return i, patient_id, {"success": False, "stopped": "budget"}, time.time() - start_time
+                except CircuitOpenError as e:
+                    # 接口熔断：暂停到熔断器半开后从头重新生成该患者，已生成的半截对话丢弃；
+                    # 停机超过上限时中止，不记为失败，续跑时重新生成
+                    if not self._wait_for_circuit(e, f"患者 {i+1} "):
+                        return i, patient_id, {"success": False, "stopped": "outage"}, time.time() - start_time
+        
+        # 遍历患者进行生成（并行时结果仍按患者顺序处理，进度与断点续跑语义不变）
+        for i, patient_id, result, elapsed in ordered_parallel_map(generate, range(start_index, len(patients)), self.workers):
+            if result is None:
+                print(f"\n--- 患者 {i+1}/{len(patients)} 已跳过（已完成） ---")
+                if not stopped:
+                    self.progress["current_index"] = i + 1
+                continue
+            if result.get("stopped"):
+                # 之后的患者不再推进 current_index，续跑时从第一个未生成的患者开始
+                stopped = stopped or result["stopped"]
+                continue
             
-            # 生成对话
-            result = self.generate_for_patient(patient, i, patient_id)
-            
-            self.progress["statistics"]["total_api_calls"] += 1
+            self.progress["statistics"]["total_api_calls"] = (
+                api_calls_base + self.api_client.metrics.total_calls() - api_calls_before
+            )
+            budget_summary = self.budget.summary()
+            self.progress["statistics"]["total_tokens"] = tokens_base + budget_summary["total_tokens"]
+            self.progress["statistics"]["estimated_cost"] = round(cost_base + budget_summary["estimated_cost"], 6)
             
             if result["success"]:
                 try:
@@ -389,13 +531,16 @@ class ConsolidatedDialogueGenerator:
                     
                     # 更新进度
                     self.progress["completed"].append(patient_id)
-                    self.progress["current_index"] = i + 1
+                    if not stopped:
+                        self.progress["current_index"] = i + 1
                     self.progress["statistics"]["total_generated"] += 1
+                    self.progress["statistics"]["total_turns_generated"] += len(result["data"]["dialogue_history"])
                     
-                    elapsed = time.time() - start_time
                     turns = len(result["data"]["dialogue_history"])
                     
-                    print(f"  ✅ 成功生成 {turns} 轮对话，耗时 {elapsed:.1f}秒")
+                    usage = result["data"]["metadata"]["usage"]
+                    print(f"  ✅ 患者 {i+1} 成功生成 {turns} 轮对话，耗时 {elapsed:.1f}秒，"
+                          f"{usage['total_tokens']} tokens（¥{usage['estimated_cost']:.4f}）")
                     print(f"     已追加到 {self.output_file.name}，当前对话数: {self.progress['statistics']['total_generated']}")
                     
                 except Exception as e:
@@ -417,7 +562,7 @@ class ConsolidatedDialogueGenerator:
                 }
                 self.progress["failed"].append(error_info)
                 self.progress["statistics"]["total_errors"] += 1
-                print(f"  ❌ 生成失败")
+                print(f"  ❌ 患者 {i+1} 生成失败")
             
             # 定期保存进度
             if (i + 1) % 10 == 0 or i == len(patients) - 1:
@@ -429,12 +574,19 @@ class ConsolidatedDialogueGenerator:
             failed = len(self.progress["failed"])
             total = self.progress["total_patients"]
             print(f"  进度: {completed}/{total} 成功, {failed} 失败, {completed/total*100:.1f}%")
+            print(f"  累计用量: {self.progress['statistics']['total_tokens']} tokens，"
+                  f"预估 ¥{self.progress['statistics']['estimated_cost']:.2f}")
             
-            # 延迟避免API限制
-            if i < len(patients) - 1:
+            # 限流由 API 客户端按配额完成，这里只处理额外的人工降速
+            if self.delay > 0 and i < len(patients) - 1:
                 print(f"  等待 {self.delay} 秒...")
                 time.sleep(self.delay)
         
+        if stopped:
+            self._save_progress()
+            reason = "已达到预算上限" if stopped == "budget" else "接口持续不可用"
+            print(f"\n{reason}，停止调度新的对话（续跑从索引 {self.progress['current_index']} 开始）")
+        
         # 生成最终报告
         self._generate_final_report()
         
@@ -442,6 +594,32 @@ class ConsolidatedDialogueGenerator:
         print("批量生成完成！")
         print('='*80)
 
+    def _outage_exceeded(self) -> bool:
+        """连续熔断（期间没有对话成功生成）的时长是否已超过 config.CIRCUIT_MAX_OUTAGE"""
+        started = self._outage_started
+        return started is not None and time.monotonic() - started >= config.CIRCUIT_MAX_OUTAGE
+
+    def _wait_for_circuit(self, error: CircuitOpenError, label: str = "") -> bool:
+        """
+        接口熔断时暂停到熔断器半开
+
+        Args:
+            error: 客户端抛出的熔断异常（retry_after 为距半开的秒数）
+            label: 日志中的患者标识
+
+        Returns:
+            True 表示已暂停、可以重新生成；False 表示连续熔断已超过 config.CIRCUIT_MAX_OUTAGE，应停止
+        """
+        if self._outage_started is None:
+            self._outage_started = time.monotonic()
+        elif self._outage_exceeded():
+            print(f"  ⏹ 接口已连续熔断超过 {config.CIRCUIT_MAX_OUTAGE:.0f} 秒，{label}停止重新生成")
+            return False
+        wait = max(error.retry_after or 0.0, 1.0)
+        print(f"  ⏸ 接口熔断，{label}暂停 {wait:.0f} 秒后重新生成")
+        time.sleep(wait)
+        return True
+
     def resume(self):
         """
         从断点继续生成
@@ -468,6 +646,11 @@ class ConsolidatedDialogueGenerator:
             patient_index = retry_item["patient_index"]
             patient_id = retry_item["patient_id"]
             
+            if self.budget.soft_exceeded():
+                # 预算用尽，剩余的失败案例原样保留
+                self.progress["failed"].append(retry_item)
+                continue
+            
             if patient_index >= len(patients):
                 print(f"  跳过无效索引 {patient_index}")
                 continue
@@ -481,7 +664,8 @@ class ConsolidatedDialogueGenerator:
                 print(f"  重试尝试 {attempt+1}/{max_retries}...")
                 
                 try:
-                    result = self.generate_for_patient(patient, patient_index, patient_id)
+                    result = self._generate_with_usage(patient, patient_index, patient_id)
+                    self._outage_started = None
                     
                     if result["success"]:
                         self._append_dialogue(result["data"])
@@ -489,12 +673,22 @@ class ConsolidatedDialogueGenerator:
                         
                         self.progress["completed"].append(patient_id)
                         self.progress["statistics"]["total_generated"] += 1
+                        self.progress["statistics"]["total_turns_generated"] += len(result["data"]["dialogue_history"])
                         
                         print(f"  ✅ 重试成功，已追加")
                         break
                     else:
                         print(f"  ❌ 重试失败: {result.get('error', '未知错误')}")
                         
+                except BudgetExceededError:
+                    print(f"  ⏹ 预算已耗尽，停止重试")
+                    self.progress["failed"].append(retry_item)
+                    break
+                except CircuitOpenError as e:
+                    if not self._wait_for_circuit(e):
+                        self.progress["failed"].append(retry_item)
+                        break
+                    continue
                 except Exception as e:
                     print(f"  ❌ 重试异常: {e}")
                 
@@ -764,6 +958,34 @@ class ConsolidatedDialogueGenerator:
         print(f"  总生成轮数: {stats['total_turns_generated']}")
         print(f"  平均轮数/对话: {stats['total_turns_generated']/dialogues_count:.1f}" if dialogues_count > 0 else "  平均轮数/对话: N/A")
         print(f"  成功率: {len(self.progress['completed'])/self.progress['total_patients']*100:.1f}%")
+        self.api_client.metrics.print_summary()
+        if self.api_client.key_pool is not None:
+            print("  API key 使用情况:")
+            for key_stats in self.api_client.key_pool.stats():
+                print(f"    {key_stats['key']}: {key_stats['calls']} 次调用, {key_stats['errors']} 次错误, "
+                      f"摘除 {key_stats['ejections']} 次")
+        if self.api_client.circuit_breaker is not None:
+            breaker_stats = self.api_client.circuit_breaker.stats()
+            print(f"  熔断: {breaker_stats['open_count']} 次，熔断期间拒绝 {breaker_stats['rejected']} 次调用")
+        budget_summary = self.budget.summary()
+        print(f"  本次运行用量: {budget_summary['total_tokens']} tokens，预估 ¥{budget_summary['estimated_cost']:.2f}")
+        for model, model_usage in sorted(budget_summary["by_model"].items()):
+            print(f"    [{model}] 输入 {model_usage['input_tokens']} / 输出 {model_usage['output_tokens']} tokens，"
+                  f"¥{model_usage['cost']:.2f}")
+        if self.api_client.hedge is not None:
+            hedge_stats = self.api_client.hedge.stats()
+            print(f"  对冲: {hedge_stats['hedges']}/{hedge_stats['requests']} 次请求")
+        self.api_client.metrics.save(
+            json_path=str(self.output_dir / "api_metrics.json"),
+            prometheus_path=str(self.output_dir / "api_metrics.prom")
+        )
+        print(f"  API指标已保存到: {self.output_dir / 'api_metrics.json'}（Prometheus 格式: api_metrics.prom）")
+        if self.stream:
+            stream_stats = self.api_client.stream_stats()
+            print(f"  流式调用: {stream_stats['stream_calls']} 次，提前截断 {stream_stats['early_stops']} 次")
+            if stream_stats["ttft_avg"] is not None:
+                print(f"  首token延迟: 平均 {stream_stats['ttft_avg']:.2f}s, "
+                      f"p50 {stream_stats['ttft_p50']:.2f}s, p95 {stream_stats['ttft_p95']:.2f}s")
         
         if self.output_file.exists():
             file_size = os.path.getsize(self.output_file)
@@ -778,6 +1000,98 @@ class ConsolidatedDialogueGenerator:
             print(f"     对话轮数: {len(first.get('dialogue_history', []))}")
             print(f"     主题: {first.get('metadata', {}).get('topic', 'N/A')[:30]}...")
 
+    def _generate_with_usage(self, patient: Dict, patient_index: int, patient_id: str) -> Dict[str, Any]:
+        """生成一个患者的对话，并把这段对话真正发出的请求的 token 用量与预估费用写入 metadata"""
+        with track_usage(config.MODEL_PRICES) as usage:
+            result = self.generate_for_patient(patient, patient_index, patient_id)
+        if result["success"]:
+            result["data"]["metadata"]["usage"] = usage.summary()
+        return result
+
+    def _print_cost_estimate(self, remaining: int, patient: Optional[Dict] = None):
+        """
+        估算剩余患者的 token 与费用
+
+        有已生成的对话时按其 metadata 中的平均用量估算；首次运行时按语料和提示词做先验预估（见 _estimate_dialogue_usage）
+
+        Args:
+            remaining: 剩余患者数
+            patient: 第一个待生成的患者，用于构建先验预估的提示词
+        """
+        usages = [d["metadata"]["usage"] for d in self.all_dialogues if "usage" in d.get("metadata", {})]
+        if not usages:
+            usage = self._estimate_dialogue_usage(self._extract_background_story(patient)) if patient is not None else None
+            if usage is None:
+                print("暂无历史用量数据，无法预估本次花费（生成后每个对话的用量写入 metadata.usage）")
+                return
+            print(f"暂无历史用量数据，按语料和提示词先验估算每个对话约 {usage['total_tokens']:.0f} tokens / ¥{usage['estimated_cost']:.4f}，"
+                  f"剩余 {remaining} 个患者预计 {usage['total_tokens'] * remaining / 1e6:.2f}M tokens，约 ¥{usage['estimated_cost'] * remaining:.2f}"
+                  f"（不含主题生成等辅助调用与重试）")
+            return
+        avg_tokens = sum(u["total_tokens"] for u in usages) / len(usages)
+        avg_cost = sum(u["estimated_cost"] for u in usages) / len(usages)
+        print(f"按已有 {len(usages)} 个对话的平均用量（{avg_tokens:.0f} tokens / ¥{avg_cost:.4f}）估算，"
+              f"剩余 {remaining} 个患者预计 {avg_tokens * remaining / 1e6:.2f}M tokens，约 ¥{avg_cost * remaining:.2f}")
+
+    def _estimate_dialogue_usage(self, persona: Dict) -> Optional[Dict[str, float]]:
+        """
+        没有历史用量时的先验预估：一段对话的 token 数与费用（不发出请求）
+
+        对话的消息数、各角色每次输出的 token 数和历史中每条消息的 token 数取语料
+        （config.OUTPUT_LENGTH_CORPUS）中的均值；每次调用的输入 = 用该患者画像构建的首轮提示词
+        + 最近 6 条历史（与生成器的历史窗口一致）。整段生成时为一次调用，输出为整段对话的 JSON。
+        费用按各生成器的模型和 config.MODEL_PRICES 计算。
+
+        Args:
+            persona: 患者画像（_extract_background_story 的结果）
+
+        Returns:
+            {"total_tokens", "estimated_cost"}，语料为空时返回 None
+        """
+        records = [r for r in iter_corpus_records(config.OUTPUT_LENGTH_CORPUS) if r.get("dialogue_history")]
+        if not records:
+            return None
+        estimator = self.token_estimator
+        topic = next((r["metadata"]["topic"] for r in records if (r.get("metadata") or {}).get("topic")), "")
+
+        def mean(values):
+            return sum(values) / len(values) if values else 0.0
+
+        def prompt_tokens(prompt):
+            return estimator.count_messages([{"role": "user", "content": prompt}] if isinstance(prompt, str) else prompt)
+
+        if self.one_shot_generator is not None:
+            generator = self.one_shot_generator
+            input_tokens = prompt_tokens(generator._build_prompt(persona, topic))
+            output_tokens = mean([
+                estimator.count(json.dumps({"dialogue": r["dialogue_history"]}, ensure_ascii=False)) for r in records
+            ])
+            return {
+                "total_tokens": input_tokens + output_tokens,
+                "estimated_cost": estimate_cost(generator.CALL_PARAMS["model"], input_tokens, output_tokens, config.MODEL_PRICES)
+            }
+
+        outputs = {"user": [], "assistant": []}
+        history = []
+        for record in records:
+            for msg in record["dialogue_history"]:
+                if msg.get("role") in outputs:
+                    outputs[msg["role"]].append(estimator.count(render_output(msg)))
+                    history.append(estimator.count(msg.get("content") or ""))
+        generators = {"user": self.patient_generator, "assistant": self.assistant_generator}
+        # 空历史的首轮提示词不会触发滚动摘要的调用
+        base = {role: prompt_tokens(generator._prepare_prompt(persona, topic, "", [], None)) for role, generator in generators.items()}
+        total_tokens = 0.0
+        cost = 0.0
+        for k in range(round(mean([len(r["dialogue_history"]) for r in records]))):
+            role = "user" if k % 2 == 0 else "assistant"
+            generator = generators[role]
+            input_tokens = base[role] + min(k, 6) * mean(history)
+            output_tokens = mean(outputs[role]) * getattr(generator, "num_candidates", 1)
+            total_tokens += input_tokens + output_tokens
+            cost += estimate_cost(generator.CALL_PARAMS["model"], input_tokens, output_tokens, config.MODEL_PRICES)
+        return {"total_tokens": total_tokens, "estimated_cost": cost}
+
     def generate_for_patient(self, patient: Dict, patient_index: int, patient_id: str) -> Dict[str, Any]:
         topic = self._select_topic(patient_index)
         background_story = self._extract_background_story(patient)
@@ -789,6 +1103,14 @@ class ConsolidatedDialogueGenerator:
         print(f"     主题: {topic[:50]}...")
 
         try:
+            if self.one_shot_generator is not None:
+                dialogue_history = self.one_shot_generator.generate_dialogue(background_story, topic)
+                print(f"     整段生成 {len(dialogue_history)} 条消息")
+                return self._finish_dialogue(
+                    dialogue_history, background_story, topic, patient_index, patient_id,
+                    ended_naturally=True, generation_mode="one_shot"
+                )
+
             background_state = ""
             story = None
             dialogue_history: List[Dict[str, Any]] = []
@@ -796,6 +1118,8 @@ class ConsolidatedDialogueGenerator:
 
             turn = 0 
             patient_has_ended = False
+            failed_turns = 0
+            turn_error = None
             
             while turn < max_safety_turns and not patient_has_ended:
                 response_text = ""
@@ -807,7 +1131,7 @@ class ConsolidatedDialogueGenerator:
                     break
 
                 # 2. 确定当前轮次是谁发言（确保角色交替）
-                if turn == 0 or (dialogue_history and dialogue_history[-1]["role"] == "assistant"):
+                if not dialogue_history or dialogue_history[-1]["role"] == "assistant":
                     # 患者轮：要么是第一轮，要么上一轮是助手
                     current_role = "user"
                 else:
@@ -818,13 +1142,22 @@ class ConsolidatedDialogueGenerator:
 
                 if current_role == "user":  # 患者轮
                     # 生成患者回复
-                    result = self.patient_generator.generate_response(
-                        persona=background_story,
-                        dialogue_topic=topic,
-                        background=background_state,
-                        dialogue_history=dialogue_history,
-                        story=story
-                    )
+                    try:
+                        result = self.patient_generator.generate_response(
+                            persona=background_story,
+                            dialogue_topic=topic,
+                            background=background_state,
+                            dialogue_history=dialogue_history,
+                            story=story
+                        )
+                    except StructuredOutputError as e:
+                        failed_turns += 1
+                        turn_error = e
+                        if failed_turns > self.MAX_FAILED_TURNS:
+                            break
+                        self._log_failed_turn(e, turn, failed_turns)
+                        turn += 1
+                        continue
                     
                     if result is None or not isinstance(result, dict):
                         print(f"第 {turn+1} 轮患者生成失败，返回 None 或无效格式")
@@ -877,13 +1210,22 @@ class ConsolidatedDialogueGenerator:
                         thinking_text = "患者已表达结束意图，生成礼貌结束语"
                     else:
                         # 正常生成助手回复
-                        result = self.assistant_generator.generate_reply(
-                            persona=background_story,
-                            dialogue_topic=topic,
-                            background=background_state,
-                            dialogue_history=dialogue_history,
-                            story=story
-                        )
+                        try:
+                            result = self.assistant_generator.generate_reply(
+                                persona=background_story,
+                                dialogue_topic=topic,
+                                background=background_state,
+                                dialogue_history=dialogue_history,
+                                story=story
+                            )
+                        except StructuredOutputError as e:
+                            failed_turns += 1
+                            turn_error = e
+                            if failed_turns > self.MAX_FAILED_TURNS:
+                                break
+                            self._log_failed_turn(e, turn, failed_turns)
+                            turn += 1
+                            continue
                         
                         if result is None or not isinstance(result, dict):
                             print(f"第 {turn+1} 轮助手生成失败，返回 None 或无效格式")
@@ -925,7 +1267,20 @@ class ConsolidatedDialogueGenerator:
                         background_state = background_state[-400:]
 
                 turn += 1
-                time.sleep(self.delay)
+                if self.delay > 0:
+                    time.sleep(self.delay)
+
+            # 失败的轮次过多：结束这段对话，去掉没有得到回复的患者消息，保留已生成的轮次
+            if failed_turns > self.MAX_FAILED_TURNS:
+                print(f"     本段对话已有 {failed_turns} 轮输出不合法（最近一次: {turn_error}），保留已生成的轮次并结束")
+                if dialogue_history and dialogue_history[-1]["role"] == "user":
+                    dialogue_history.pop()
+                if not dialogue_history:
+                    return {"success": False, "error": f"输出不合法: {turn_error}", "patient_index": patient_index}
+                return self._finish_dialogue(
+                    dialogue_history, background_story, topic, patient_index, patient_id,
+                    ended_naturally=False, generation_mode="turn_by_turn", failed_turns=failed_turns
+                )
 
             # 4. 达到安全上限时强制结束
             if turn >= max_safety_turns:
@@ -939,43 +1294,71 @@ class ConsolidatedDialogueGenerator:
                         "thinking": "达到最大轮次，生成结束语"
                     })
             
-            # 5. 验证和修复对话序列
-            dialogue_history = self._fix_turn_sequence(dialogue_history)
-            
-            # 6. 质量检查
-            quality_check = self._validate_dialogue_quality(dialogue_history)
-            if not quality_check["valid"]:
-                print(f"     对话质量检查未通过: {quality_check['reason']}")
-            
-            metadata = {
-                "patient_index": patient_index,
-                "patient_id": patient_id,
-                "generation_time": datetime.now().isoformat(),
-                "topic": topic,
-                "turns": len(dialogue_history),
-                "gender": gender,
-                "age": age,
-                "ended_naturally": patient_has_ended or turn < max_safety_turns,
-                "quality_score": quality_check["quality_score"],
-                "quality_reason": quality_check["reason"]
-            }
-
-            formatted_dialogue = self._format_dialogue_for_saving(
-                dialogue_history=dialogue_history,
-                background_story=background_story,
-                metadata=metadata
+            return self._finish_dialogue(
+                dialogue_history, background_story, topic, patient_index, patient_id,
+                ended_naturally=patient_has_ended or turn < max_safety_turns, generation_mode="turn_by_turn",
+                failed_turns=failed_turns
             )
 
-            self.progress["statistics"]["total_turns_generated"] += len(dialogue_history)
-
-            return {"success": True, "data": formatted_dialogue}
-
+        except (CircuitOpenError, BudgetExceededError):
+            # 熔断或预算耗尽时交给调用方暂停重跑/停止，不记为该患者失败
+            raise
         except Exception as e:
             error_msg = str(e)
             print(f"     错误: {error_msg[:200]}...")
             return {"success": False, "error": error_msg, "patient_index": patient_index}
+
+    @staticmethod
+    def _log_failed_turn(error: StructuredOutputError, turn: int, failed_turns: int):
+        """某一轮在修复、重新请求后仍不合法：丢弃该轮，重新生成"""
+        print(f"     第 {turn+1} 轮输出修复、重新请求后仍不合法（{error}），丢弃该轮并重新生成（本段对话第 {failed_turns} 次）")
         
-        
+
+    def _finish_dialogue(self,
+                         dialogue_history: List[Dict[str, Any]],
+                         background_story: Dict,
+                         topic: str,
+                         patient_index: int,
+                         patient_id: str,
+                         ended_naturally: bool,
+                         generation_mode: str,
+                         failed_turns: int = 0) -> Dict[str, Any]:
+        """
+        修复轮次序列、检查质量并整理为保存格式（逐轮生成与整段生成共用）
+
+        failed_turns 为结构化输出模式下被丢弃后重新生成的轮次数，写入 metadata.failed_turns
+        """
+        # 5. 验证和修复对话序列
+        dialogue_history = self._fix_turn_sequence(dialogue_history)
+        
+        # 6. 质量检查
+        quality_check = self._validate_dialogue_quality(dialogue_history)
+        if not quality_check["valid"]:
+            print(f"     对话质量检查未通过: {quality_check['reason']}")
+        
+        metadata = {
+            "patient_index": patient_index,
+            "patient_id": patient_id,
+            "generation_time": datetime.now().isoformat(),
+            "topic": topic,
+            "turns": len(dialogue_history),
+            "gender": background_story["基本信息"].get("性别", "未知"),
+            "age": background_story["基本信息"].get("年龄", "未知"),
+            "ended_naturally": ended_naturally,
+            # 轮次过少等提前返回的检查结果没有质量分（因输出不合法提前结束的对话可能很短）
+            "quality_score": quality_check.get("quality_score", 0.0),
+            "quality_reason": quality_check["reason"],
+            "generation_mode": generation_mode,
+            "failed_turns": failed_turns
+        }
+
+        formatted_dialogue = self._format_dialogue_for_saving(
+            dialogue_history=dialogue_history,
+            background_story=background_story,
+            metadata=metadata
+        )
+
+        return {"success": True, "data": formatted_dialogue}
 
     def _format_dialogue_for_saving(self, 
                                     dialogue_history: List[Dict], 
@@ -991,7 +1374,9 @@ class ConsolidatedDialogueGenerator:
                 "turns": metadata.get("turns", 0),
                 "patient_gender": metadata.get("gender", "未知"),
                 "patient_age": metadata.get("age", "未知"),
-                "topic_length": metadata.get("topic_length", 0)
+                "topic_length": metadata.get("topic_length", 0),
+                "generation_mode": metadata.get("generation_mode", "turn_by_turn"),
+                "failed_turns": metadata.get("failed_turns", 0)
             }
         }
 
@@ -1007,12 +1392,48 @@ def main():
     parser = argparse.ArgumentParser(description="批量生成助手带Thinking的对话数据集")
     parser.add_argument("--output-file", type=str, default="dialogues/all_dialogues_assistant_thinking.jsonl")
     parser.add_argument("--max-turns", type=int, default=25)
-    parser.add_argument("--delay", type=float, default=1.0)
+    parser.add_argument("--delay", type=float, default=0.0,
+                        help="额外的人工降速（秒），限流默认由 config.MODEL_RATE_LIMITS 控制")
     parser.add_argument("--resume", action="store_true")
     parser.add_argument("--retry-failed", action="store_true")
     parser.add_argument("--num-patients", type=int, default=3)
     parser.add_argument("--num-topics", type=int, default=10)
     parser.add_argument("--start-from", type=int, default=0)
+    parser.add_argument("--cache-file", type=str, default=config.RESPONSE_CACHE_PATH,
+                        help="响应缓存文件（SQLite），默认 config.RESPONSE_CACHE_PATH")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="不使用响应缓存")
+    parser.add_argument("--cache-mode", type=str, choices=["deterministic", "all"], default="deterministic",
+                        help="deterministic 只缓存 temperature=0 的调用；all 缓存全部调用，用于重放")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="同时生成的患者数，>1 时启用自适应并发控制（AIMD），在途请求上限在 workers 以内自动调整；"
+                             "默认串行（日志按患者顺序输出，单个对话的调用前后依赖，AIMD 无从调节）")
+    parser.add_argument("--stream", action="store_true",
+                        help="患者/助手回复使用流式输出，Response 段完整后提前截断")
+    parser.add_argument("--hedge", action="store_true",
+                        help="慢请求超过近期 p95 延迟后补发一个相同请求，先返回的胜出（仅非流式调用）")
+    parser.add_argument("--token-budget", type=int, default=None,
+                        help="token 硬上限：达到后不再发出新请求，进行中的对话中止")
+    parser.add_argument("--cost-budget", type=float, default=None,
+                        help="预估费用硬上限（元，按 config.MODEL_PRICES 计算）")
+    parser.add_argument("--soft-token-budget", type=int, default=None,
+                        help="token 软上限：达到后不再开始新的对话，进行中的对话正常完成")
+    parser.add_argument("--soft-cost-budget", type=float, default=None,
+                        help="预估费用软上限（元）")
+    parser.add_argument("--messages-mode", action="store_true",
+                        help="患者侧使用增量消息模式（固定的 system 消息 + 按角色追加的历史），便于命中前缀缓存")
+    parser.add_argument("--rolling-history", action="store_true",
+                        help="患者/助手提示词只保留最近几条历史，更早的折叠成摘要（见 config.HISTORY_CONTEXT）")
+    parser.add_argument("--prompt-budget", action="store_true",
+                        help="调用前预估提示词 token 数，超出 config.PROMPT_TOKEN_LIMITS 时裁剪故事、生活状态和较早的历史")
+    parser.add_argument("--structured-output", action="store_true",
+                        help="患者/助手输出 JSON 并按 schema 严格解析，不合法时只修复该轮一次")
+    parser.add_argument("--one-shot", action="store_true",
+                        help="低成本档：每段对话（含照护师 thinking）一次生成再严格解析，1~2 次调用，不再逐轮生成")
+    parser.add_argument("--candidates", type=int, default=1,
+                        help="患者轮每次调用生成的候选数，>1 时本地挑选不与历史重复、得分最高的一条（同基线脚本的 --candidates）")
+    parser.add_argument("--length-governor", action="store_true",
+                        help="按语料（config.OUTPUT_LENGTH_CORPUS）中各角色回复的真实长度设置 max_tokens 和 stop 序列，截断时放宽重试")
 
     args = parser.parse_args()
     
@@ -1020,7 +1441,26 @@ def main():
         output_file=args.output_file,
         max_turns_per_convo=args.max_turns,
         delay_between_calls=args.delay,
-        num_topics_to_generate=args.num_topics
+        num_topics_to_generate=args.num_topics,
+        cache_file=None if args.no_cache else args.cache_file,
+        cache_mode=args.cache_mode,
+        stream=args.stream,
+        workers=args.workers,
+        hedge=args.hedge,
+        messages_mode=args.messages_mode,
+        rolling_history=args.rolling_history,
+        prompt_budget=args.prompt_budget,
+        structured_output=args.structured_output,
+        length_governor=args.length_governor,
+        one_shot=args.one_shot,
+        num_candidates=args.candidates,
+        budget=TokenBudget(
+            max_tokens=args.token_budget,
+            max_cost=args.cost_budget,
+            soft_max_tokens=args.soft_token_budget,
+            soft_max_cost=args.soft_cost_budget,
+            prices=config.MODEL_PRICES
+        )
     )
     
     if args.retry_failed:
@@ -1,25 +1,70 @@
 """
 用户模拟器模块
 """
-from .api_client import QwenAPIClient
+from .api_client import BudgetExceededError, CircuitOpenError, QwenAPIClient, QwenAPIError
+from .async_api_client import AsyncQwenAPIClient
+from .backends import LLMBackend, MockLLMClient, OpenAICompatibleClient, create_client
+from .rate_limiter import RateLimiter
+from .retry import RetryPolicy
+from .response_cache import ResponseCache
+from .metrics import APIMetrics
+from .key_pool import APIEndpoint, KeyPool
+from .circuit_breaker import CircuitBreaker
+from .batch_job import BatchJobWriter, load_batch_results
+from .budget import TokenBudget, track_usage
+from .token_estimator import PromptBudgetEnforcer, TokenEstimator
+from .structured_output import StructuredOutputError, StructuredTurnParser
+from .length_governor import OutputLengthGovernor
+from .one_shot_dialogue import OneShotDialogueGenerator
 from .persona_generator import PersonaGenerator
 from .background_generator import BackgroundGenerator
 from .story_generator import StoryGenerator
 from .dialogue_generator import DialogueGenerator
-from .health_assistant_generator import HealthAssistantGenerator
 from .generic_ai_generator import GenericAIGenerator
-from .dialogue_generator import DialogueGenerator
 from .health_assistant_generator_thinking import HealthAssistantGenerator_thinking
 
+try:
+    from .health_assistant_generator import HealthAssistantGenerator
+except ModuleNotFoundError as e:
+    # health_assistant_generator.py 不在仓库中：其余模块照常导入，main.py 改用 HealthAssistantGenerator_thinking
+    if e.name != f"{__name__}.health_assistant_generator":
+        raise
+    HealthAssistantGenerator = None
 
 
 __all__ = [
     "QwenAPIClient",
+    "QwenAPIError",
+    "CircuitOpenError",
+    "BudgetExceededError",
+    "AsyncQwenAPIClient",
+    "LLMBackend",
+    "OpenAICompatibleClient",
+    "MockLLMClient",
+    "create_client",
+    "RateLimiter",
+    "RetryPolicy",
+    "ResponseCache",
+    "APIMetrics",
+    "APIEndpoint",
+    "KeyPool",
+    "CircuitBreaker",
+    "BatchJobWriter",
+    "load_batch_results",
+    "TokenBudget",
+    "track_usage",
+    "TokenEstimator",
+    "PromptBudgetEnforcer",
+    "StructuredOutputError",
+    "StructuredTurnParser",
+    "OutputLengthGovernor",
+    "OneShotDialogueGenerator",
     "PersonaGenerator",
     "BackgroundGenerator",
     "StoryGenerator",
     "DialogueGenerator",
     "HealthAssistantGenerator",
-    "GenericAIGenerator"
+    "GenericAIGenerator",
+    "HealthAssistantGenerator_thinking"
 ]
 
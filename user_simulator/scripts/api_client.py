@@ -2,136 +2,324 @@
 阿里百炼Qwen API客户端
 """
 import json
+import threading
+import time
 import requests
-from typing import Dict, Optional, List
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from requests.adapters import HTTPAdapter
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from .budget import TokenBudget, UsageTracker, current_usage_tracker
+from .circuit_breaker import CircuitBreaker
+from .coalescing import RequestCoalescer
+from .concurrency import AdaptiveConcurrencyLimiter, is_congestion
+from .hedging import HedgePolicy
+from .key_pool import AUTH_STATUS_CODES, QUOTA_STATUS_CODES, APIEndpoint, KeyPool
+from .metrics import APIMetrics
+from .rate_limiter import RateLimiter
+from .response_cache import ResponseCache, make_request_key
+from .retry import RetryPolicy, is_retryable_status, parse_retry_after
+from .streaming import iter_sse_events
+from .token_estimator import TokenEstimator
+
+
+DEFAULT_BASE_URL = "https://dashscope.aliyuncs.com/api/v1/services/aigc/text-generation/generation"
+
+
+class QwenAPIError(Exception):
+    """
+    API调用失败
+
+    Attributes:
+        status_code: HTTP状态码（网络层错误时为 None）
+        retry_after: 服务端 Retry-After 要求等待的秒数
+        transient: 是否为可重试的瞬时错误（429、5xx、连接重置、超时）
+    """
+
+    def __init__(self,
+                 message: str,
+                 status_code: Optional[int] = None,
+                 retry_after: Optional[float] = None,
+                 transient: bool = False):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self.transient = transient
+
+
+class CircuitOpenError(QwenAPIError):
+    """
+    熔断器打开，请求未发出直接失败
+
+    retry_after 为距离熔断器进入半开状态的秒数，批量任务应暂停而不是继续消耗对话轮次。
+    """
+
+
+class BudgetExceededError(QwenAPIError):
+    """已达到 token / 费用硬上限，请求未发出直接失败"""
 
 
 class QwenAPIClient:
     """阿里百炼Qwen系列模型API客户端"""
-    
-    def __init__(self, api_key: str, base_url: str = None):
+
+    def __init__(self,
+                 api_key: str,
+                 base_url: str = None,
+                 pool_connections: int = 10,
+                 pool_maxsize: int = 32,
+                 pool_block: bool = False,
+                 rate_limiter: Optional[RateLimiter] = None,
+                 retry_policy: Optional[RetryPolicy] = None,
+                 cache: Optional[ResponseCache] = None,
+                 cache_mode: str = "deterministic",
+                 metrics: Optional[APIMetrics] = None,
+                 key_pool: Optional[KeyPool] = None,
+                 concurrency: Optional[AdaptiveConcurrencyLimiter] = None,
+                 circuit_breaker: Optional[CircuitBreaker] = None,
+                 hedge: Optional[HedgePolicy] = None,
+                 budget: Optional[TokenBudget] = None,
+                 token_estimator: Optional[TokenEstimator] = None):
         """
         初始化API客户端
-        
+
+        客户端内部持有一个带连接池的 requests.Session，所有调用复用 keep-alive 连接，
+        同一个客户端实例可以在多个线程之间共享。
+        传入 rate_limiter 后，每次调用都会先按模型配额排队。
+        瞬时错误（429、5xx、连接重置、读超时）按 retry_policy 在单次调用内部重试。
+        传入 cache 后，可缓存的调用先查磁盘缓存，命中则不再请求网络。
+        确定性调用（temperature=0）默认合并相同的在途请求，并发的相同调用只发一次网络请求。
+        每次调用的延迟、token用量、错误与重试都记录在 metrics 中，按模型和调用方（caller）分组。
+        传入 key_pool 后，每次请求路由到负载最低的健康 key（各自按自己的配额限流），
+        此时 api_key / base_url / rate_limiter 不再使用。
+        传入 concurrency 后，同时在途的请求数由 AIMD 控制器按 429 和延迟自动调整。
+        传入 circuit_breaker 后，接口连续失败时熔断，熔断期间的调用直接抛出 CircuitOpenError。
+        传入 hedge 后，非流式请求超过近期延迟分位数仍未返回时再发一个相同请求，先返回的胜出。
+        传入 budget 后，每次请求的用量计入预算，达到硬上限后调用直接抛出 BudgetExceededError；
+        在 track_usage() 块内发起的调用同时计入该块的用量统计（如单个对话的用量）。
+        传入 token_estimator 后，每次请求前离线预估输入 token 数（用于限流预扣，并与真实用量一起记入 metrics），
+        请求后用真实用量修正该模型的预估系数。
+
         Args:
             api_key: API密钥
             base_url: API基础URL，如果为None则使用默认值
+            pool_connections: 连接池缓存的主机数
+            pool_maxsize: 每个主机保持的最大连接数（即单主机并发上限）
+            pool_block: 连接池耗尽时是否阻塞等待空闲连接（False 时临时新建连接，用完即丢弃）
+            rate_limiter: 按模型的RPM/TPM限流器，可在多个客户端之间共享
+            retry_policy: 重试策略，None 时使用默认策略，传入 RetryPolicy(max_retries=0) 可关闭重试
+            cache: 响应缓存
+            cache_mode: "deterministic" 只缓存 temperature=0 的确定性调用；"all" 缓存全部调用（用于重放）
+            metrics: 指标收集器，None 时新建一个，可在多个客户端之间共享
+            key_pool: 多 key / 多接入点池
+            concurrency: 自适应并发限制器，可在多个客户端之间共享
+            circuit_breaker: 熔断器，可在多个客户端之间共享
+            hedge: 对冲策略，可在多个客户端之间共享
+            budget: token / 费用预算，可在多个客户端之间共享
+            token_estimator: 离线 token 预估器，可与 PromptBudgetEnforcer 共享
         """
+        if cache_mode not in ("deterministic", "all"):
+            raise ValueError(f"不支持的 cache_mode: {cache_mode}")
         self.api_key = api_key
-        self.base_url = base_url or "https://dashscope.aliyuncs.com/api/v1/services/aigc/text-generation/generation"
+        self.base_url = base_url or DEFAULT_BASE_URL
         self.headers = {
             "Authorization": f"Bearer {api_key}",
             "Content-Type": "application/json"
         }
-    
-    def call(self, 
-             prompt: str, 
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.pool_block = pool_block
+        self.rate_limiter = rate_limiter
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.cache = cache
+        self.cache_mode = cache_mode
+        self._session: Optional[requests.Session] = None
+        self._session_lock = threading.Lock()
+        self.metrics = metrics or APIMetrics()
+        self.coalescer = RequestCoalescer()
+        self.key_pool = key_pool
+        self.concurrency = concurrency
+        self.circuit_breaker = circuit_breaker
+        self.hedge = hedge
+        self.budget = budget
+        self.token_estimator = token_estimator
+        self._hedge_executor: Optional[ThreadPoolExecutor] = None
+
+    @property
+    def session(self) -> requests.Session:
+        """懒加载的共享会话（线程安全）"""
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    self._session = self._create_session()
+        return self._session
+
+    def _create_session(self) -> requests.Session:
+        """创建带连接池的会话，http/https 共用同一套池参数"""
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=self.pool_connections,
+            pool_maxsize=self.pool_maxsize,
+            pool_block=self.pool_block
+        )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.headers.update(self.headers)
+        return session
+
+    def close(self):
+        """关闭会话，释放连接池中的所有连接"""
+        with self._session_lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def call(self,
+             prompt: str,
              model: str = "qwen-plus",
              temperature: float = 0.7,
              max_tokens: int = 2000,
              top_p: float = 0.8,
+             caller: Optional[str] = None,
+             coalesce: Optional[bool] = None,
              **kwargs) -> str:
         """
         调用Qwen API生成文本
-        
+
         Args:
             prompt: 输入提示词
             model: 模型名称，可选值: qwen-plus, qwen-max, qwen-turbo等
             temperature: 温度参数，控制随机性
             max_tokens: 最大生成token数
             top_p: nucleus sampling参数
+            caller: 调用方名称（通常是生成器类名），用于分组统计指标
+            coalesce: 是否与相同的在途请求合并，None 表示仅对 temperature=0 的调用合并；
+                      采样调用显式传 True 表示并发调用方可以共享同一个结果
             **kwargs: 其他参数
-            
+
         Returns:
             生成的文本内容
         """
-        payload = {
-            "model": model,
-            "input": {
-                "messages": [
-                    {
-                        "role": "user",
-                        "content": prompt
-                    }
-                ]
-            },
-            "parameters": {
-                "temperature": temperature,
-                "max_tokens": max_tokens,
-                "top_p": top_p,
-                **kwargs
+        messages = [
+            {
+                "role": "user",
+                "content": prompt
             }
-        }
-        
-        try:
-            response = requests.post(
-                self.base_url,
-                headers=self.headers,
-                json=payload,
-                timeout=600
-            )
-            response.raise_for_status()
-            
-            result = response.json()
-            
-            # 解析响应 - 兼容多种响应格式
-            if "output" in result:
-                output = result["output"]
-                # 格式1: output.choices[0].message.content
-                if "choices" in output and len(output["choices"]) > 0:
-                    choice = output["choices"][0]
-                    if "message" in choice and "content" in choice["message"]:
-                        return choice["message"]["content"]
-                    elif "text" in choice:
-                        return choice["text"]
-                # 格式2: output.text
-                elif "text" in output:
-                    return output["text"]
-                # 格式3: output.result
-                elif "result" in output:
-                    return output["result"]
-            
-            # 如果都没有，尝试直接获取text字段
-            if "text" in result:
-                return result["text"]
-            
-            # 如果还是找不到，抛出错误并显示完整响应
-            raise ValueError(f"Unexpected API response format: {json.dumps(result, ensure_ascii=False, indent=2)}")
-                
-        except requests.exceptions.RequestException as e:
-            error_msg = f"API request failed: {str(e)}"
-            if hasattr(e, 'response') and e.response is not None:
-                try:
-                    error_detail = e.response.json()
-                    error_msg += f"\nResponse: {json.dumps(error_detail, ensure_ascii=False, indent=2)}"
-                except:
-                    error_msg += f"\nResponse text: {e.response.text}"
-            raise Exception(error_msg)
-        except Exception as e:
-            raise Exception(f"Failed to parse API response: {str(e)}")
-    
+        ]
+        payload = self._build_payload(messages, model, temperature, max_tokens, top_p, **kwargs)
+        return self._request(payload, timeout=600, caller=caller, coalesce=coalesce)
+
     def call_with_messages(self,
                            messages: List[Dict[str, str]],
                            model: str = "qwen-plus",
                            temperature: float = 0.7,
                            max_tokens: int = 2000,
                            top_p: float = 0.8,
+                           caller: Optional[str] = None,
+                           coalesce: Optional[bool] = None,
                            **kwargs) -> str:
         """
         使用消息列表调用API（支持多轮对话）
-        
+
         Args:
             messages: 消息列表，格式: [{"role": "user", "content": "..."}, ...]
             model: 模型名称
             temperature: 温度参数
             max_tokens: 最大生成token数
             top_p: nucleus sampling参数
+            caller: 调用方名称，用于分组统计指标
+            coalesce: 是否与相同的在途请求合并，None 表示仅对 temperature=0 的调用合并
             **kwargs: 其他参数
-            
+
         Returns:
             生成的文本内容
         """
-        payload = {
+        payload = self._build_payload(messages, model, temperature, max_tokens, top_p, **kwargs)
+        return self._request(payload, timeout=60, caller=caller, coalesce=coalesce)
+
+    def call_stream(self,
+                    prompt: str,
+                    model: str = "qwen-plus",
+                    temperature: float = 0.7,
+                    max_tokens: int = 2000,
+                    top_p: float = 0.8,
+                    stop_when: Optional[Callable[[str], bool]] = None,
+                    caller: Optional[str] = None,
+                    **kwargs) -> str:
+        """
+        以流式（SSE、增量输出）方式调用Qwen API
+
+        Args:
+            prompt: 输入提示词
+            model: 模型名称
+            temperature: 温度参数
+            max_tokens: 最大生成token数
+            top_p: nucleus sampling参数
+            stop_when: 截断判断函数，参数为目前累计的输出，返回 True 时立即断开连接，
+                       不再等待（也不再计费）剩余的生成内容
+            caller: 调用方名称，用于分组统计指标
+            **kwargs: 其他参数
+
+        Returns:
+            生成（或截断后）的文本内容
+        """
+        messages = [
+            {
+                "role": "user",
+                "content": prompt
+            }
+        ]
+        return self.call_with_messages_stream(
+            messages, model, temperature, max_tokens, top_p,
+            stop_when=stop_when, timeout=600, caller=caller, **kwargs
+        )
+
+    def call_with_messages_stream(self,
+                                  messages: List[Dict[str, str]],
+                                  model: str = "qwen-plus",
+                                  temperature: float = 0.7,
+                                  max_tokens: int = 2000,
+                                  top_p: float = 0.8,
+                                  stop_when: Optional[Callable[[str], bool]] = None,
+                                  timeout: float = 60,
+                                  caller: Optional[str] = None,
+                                  **kwargs) -> str:
+        """
+        使用消息列表以流式方式调用API，参数含义同 call_stream
+
+        Returns:
+            生成（或截断后）的文本内容
+        """
+        payload = self._build_payload(
+            messages, model, temperature, max_tokens, top_p, incremental_output=True, **kwargs
+        )
+        return self._request_with_retry(
+            payload, timeout, caller, send=lambda p, t: self._stream_once(p, t, stop_when, caller)
+        )
+
+    def stream_stats(self) -> Dict[str, Any]:
+        """
+        流式调用统计
+
+        Returns:
+            {"stream_calls", "early_stops", "ttft_avg", "ttft_p50", "ttft_p95"}，时间单位为秒
+        """
+        return self.metrics.stream_summary()
+
+    def _build_payload(self,
+                       messages: List[Dict[str, str]],
+                       model: str,
+                       temperature: float,
+                       max_tokens: int,
+                       top_p: float,
+                       **kwargs) -> Dict[str, Any]:
+        """构建请求体"""
+        return {
             "model": model,
             "input": {
                 "messages": messages
@@ -143,51 +331,555 @@ class QwenAPIClient:
                 **kwargs
             }
         }
-        
+
+    def _wire_payload(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        把内部统一的请求体转换为服务端的请求格式
+
+        内部请求体（缓存键、合并、限流预估都基于它）始终是百炼格式，其他后端在子类中覆盖此方法。
+        """
+        return payload
+
+    def _stream_headers(self) -> Dict[str, str]:
+        """流式请求额外的请求头"""
+        return {"X-DashScope-SSE": "enable", "Accept": "text/event-stream"}
+
+    def _extract_stream_delta(self, event: Dict[str, Any]) -> str:
+        """从一个流式事件中提取新增的文本（增量输出模式下与非流式响应结构相同）"""
+        return self._extract_text(event)
+
+    def _request(self,
+                 payload: Dict[str, Any],
+                 timeout: float,
+                 caller: Optional[str] = None,
+                 coalesce: Optional[bool] = None) -> str:
+        """发送请求并解析生成的文本，可缓存的调用先查缓存，可合并的调用与相同的在途请求共享结果"""
+        cache_key = self._cache_key(payload)
+        if cache_key is not None:
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                self.metrics.record_cache_hit(payload["model"], caller)
+                return cached
+
+        if self._should_coalesce(payload, coalesce):
+            text, shared = self.coalescer.run(
+                make_request_key(payload),
+                lambda: self._request_with_retry(payload, timeout, caller)
+            )
+            if shared:
+                # 结果由 leader 负责写缓存
+                self.metrics.record_coalesced(payload["model"], caller)
+                return text
+        else:
+            text = self._request_with_retry(payload, timeout, caller)
+
+        if cache_key is not None:
+            self.cache.put(cache_key, payload["model"], text)
+        return text
+
+    @staticmethod
+    def _should_coalesce(payload: Dict[str, Any], coalesce: Optional[bool]) -> bool:
+        """显式指定时按指定，否则只合并 temperature=0 的确定性调用"""
+        if coalesce is not None:
+            return coalesce
+        return payload["parameters"].get("temperature") == 0
+
+    def _cache_key(self, payload: Dict[str, Any]) -> Optional[str]:
+        """返回请求的缓存键，不可缓存时返回 None"""
+        if self.cache is None:
+            return None
+        if self.cache_mode == "deterministic" and payload["parameters"].get("temperature") != 0:
+            return None
+        return make_request_key(payload)
+
+    def _request_with_retry(self,
+                            payload: Dict[str, Any],
+                            timeout: float,
+                            caller: Optional[str] = None,
+                            send: Optional[Callable[[Dict[str, Any], float], Tuple[str, Dict[str, int]]]] = None) -> str:
+        """
+        瞬时错误按重试策略在本次调用内重试，并记录本次调用的指标
+
+        send 默认为普通的单次请求（配置了对冲策略时为对冲请求），返回 (文本, token用量)
+        """
+        if send is None:
+            send = self._send_once if self.hedge is None else (lambda p, t: self._send_hedged(p, t, caller))
+        raw_estimate, estimate = self._estimate_input_tokens(payload)
+        started_at = time.monotonic()
+        attempt = 0
+        while True:
+            try:
+                self._check_budget()
+                self._check_circuit()
+                text, usage = send(payload, timeout)
+            except QwenAPIError as e:
+                self._record_circuit(e)
+                delay = self.retry_policy.next_delay(e, attempt, started_at)
+                if delay is None:
+                    self.metrics.record_call(
+                        payload["model"], caller, time.monotonic() - started_at, error=self._error_reason(e)
+                    )
+                    raise
+                self.metrics.record_retry(payload["model"], caller)
+                self._log_retry(e, attempt, delay)
+                time.sleep(delay)
+                attempt += 1
+            else:
+                self._record_circuit(None)
+                self._account_usage(payload["model"], usage)
+                self._observe_estimate(payload["model"], raw_estimate, usage)
+                self.metrics.record_call(
+                    payload["model"], caller, time.monotonic() - started_at, usage, estimated_input_tokens=estimate
+                )
+                return text
+
+    def _estimate_input_tokens(self, payload: Dict[str, Any]) -> Tuple[Optional[int], Optional[int]]:
+        """请求前的离线输入 token 预估，返回 (原始预估, 按模型修正后的预估)，未配置预估器时为 (None, None)"""
+        if self.token_estimator is None:
+            return None, None
+        messages = payload["input"]["messages"]
+        raw_estimate = self.token_estimator.count_messages(messages)
+        return raw_estimate, int(round(raw_estimate * self.token_estimator.scale(payload["model"])))
+
+    def _observe_estimate(self, model: str, raw_estimate: Optional[int], usage: Dict[str, int]):
+        """用真实输入 token 数修正预估系数（流式调用提前截断等拿不到用量时跳过）"""
+        if raw_estimate is not None and usage.get("input_tokens"):
+            self.token_estimator.observe(model, raw_estimate, usage["input_tokens"])
+
+    def _check_budget(self):
+        """达到硬上限时直接抛出 BudgetExceededError，不发出请求"""
+        if self.budget is not None and self.budget.hard_exceeded():
+            summary = self.budget.summary()
+            raise BudgetExceededError(
+                f"API budget exhausted: {summary['total_tokens']} tokens, estimated cost {summary['estimated_cost']:.2f}"
+            )
+
+    def _account_usage(self, model: str, usage: Dict[str, int], tracker: Optional[UsageTracker] = None):
+        """把真正发出的请求的用量计入当前的用量统计（默认取当前线程/协程的）和本次运行的预算"""
+        tracker = tracker or current_usage_tracker()
+        if tracker is not None:
+            tracker.add(model, usage)
+        if self.budget is not None:
+            self.budget.record(model, usage)
+
+    def _check_circuit(self):
+        """熔断器打开时直接抛出 CircuitOpenError，不发出请求"""
+        if self.circuit_breaker is None or self.circuit_breaker.allow_request():
+            return
+        remaining = self.circuit_breaker.remaining_open_time()
+        raise CircuitOpenError(f"API circuit open, retry in {remaining:.0f}s", retry_after=remaining)
+
+    def _record_circuit(self, error: Optional[QwenAPIError]):
+        """
+        把一次请求的结果反馈给熔断器：只有 5xx、超时和连接错误算作接口故障
+
+        429 只交给限流器和 key 摘除处理，不计入熔断（也不重置连续失败数）；其他 4xx 说明接口可达，按成功记录。
+        """
+        if self.circuit_breaker is None or isinstance(error, (CircuitOpenError, BudgetExceededError)):
+            return
+        if error is None:
+            self.circuit_breaker.record_success()
+        elif error.status_code == 429:
+            self.circuit_breaker.record_ignored()
+        elif (error.status_code or 0) >= 500 or (error.status_code is None and error.transient):
+            self.circuit_breaker.record_failure()
+        else:
+            self.circuit_breaker.record_success()
+
+    def _send_once(self,
+                   payload: Dict[str, Any],
+                   timeout: float,
+                   abandoned: Optional[threading.Event] = None) -> Tuple[str, Dict[str, int]]:
+        """
+        发送一次请求（不重试），返回 (文本, token用量)
+
+        abandoned 由 _send_hedged 传入，对冲落败时置位：同步请求无法中途取消，跑完后只归还名额和 key，
+        不作为成功计入 AIMD、延迟基线和 key 健康状态（token 用量由 _record_hedge_loser 照常计入）。
+        """
+        estimated_tokens = self._estimate_tokens(payload)
+        endpoint = self._acquire_endpoint_and_slot(payload, estimated_tokens)
+        error = None
+        sent_at = time.monotonic()
+
         try:
-            response = requests.post(
-                self.base_url,
-                headers=self.headers,
-                json=payload,
-                timeout=60
+            response = self.session.post(
+                endpoint.base_url if endpoint else self.base_url,
+                json=self._wire_payload(payload),
+                headers=endpoint.headers if endpoint else None,
+                timeout=timeout
             )
             response.raise_for_status()
-            
+
             result = response.json()
-            
-            # 解析响应 - 兼容多种响应格式
-            if "output" in result:
-                output = result["output"]
-                # 格式1: output.choices[0].message.content
-                if "choices" in output and len(output["choices"]) > 0:
-                    choice = output["choices"][0]
-                    if "message" in choice and "content" in choice["message"]:
-                        return choice["message"]["content"]
-                    elif "text" in choice:
-                        return choice["text"]
-                # 格式2: output.text
-                elif "text" in output:
-                    return output["text"]
-                # 格式3: output.result
-                elif "result" in output:
-                    return output["result"]
-            
-            # 如果都没有，尝试直接获取text字段
-            if "text" in result:
-                return result["text"]
-            
-            # 如果还是找不到，抛出错误并显示完整响应
-            raise ValueError(f"Unexpected API response format: {json.dumps(result, ensure_ascii=False, indent=2)}")
-                
+            if abandoned is None or not abandoned.is_set():
+                self._observe_latency(payload["model"], time.monotonic() - sent_at)
+            self._reconcile_usage(payload, estimated_tokens, result, endpoint)
+            return self._extract_text(result), self._result_usage(result)
+
         except requests.exceptions.RequestException as e:
-            error_msg = f"API request failed: {str(e)}"
-            if hasattr(e, 'response') and e.response is not None:
-                try:
-                    error_detail = e.response.json()
-                    error_msg += f"\nResponse: {json.dumps(error_detail, ensure_ascii=False, indent=2)}"
-                except:
-                    error_msg += f"\nResponse text: {e.response.text}"
-            raise Exception(error_msg)
+            error = self._to_api_error(e)
+            raise error
         except Exception as e:
-            raise Exception(f"Failed to parse API response: {str(e)}")
+            error = QwenAPIError(f"Failed to parse API response: {str(e)}")
+            raise error
+        finally:
+            cancelled = abandoned is not None and abandoned.is_set()
+            self._release_slot(payload["model"], error, time.monotonic() - sent_at, cancelled=cancelled)
+            self._release_endpoint(endpoint, error, cancelled=cancelled)
+
+    def _send_hedged(self,
+                     payload: Dict[str, Any],
+                     timeout: float,
+                     caller: Optional[str] = None) -> Tuple[str, Dict[str, int]]:
+        """
+        对冲请求：主请求超过 hedge_delay 仍未返回时再发一个相同请求，先成功的结果胜出
+
+        同步请求无法中途取消，落败的请求在后台跑完：结束时只归还名额和 key（不计入 AIMD 和延迟基线），
+        token用量照常计入指标和预算。两个请求都失败时抛出后失败的那个错误，交给外层按重试策略处理。
+        """
+        model = payload["model"]
+        self.hedge.record_request()
+        delay = self.hedge.hedge_delay(model)
+        if delay is None:
+            return self._send_once(payload, timeout)
+        # 落败请求在后台线程完成，用量要计入发起调用时所在的统计
+        tracker = current_usage_tracker()
+
+        executor = self._get_hedge_executor()
+        primary_abandoned = threading.Event()
+        primary = executor.submit(self._send_once, payload, timeout, primary_abandoned)
+        done, _ = wait([primary], timeout=delay)
+        if done or not self._has_spare_capacity() or not self.hedge.try_hedge():
+            return primary.result()
+
+        self.metrics.record_hedge(model, caller)
+        hedged_abandoned = threading.Event()
+        hedged = executor.submit(self._send_once, payload, timeout, hedged_abandoned)
+        pending = {primary, hedged}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    error = future.exception()
+                    continue
+                if future is hedged:
+                    self.metrics.record_hedge(model, caller, won=True)
+                # 落败的请求跑完后只归还名额和 key
+                (primary_abandoned if future is hedged else hedged_abandoned).set()
+                for loser in pending:
+                    loser.add_done_callback(lambda f: self._record_hedge_loser(f, model, caller, tracker))
+                return future.result()
+        raise error
+
+    def _record_hedge_loser(self,
+                            future: Future,
+                            model: str,
+                            caller: Optional[str],
+                            tracker: Optional[UsageTracker]):
+        """落败的对冲请求完成后，把它消耗的token计入指标和预算"""
+        if future.exception() is None:
+            usage = future.result()[1]
+            self.metrics.record_usage(model, caller, usage)
+            self._account_usage(model, usage, tracker)
+
+    def _observe_latency(self, model: str, latency: float):
+        """成功请求的网络耗时（不含排队）记入对冲策略"""
+        if self.hedge is not None:
+            self.hedge.record_latency(model, latency)
+
+    def _has_spare_capacity(self) -> bool:
+        """并发名额还有空余时才对冲，已经饱和时再加请求只会让排队更久"""
+        return self.concurrency is None or self.concurrency.in_flight < int(self.concurrency.limit)
+
+    def _get_hedge_executor(self) -> ThreadPoolExecutor:
+        """懒加载对冲请求使用的线程池（线程安全）"""
+        if self._hedge_executor is None:
+            with self._session_lock:
+                if self._hedge_executor is None:
+                    self._hedge_executor = ThreadPoolExecutor(
+                        max_workers=self.pool_maxsize * 2, thread_name_prefix="qwen-hedge"
+                    )
+        return self._hedge_executor
+
+    def _stream_once(self,
+                     payload: Dict[str, Any],
+                     timeout: float,
+                     stop_when: Optional[Callable[[str], bool]],
+                     caller: Optional[str] = None) -> Tuple[str, Dict[str, int]]:
+        """
+        发送一次流式请求（不重试），按 stop_when 提前断开，返回 (文本, token用量)
+
+        网络错误按 _to_api_error 判断是否可重试；事件解析、用量提取和 stop_when 本身抛出的异常
+        统一包装为不可重试的 QwenAPIError。任何失败都会带着错误归还并发名额和 key。
+        """
+        estimated_tokens = self._estimate_tokens(payload)
+        endpoint = self._acquire_endpoint_and_slot(payload, estimated_tokens)
+        error = None
+
+        started_at = time.monotonic()
+        first_token_at = None
+        stopped_early = False
+        last_event = None
+        finish_reason = None
+        text = ""
+        try:
+            headers = self._stream_headers()
+            if endpoint is not None:
+                headers.update(endpoint.headers)
+            response = self.session.post(
+                endpoint.base_url if endpoint else self.base_url,
+                json=self._wire_payload(payload),
+                headers=headers,
+                timeout=timeout,
+                stream=True
+            )
+            try:
+                if response.status_code >= 400:
+                    # 先读出错误响应体，关闭连接后仍可用于拼接错误信息
+                    response.content
+                response.raise_for_status()
+                # SSE 响应通常不带 charset，requests 会按 ISO-8859-1 解码，这里显式指定
+                response.encoding = "utf-8"
+                for event in iter_sse_events(response.iter_lines(decode_unicode=True)):
+                    last_event = event
+                    finish_reason = self._finish_reason(event) or finish_reason
+                    try:
+                        delta = self._extract_stream_delta(event)
+                    except ValueError:
+                        continue
+                    if not delta:
+                        continue
+                    if first_token_at is None:
+                        first_token_at = time.monotonic()
+                    text += delta
+                    if stop_when is not None and stop_when(text):
+                        stopped_early = True
+                        break
+            finally:
+                # 提前截断时直接关闭连接，服务端随之停止生成
+                response.close()
+
+            usage = {"input_tokens": 0, "output_tokens": 0, "total_tokens": 0}
+            if last_event is not None:
+                # 增量输出的每个事件都携带截至当前的累计用量
+                self._reconcile_usage(payload, estimated_tokens, last_event, endpoint)
+                usage = self._extract_usage(last_event)
+        except requests.exceptions.RequestException as e:
+            error = self._to_api_error(e)
+            raise error
+        except QwenAPIError as e:
+            error = e
+            raise
+        except Exception as e:
+            error = QwenAPIError(f"Failed to parse stream response: {type(e).__name__}: {str(e)}")
+            raise error from e
+        finally:
+            # 流式调用的总耗时取决于何时截断，不作为延迟信号
+            self._release_slot(payload["model"], error)
+            self._release_endpoint(endpoint, error)
+
+        usage["truncated"] = int(not stopped_early and finish_reason == "length")
+        ttft = first_token_at - started_at if first_token_at is not None else None
+        self.metrics.record_stream(payload["model"], caller, ttft, stopped_early)
+        return text, usage
+
+    @staticmethod
+    def _to_api_error(e: requests.exceptions.RequestException) -> "QwenAPIError":
+        """把 requests 异常转换为 QwenAPIError，并标记是否可重试"""
+        error_msg = f"API request failed: {str(e)}"
+        status_code = None
+        retry_after = None
+        if hasattr(e, 'response') and e.response is not None:
+            status_code = e.response.status_code
+            retry_after = parse_retry_after(e.response.headers.get("Retry-After"))
+            try:
+                error_detail = e.response.json()
+                error_msg += f"\nResponse: {json.dumps(error_detail, ensure_ascii=False, indent=2)}"
+            except:
+                error_msg += f"\nResponse text: {e.response.text}"
+        # 连接重置、读超时、响应体读取中断都视为瞬时错误
+        transient = is_retryable_status(status_code) or isinstance(e, (
+            requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout,
+            requests.exceptions.ChunkedEncodingError
+        ))
+        return QwenAPIError(error_msg, status_code=status_code, retry_after=retry_after, transient=transient)
+
+    @staticmethod
+    def _error_reason(error: "QwenAPIError") -> str:
+        """指标中使用的失败原因：HTTP状态码、熔断，或网络/解析错误"""
+        if isinstance(error, CircuitOpenError):
+            return "circuit_open"
+        if isinstance(error, BudgetExceededError):
+            return "budget"
+        if error.status_code is not None:
+            return str(error.status_code)
+        return "network" if error.transient else "other"
+
+    @staticmethod
+    def _log_retry(error: "QwenAPIError", attempt: int, delay: float):
+        """打印重试信息"""
+        reason = error.status_code or str(error).split("\n", 1)[0][:80]
+        print(f"API 调用遇到瞬时错误（{reason}），{delay:.1f} 秒后进行第 {attempt + 1} 次重试")
+
+    def _acquire_endpoint(self, payload: Dict[str, Any], estimated_tokens: int) -> Optional[APIEndpoint]:
+        """按配额排队；配置了 key 池时选出本次请求使用的 key"""
+        if self.key_pool is not None:
+            return self.key_pool.acquire(payload["model"], estimated_tokens)
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(payload["model"], estimated_tokens)
+        return None
+
+    def _acquire_endpoint_and_slot(self, payload: Dict[str, Any], estimated_tokens: int) -> Optional[APIEndpoint]:
+        """按配额排队、选 key，再占用并发名额；占名额失败（如被中断）时归还已选中的 key，不计入其健康状态"""
+        endpoint = self._acquire_endpoint(payload, estimated_tokens)
+        try:
+            self._acquire_slot()
+        except BaseException:
+            self._release_endpoint(endpoint, None, cancelled=True)
+            raise
+        return endpoint
+
+    def _acquire_slot(self):
+        """占用一个并发名额（未配置自适应并发时不限制）"""
+        if self.concurrency is not None:
+            self.concurrency.acquire()
+
+    def _release_slot(self,
+                      model: str,
+                      error: Optional["QwenAPIError"],
+                      latency: Optional[float] = None,
+                      cancelled: bool = False):
+        """归还并发名额，把本次结果反馈给 AIMD 控制器，并更新并发上限指标（被取消的请求只归还名额）"""
+        if self.concurrency is None:
+            return
+        congested = error is not None and is_congestion(error.status_code, error.transient)
+        self.concurrency.release(
+            model, latency=latency if error is None else None, congested=congested, cancelled=cancelled
+        )
+        self.metrics.set_gauge("concurrency_limit", int(self.concurrency.limit))
+
+    def _release_endpoint(self,
+                          endpoint: Optional[APIEndpoint],
+                          error: Optional["QwenAPIError"],
+                          cancelled: bool = False):
+        """归还 key 并更新其健康状态；还有其他健康 key 时，配额/鉴权错误改为立即换 key 重试（被取消的请求只归还 key）"""
+        if endpoint is None:
+            return
+        if cancelled:
+            self.key_pool.release(endpoint, cancelled=True)
+            return
+        if error is None:
+            self.key_pool.release(endpoint)
+            return
+        self.key_pool.release(
+            endpoint,
+            status_code=error.status_code,
+            retry_after=error.retry_after,
+            transient=error.transient,
+            failed=True
+        )
+        if error.status_code in QUOTA_STATUS_CODES | AUTH_STATUS_CODES and self.key_pool.has_healthy():
+            error.transient = True
+            error.retry_after = None
+
+    def _reconcile_usage(self,
+                         payload: Dict[str, Any],
+                         estimated_tokens: int,
+                         result: Dict[str, Any],
+                         endpoint: Optional[APIEndpoint] = None):
+        """用响应中的真实用量修正限流器预扣的token数（使用 key 池时修正该 key 自己的限流器）"""
+        rate_limiter = endpoint.rate_limiter if endpoint is not None else self.rate_limiter
+        if rate_limiter is None:
+            return
+        usage = self._extract_usage(result)
+        if usage["total_tokens"]:
+            rate_limiter.reconcile(payload["model"], estimated_tokens, usage["total_tokens"])
+
+    def _estimate_tokens(self, payload: Dict[str, Any]) -> int:
+        """
+        粗略预估一次请求的token消耗，用于限流预扣
+
+        输入按 token_estimator 预估，未配置时按字符数计（中文提示词下偏保守），
+        输出按 max_tokens 计，调用后再用真实用量修正
+        """
+        messages = payload["input"]["messages"]
+        if self.token_estimator is not None:
+            input_tokens = self.token_estimator.estimate_messages(messages, payload["model"])
+        else:
+            input_tokens = sum(len(str(msg.get("content", ""))) for msg in messages)
+        return input_tokens + int(payload["parameters"].get("max_tokens") or 0)
+
+    @staticmethod
+    def _extract_usage(result: Dict[str, Any]) -> Dict[str, int]:
+        """
+        从响应JSON中提取token用量，缺失的字段记为0
+
+        Returns:
+            {"input_tokens": ..., "output_tokens": ..., "total_tokens": ...}
+        """
+        usage = result.get("usage") or {}
+        input_tokens = int(usage.get("input_tokens") or 0)
+        output_tokens = int(usage.get("output_tokens") or 0)
+        total_tokens = int(usage.get("total_tokens") or (input_tokens + output_tokens))
+        return {
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "total_tokens": total_tokens
+        }
+
+    def _result_usage(self, result: Dict[str, Any]) -> Dict[str, int]:
+        """
+        非流式响应的用量，附带是否因达到 max_tokens 被截断
+
+        Returns:
+            {"input_tokens": ..., "output_tokens": ..., "total_tokens": ..., "truncated": 0 或 1}
+        """
+        usage = self._extract_usage(result)
+        usage["truncated"] = int(self._finish_reason(result) == "length")
+        return usage
+
+    @staticmethod
+    def _finish_reason(result: Dict[str, Any]) -> Optional[str]:
+        """响应（或流式事件）的结束原因，"length" 表示达到 max_tokens 被截断；流式中间事件为空"""
+        output = result.get("output") or {}
+        choices = output.get("choices") or []
+        if choices:
+            return choices[0].get("finish_reason")
+        return output.get("finish_reason")
+
+    @staticmethod
+    def _extract_text(result: Dict[str, Any]) -> str:
+        """
+        从响应JSON中提取生成的文本
+
+        Args:
+            result: API返回的JSON
+
+        Returns:
+            生成的文本内容
+        """
+        # 解析响应 - 兼容多种响应格式
+        if "output" in result:
+            output = result["output"]
+            # 格式1: output.choices[0].message.content
+            if "choices" in output and len(output["choices"]) > 0:
+                choice = output["choices"][0]
+                if "message" in choice and "content" in choice["message"]:
+                    return choice["message"]["content"]
+                elif "text" in choice:
+                    return choice["text"]
+            # 格式2: output.text
+            elif "text" in output:
+                return output["text"]
+            # 格式3: output.result
+            elif "result" in output:
+                return output["result"]
+
+        # 如果都没有，尝试直接获取text字段
+        if "text" in result:
+            return result["text"]
 
+        # 如果还是找不到，抛出错误并显示完整响应
+        raise ValueError(f"Unexpected API response format: {json.dumps(result, ensure_ascii=False, indent=2)}")
@@ -0,0 +1,361 @@
+"""
+阿里百炼Qwen API异步客户端
+在单个事件循环上并发发起多个请求，并用信号量限制同时在途的请求数
+"""
+import asyncio
+import json
+import time
+import aiohttp
+from typing import Any, Dict, List, Optional, Tuple
+
+from .api_client import QwenAPIClient, QwenAPIError
+from .budget import TokenBudget
+from .circuit_breaker import CircuitBreaker
+from .concurrency import AdaptiveConcurrencyLimiter
+from .hedging import HedgePolicy
+from .key_pool import APIEndpoint, KeyPool
+from .metrics import APIMetrics
+from .rate_limiter import RateLimiter
+from .response_cache import ResponseCache, make_request_key
+from .retry import RetryPolicy, is_retryable_status, parse_retry_after
+from .token_estimator import TokenEstimator
+
+
+class AsyncQwenAPIClient(QwenAPIClient):
+    """
+    QwenAPIClient 的异步版本
+
+    继承同步客户端的全部能力（call / call_with_messages 仍可使用），
+    额外提供 acall / acall_with_messages 两个协程方法。
+    一个实例只应在同一个事件循环内使用，用完后调用 aclose()。
+    """
+
+    def __init__(self,
+                 api_key: str,
+                 base_url: str = None,
+                 max_concurrency: int = 16,
+                 pool_connections: int = 10,
+                 pool_maxsize: int = 32,
+                 pool_block: bool = False,
+                 rate_limiter: Optional[RateLimiter] = None,
+                 retry_policy: Optional[RetryPolicy] = None,
+                 cache: Optional[ResponseCache] = None,
+                 cache_mode: str = "deterministic",
+                 metrics: Optional[APIMetrics] = None,
+                 key_pool: Optional[KeyPool] = None,
+                 concurrency: Optional[AdaptiveConcurrencyLimiter] = None,
+                 circuit_breaker: Optional[CircuitBreaker] = None,
+                 hedge: Optional[HedgePolicy] = None,
+                 budget: Optional[TokenBudget] = None,
+                 token_estimator: Optional[TokenEstimator] = None):
+        """
+        初始化异步API客户端
+
+        Args:
+            api_key: API密钥
+            base_url: API基础URL，如果为None则使用默认值
+            max_concurrency: 同时在途的最大请求数
+            pool_connections: 同步会话连接池缓存的主机数
+            pool_maxsize: 每个主机保持的最大连接数
+            pool_block: 同步会话连接池耗尽时是否阻塞等待
+            rate_limiter: 按模型的RPM/TPM限流器，可与同步客户端共享
+            retry_policy: 重试策略，None 时使用默认策略
+            cache: 响应缓存，可与同步客户端共享
+            cache_mode: "deterministic" 只缓存 temperature=0 的调用；"all" 缓存全部调用
+            metrics: 指标收集器，可与同步客户端共享
+            key_pool: 多 key / 多接入点池，可与同步客户端共享
+            concurrency: 自适应并发限制器，在 max_concurrency 之内进一步按 429 和延迟调整在途上限
+                         （上限的上界会收紧到 max_concurrency）
+            circuit_breaker: 熔断器，可与同步客户端共享
+            hedge: 对冲策略，落败的请求会被直接取消
+            budget: token / 费用预算，可与同步客户端共享
+            token_estimator: 离线 token 预估器，可与同步客户端共享
+        """
+        super().__init__(
+            api_key,
+            base_url,
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            pool_block=pool_block,
+            rate_limiter=rate_limiter,
+            retry_policy=retry_policy,
+            cache=cache,
+            cache_mode=cache_mode,
+            metrics=metrics,
+            key_pool=key_pool,
+            concurrency=concurrency,
+            circuit_breaker=circuit_breaker,
+            hedge=hedge,
+            budget=budget,
+            token_estimator=token_estimator
+        )
+        self.max_concurrency = max_concurrency
+        if concurrency is not None:
+            # 信号量之外的名额永远用不上
+            concurrency.cap(max_concurrency)
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._aio_session: Optional[aiohttp.ClientSession] = None
+
+    async def _get_aio_session(self) -> aiohttp.ClientSession:
+        """懒加载的 aiohttp 会话，必须在事件循环内创建"""
+        if self._aio_session is None or self._aio_session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=max(self.max_concurrency, self.pool_maxsize),
+                limit_per_host=self.pool_maxsize
+            )
+            self._aio_session = aiohttp.ClientSession(
+                connector=connector,
+                headers=self.headers
+            )
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._aio_session
+
+    async def aclose(self):
+        """关闭异步会话（同步会话仍需调用 close()）"""
+        if self._aio_session is not None and not self._aio_session.closed:
+            await self._aio_session.close()
+        self._aio_session = None
+        self._semaphore = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.aclose()
+        self.close()
+
+    async def acall(self,
+                    prompt: str,
+                    model: str = "qwen-plus",
+                    temperature: float = 0.7,
+                    max_tokens: int = 2000,
+                    top_p: float = 0.8,
+                    caller: Optional[str] = None,
+                    coalesce: Optional[bool] = None,
+                    **kwargs) -> str:
+        """
+        异步调用Qwen API生成文本，参数与 call 相同
+
+        Returns:
+            生成的文本内容
+        """
+        messages = [
+            {
+                "role": "user",
+                "content": prompt
+            }
+        ]
+        payload = self._build_payload(messages, model, temperature, max_tokens, top_p, **kwargs)
+        return await self._arequest(payload, timeout=600, caller=caller, coalesce=coalesce)
+
+    async def acall_with_messages(self,
+                                  messages: List[Dict[str, str]],
+                                  model: str = "qwen-plus",
+                                  temperature: float = 0.7,
+                                  max_tokens: int = 2000,
+                                  top_p: float = 0.8,
+                                  caller: Optional[str] = None,
+                                  coalesce: Optional[bool] = None,
+                                  **kwargs) -> str:
+        """
+        异步使用消息列表调用API，参数与 call_with_messages 相同
+
+        Returns:
+            生成的文本内容
+        """
+        payload = self._build_payload(messages, model, temperature, max_tokens, top_p, **kwargs)
+        return await self._arequest(payload, timeout=60, caller=caller, coalesce=coalesce)
+
+    async def _arequest(self,
+                        payload: Dict[str, Any],
+                        timeout: float,
+                        caller: Optional[str] = None,
+                        coalesce: Optional[bool] = None) -> str:
+        """发送请求，可缓存的调用先查缓存，可合并的调用与相同的在途请求共享结果"""
+        cache_key = self._cache_key(payload)
+        if cache_key is not None:
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                self.metrics.record_cache_hit(payload["model"], caller)
+                return cached
+
+        if self._should_coalesce(payload, coalesce):
+            text, shared = await self.coalescer.arun(
+                make_request_key(payload),
+                lambda: self._arequest_with_retry(payload, timeout, caller)
+            )
+            if shared:
+                self.metrics.record_coalesced(payload["model"], caller)
+                return text
+        else:
+            text = await self._arequest_with_retry(payload, timeout, caller)
+
+        if cache_key is not None:
+            self.cache.put(cache_key, payload["model"], text)
+        return text
+
+    async def _arequest_with_retry(self, payload: Dict[str, Any], timeout: float, caller: Optional[str] = None) -> str:
+        """瞬时错误按重试策略重试（退避期间不占用并发名额），并记录本次调用的指标"""
+        raw_estimate, estimate = self._estimate_input_tokens(payload)
+        started_at = time.monotonic()
+        attempt = 0
+        while True:
+            try:
+                self._check_budget()
+                self._check_circuit()
+                if self.hedge is None:
+                    text, usage = await self._asend_once(payload, timeout)
+                else:
+                    text, usage = await self._asend_hedged(payload, timeout, caller)
+            except QwenAPIError as e:
+                self._record_circuit(e)
+                delay = self.retry_policy.next_delay(e, attempt, started_at)
+                if delay is None:
+                    self.metrics.record_call(
+                        payload["model"], caller, time.monotonic() - started_at, error=self._error_reason(e)
+                    )
+                    raise
+                self.metrics.record_retry(payload["model"], caller)
+                self._log_retry(e, attempt, delay)
+                await asyncio.sleep(delay)
+                attempt += 1
+            else:
+                self._record_circuit(None)
+                self._account_usage(payload["model"], usage)
+                self._observe_estimate(payload["model"], raw_estimate, usage)
+                self.metrics.record_call(
+                    payload["model"], caller, time.monotonic() - started_at, usage, estimated_input_tokens=estimate
+                )
+                return text
+
+    async def _asend_hedged(self,
+                            payload: Dict[str, Any],
+                            timeout: float,
+                            caller: Optional[str] = None) -> Tuple[str, Dict[str, int]]:
+        """_send_hedged 的协程版本，胜出后取消落败的请求"""
+        model = payload["model"]
+        self.hedge.record_request()
+        delay = self.hedge.hedge_delay(model)
+        if delay is None:
+            return await self._asend_once(payload, timeout)
+
+        primary = asyncio.ensure_future(self._asend_once(payload, timeout))
+        tasks = [primary]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if done or not self._has_spare_capacity() or not self.hedge.try_hedge():
+                return await primary
+
+            self.metrics.record_hedge(model, caller)
+            hedged = asyncio.ensure_future(self._asend_once(payload, timeout))
+            tasks.append(hedged)
+            pending = set(tasks)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                        continue
+                    if task is hedged:
+                        self.metrics.record_hedge(model, caller, won=True)
+                    return task.result()
+            raise error
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    async def _asend_once(self, payload: Dict[str, Any], timeout: float) -> Tuple[str, Dict[str, int]]:
+        """
+        在信号量保护下发送一次请求，解析逻辑与同步版本完全一致，返回 (文本, token用量)
+
+        先占信号量，再按配额排队、选 key、占 AIMD 名额：在信号量上排队的协程不占用名额和 key，也不提前扣减配额。
+        被取消（对冲落败）的请求只归还名额和 key，不作为成功计入 AIMD、延迟基线和 key 健康状态。
+        """
+        session = await self._get_aio_session()
+        estimated_tokens = self._estimate_tokens(payload)
+        async with self._semaphore:
+            endpoint = await self._aacquire_endpoint(payload, estimated_tokens)
+            if self.concurrency is not None:
+                try:
+                    await self.concurrency.aacquire()
+                except BaseException:
+                    self._release_endpoint(endpoint, None, cancelled=True)
+                    raise
+            error = None
+            cancelled = False
+            sent_at = time.monotonic()
+            try:
+                text, usage = await self._apost(session, payload, timeout, estimated_tokens, endpoint)
+            except QwenAPIError as e:
+                error = e
+                raise
+            except asyncio.CancelledError:
+                cancelled = True
+                raise
+            finally:
+                self._release_slot(payload["model"], error, time.monotonic() - sent_at, cancelled=cancelled)
+                self._release_endpoint(endpoint, error, cancelled=cancelled)
+        return text, usage
+
+    def _has_spare_capacity(self) -> bool:
+        """信号量和自适应并发名额都还有空余时才对冲"""
+        if self._semaphore is not None and self._semaphore.locked():
+            return False
+        return super()._has_spare_capacity()
+
+    async def _aacquire_endpoint(self, payload: Dict[str, Any], estimated_tokens: int) -> Optional[APIEndpoint]:
+        """_acquire_endpoint 的协程版本"""
+        if self.key_pool is not None:
+            return await self.key_pool.aacquire(payload["model"], estimated_tokens)
+        if self.rate_limiter is not None:
+            await self.rate_limiter.aacquire(payload["model"], estimated_tokens)
+        return None
+
+    async def _apost(self,
+                     session: aiohttp.ClientSession,
+                     payload: Dict[str, Any],
+                     timeout: float,
+                     estimated_tokens: int,
+                     endpoint: Optional[APIEndpoint]) -> Tuple[str, Dict[str, int]]:
+        """发出请求并解析响应，错误统一转换为 QwenAPIError（调用方已持有信号量）"""
+        posted_at = time.monotonic()
+        try:
+            async with session.post(
+                endpoint.base_url if endpoint else self.base_url,
+                json=self._wire_payload(payload),
+                headers=endpoint.headers if endpoint else None,
+                timeout=aiohttp.ClientTimeout(total=timeout)
+            ) as response:
+                body = await response.text()
+                if response.status >= 400:
+                    error_msg = f"API request failed: {response.status} {response.reason} for url: {response.url}"
+                    try:
+                        error_detail = json.loads(body)
+                        error_msg += f"\nResponse: {json.dumps(error_detail, ensure_ascii=False, indent=2)}"
+                    except ValueError:
+                        error_msg += f"\nResponse text: {body}"
+                    raise QwenAPIError(
+                        error_msg,
+                        status_code=response.status,
+                        retry_after=parse_retry_after(response.headers.get("Retry-After")),
+                        transient=is_retryable_status(response.status)
+                    )
+                self._observe_latency(payload["model"], time.monotonic() - posted_at)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            # 连接重置、超时、响应体读取中断都视为瞬时错误
+            transient = isinstance(e, (
+                aiohttp.ClientConnectionError,
+                aiohttp.ClientPayloadError,
+                asyncio.TimeoutError
+            ))
+            raise QwenAPIError(f"API request failed: {type(e).__name__}: {str(e)}", transient=transient)
+
+        try:
+            result = json.loads(body)
+            self._reconcile_usage(payload, estimated_tokens, result, endpoint)
+            return self._extract_text(result), self._result_usage(result)
+        except Exception as e:
+            raise QwenAPIError(f"Failed to parse API response: {str(e)}")
@@ -0,0 +1,273 @@
+"""
+可替换的大模型后端
+生成器只依赖 LLMBackend 接口（call / call_with_messages 及其流式版本），不关心请求发往哪里：
+- dashscope: 阿里百炼（QwenAPIClient，默认）
+- openai: OpenAI 兼容接口，如本地的 vLLM / llama.cpp / Ollama 服务
+- mock: 进程内模拟回复，不走网络，用于离线调试和回归测试
+
+三种后端共用同一套重试、缓存、合并、熔断、预算与指标逻辑，只有请求格式和发送方式不同。
+"""
+import asyncio
+import random
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Protocol, Tuple, runtime_checkable
+
+from .api_client import QwenAPIClient, QwenAPIError
+from .async_api_client import AsyncQwenAPIClient
+from .metrics import APIMetrics
+from .mock_responder import MockResponder, apply_generation_limits
+from .response_cache import make_request_key
+
+
+DEFAULT_OPENAI_BASE_URL = "http://127.0.0.1:8000/v1"
+
+# 只有百炼接口认识的参数，发往 OpenAI 兼容接口前去掉
+DASHSCOPE_ONLY_PARAMS = ("incremental_output", "result_format", "enable_search")
+
+
+@runtime_checkable
+class LLMBackend(Protocol):
+    """生成器依赖的后端接口，参数含义见 QwenAPIClient 的同名方法"""
+
+    metrics: APIMetrics
+
+    def call(self, prompt: str, model: str = "qwen-plus", temperature: float = 0.7,
+             max_tokens: int = 2000, top_p: float = 0.8, caller: Optional[str] = None,
+             coalesce: Optional[bool] = None, **kwargs) -> str:
+        ...
+
+    def call_with_messages(self, messages: List[Dict[str, str]], model: str = "qwen-plus",
+                           temperature: float = 0.7, max_tokens: int = 2000, top_p: float = 0.8,
+                           caller: Optional[str] = None, coalesce: Optional[bool] = None, **kwargs) -> str:
+        ...
+
+    def call_stream(self, prompt: str, model: str = "qwen-plus", temperature: float = 0.7,
+                    max_tokens: int = 2000, top_p: float = 0.8,
+                    stop_when: Optional[Callable[[str], bool]] = None,
+                    caller: Optional[str] = None, **kwargs) -> str:
+        ...
+
+    def call_with_messages_stream(self, messages: List[Dict[str, str]], model: str = "qwen-plus",
+                                  temperature: float = 0.7, max_tokens: int = 2000, top_p: float = 0.8,
+                                  stop_when: Optional[Callable[[str], bool]] = None, timeout: float = 60,
+                                  caller: Optional[str] = None, **kwargs) -> str:
+        ...
+
+
+def openai_chat_url(base_url: str) -> str:
+    """OpenAI 兼容服务的根地址（如 http://127.0.0.1:8000/v1）补全为 chat/completions 接口地址"""
+    base_url = base_url.rstrip("/")
+    if base_url.endswith("/chat/completions"):
+        return base_url
+    return base_url + "/chat/completions"
+
+
+class OpenAICompatibleClient(QwenAPIClient):
+    """
+    OpenAI 兼容接口（/v1/chat/completions）客户端
+
+    内部请求体仍是百炼格式（缓存键、合并、限流预估都基于它），发送前转换为 OpenAI 格式，
+    因此同一份缓存可以在不同后端之间复用，切换后端不影响调用方。
+    """
+
+    def __init__(self,
+                 api_key: str = "EMPTY",
+                 base_url: str = DEFAULT_OPENAI_BASE_URL,
+                 model_override: Optional[str] = None,
+                 **kwargs):
+        """
+        Args:
+            api_key: API密钥，本地服务通常不校验，传任意值即可
+            base_url: 服务根地址或完整的 chat/completions 地址
+            model_override: 实际请求的模型名（本地服务加载的模型名通常与 qwen-plus 等不同）；
+                            指标、预算和缓存仍按调用方传入的模型名统计
+            **kwargs: 其余参数同 QwenAPIClient（AsyncOpenAICompatibleClient 同 AsyncQwenAPIClient）
+        """
+        super().__init__(api_key, openai_chat_url(base_url or DEFAULT_OPENAI_BASE_URL), **kwargs)
+        self.model_override = model_override
+
+    def _wire_payload(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """转换为 OpenAI Chat Completions 请求体"""
+        params = dict(payload["parameters"])
+        stream = bool(params.get("incremental_output"))
+        for name in DASHSCOPE_ONLY_PARAMS:
+            params.pop(name, None)
+        body = {
+            "model": self.model_override or payload["model"],
+            "messages": payload["input"]["messages"],
+            **params
+        }
+        if stream:
+            # 最后一个事件携带用量，否则流式调用无法计入预算
+            body["stream"] = True
+            body["stream_options"] = {"include_usage": True}
+        return body
+
+    def _stream_headers(self) -> Dict[str, str]:
+        return {"Accept": "text/event-stream"}
+
+    def _extract_stream_delta(self, event: Dict[str, Any]) -> str:
+        choices = event.get("choices") or []
+        if not choices:
+            # 只携带用量的最后一个事件
+            return ""
+        return (choices[0].get("delta") or {}).get("content") or ""
+
+    @staticmethod
+    def _extract_text(result: Dict[str, Any]) -> str:
+        """从 OpenAI 格式的响应中提取生成的文本"""
+        try:
+            return result["choices"][0]["message"]["content"] or ""
+        except (KeyError, IndexError, TypeError):
+            raise ValueError(f"Unexpected API response format: {result}")
+
+    @staticmethod
+    def _extract_usage(result: Dict[str, Any]) -> Dict[str, int]:
+        """OpenAI 格式的 prompt_tokens / completion_tokens 转换为统一的用量字段"""
+        usage = result.get("usage") or {}
+        input_tokens = int(usage.get("prompt_tokens") or 0)
+        output_tokens = int(usage.get("completion_tokens") or 0)
+        return {
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "total_tokens": int(usage.get("total_tokens") or (input_tokens + output_tokens))
+        }
+
+    @staticmethod
+    def _finish_reason(result: Dict[str, Any]) -> Optional[str]:
+        """OpenAI 格式的 choices[0].finish_reason（只携带用量的流式事件没有 choices）"""
+        choices = result.get("choices") or [{}]
+        return choices[0].get("finish_reason")
+
+
+class AsyncOpenAICompatibleClient(OpenAICompatibleClient, AsyncQwenAPIClient):
+    """OpenAI 兼容接口的异步客户端，参数同 OpenAICompatibleClient 与 AsyncQwenAPIClient"""
+
+
+class MockLLMClient(QwenAPIClient):
+    """
+    进程内的模拟后端，回复内容与本地模拟服务（mock_dashscope_server）一致（都由 mock_responder 生成）
+
+    同一请求体（含 temperature 等参数）在同一 seed 下总是得到相同的回复，便于回归对比；
+    token 用量按字符数计，回复按 stop 与 max_tokens 截断（超过 max_tokens 时记为截断）。
+    """
+
+    def __init__(self,
+                 api_key: str = "mock",
+                 base_url: Optional[str] = None,
+                 latency: float = 0.0,
+                 seed: int = 0,
+                 responder: Optional[MockResponder] = None,
+                 stream_chunk_chars: int = 4,
+                 **kwargs):
+        """
+        Args:
+            api_key: 不使用，保持与其他后端相同的签名
+            base_url: 不使用
+            latency: 每次调用模拟的延迟（秒）
+            seed: 随机种子
+            responder: 回复生成器，None 时按提示词内容生成模板回复
+            stream_chunk_chars: 流式调用时每个增量的字符数
+            **kwargs: 其余参数同 QwenAPIClient（限流、key 池对模拟后端没有意义，不建议传入）
+        """
+        super().__init__(api_key, base_url, **kwargs)
+        self.latency = latency
+        self.seed = seed
+        self.responder = responder or MockResponder()
+        self.stream_chunk_chars = stream_chunk_chars
+
+    def _mock_result(self, payload: Dict[str, Any]) -> Tuple[str, Dict[str, int]]:
+        """生成回复文本与用量"""
+        messages = payload["input"]["messages"]
+        rng = random.Random(f"{self.seed}:{make_request_key(payload)}")
+        text, finish_reason = apply_generation_limits(self.responder.respond(messages, rng), payload["parameters"])
+        input_tokens = sum(len(str(msg.get("content", ""))) for msg in messages)
+        return text, {
+            "input_tokens": input_tokens,
+            "output_tokens": len(text),
+            "total_tokens": input_tokens + len(text),
+            "truncated": int(finish_reason == "length")
+        }
+
+    def _send_once(self,
+                   payload: Dict[str, Any],
+                   timeout: float,
+                   abandoned: Optional[threading.Event] = None) -> Tuple[str, Dict[str, int]]:
+        """模拟一次请求，不走网络（对冲落败的请求不计入延迟基线）"""
+        sent_at = time.monotonic()
+        if self.latency > 0:
+            time.sleep(self.latency)
+        result = self._mock_result(payload)
+        if abandoned is None or not abandoned.is_set():
+            self._observe_latency(payload["model"], time.monotonic() - sent_at)
+        return result
+
+    def _stream_once(self,
+                     payload: Dict[str, Any],
+                     timeout: float,
+                     stop_when: Optional[Callable[[str], bool]],
+                     caller: Optional[str] = None) -> Tuple[str, Dict[str, int]]:
+        """模拟一次流式请求，按 stream_chunk_chars 切片并按 stop_when 提前截断"""
+        started_at = time.monotonic()
+        if self.latency > 0:
+            time.sleep(self.latency)
+        full_text, usage = self._mock_result(payload)
+        ttft = time.monotonic() - started_at
+
+        text = ""
+        stopped_early = False
+        step = max(1, self.stream_chunk_chars)
+        for i in range(0, len(full_text), step):
+            text += full_text[i:i + step]
+            try:
+                stop = stop_when is not None and stop_when(text)
+            except Exception as e:
+                # 与真实客户端一致：stop_when 的异常包装为不可重试的 QwenAPIError
+                raise QwenAPIError(f"Failed to parse stream response: {type(e).__name__}: {str(e)}") from e
+            if stop:
+                stopped_early = True
+                break
+        if stopped_early:
+            usage["output_tokens"] = len(text)
+            usage["total_tokens"] = usage["input_tokens"] + len(text)
+            usage["truncated"] = 0
+        self.metrics.record_stream(payload["model"], caller, ttft if text else None, stopped_early)
+        return text, usage
+
+
+class AsyncMockLLMClient(MockLLMClient, AsyncQwenAPIClient):
+    """模拟后端的异步版本，参数同 MockLLMClient 与 AsyncQwenAPIClient"""
+
+    async def _asend_once(self, payload: Dict[str, Any], timeout: float) -> Tuple[str, Dict[str, int]]:
+        sent_at = time.monotonic()
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+        result = self._mock_result(payload)
+        self._observe_latency(payload["model"], time.monotonic() - sent_at)
+        return result
+
+
+BACKENDS = {
+    "dashscope": (QwenAPIClient, AsyncQwenAPIClient),
+    "openai": (OpenAICompatibleClient, AsyncOpenAICompatibleClient),
+    "mock": (MockLLMClient, AsyncMockLLMClient),
+}
+
+
+def create_client(backend: str = "dashscope", async_client: bool = False, **kwargs) -> LLMBackend:
+    """
+    按名称创建后端客户端
+
+    Args:
+        backend: "dashscope" / "openai" / "mock"
+        async_client: 是否创建异步客户端（额外提供 acall / acall_with_messages）
+        **kwargs: 传给对应客户端的参数（api_key、base_url、cache、budget 等）
+
+    Returns:
+        客户端实例
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"不支持的后端: {backend}，可选: {', '.join(BACKENDS)}")
+    sync_cls, async_cls = BACKENDS[backend]
+    return (async_cls if async_client else sync_cls)(**kwargs)
@@ -3,13 +3,16 @@
 生成患者24小时生活状态
 """
 from typing import Dict, Any
-from .api_client import QwenAPIClient
+from .backends import LLMBackend
 
 
 class BackgroundGenerator:
     """背景生成器"""
+
+    # 同步/异步调用共用的模型参数
+    CALL_PARAMS = {"model": "qwen-plus", "temperature": 0.8, "max_tokens": 2000}
     
-    def __init__(self, api_client: QwenAPIClient):
+    def __init__(self, api_client: LLMBackend):
         """
         初始化背景生成器
         
@@ -33,14 +36,16 @@ class BackgroundGenerator:
         prompt = self._build_background_prompt(persona, dialogue_topic)
         
         # 调用API生成
-        result = self.api_client.call(
-            prompt=prompt,
-            model="qwen-plus",
-            temperature=0.8,
-            max_tokens=2000
-        )
+        result = self.api_client.call(prompt=prompt, caller=self.__class__.__name__, **self.CALL_PARAMS)
         
         return result
+
+    async def agenerate_background(self, persona: Dict[str, Any], dialogue_topic: str) -> str:
+        """
+        generate_background 的异步版本（api_client 需为 AsyncQwenAPIClient）
+        """
+        prompt = self._build_background_prompt(persona, dialogue_topic)
+        return await self.api_client.acall(prompt=prompt, caller=self.__class__.__name__, **self.CALL_PARAMS)
     
     def _build_background_prompt(self, persona: Dict[str, Any], dialogue_topic: str) -> str:
         """构建背景生成的提示词"""
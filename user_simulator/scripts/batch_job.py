@@ -0,0 +1,200 @@
+"""
+离线批量推理（Batch 通道）
+把请求写成批量任务 JSONL（每行一个 custom_id），提交到服务商的 batch 接口；
+任务完成后读取结果文件，按 custom_id 合并回原始记录。适合不要求实时性的大批量任务，费用更低、吞吐更高
+
+文件格式与 DashScope / OpenAI 兼容的 Batch 接口一致:
+    请求行: {"custom_id": "...", "method": "POST", "url": "/v1/chat/completions", "body": {"model": ..., "messages": [...], ...}}
+    结果行: {"custom_id": "...", "response": {"status_code": 200, "body": {"choices": [...], "usage": {...}}}, "error": null}
+
+本地测试（在 user_simulator 目录下），用模拟回复生成一个假的结果文件:
+    python -m scripts.batch_job --fake-results batch_input.jsonl batch_output.jsonl
+"""
+import argparse
+import json
+import random
+from typing import Any, Dict, List, Optional
+
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+
+
+class BatchJobWriter:
+    """批量任务文件写入器，可作为上下文管理器使用"""
+
+    def __init__(self, path: str, endpoint: str = BATCH_ENDPOINT):
+        """
+        Args:
+            path: 输出的批量任务 JSONL 路径
+            endpoint: 每行请求的 url 字段
+        """
+        self.path = path
+        self.endpoint = endpoint
+        self.count = 0
+        self._ids = set()
+        self._file = open(path, "w", encoding="utf-8")
+
+    def add(self,
+            custom_id: str,
+            messages: List[Dict[str, str]],
+            model: str = "qwen-plus",
+            temperature: float = 0.7,
+            max_tokens: int = 2000,
+            top_p: float = 0.8,
+            **kwargs):
+        """
+        写入一条请求，参数含义同 QwenAPIClient.call_with_messages
+
+        Args:
+            custom_id: 请求标识，合并结果时用它找回原始记录，同一文件内不能重复
+            messages: 消息列表
+        """
+        if custom_id in self._ids:
+            raise ValueError(f"重复的 custom_id: {custom_id}")
+        self._ids.add(custom_id)
+        line = {
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": self.endpoint,
+            "body": {
+                "model": model,
+                "messages": messages,
+                "temperature": temperature,
+                "max_tokens": max_tokens,
+                "top_p": top_p,
+                **kwargs
+            }
+        }
+        self._file.write(json.dumps(line, ensure_ascii=False) + "\n")
+        self.count += 1
+
+    def add_prompt(self, custom_id: str, prompt: str, **params):
+        """写入一条单轮提示词请求，参数含义同 QwenAPIClient.call"""
+        self.add(custom_id, [{"role": "user", "content": prompt}], **params)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self) -> "BatchJobWriter":
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def _extract_body_text(body: Dict[str, Any]) -> str:
+    """从结果行的 body 中提取文本，兼容 OpenAI 兼容格式和 DashScope 原生格式"""
+    choices = body.get("choices") or (body.get("output") or {}).get("choices")
+    if choices:
+        return choices[0]["message"]["content"]
+    if "text" in (body.get("output") or {}):
+        return body["output"]["text"]
+    raise ValueError(f"无法解析的批量结果: {json.dumps(body, ensure_ascii=False)[:200]}")
+
+
+def load_batch_results(path: str) -> Dict[str, Dict[str, Any]]:
+    """
+    读取服务商返回的结果文件（或错误文件）
+
+    Args:
+        path: 结果 JSONL 路径
+
+    Returns:
+        {custom_id: {"text": 文本或 None, "error": 错误信息或 None, "usage": token用量}}
+    """
+    results = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            response = row.get("response") or {}
+            body = response.get("body") or {}
+            usage = body.get("usage") or {}
+            item = {
+                "text": None,
+                "error": None,
+                "usage": {
+                    "input_tokens": int(usage.get("prompt_tokens") or usage.get("input_tokens") or 0),
+                    "output_tokens": int(usage.get("completion_tokens") or usage.get("output_tokens") or 0)
+                }
+            }
+            error = row.get("error")
+            if error:
+                item["error"] = error.get("message") or json.dumps(error, ensure_ascii=False)
+            elif response.get("status_code", 200) != 200:
+                item["error"] = f"HTTP {response.get('status_code')}: {json.dumps(body, ensure_ascii=False)[:200]}"
+            else:
+                try:
+                    item["text"] = _extract_body_text(body)
+                except (KeyError, IndexError, TypeError, ValueError) as e:
+                    item["error"] = str(e)
+            results[row["custom_id"]] = item
+    return results
+
+
+def write_fake_batch_results(input_path: str,
+                             output_path: str,
+                             error_rate: float = 0.0,
+                             seed: Optional[int] = None) -> int:
+    """
+    按批量任务文件生成一个模拟的结果文件，回复内容与本地模拟服务一致，用于离线测试合并流程
+
+    Args:
+        input_path: 批量任务 JSONL
+        output_path: 输出的结果 JSONL
+        error_rate: 随机返回错误的比例
+        seed: 随机种子
+
+    Returns:
+        写入的结果行数
+    """
+    from .mock_responder import MockResponder
+
+    rng = random.Random(seed)
+    responder = MockResponder()
+    count = 0
+    with open(input_path, "r", encoding="utf-8") as fin, open(output_path, "w", encoding="utf-8") as fout:
+        for line in fin:
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            messages = request["body"]["messages"]
+            row = {"id": f"batch-req-{count}", "custom_id": request["custom_id"]}
+            if rng.random() < error_rate:
+                row["response"] = {"status_code": 500, "body": {"error": {"message": "Injected error (mock)."}}}
+                row["error"] = {"code": "InternalError", "message": "Injected error (mock)."}
+            else:
+                text = responder.respond(messages, rng)
+                prompt_tokens = sum(len(str(msg.get("content", ""))) for msg in messages)
+                row["response"] = {
+                    "status_code": 200,
+                    "request_id": f"mock-batch-{count}",
+                    "body": {
+                        "choices": [{"index": 0, "finish_reason": "stop",
+                                     "message": {"role": "assistant", "content": text}}],
+                        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(text),
+                                  "total_tokens": prompt_tokens + len(text)}
+                    }
+                }
+                row["error"] = None
+            fout.write(json.dumps(row, ensure_ascii=False) + "\n")
+            count += 1
+    return count
+
+
+def main():
+    """主函数"""
+    parser = argparse.ArgumentParser(description="批量任务工具")
+    parser.add_argument("--fake-results", nargs=2, metavar=("INPUT", "OUTPUT"), required=True,
+                        help="按批量任务文件生成模拟结果文件")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="模拟结果中出错的比例")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    count = write_fake_batch_results(args.fake_results[0], args.fake_results[1], args.error_rate, args.seed)
+    print(f"已生成 {count} 条模拟结果: {args.fake_results[1]}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+"""
+token 用量与费用预算
+按模型统计 token 与预估费用：软上限触发后批量任务不再调度新的对话，硬上限触发后客户端拒绝发出新请求。
+track_usage() 统计一段代码（如一段对话）内真正发出的请求的用量，各线程、协程互不干扰
+"""
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, Optional
+
+
+def estimate_cost(model: str,
+                  input_tokens: int,
+                  output_tokens: int,
+                  prices: Optional[Dict[str, Dict[str, float]]]) -> float:
+    """
+    按单价估算费用
+
+    Args:
+        model: 模型名称
+        input_tokens: 输入token数
+        output_tokens: 输出token数
+        prices: 按模型的单价（元/千token），格式同 config.MODEL_PRICES；未配置的模型按 0 计
+
+    Returns:
+        预估费用（元）
+    """
+    price = (prices or {}).get(model)
+    if not price:
+        return 0.0
+    return (input_tokens * price.get("input", 0.0) + output_tokens * price.get("output", 0.0)) / 1000
+
+
+class UsageTracker:
+    """一段代码内的用量统计（线程安全），嵌套时同时计入外层"""
+
+    def __init__(self,
+                 prices: Optional[Dict[str, Dict[str, float]]] = None,
+                 parent: Optional["UsageTracker"] = None):
+        """
+        Args:
+            prices: 按模型的单价（元/千token）
+            parent: 外层统计
+        """
+        self.prices = prices
+        self.parent = parent
+        self.api_calls = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.cost = 0.0
+        # 因达到 max_tokens 被截断的请求数
+        self.truncated_calls = 0
+        self._lock = threading.Lock()
+
+    def add(self, model: str, usage: Dict[str, int]):
+        """计入一次请求的用量"""
+        input_tokens = usage.get("input_tokens", 0)
+        output_tokens = usage.get("output_tokens", 0)
+        with self._lock:
+            self.api_calls += 1
+            self.input_tokens += input_tokens
+            self.output_tokens += output_tokens
+            self.truncated_calls += usage.get("truncated", 0)
+            self.cost += estimate_cost(model, input_tokens, output_tokens, self.prices)
+        if self.parent is not None:
+            self.parent.add(model, usage)
+
+    def summary(self) -> Dict[str, Any]:
+        """写入对话 metadata 的用量摘要"""
+        with self._lock:
+            return {
+                "api_calls": self.api_calls,
+                "input_tokens": self.input_tokens,
+                "output_tokens": self.output_tokens,
+                "total_tokens": self.input_tokens + self.output_tokens,
+                "estimated_cost": round(self.cost, 6)
+            }
+
+
+_current_tracker: ContextVar[Optional[UsageTracker]] = ContextVar("usage_tracker", default=None)
+
+
+@contextmanager
+def track_usage(prices: Optional[Dict[str, Dict[str, float]]] = None) -> Iterator[UsageTracker]:
+    """
+    统计 with 块内当前线程/协程发出的请求的用量
+
+    用法:
+        with track_usage(config.MODEL_PRICES) as usage:
+            result = generator.generate_for_patient(...)
+        metadata["usage"] = usage.summary()
+    """
+    tracker = UsageTracker(prices, parent=_current_tracker.get())
+    token = _current_tracker.set(tracker)
+    try:
+        yield tracker
+    finally:
+        _current_tracker.reset(token)
+
+
+def current_usage_tracker() -> Optional[UsageTracker]:
+    """当前线程/协程所在的用量统计，不在 track_usage 块内时为 None"""
+    return _current_tracker.get()
+
+
+class TokenBudget:
+    """
+    一次运行的 token / 费用预算（线程安全，可在多个客户端之间共享）
+
+    上限为 None 表示不限制，只做统计。
+    - 软上限：soft_exceeded() 为 True，调用方应停止调度新任务，进行中的任务可以正常完成
+    - 硬上限：客户端在发出新请求前抛出 BudgetExceededError，进行中的任务随之中止
+    """
+
+    def __init__(self,
+                 max_tokens: Optional[int] = None,
+                 max_cost: Optional[float] = None,
+                 soft_max_tokens: Optional[int] = None,
+                 soft_max_cost: Optional[float] = None,
+                 prices: Optional[Dict[str, Dict[str, float]]] = None):
+        """
+        Args:
+            max_tokens: token 硬上限
+            max_cost: 费用硬上限（元）
+            soft_max_tokens: token 软上限
+            soft_max_cost: 费用软上限（元）
+            prices: 按模型的单价（元/千token）
+        """
+        self.max_tokens = max_tokens
+        self.max_cost = max_cost
+        self.soft_max_tokens = soft_max_tokens
+        self.soft_max_cost = soft_max_cost
+        self.prices = prices
+        self.total_tokens = 0
+        self.cost = 0.0
+        self._by_model: Dict[str, Dict[str, float]] = {}
+        self._warned = set()
+        self._lock = threading.Lock()
+
+    def record(self, model: str, usage: Dict[str, int]):
+        """计入一次请求的用量"""
+        input_tokens = usage.get("input_tokens", 0)
+        output_tokens = usage.get("output_tokens", 0)
+        cost = estimate_cost(model, input_tokens, output_tokens, self.prices)
+        with self._lock:
+            stats = self._by_model.setdefault(model, {"input_tokens": 0, "output_tokens": 0, "cost": 0.0})
+            stats["input_tokens"] += input_tokens
+            stats["output_tokens"] += output_tokens
+            stats["cost"] += cost
+            self.total_tokens += input_tokens + output_tokens
+            self.cost += cost
+            status = self._status()
+            newly_exceeded = status is not None and status not in self._warned
+            self._warned.add(status)
+        if newly_exceeded:
+            print(f"已达到{'硬' if status == 'hard' else '软'}预算上限："
+                  f"{self.total_tokens} tokens，预估 ¥{self.cost:.2f}")
+
+    @staticmethod
+    def _over(value: float, limit: Optional[float]) -> bool:
+        return limit is not None and value >= limit
+
+    def _status(self) -> Optional[str]:
+        """当前状态，调用方需持有锁"""
+        if self._over(self.total_tokens, self.max_tokens) or self._over(self.cost, self.max_cost):
+            return "hard"
+        if self._over(self.total_tokens, self.soft_max_tokens) or self._over(self.cost, self.soft_max_cost):
+            return "soft"
+        return None
+
+    def hard_exceeded(self) -> bool:
+        """是否已达到硬上限"""
+        with self._lock:
+            return self._status() == "hard"
+
+    def soft_exceeded(self) -> bool:
+        """是否已达到软上限（达到硬上限时也为 True）"""
+        with self._lock:
+            return self._status() is not None
+
+    def summary(self) -> Dict[str, Any]:
+        """累计用量、预估费用与各模型明细"""
+        with self._lock:
+            return {
+                "total_tokens": self.total_tokens,
+                "estimated_cost": round(self.cost, 6),
+                "status": self._status() or "ok",
+                "by_model": {model: dict(stats) for model, stats in self._by_model.items()}
+            }
@@ -0,0 +1,93 @@
+"""
+患者轮多候选的本地挑选
+一次调用生成多条候选回复（{"candidates": [...]}），在本地排除与历史重复的候选，
+再按与之前回复的差异、长度和问题数挑选一条，重复不再白白浪费一轮调用。
+基线脚本（BaselineDialogueGenerator）和主流程（DialogueGenerator）共用。
+"""
+from typing import Dict, List
+
+
+# 多候选模式的输出格式：一次调用生成多条候选，本地挑选
+CANDIDATES_FORMAT = """### 输出格式
+请给出 {num_candidates} 条候选回复，候选之间的措辞和内容要有明显差别，且都不能与之前说过的话重复。
+只输出一个 JSON 对象，不要输出其他内容：
+{{"candidates": ["候选回复1", "候选回复2"]}}"""
+
+
+def similarity(a: str, b: str) -> float:
+    """两段文本的字符集合重合度（0~1）"""
+    if not a or not b:
+        return 0.0
+    return len(set(a) & set(b)) / max(len(set(a)), len(set(b)))
+
+
+def previous_patient_responses(dialogue_history: List[Dict[str, str]]) -> List[str]:
+    """之前所有患者回复（去掉首尾空白）"""
+    return [msg.get("content", "").strip() for msg in dialogue_history if msg.get("role") == "user"]
+
+
+def is_repetitive(response: str, dialogue_history: List[Dict[str, str]]) -> bool:
+    """
+    检查患者回复是否与历史回复重复
+
+    Args:
+        response: 当前患者回复
+        dialogue_history: 对话历史
+
+    Returns:
+        是否与之前的回复完全相同或高度相似（都超过 10 字且超过 80% 的字符相同）
+    """
+    response_clean = response.strip()
+    for prev_clean in previous_patient_responses(dialogue_history):
+        # 完全相同
+        if response_clean == prev_clean:
+            return True
+        # 高度相似（超过80%的字符相同）
+        if len(response_clean) > 10 and len(prev_clean) > 10 and similarity(response_clean, prev_clean) > 0.8:
+            return True
+    return False
+
+
+def score_candidate(response: str, dialogue_history: List[Dict[str, str]]) -> float:
+    """
+    候选回复的本地评分（越高越好）
+
+    与之前患者回复的差异越大得分越高；超出 8~40 字、超过 1 个问题（核心规则中的长度和动作上限）扣分
+
+    Args:
+        response: 候选回复
+        dialogue_history: 对话历史
+
+    Returns:
+        得分
+    """
+    response_clean = response.strip()
+    novelty = 1 - max(
+        (similarity(response_clean, prev) for prev in previous_patient_responses(dialogue_history)), default=0.0
+    )
+    length_penalty = 0.0 if 8 <= len(response_clean) <= 40 else 0.5
+    question_penalty = 0.3 * max(response_clean.count("？") + response_clean.count("?") - 1, 0)
+    return novelty - length_penalty - question_penalty
+
+
+def choose_candidate(candidates: List[str], dialogue_history: List[Dict[str, str]]) -> str:
+    """
+    从候选中挑选本轮回复
+
+    排除与历史重复的候选，其余按 score_candidate 取最高分（同分取靠前的）；
+    全部重复时返回第一条，由调用方按重复处理。
+
+    Args:
+        candidates: 候选回复（parse_candidates 的结果，非空）
+        dialogue_history: 对话历史
+
+    Returns:
+        选中的回复
+    """
+    fresh = [candidate for candidate in candidates if not is_repetitive(candidate, dialogue_history)]
+    if not fresh:
+        print(f"{len(candidates)} 条候选均与历史重复")
+        return candidates[0]
+    if len(fresh) < len(candidates):
+        print(f"{len(candidates)} 条候选中 {len(candidates) - len(fresh)} 条重复，已排除")
+    return max(fresh, key=lambda candidate: score_candidate(candidate, dialogue_history))
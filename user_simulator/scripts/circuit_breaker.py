@@ -0,0 +1,116 @@
+"""
+熔断器
+接口连续失败 N 次后熔断，熔断期间调用直接失败；冷却后放行少量探测请求（半开），探测成功才恢复
+"""
+import threading
+import time
+from typing import Any, Dict, Optional
+
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """
+    三态熔断器（线程安全，也可在协程中使用）
+
+    - closed: 正常放行，连续失败达到 failure_threshold 次后转为 open
+    - open: 所有请求直接拒绝，recovery_timeout 秒后转为 half_open
+    - half_open: 最多放行 half_open_max_calls 个探测请求，成功则 closed，失败则重新 open
+    只有服务端/网络类失败计入（5xx、超时、连接错误），4xx 参数错误是调用方的问题，不触发熔断；
+    429 说明接口正常、只是超出配额，交给限流和 key 摘除处理，既不算失败也不算成功。
+    """
+
+    def __init__(self,
+                 failure_threshold: int = 5,
+                 recovery_timeout: float = 30.0,
+                 half_open_max_calls: int = 1):
+        """
+        Args:
+            failure_threshold: 连续失败多少次后熔断
+            recovery_timeout: 熔断后多少秒进入半开状态
+            half_open_max_calls: 半开状态下同时放行的探测请求数
+        """
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.open_count = 0
+        self.rejected = 0
+        self._probes = 0
+        self._probe_started_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow_request(self) -> bool:
+        """
+        判断是否放行本次请求
+
+        放行后必须调用 record_success、record_failure 或 record_ignored，否则半开状态的探测名额不会归还。
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self.state == OPEN:
+                if now - self.opened_at < self.recovery_timeout:
+                    self.rejected += 1
+                    return False
+                self.state = HALF_OPEN
+                self._probes = 0
+            if self.state == HALF_OPEN:
+                # 探测请求迟迟没有结果（如被中断）时，超时后允许新的探测
+                if self._probes >= self.half_open_max_calls and now - self._probe_started_at < self.recovery_timeout:
+                    self.rejected += 1
+                    return False
+                if self._probes >= self.half_open_max_calls:
+                    self._probes = 0
+                self._probes += 1
+                self._probe_started_at = now
+            return True
+
+    def record_success(self):
+        """记录一次成功"""
+        with self._lock:
+            if self.state != CLOSED:
+                print("接口探测成功，熔断器恢复")
+            self.state = CLOSED
+            self.consecutive_failures = 0
+            self._probes = 0
+
+    def record_failure(self):
+        """记录一次服务端/网络类失败"""
+        with self._lock:
+            self.consecutive_failures += 1
+            if self.state == HALF_OPEN or (
+                self.state == CLOSED and self.consecutive_failures >= self.failure_threshold
+            ):
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+                self.open_count += 1
+                self._probes = 0
+                print(f"接口连续失败 {self.consecutive_failures} 次，熔断 {self.recovery_timeout:.0f} 秒")
+
+    def record_ignored(self):
+        """记录一次不反映接口健康状况的结果（如 429）：不改变状态和连续失败数，只归还半开状态的探测名额"""
+        with self._lock:
+            if self.state == HALF_OPEN and self._probes > 0:
+                self._probes -= 1
+
+    def remaining_open_time(self) -> float:
+        """距离进入半开状态还需等待的秒数（未熔断时为 0）"""
+        with self._lock:
+            if self.state != OPEN:
+                return 0.0
+            return max(0.0, self.opened_at + self.recovery_timeout - time.monotonic())
+
+    def stats(self) -> Dict[str, Any]:
+        """当前状态与累计统计"""
+        with self._lock:
+            return {
+                "state": self.state,
+                "consecutive_failures": self.consecutive_failures,
+                "open_count": self.open_count,
+                "rejected": self.rejected
+            }
@@ -0,0 +1,111 @@
+"""
+在途请求合并（single-flight）
+同一时刻发出的相同请求只走一次网络，其余调用方等待并共享结果
+"""
+import asyncio
+import threading
+from typing import Any, Awaitable, Callable, Dict, Tuple
+
+
+class _InFlightCall:
+    """一次正在进行的调用"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result: Any = None
+        self.error: BaseException = None
+
+
+class _LeaderCancelled(Exception):
+    """协程版本的 leader 被取消：等待者不应随之取消，而是由其中一个重新发起调用"""
+
+
+class RequestCoalescer:
+    """
+    按请求键合并在途调用（线程安全）
+
+    只合并“同时”在途的调用：首个调用方（leader）完成后键即被移除，
+    之后到达的相同请求会重新发起，不会拿到过期结果（持久复用交给响应缓存）。
+    leader 失败时，等待中的调用方收到同一个异常；协程版本的 leader 被取消（如对冲落败、调用方超时）时，
+    等待者不会随之收到 CancelledError，而是由最先被唤醒的等待者作为新的 leader 重新发起调用。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._inflight: Dict[str, _InFlightCall] = {}
+        self._async_inflight: Dict[str, asyncio.Future] = {}
+
+    def run(self, key: str, fn: Callable[[], Any]) -> Tuple[Any, bool]:
+        """
+        执行或加入一次调用
+
+        Args:
+            key: 请求键
+            fn: 真正发起请求的函数
+
+        Returns:
+            (结果, 是否为共享的结果)
+        """
+        with self._lock:
+            call = self._inflight.get(key)
+            leader = call is None
+            if leader:
+                call = _InFlightCall()
+                self._inflight[key] = call
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            call.event.set()
+        return call.result, False
+
+    async def arun(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """
+        run 的协程版本，只在同一个事件循环内合并
+
+        Args:
+            key: 请求键
+            fn: 返回协程的函数
+
+        Returns:
+            (结果, 是否为共享的结果)
+        """
+        future = self._async_inflight.get(key)
+        while future is not None:
+            try:
+                # shield：某个等待者被取消时不影响 leader 和其他等待者
+                return await asyncio.shield(future), True
+            except _LeaderCancelled:
+                # leader 被取消时键已移除：最先醒来的等待者成为新的 leader，其余等待者加入它
+                future = self._async_inflight.get(key)
+
+        future = asyncio.get_running_loop().create_future()
+        self._async_inflight[key] = future
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            # 不取消共享的 future：等待者各自的调用方并没有取消
+            future.set_exception(_LeaderCancelled())
+            future.exception()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # 没有等待者时避免 "exception was never retrieved" 警告
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            del self._async_inflight[key]
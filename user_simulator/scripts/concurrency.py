@@ -0,0 +1,190 @@
+"""
+自适应并发控制（AIMD）
+成功且延迟正常时加性提高在途请求上限，遇到 429 / 拥塞错误或延迟突增时乘性降低，
+让批量任务自动逼近当前时段可持续的最大吞吐
+"""
+import asyncio
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional
+
+
+# 视为拥塞信号的状态码：限流、服务过载、网关超时
+CONGESTION_STATUS_CODES = {429, 503, 504}
+
+
+def is_congestion(status_code: Optional[int], transient: bool) -> bool:
+    """
+    判断一次失败是否说明服务端已经过载
+
+    Args:
+        status_code: HTTP状态码，网络层错误时为 None
+        transient: 是否为瞬时错误（连接重置、超时等）
+    """
+    if status_code is None:
+        return transient
+    return status_code in CONGESTION_STATUS_CODES
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    AIMD 并发限制器（线程安全，也可在协程中使用）
+
+    - 加性增：上限被用到一半以上时，每个成功的请求让上限增加 increase_step / limit，
+      即每完成约一个上限数量的请求，上限 +increase_step
+    - 乘性减：拥塞错误或延迟超过基线 latency_tolerance 倍时，上限乘以 decrease_factor；
+      cooldown 秒内最多降一次，避免同一波 429 把上限连续砍到底
+    - 延迟基线按 key（通常是模型名）分别维护 EWMA，样本数不足 min_samples 时不判断突增
+    """
+
+    def __init__(self,
+                 initial_limit: float = 4,
+                 min_limit: float = 1,
+                 max_limit: float = 64,
+                 increase_step: float = 1.0,
+                 decrease_factor: float = 0.5,
+                 latency_tolerance: float = 2.0,
+                 cooldown: float = 2.0,
+                 ewma_alpha: float = 0.1,
+                 min_samples: int = 10):
+        """
+        Args:
+            initial_limit: 初始在途上限
+            min_limit: 上限的下界
+            max_limit: 上限的上界
+            increase_step: 每轮（约 limit 个成功请求）增加的上限
+            decrease_factor: 拥塞时上限乘以的系数
+            latency_tolerance: 延迟超过基线多少倍视为突增
+            cooldown: 两次降低之间的最短间隔（秒）
+            ewma_alpha: 延迟基线的平滑系数
+            min_samples: 开始判断延迟突增前需要的样本数
+        """
+        self.limit = float(min(max(initial_limit, min_limit), max_limit))
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+        self.latency_tolerance = latency_tolerance
+        self.cooldown = cooldown
+        self.ewma_alpha = ewma_alpha
+        self.min_samples = min_samples
+        self.in_flight = 0
+        self.decreases = 0
+        self._last_decrease = 0.0
+        self._baselines: Dict[str, float] = {}
+        self._samples: Dict[str, int] = {}
+        self._cond = threading.Condition()
+
+    def cap(self, capacity: int) -> "AdaptiveConcurrencyLimiter":
+        """
+        把上限的上界收紧到调用方实际能同时发出的请求数（线程池大小、信号量等）
+
+        在途请求数受线程池限制时，上限超过线程数也不会有更多请求发出，
+        不收紧的话上限会涨到用不上的数值，concurrency_limit 指标报告的是不存在的容量。
+
+        Args:
+            capacity: 同时在途请求数的实际上界
+
+        Returns:
+            自身，便于在构造时链式调用
+        """
+        with self._cond:
+            self.max_limit = max(self.min_limit, min(self.max_limit, capacity))
+            self.limit = min(self.limit, self.max_limit)
+        return self
+
+    def try_acquire(self) -> bool:
+        """有空闲名额时占用一个并返回 True"""
+        with self._cond:
+            if self.in_flight < int(self.limit):
+                self.in_flight += 1
+                return True
+            return False
+
+    def acquire(self):
+        """阻塞直到有空闲名额"""
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+
+    async def aacquire(self, poll_interval: float = 0.01):
+        """acquire 的协程版本（轮询，不阻塞事件循环）"""
+        while not self.try_acquire():
+            await asyncio.sleep(poll_interval)
+
+    def release(self, key: str, latency: Optional[float] = None, congested: bool = False, cancelled: bool = False):
+        """
+        归还名额，并根据本次请求的结果调整上限
+
+        Args:
+            key: 延迟基线的分组键（通常是模型名）
+            latency: 本次请求的耗时（秒），None 表示不参与延迟判断
+            congested: 本次请求是否遇到拥塞错误
+            cancelled: 本次请求被调用方取消（如对冲落败），只归还名额，不调整上限和延迟基线
+        """
+        with self._cond:
+            utilized = self.in_flight >= self.limit / 2
+            self.in_flight -= 1
+            if cancelled:
+                self._cond.notify_all()
+                return
+            spike = False
+            if latency is not None and not congested:
+                baseline = self._baselines.get(key)
+                samples = self._samples.get(key, 0)
+                spike = (baseline is not None and samples >= self.min_samples
+                         and latency > baseline * self.latency_tolerance)
+                self._baselines[key] = latency if baseline is None else (
+                    (1 - self.ewma_alpha) * baseline + self.ewma_alpha * latency
+                )
+                self._samples[key] = samples + 1
+
+            if congested or spike:
+                now = time.monotonic()
+                if now - self._last_decrease >= self.cooldown:
+                    self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+                    self._last_decrease = now
+                    self.decreases += 1
+            elif utilized:
+                self.limit = min(self.max_limit, self.limit + self.increase_step / self.limit)
+            self._cond.notify_all()
+
+    def stats(self) -> Dict[str, Any]:
+        """当前上限、在途数与累计降低次数"""
+        with self._cond:
+            return {
+                "limit": int(self.limit),
+                "in_flight": self.in_flight,
+                "decreases": self.decreases,
+                "latency_baselines": dict(self._baselines)
+            }
+
+
+def ordered_parallel_map(fn: Callable[[Any], Any], items: Iterable[Any], workers: int) -> Iterator[Any]:
+    """
+    用线程池并行执行 fn，按输入顺序逐个产出结果
+
+    同时最多有 workers * 2 个任务在排队或执行，结果在调用方线程中按顺序处理，
+    因此写文件、更新进度等逻辑不需要加锁，断点续跑的语义也与串行执行一致。
+
+    Args:
+        fn: 处理单个输入的函数
+        items: 输入序列
+        workers: 线程数，<= 1 时直接串行执行
+    """
+    if workers <= 1:
+        for item in items:
+            yield fn(item)
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(fn, item))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
@@ -1,207 +1,20 @@
-# """
-# 患者对话生成模块
-# 生成患者与照护师的多轮对话
-# """
-# from typing import Dict, Any, List, Optional
-# from .api_client import QwenAPIClient
-
-
-# class DialogueGenerator:
-#     """患者对话生成器"""
-    
-#     def __init__(self, api_client: QwenAPIClient):
-#         """
-#         初始化对话生成器
-        
-#         Args:
-#             api_client: API客户端实例
-#         """
-#         self.api_client = api_client
-    
-#     def generate_response(self,
-#                           persona: Dict[str, Any],
-#                           dialogue_topic: str,
-#                           background: str,
-#                           dialogue_history: List[Dict[str, str]],
-#                           story: Optional[str] = None) -> Dict[str, str]:
-#         """
-#         生成患者的一轮对话回复
-        
-#         Args:
-#             persona: 患者用户画像
-#             dialogue_topic: 对话主题
-#             background: 24小时生活状态
-#             dialogue_history: 对话历史，格式: [{"role": "user/assistant", "content": "..."}, ...]
-#             story: 故事背景（可选）
-            
-#         Returns:
-#             包含Thinking和Response的字典
-#         """
-#         # 构建提示词
-#         prompt = self._build_dialogue_prompt(persona, dialogue_topic, background, dialogue_history, story)
-        
-#         # 调用API生成
-#         result = self.api_client.call(
-#             prompt=prompt,
-#             model="qwen-plus",
-#             temperature=0.65,
-#             max_tokens=2000
-#         )
-        
-#         # 解析结果
-#         return self._parse_response(result)
-    
-#     def _build_dialogue_prompt(self,
-#                                persona: Dict[str, Any],
-#                                dialogue_topic: str,
-#                                background: str,
-#                                dialogue_history: List[Dict[str, str]],
-#                                story: Optional[str] = None) -> str:
-#         """构建对话生成的提示词"""
-#         current_turn = len(dialogue_history) + 1
-        
-#         prompt = f"""### 任务描述
-# 你是一位血糖异常患者。请围绕对话主题，结合患者用户画像，生成一轮患者回复。
-
-# ### 核心规则（必须严格遵守，优先级最高！）
-# 对话必须遵循"开场→互动→聚焦→收束"节奏，不可跳级：
-# 1. 开场：首轮建立场景、情绪、主诉，不要直奔主题。
-# 2. 互动/补充：回应照护师、补充信息，明确诉求。
-# 3. 聚焦：判断照护师建议是否解答疑问、满足需求。
-# 4. 收束：疑问真正解决、内心有底时，必须主动结束。
-
-# **收束判断（每轮必须认真评估）**：
-# - 只有当你内心真正觉得“问题已解决”“诉求得到满足”“已经安心/有底”时，才收束。
-# - 如果照护师连续2~3次给出你真正关心的答案/建议/安慰，且你没有新的疑问或担忧，**本轮必须主动收束**。
-# - 禁止无限追问：本轮问题与上上轮本质相同（换说法/场景），视为重复，必须结束。
-# - 当前是第 {current_turn} 轮：
-#   - 轮次 >= 10：如果你觉得话题已覆盖，优先考虑收束
-#   - 轮次 >= 20：除非还有关键未解疑问，否则必须收束
-# - 收束方式：用**自然、多样、口语化**结束语，长度10~30字，必须包含感谢/行动/安心感。
-#   **必须个性化！禁止重复模板句**。根据上下文和情绪变化，例如：
-#   - 谢谢你，我今晚就早点睡试试～
-#   - 嗯，方向清楚了，先去按你说的做，谢谢！
-#   - 感觉踏实多了，谢谢你的耐心～
-#   - 好的，我懂了，先稳住再说，谢谢你！
-#   - 心里亮堂了，先去执行，谢谢～
-#   - 太感谢了，我先消化一下这些建议。
-#   - 嗯，有谱了，谢谢你的陪伴！
-#   - 谢谢，聊得真开心，先去调整一下～
-#   - 感觉好多了，先试几天看看，谢谢！
-#   - 明白了～心里有底了，先去行动起来。
-#   - 谢谢你，我先去试试你说的办法～
-#   - 嗯嗯，谢谢～先稳住再说。
-#   - 好，我记住了，先照着做几天。
-#   - 谢谢，方向有了，我先去试试看～
-#   - 聊了这么多，我心里舒服多了，谢谢你！
-#   - 谢谢你的建议，我先去落实～
-
-# 其他规则：
-# - 每回合只做1件事，最多1个问题。
-# - 最多提供1个新数据。
-# - 回复长度8~30字为主，必要时到40字。
-# - 语言口语化，根据画像调整（非医学爱好者避免医学术语）。
-# - 主动性、配合度参照画像中的语言表现层与互动干扰项。
-
-# ### 回复生成流程
-# 1. 代入患者情绪、思维模式。
-# 2. 先判断本轮是否满足收束条件（最重要！）。
-# 3. 生成回复（Response）：自然口语化，与上轮不相似。
-
-# ### 输出格式（必须严格遵守）
-# Response:
-# [患者回复，一句话]
-
-# ### 对话主题
-# {dialogue_topic}
-
-# ### 患者用户画像
-# {json.dumps(persona, ensure_ascii=False, indent=2)}
-
-# ### 患者24小时生活状态
-# {background}
-
-# ### 对话上下文
-# """
-        
-#         prompt += f"{dialogue_topic}\n\n"
-        
-#         # 添加故事背景（如果有）
-#         if story:
-#             prompt += f"### 故事背景\n{story}\n\n"
-        
-#         # 添加用户画像
-#         import json
-#         prompt += "### 患者用户画像\n"
-#         prompt += json.dumps(persona, ensure_ascii=False, indent=2)
-#         prompt += "\n\n"
-        
-#         # 添加24小时生活状态
-#         prompt += f"### 患者24小时生活状态\n{background}\n\n"
-        
-#         # 添加对话历史
-#         if dialogue_history:
-#             prompt += "### 对话上下文\n"
-#             for msg in dialogue_history:
-#                 role_name = "患者" if msg["role"] == "user" else "照护师"
-#                 prompt += f"{role_name}: {msg['content']}\n"
-#             prompt += "\n"
-#         else:
-#             prompt += "### 对话上下文\n对话开始，你是患者，请你先发起话题，用简短的回复开启倾听\n\n"
-        
-#         prompt = prompt.replace("{current_turn}", str(len(dialogue_history) + 1))  # 在返回prompt前替换
-
-#         return prompt
-    
-#     def _parse_response(self, response: str) -> Dict[str, str]:
-#         """
-#         解析API返回的响应，提取Thinking和Response
-        
-#         Args:
-#             response: API返回的原始文本
-            
-#         Returns:
-#             包含thinking和response的字典
-#         """
-#         result = {
-#             "thinking": "",
-#             "response": ""
-#         }
-        
-#         # # 尝试解析格式化的输出
-#         # if "Thinking:" in response:
-#         #     parts = response.split("Thinking:", 1)
-#         #     if len(parts) > 1:
-#         #         thinking_part = parts[1]
-#         #         if "Response:" in thinking_part:
-#         #             thinking, response_part = thinking_part.split("Response:", 1)
-#         #             result["thinking"] = thinking.strip()
-#         #             result["response"] = response_part.strip()
-#         #         else:
-#         #             result["thinking"] = thinking_part.strip()
-#         # elif "Response:" in response:
-#         #     parts = response.split("Response:", 1)
-#         #     result["response"] = parts[1].strip()
-#         # else:
-#         #     # 如果没有明确格式，将整个响应作为response
-#         #     result["response"] = response.strip()
-        
-#         # return result
-
-#         if "Response:" in response:
-#             parts = response.split("Response:", 1)
-#             result["response"] = parts[1].strip()
-#         else:
-#             result["response"] = response.strip()
-    
-#         return result
 """
 患者对话生成模块
 生成患者与照护师的多轮对话
 """
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, Callable, List, Optional, Union
 import json
-from .api_client import QwenAPIClient
+from .backends import LLMBackend
+from .history_context import RollingHistory
+from .length_governor import OutputLengthGovernor
+from .prompt_templates import FragmentCache, PromptTemplate
+from .streaming import response_section_complete, trim_to_response_section
+from .candidate_selection import CANDIDATES_FORMAT, choose_candidate
+from .structured_output import (
+    RESPONSE_FORMAT, StructuredOutputError, StructuredTurnParser, format_instructions, json_object_complete,
+    parse_candidates
+)
+from .token_estimator import PromptBudgetEnforcer
 
 
 class DialogueGenerator:
@@ -221,59 +34,16 @@ class DialogueGenerator:
     "咱们先这样", "先按这个来", "先试试看", "有情况再说",
     "先聊到这", "今天先这样", "你先试试", "回头联系"
 ]
-    
-    
-    def __init__(self, api_client: QwenAPIClient):
-        """
-        初始化对话生成器
-        
-        Args:
-            api_client: API客户端实例
-        """
-        self.api_client = api_client
-    
-    def generate_response(self,
-                          persona: Dict[str, Any],
-                          dialogue_topic: str,
-                          background: str,
-                          dialogue_history: List[Dict[str, str]],
-                          story: Optional[str] = None) -> Dict[str, str]:
-        """
-        生成患者的一轮对话回复
-        
-        Args:
-            persona: 患者用户画像
-            dialogue_topic: 对话主题
-            background: 24小时生活状态
-            dialogue_history: 对话历史
-            story: 故事背景（可选）
-            
-        Returns:
-            包含Thinking和Response的字典
-        """
-        # 构建提示词
-        prompt = self._build_dialogue_prompt(persona, dialogue_topic, background, dialogue_history, story)
-        
-        # 调用API生成
-        result = self.api_client.call(
-            prompt=prompt,
-            model="qwen-plus",
-            temperature=0.6,  # 降低创造性，确保执行规则
-            max_tokens=1500
-        )
-        
-        # 解析结果（严格解析 Thinking 和 Response）
-        return self._parse_response(result)
-    
-    def _build_dialogue_prompt(self,
-                           persona: Dict[str, Any],
-                           dialogue_topic: str,
-                           background: str,
-                           dialogue_history: List[Dict[str, str]],
-                           story: Optional[str] = None) -> str:
-        current_turn = len(dialogue_history) + 1
-        
-        prompt = f"""### 任务描述
+
+    # 同步/异步调用共用的模型参数（降低创造性，确保执行规则）
+    CALL_PARAMS = {"model": "qwen-plus", "temperature": 0.6, "max_tokens": 1500}
+
+    # 提示词预算与输出长度控制中的角色
+    PROMPT_ROLE = "patient"
+
+    # 规则与输出格式，{current_turn} 为当前轮次，{output_format} 为输出格式
+    # （类定义时预编译，实例化时填入输出格式，每轮只填入轮次）
+    PROMPT_RULES = PromptTemplate("""### 任务描述
 你是一位真实的血糖异常患者，正在和照护师聊天。请围绕对话主题，结合患者画像，生成一轮自然回复。
 
 ### 核心规则（必须严格遵守，优先级最高！）
@@ -327,35 +97,332 @@ class DialogueGenerator:
 ### 回复生成流程
 1. 评估收束：严格回答3个问题。如果有两个答案为“是”，生成结束句；否则，继续正常互动。
 2. 生成回复（Response）：自然口语化，一句话。如果没收束，可以追问细节或表达情绪。
-    ### 输出格式（必须严格遵守）
+{output_format}""")
+
+    # 文本模式的输出格式
+    OUTPUT_FORMAT = """    ### 输出格式（必须严格遵守）
     
     Response:
     [患者回复，一句话]
+"""
 
+    # 主题、画像与生活状态，整段对话内不变，按对话缓存
+    CONTEXT_TEMPLATE = PromptTemplate("""
     ### 对话主题
     {dialogue_topic}
 
     ### 患者用户画像
-    {json.dumps(persona, ensure_ascii=False, indent=2)}
+    {persona_json}
 
     ### 患者24小时生活状态
     {background}
 
     ### 对话上下文
-    """
+    """)
+
+    # 增量消息模式下，第一轮代替照护师发出的开场消息
+    OPENING_MESSAGE = "对话开始，你是患者，请先发起话题，用简短回复开启倾听"
+    
+    def __init__(self,
+                 api_client: LLMBackend,
+                 stream: bool = False,
+                 messages_mode: bool = False,
+                 history: Optional[RollingHistory] = None,
+                 prompt_budget: Optional[PromptBudgetEnforcer] = None,
+                 structured_output: bool = False,
+                 length_governor: Optional[OutputLengthGovernor] = None,
+                 num_candidates: int = 1):
+        """
+        初始化对话生成器
         
-        if dialogue_history:
-            for msg in dialogue_history:
-                role_name = "患者" if msg["role"] == "user" else "照护师"
-                prompt += f"{role_name}: {msg['content']}\n"
-            prompt += "\n"
+        Args:
+            api_client: API客户端实例
+            stream: 是否使用流式输出，Response 段完整后立即截断
+            messages_mode: 是否使用增量消息模式：规则、画像等作为不变的 system 消息，
+                           历史按角色逐条追加，每轮只新增几条消息（可命中服务端前缀缓存）
+            history: 滚动历史策略，None 时提示词包含完整的对话历史
+            prompt_budget: 提示词预算，超出患者侧上限时调用前裁剪故事、生活状态和较早的历史
+            structured_output: 是否要求模型输出 JSON（{"response": ...}），按 schema 严格解析，
+                               不合法时只对本轮修复一次，仍不合法时用原提示词重新请求本轮（次数有限），
+                               都不合法才抛出 StructuredOutputError
+            length_governor: 输出长度控制，按患者回复的真实长度设置 max_tokens 和 stop 序列，
+                             None 时使用固定的 max_tokens
+            num_candidates: 每次调用生成的候选数，大于 1 时输出 {"candidates": [...]}，
+                            本地挑选不与历史重复、得分最高的一条（优先于 structured_output）
+        """
+        self.api_client = api_client
+        self.stream = stream
+        self.messages_mode = messages_mode
+        self.length_governor = length_governor
+        self.history = history
+        self.prompt_budget = prompt_budget
+        self.structured_output = structured_output
+        self.num_candidates = num_candidates
+        self._fragments = FragmentCache()
+        if num_candidates > 1:
+            self._rules = self.PROMPT_RULES.partial(output_format=CANDIDATES_FORMAT.format(num_candidates=num_candidates))
+            self._call_params = {**self.CALL_PARAMS, "response_format": RESPONSE_FORMAT}
+            self._stop_when = json_object_complete
+            self._turn_parser = None
+        elif structured_output:
+            self._rules = self.PROMPT_RULES.partial(output_format=format_instructions(("response",)))
+            self._call_params = {**self.CALL_PARAMS, "response_format": RESPONSE_FORMAT}
+            self._stop_when = json_object_complete
+            self._turn_parser = StructuredTurnParser(api_client, ("response",))
         else:
-            prompt += "### 对话上下文\n对话开始，你是患者，请先发起话题，用简短回复开启倾听\n\n"
+            self._rules = self.PROMPT_RULES.partial(output_format=self.OUTPUT_FORMAT)
+            self._call_params = self.CALL_PARAMS
+            self._stop_when = response_section_complete
+            self._turn_parser = None
+    
+    def generate_response(self,
+                          persona: Dict[str, Any],
+                          dialogue_topic: str,
+                          background: str,
+                          dialogue_history: List[Dict[str, str]],
+                          story: Optional[str] = None) -> Dict[str, str]:
+        """
+        生成患者的一轮对话回复
         
+        Args:
+            persona: 患者用户画像
+            dialogue_topic: 对话主题
+            background: 24小时生活状态
+            dialogue_history: 对话历史
+            story: 故事背景（可选）
+            
+        Returns:
+            包含Thinking和Response的字典
+        """
+        # 构建提示词（增量消息模式下为消息列表）
+        prompt = self._prepare_prompt(persona, dialogue_topic, background, dialogue_history, story)
+
+        # 调用API生成
+        result = self._request(prompt)
+
+        # 多候选：本地挑选不重复、得分最高的一条
+        if self.num_candidates > 1:
+            return {"thinking": "(无思考过程)", "response": self._choose_candidate(result, dialogue_history)}
+        # 解析结果（严格解析 Thinking 和 Response；修复失败时用同一提示词重新请求本轮）
+        return self._parse_turn(result, regenerate=lambda attempt: self._request(prompt, seed=attempt))
+
+    async def agenerate_response(self,
+                                 persona: Dict[str, Any],
+                                 dialogue_topic: str,
+                                 background: str,
+                                 dialogue_history: List[Dict[str, str]],
+                                 story: Optional[str] = None) -> Dict[str, str]:
+        """
+        generate_response 的异步版本（api_client 需为 AsyncQwenAPIClient）
+        """
+        prompt = self._prepare_prompt(persona, dialogue_topic, background, dialogue_history, story)
+        result = await self._arequest(prompt)
+        if self.num_candidates > 1:
+            return {"thinking": "(无思考过程)", "response": self._choose_candidate(result, dialogue_history)}
+        if self._turn_parser is not None:
+            parsed = await self._turn_parser.aparse(
+                result,
+                caller=self.__class__.__name__,
+                regenerate=lambda attempt: self._arequest(prompt, seed=attempt)
+            )
+            return {"thinking": "(无思考过程)", "response": parsed["response"]}
+        return self._parse_response(result)
+
+    def _prepare_prompt(self,
+                        persona: Dict[str, Any],
+                        dialogue_topic: str,
+                        background: str,
+                        dialogue_history: List[Dict[str, str]],
+                        story: Optional[str] = None) -> Union[str, List[Dict[str, str]]]:
+        """构建本轮的提示词（增量消息模式下为消息列表），配置了 prompt_budget 时裁剪到患者侧上限以内"""
+        build = self._build_messages if self.messages_mode else self._build_dialogue_prompt
+        if self.prompt_budget is None:
+            return build(persona, dialogue_topic, background, dialogue_history, story)
+        return self.prompt_budget.fit(
+            self.PROMPT_ROLE,
+            lambda story, background, max_history: build(
+                persona, dialogue_topic, background, dialogue_history, story, max_history
+            ),
+            story,
+            background,
+            len(dialogue_history),
+            model=self.CALL_PARAMS["model"]
+        )
+
+    def _request(self, prompt: Any, **kwargs) -> str:
+        """发送本轮请求（prompt 在增量消息模式下为消息列表），kwargs 为额外的请求参数"""
+        if self.messages_mode:
+            return self._call_with_messages(prompt, **kwargs)
+        if self.stream:
+            return self._trim_stream(
+                self._send(self.api_client.call_stream, prompt=prompt, stop_when=self._stop_when, **kwargs)
+            )
+        return self._send(self.api_client.call, prompt=prompt, **kwargs)
+
+    async def _arequest(self, prompt: Any, **kwargs) -> str:
+        """_request 的异步版本"""
+        if self.messages_mode:
+            return await self._asend(self.api_client.acall_with_messages, prompt, **kwargs)
+        return await self._asend(self.api_client.acall, prompt=prompt, **kwargs)
+
+    def _call_with_messages(self, messages: List[Dict[str, str]], **kwargs) -> str:
+        """增量消息模式的调用，流式时 Response 段（结构化输出时为 JSON 对象）完整后立即截断"""
+        if self.stream:
+            return self._trim_stream(
+                self._send(self.api_client.call_with_messages_stream, messages, stop_when=self._stop_when, **kwargs)
+            )
+        return self._send(self.api_client.call_with_messages, messages, **kwargs)
+
+    def _send(self, send: Callable[..., str], *args, **kwargs) -> str:
+        """发送本轮请求，配置了 length_governor 时按患者回复的长度设置 max_tokens 和 stop 序列，截断时放宽重试"""
+        kwargs = {"caller": self.__class__.__name__, **self._call_params, **kwargs}
+        if self.length_governor is None:
+            return send(*args, **kwargs)
+        return self.length_governor.call(self.PROMPT_ROLE, send, *args, replies=self.num_candidates, **kwargs)
+
+    async def _asend(self, send: Callable[..., Any], *args, **kwargs) -> str:
+        """_send 的异步版本"""
+        kwargs = {"caller": self.__class__.__name__, **self._call_params, **kwargs}
+        if self.length_governor is None:
+            return await send(*args, **kwargs)
+        return await self.length_governor.acall(self.PROMPT_ROLE, send, *args, replies=self.num_candidates, **kwargs)
+
+    def _trim_stream(self, result: str) -> str:
+        """去掉流式截断时多收到的内容（JSON 对象完整时已经停止接收，无需处理）"""
+        return result if self._stop_when is json_object_complete else trim_to_response_section(result)
+
+    def _choose_candidate(self, result: str, dialogue_history: List[Dict[str, str]]) -> str:
+        """从多候选输出中挑选本轮回复（见 scripts.candidate_selection），候选格式解析失败时按单条回复解析"""
+        try:
+            candidates = parse_candidates(result)
+        except StructuredOutputError as e:
+            print(f"候选格式解析失败（{e}），按单条回复处理")
+            return self._parse_response(result)["response"]
+        return choose_candidate(candidates, dialogue_history)
+
+    def _parse_turn(self, result: str, regenerate: Optional[Callable[[int], str]] = None) -> Dict[str, str]:
+        """解析本轮输出：结构化输出时严格解析（必要时修复一次、重新请求本轮），否则按 Response: 标记解析"""
+        if self._turn_parser is not None:
+            parsed = self._turn_parser.parse(result, caller=self.__class__.__name__, regenerate=regenerate)
+            return {"thinking": "(无思考过程)", "response": parsed["response"]}
+        return self._parse_response(result)
+
+    def _build_system_prompt(self,
+                             persona: Dict[str, Any],
+                             dialogue_topic: str,
+                             background: str,
+                             story: Optional[str] = None) -> str:
+        """
+        增量消息模式的 system 消息，轮次放在最后一条照护师消息中
+
+        规则、主题和画像在整段对话内不变（按对话缓存）；生活状态每轮都可能更新，在缓存的片段之外拼接
+        """
+        head = self._fragments.get(
+            persona,
+            ("system", dialogue_topic),
+            lambda: self._rules.render(current_turn="N") + f"""
+### 对话主题
+{dialogue_topic}
+
+### 患者用户画像
+{self._persona_json(persona)}
+
+### 患者24小时生活状态
+"""
+        )
+        prompt = f"{head}{background}\n\n"
         if story:
             prompt += f"### 故事背景\n{story}\n\n"
+        prompt += "### 对话上下文\n后续消息是你（患者）与照护师的对话，照护师最后一条消息末尾注明了当前轮次 N。\n"
+        return prompt
+
+    def _build_messages(self,
+                        persona: Dict[str, Any],
+                        dialogue_topic: str,
+                        background: str,
+                        dialogue_history: List[Dict[str, str]],
+                        story: Optional[str] = None,
+                        max_history: Optional[int] = None) -> List[Dict[str, str]]:
+        """
+        构建增量消息模式的消息列表
+
+        模型扮演患者：患者的发言作为 assistant 消息，照护师的发言作为 user 消息。
+        轮次提示只追加在最后一条 user 消息上，前面的消息与上一轮请求完全一致，
+        每轮输入中只有新增的两三条消息无法命中前缀缓存。
+        max_history 不为 None 时（超出提示词预算）只保留最近 max_history 条消息。
+        """
+        messages = [{"role": "system", "content": self._build_system_prompt(persona, dialogue_topic, background, story)}]
+        recent = dialogue_history
+        if max_history is not None:
+            recent = dialogue_history[max(len(dialogue_history) - max_history, 0):]
+        elif self.history is not None:
+            # 窗口按批滑动，两次滑动之间前缀不变
+            summary, recent = self.history.window(dialogue_history)
+            if summary:
+                messages.append({"role": "user", "content": f"（更早的对话摘要）\n{summary}"})
+        for msg in recent:
+            role = "assistant" if msg["role"] == "user" else "user"
+            if messages[-1]["role"] == role:
+                # 同一方连续发言时合并，保证角色交替
+                messages[-1] = {"role": role, "content": f"{messages[-1]['content']}\n{msg['content']}"}
+            else:
+                messages.append({"role": role, "content": msg["content"]})
+
+        turn_hint = f"（当前是第 {len(dialogue_history) + 1} 轮，请按输出格式回复）"
+        if len(messages) == 1:
+            messages.append({"role": "user", "content": f"{self.OPENING_MESSAGE}\n\n{turn_hint}"})
+        elif messages[-1]["role"] == "user":
+            messages[-1] = {"role": "user", "content": f"{messages[-1]['content']}\n\n{turn_hint}"}
+        else:
+            messages.append({"role": "user", "content": turn_hint})
+        return messages
+    
+    def _build_dialogue_prompt(self,
+                           persona: Dict[str, Any],
+                           dialogue_topic: str,
+                           background: str,
+                           dialogue_history: List[Dict[str, str]],
+                           story: Optional[str] = None,
+                           max_history: Optional[int] = None) -> str:
+        current_turn = len(dialogue_history) + 1
         
+        # 主题和画像按对话预先填入，生活状态每轮都可能更新，每轮填入
+        context = self._fragments.get(
+            persona,
+            ("context", dialogue_topic),
+            lambda: self.CONTEXT_TEMPLATE.partial(
+                dialogue_topic=dialogue_topic,
+                persona_json=self._persona_json(persona)
+            )
+        )
+        prompt = self._rules.render(current_turn=current_turn) + context.render(background=background)
+
+        if dialogue_history and max_history is not None:
+            # 超出提示词预算：只保留最近 max_history 条（轮次仍按完整历史计算）
+            recent = dialogue_history[max(len(dialogue_history) - max_history, 0):]
+            prompt += "".join(self._render_history_message(msg) for msg in recent) + "\n"
+        elif dialogue_history and self.history is not None:
+            # 最近几条原样保留，更早的折叠成摘要
+            prompt += self.history.render(dialogue_history, self._render_history_message) + "\n"
+        elif dialogue_history:
+            prompt += self._fragments.history(dialogue_history, self._render_history_message) + "\n"
+        else:
+            prompt += f"### 对话上下文\n{self.OPENING_MESSAGE}\n\n"
+
+        if story:
+            prompt += f"### 故事背景\n{story}\n\n"
+
         return prompt
+
+    def _persona_json(self, persona: Dict[str, Any]) -> str:
+        """画像 JSON（只按画像缓存，同一画像的各个主题共用）"""
+        return self._fragments.get(persona, "persona_json", lambda: json.dumps(persona, ensure_ascii=False, indent=2))
+
+    @staticmethod
+    def _render_history_message(msg: Dict[str, str]) -> str:
+        """对话上下文中的一条消息"""
+        role_name = "患者" if msg["role"] == "user" else "照护师"
+        return f"{role_name}: {msg['content']}\n"
     def _parse_response(self, response: str) -> Dict[str, str]:
         """
         严格解析API返回的响应，提取Thinking和Response
@@ -12,30 +12,124 @@ from datetime import datetime
 from scripts import (
     QwenAPIClient,
     DialogueGenerator,
+    RateLimiter,
 )
+from scripts.api_client import BudgetExceededError, CircuitOpenError
+from scripts.candidate_selection import CANDIDATES_FORMAT, choose_candidate, is_repetitive
 from scripts.generic_ai_generator import GenericAIGenerator
+from scripts.length_governor import OutputLengthGovernor
+from scripts.prompt_templates import FragmentCache, PromptTemplate
+from scripts.structured_output import (
+    RESPONSE_FORMAT, StructuredOutputError, StructuredTurnParser, format_instructions, parse_candidates
+)
 import config
 
 
 class BaselineDialogueGenerator:
     """基线对话生成器"""
+
+    # 患者轮提示词模板（类定义时预编译，{output_format} 为输出格式）
+    PATIENT_PROMPT_TEMPLATE = PromptTemplate("""### 任务描述
+你是一位血糖异常患者。请根据场景提示和患者用户画像，生成一轮对话回复。
+
+### 当前对话轮次
+这是第 {current_turn} 轮对话。{turn_note}
+
+### 场景提示
+{patient_instruction}
+
+### 患者用户画像
+{persona_json}
+
+### 对话历史
+{history_text}
+
+### 核心规则
+1. **对话连贯性**：必须根据对话历史生成回复，不能重复之前说过的话。如果助手已经回答了你的问题，你应该：
+   - 要么确认理解并追问细节
+   - 要么提出新的相关问题
+   - 要么表达新的担忧或补充信息
+   - 绝对不能重复完全相同的问题或陈述
+
+2. **对话节奏**：遵循'开场铺垫→互动补充→聚焦结果→收束对话'的四阶段
+   - 第一轮：开场铺垫，描述现状和核心问题
+   - 后续轮次：根据助手的回复，进行确认、追问、补充或提出新问题
+
+3. **每回合动作上限**：只做1件事（陈述/回答/确认/提问四选一），最多1个问题
+
+4. **每回合数据上限**：最多只能提供1个新的数据
+
+5. **长度约束**：每回合8~30字为主；必要时可到40字
+
+6. **主题聚焦**：只围绕场景主题推进
+
+7. **承接对方**：必须回应助手的最新回复，不能忽略助手的回答。如果助手给出了建议，你应该：
+   - 确认是否理解（"所以我应该..."）
+   - 追问具体步骤（"具体怎么做？"）
+   - 表达担忧（"我担心..."）
+   - 提供补充信息（"但是我..."）
+
+### 重要提醒
+- **禁止重复**：绝对不能重复之前轮次中已经说过的完全相同的话
+- **必须变化**：每一轮的回复必须与之前不同，体现对话的推进
+- **回应助手**：必须回应助手的最新回复，不能无视助手的回答
+
+{output_format}""")
+
+    # 文本模式的输出格式
+    OUTPUT_FORMAT = """### 输出格式
+请直接输出你的回复内容，不需要包含思考过程。
+
+### 你的回复："""
     
-    def __init__(self, api_key: str = None):
+    def __init__(self,
+                 api_key: str = None,
+                 structured_output: bool = False,
+                 num_candidates: int = 1,
+                 length_governor: bool = False):
         """
         初始化基线对话生成器
         
         Args:
             api_key: API密钥，如果不提供则使用配置文件中的
+            structured_output: 患者轮是否要求模型输出 JSON（{"response": ...}）并严格解析，
+                               不合法时只对本轮修复一次
+            num_candidates: 患者轮每次调用生成的候选数，大于 1 时本地挑选不重复、得分最高的一条，
+                            重复不再白白浪费一轮
+            length_governor: 是否按语料（config.OUTPUT_LENGTH_CORPUS）中患者回复的真实长度设置 max_tokens 和 stop 序列，
+                             截断时放宽重试
         """
         self.api_key = api_key or config.API_KEY
         if not self.api_key:
             raise ValueError("API密钥未设置，请设置环境变量 QWEN_API_KEY 或在config.py中配置")
         
-        self.api_client = QwenAPIClient(self.api_key, config.API_BASE_URL)
+        self.api_client = QwenAPIClient(
+            self.api_key,
+            config.API_BASE_URL,
+            pool_connections=config.API_POOL_CONNECTIONS,
+            pool_maxsize=config.API_POOL_MAXSIZE,
+            rate_limiter=RateLimiter(config.MODEL_RATE_LIMITS)
+        )
+        
+        self.length_governor = (
+            OutputLengthGovernor.from_corpus(config.OUTPUT_LENGTH_CORPUS, **config.OUTPUT_LENGTH)
+            if length_governor else None
+        )
         
         # 初始化生成器
-        self.dialogue_generator = DialogueGenerator(self.api_client)
+        self.dialogue_generator = DialogueGenerator(self.api_client, length_governor=self.length_governor)
         self.generic_ai_generator = GenericAIGenerator(self.api_client)
+        self._fragments = FragmentCache()
+        self.structured_output = structured_output
+        self.num_candidates = num_candidates
+        if num_candidates > 1:
+            output_format = CANDIDATES_FORMAT.format(num_candidates=num_candidates)
+        elif structured_output:
+            output_format = format_instructions(("response",))
+        else:
+            output_format = self.OUTPUT_FORMAT
+        self._patient_template = self.PATIENT_PROMPT_TEMPLATE.partial(output_format=output_format)
+        self._turn_parser = StructuredTurnParser(self.api_client, ("response",)) if structured_output else None
     
     def load_scene_prompts(self, prompts_file: str) -> List[Dict[str, Any]]:
         """
@@ -100,7 +194,7 @@ class BaselineDialogueGenerator:
                 
                 patient_content = patient_response.get("response", "")
                 
-                # 检查是否重复
+                # 检查是否重复（多候选模式下重复的候选已在本轮内排除，只有全部候选都重复时才会跳过）
                 if self._is_repetitive(patient_content, dialogue_history):
                     print(f"警告: 检测到重复回复，跳过本轮")
                     print(f"重复内容: {patient_content[:50]}...")
@@ -132,6 +226,9 @@ class BaselineDialogueGenerator:
                 
                 print(f"通用AI: {generic_ai_reply}")
                 
+            except (CircuitOpenError, BudgetExceededError):
+                # 接口熔断或预算耗尽时整批停止，不生成半截对话
+                raise
             except Exception as e:
                 print(f"生成第 {turn + 1} 轮对话时出错: {str(e)}")
                 break
@@ -173,77 +270,56 @@ class BaselineDialogueGenerator:
         patient_instruction = scene_prompt.get("patient_simulator_instruction", "")
         
         # 构建对话历史文本
-        history_text = ""
-        for msg in dialogue_history[-4:]:  # 只取最近4轮
-            role = "患者" if msg.get("role") == "user" else "助手"
-            content = msg.get("content", "")
-            history_text += f"{role}: {content}\n"
+        history_text = "".join(
+            f"{'患者' if msg.get('role') == 'user' else '助手'}: {msg.get('content', '')}\n"
+            for msg in dialogue_history[-4:]  # 只取最近4轮
+        )
         
         # 构建完整的提示词
         # 判断是否是第一轮
         is_first_turn = len(dialogue_history) == 0
-        current_turn = turn_number
-        
-        prompt = f"""### 任务描述
-你是一位血糖异常患者。请根据场景提示和患者用户画像，生成一轮对话回复。
-
-### 当前对话轮次
-这是第 {current_turn} 轮对话。{"这是对话的开始。" if is_first_turn else "请根据之前的对话内容，生成与之前不同的新回复。"}
-
-### 场景提示
-{patient_instruction}
-
-### 患者用户画像
-{json.dumps(persona, ensure_ascii=False, indent=2)}
-
-### 对话历史
-{history_text if history_text else "对话刚开始，这是第一轮。"}
-
-### 核心规则
-1. **对话连贯性**：必须根据对话历史生成回复，不能重复之前说过的话。如果助手已经回答了你的问题，你应该：
-   - 要么确认理解并追问细节
-   - 要么提出新的相关问题
-   - 要么表达新的担忧或补充信息
-   - 绝对不能重复完全相同的问题或陈述
-
-2. **对话节奏**：遵循'开场铺垫→互动补充→聚焦结果→收束对话'的四阶段
-   - 第一轮：开场铺垫，描述现状和核心问题
-   - 后续轮次：根据助手的回复，进行确认、追问、补充或提出新问题
-
-3. **每回合动作上限**：只做1件事（陈述/回答/确认/提问四选一），最多1个问题
-
-4. **每回合数据上限**：最多只能提供1个新的数据
-
-5. **长度约束**：每回合8~30字为主；必要时可到40字
-
-6. **主题聚焦**：只围绕场景主题推进
-
-7. **承接对方**：必须回应助手的最新回复，不能忽略助手的回答。如果助手给出了建议，你应该：
-   - 确认是否理解（"所以我应该..."）
-   - 追问具体步骤（"具体怎么做？"）
-   - 表达担忧（"我担心..."）
-   - 提供补充信息（"但是我..."）
-
-### 重要提醒
-- **禁止重复**：绝对不能重复之前轮次中已经说过的完全相同的话
-- **必须变化**：每一轮的回复必须与之前不同，体现对话的推进
-- **回应助手**：必须回应助手的最新回复，不能无视助手的回答
-
-### 输出格式
-请直接输出你的回复内容，不需要包含思考过程。
-
-### 你的回复："""
+        # 同一画像在所有场景、所有轮次中复用，JSON 只序列化一次
+        persona_json = self._fragments.get(
+            persona, "persona_json", lambda: json.dumps(persona, ensure_ascii=False, indent=2)
+        )
+        prompt = self._patient_template.render(
+            current_turn=turn_number,
+            turn_note="这是对话的开始。" if is_first_turn else "请根据之前的对话内容，生成与之前不同的新回复。",
+            patient_instruction=patient_instruction,
+            persona_json=persona_json,
+            history_text=history_text if history_text else "对话刚开始，这是第一轮。"
+        )
         
         # 调用API生成（提高温度以增加多样性，避免重复）
-        result = self.api_client.call(
+        call_params = dict(
             prompt=prompt,
             model="qwen-plus",
             temperature=0.9,  # 提高温度增加多样性
-            max_tokens=500
+            max_tokens=500,
+            caller=self.__class__.__name__,
+            **({"response_format": RESPONSE_FORMAT} if self.structured_output or self.num_candidates > 1 else {})
         )
-        
-        # 解析结果
+        result = self._send_patient(call_params)
+        
+        # 多候选：本地挑选不重复、得分最高的一条
+        if self.num_candidates > 1:
+            return {"response": self._choose_candidate(result, dialogue_history)}
+        # 解析结果（结构化输出时严格解析，不合法时修复一次、用同一提示词重新请求本轮，仍失败则抛出 StructuredOutputError）
+        if self._turn_parser is not None:
+            return self._turn_parser.parse(
+                result,
+                caller=self.__class__.__name__,
+                regenerate=lambda attempt: self._send_patient({**call_params, "seed": attempt})
+            )
         return self._parse_patient_response(result)
+
+    def _send_patient(self, call_params: Dict[str, Any]) -> str:
+        """发送患者回复请求，配置了 length_governor 时按基线患者回复的长度设置 max_tokens（按候选数放大，500 仍是上限）"""
+        if self.length_governor is not None:
+            return self.length_governor.call(
+                "baseline_patient", self.api_client.call, replies=self.num_candidates, **call_params
+            )
+        return self.api_client.call(**call_params)
     
     def _parse_patient_response(self, response: str) -> Dict[str, str]:
         """
@@ -278,6 +354,27 @@ class BaselineDialogueGenerator:
             "response": response_text
         }
     
+    def _choose_candidate(self, result: str, dialogue_history: List[Dict[str, str]]) -> str:
+        """
+        从多候选输出中挑选本轮回复
+
+        排除与历史重复的候选，其余按本地评分取最高分（见 scripts.candidate_selection）；
+        全部重复时返回第一条，由调用方按重复处理。候选格式解析失败时按单条回复解析。
+        
+        Args:
+            result: API返回的原始文本
+            dialogue_history: 对话历史
+            
+        Returns:
+            选中的回复
+        """
+        try:
+            candidates = parse_candidates(result)
+        except StructuredOutputError as e:
+            print(f"候选格式解析失败（{e}），按单条回复处理")
+            return self._parse_patient_response(result)["response"]
+        return choose_candidate(candidates, dialogue_history)
+    
     def _is_repetitive(self, response: str, dialogue_history: List[Dict[str, str]]) -> bool:
         """
         检查患者回复是否与历史回复重复
@@ -289,27 +386,7 @@ class BaselineDialogueGenerator:
         Returns:
             是否重复
         """
-        # 获取之前所有患者回复
-        previous_responses = [
-            msg.get("content", "") 
-            for msg in dialogue_history 
-            if msg.get("role") == "user"
-        ]
-        
-        # 检查是否与之前的回复完全相同或高度相似
-        response_clean = response.strip()
-        for prev_response in previous_responses:
-            prev_clean = prev_response.strip()
-            # 完全相同
-            if response_clean == prev_clean:
-                return True
-            # 高度相似（超过80%的字符相同）
-            if len(response_clean) > 10 and len(prev_clean) > 10:
-                similarity = len(set(response_clean) & set(prev_clean)) / max(len(set(response_clean)), len(set(prev_clean)))
-                if similarity > 0.8:
-                    return True
-        
-        return False
+        return is_repetitive(response, dialogue_history)
     
     def _should_end_dialogue(self, response: str) -> bool:
         """
@@ -385,6 +462,8 @@ class BaselineDialogueGenerator:
                     json.dump(result, f, ensure_ascii=False, indent=2)
                 print(f"已保存到: {output_file}")
                 
+            except (CircuitOpenError, BudgetExceededError):
+                raise
             except Exception as e:
                 print(f"生成场景 {scene_prompt.get('scene', '未知')} 的对话时出错: {str(e)}")
                 import traceback
@@ -484,11 +563,32 @@ def main():
         default=None,
         help="只生成指定场景的对话（场景代码，如HYPOGLYCEMIA）"
     )
+    parser.add_argument(
+        "--candidates",
+        type=int,
+        default=3,
+        help="患者轮每次调用生成的候选数，本地挑选不重复的一条（1 表示单条回复，重复时跳过该轮）"
+    )
+    parser.add_argument(
+        "--structured-output",
+        action="store_true",
+        help="患者轮要求模型输出 JSON 并严格解析（不合法时只修复该轮一次）"
+    )
+    parser.add_argument(
+        "--length-governor",
+        action="store_true",
+        help="按语料中患者回复的真实长度设置 max_tokens 和 stop 序列，只在回复被截断时放宽重试"
+    )
     
     args = parser.parse_args()
     
     # 初始化生成器
-    generator = BaselineDialogueGenerator(api_key=args.api_key)
+    generator = BaselineDialogueGenerator(
+        api_key=args.api_key,
+        structured_output=args.structured_output,
+        num_candidates=args.candidates,
+        length_governor=args.length_governor
+    )
     
     # 如果指定了单个场景，只生成该场景
     if args.scene:
@@ -3,7 +3,7 @@
 用于生成未经医疗领域专门优化的通用AI助手的回复
 """
 from typing import List, Dict
-from .api_client import QwenAPIClient
+from .backends import LLMBackend
 
 
 class GenericAIGenerator:
@@ -12,7 +12,10 @@ class GenericAIGenerator:
     负责生成通用AI助手（无医疗微调）的回复
     """
 
-    def __init__(self, api_client: QwenAPIClient):
+    # 同步/异步调用共用的模型参数（使用通用模型）
+    CALL_PARAMS = {"model": "qwen-turbo", "temperature": 0.7, "max_tokens": 200}
+
+    def __init__(self, api_client: LLMBackend):
         """
         初始化通用AI生成器
         
@@ -36,13 +39,19 @@ class GenericAIGenerator:
         """
         prompt = self._build_prompt(dialogue_history)
 
-        result = self.api_client.call(
-            prompt=prompt,
-            model="qwen-turbo",  # 使用通用模型
-            temperature=0.7,
-            max_tokens=200
-        )
+        result = self.api_client.call(prompt=prompt, caller=self.__class__.__name__, **self.CALL_PARAMS)
+
+        return result.strip()
 
+    async def agenerate_reply(
+        self,
+        dialogue_history: List[Dict[str, str]]
+    ) -> str:
+        """
+        generate_reply 的异步版本（api_client 需为 AsyncQwenAPIClient）
+        """
+        prompt = self._build_prompt(dialogue_history)
+        result = await self.api_client.acall(prompt=prompt, caller=self.__class__.__name__, **self.CALL_PARAMS)
         return result.strip()
     
     def _build_prompt(
@@ -1,238 +1,18 @@
-# from typing import List, Dict, Optional
-# from .api_client import QwenAPIClient
-
-
-# class HealthAssistantGenerator_thinking:
-#     """
-#     健康助手对话生成器
-#     负责生成照护师（健康助手）的回复，包含 Thinking 思维链
-#     """
-
-#     def __init__(self, api_client: QwenAPIClient):
-#         self.api_client = api_client
-
-#     # def generate_reply(
-#     #     self,
-#     #     persona: dict,
-#     #     dialogue_topic: str,
-#     #     background: str,
-#     #     dialogue_history: List[Dict[str, str]],
-#     #     story: str = None
-#     # ) -> Dict[str, str]:
-#     #     """
-#     #     生成健康助手的一轮回复（包含 Thinking）
-        
-#     #     Returns:
-#     #         {"thinking": "内部推理过程", "response": "实际回复内容"}
-#     #     """
-#     #     try:
-#     #         prompt = self._build_prompt(persona, dialogue_topic, background, dialogue_history, story)
-
-#     #         result = self.api_client.call(
-#     #         prompt=prompt,
-#     #         model="qwen-plus",        
-#     #         temperature=0.6,
-#     #         max_tokens=2000
-#     #     )
-
-#     #     return self._parse_response(result.strip())
-#     def generate_reply(self,
-#         persona: dict,
-#         dialogue_topic: str,
-#         background: str,
-#         dialogue_history: List[Dict[str, str]],
-#         story: str = None):
-#         try:
-#             prompt = self._build_prompt(persona, dialogue_topic, background, dialogue_history, story)
-#             api_result = self.api_client.call(prompt=prompt,
-#             model="qwen-plus",        
-#             temperature=0.6,
-#             max_tokens=2000)
-#             if api_result is None:
-#                 print("API 返回 None")
-#                 return {"thinking": "(API 返回空)", "response": "(生成失败)"}
-            
-#             parsed = self._parse_response(api_result)
-#             return parsed
-#         except Exception as e:
-#             print(f"助手生成异常: {str(e)}")
-#             return {"thinking": "(异常)", "response": "(生成失败)"}
-
-#     def generate_response(
-#         self,
-#         dialogue_topic: str,
-#         dialogue_history: List[Dict[str, str]]
-#     ) -> Dict[str, str]:
-#         """
-#         向后兼容的方法（不带 persona 等信息）
-#         """
-#         return self.generate_reply(
-#             persona={},
-#             dialogue_topic=dialogue_topic,
-#             background="",
-#             dialogue_history=dialogue_history,
-#             story=None
-#         )
-
-#     def _build_prompt(
-#         self,
-#         persona: dict,
-#         dialogue_topic: str,
-#         background: str,
-#         dialogue_history: List[Dict[str, str]],
-#         story: str = None
-#     ) -> str:
-#         """
-#         构建健康助手的提示词（要求先 Thinking 后 Response）
-#         """
-#         # 安全获取患者信息
-#         basic_info = persona.get("基本信息", {})
-#         gender = basic_info.get('性别', '未知') if isinstance(basic_info, dict) else '未知'
-#         age = basic_info.get('年龄', '未知') if isinstance(basic_info, dict) else '未知'
-#         persona_type = persona.get('人物底色', '未知')
-
-#         # 简化背景和故事
-#         background_summary = background[:150] + "..." if background and len(background) > 150 else background or "无相关背景信息"
-#         story_summary = story[:100] + "..." if story and len(story) > 100 else story or ""
-
-#         # 构建最近对话历史（限制在最近4-6轮，避免过长）
-#         history_text = ""
-#         recent_history = dialogue_history[-6:] if len(dialogue_history) > 6 else dialogue_history
-#         for msg in recent_history:
-#             role = "患者" if msg.get("role") == "user" else "照护师"
-#             content = msg.get("content", "")
-#             if len(content) > 120:
-#                 content = content[:117] + "..."
-#             history_text += f"{role}: {content}\n"
-#         current_turn = len(dialogue_history) + 1
-#         prompt = f"""# 角色定位
-# 你是一位专业、温暖、有耐心的糖尿病照护师，拥有丰富临床经验和优秀沟通能力。
-
-# ### 核心原则（优先级顺序）
-# 1. **专业准确**：先判断患者当前诉求是否已解决、数值是否正常、是否需要继续干预。
-# 2. **适度共情**：理解情绪，但不要每轮都过度夸赞或“太棒了”“真为你开心”。
-# 3. **边界感**：当问题已基本解答、患者已理解方案时，**必须主动引导收束**，不要无限推“小行动”。
-# 4. **行动建议**：只在必要时给1个具体、可执行的小建议。**不要每轮都推新动作**。
-# 5. **收束时机（每轮必须评估！）**：
-#    - 先问自己3个问题：
-#      1. 患者疑问已解、数值正常、无新担忧吗？（如果是的，必须收束）
-#      2. 患者连续2次或更多表示“行”“好”“明白了”“先这样”“去落实”等收束意图吗？（如果是的，必须收束）
-#      3. 对话是否已经覆盖主题主要内容，没有新信息需要补充？（如果是的，必须收束）
-#    - 如果以上3个问题中有2个或更多“是”，**本轮必须收束**。
-#    - 当前是第 {current_turn} 轮：
-#      - 轮次 >= 12：如果3个问题中有2个“是”，必须收束。
-#      - 轮次 >= 18：必须收束，无例外。
-#    - 收束方式：用极简、自然的结束句，长度8~20字。示例（根据上下文选最合适的，不要照抄）：
-#      - 咱们先按这个观察几天，有变化再聊。
-#      - 这个值正常，先不用调整，继续保持。
-#      - 好，先这样稳着，有问题随时说。
-#      - 明白了，先照着做3天看看。
-#      - 行，先这样吧，休息好。
-#    - **反例（禁止使用）**：不要用“慢慢来，有问题随时说～”结尾每轮；不要每轮推新小行动；不要过度肯定“太棒了”“真为你开心”。
-
-
-
-# # 患者信息
-# - 性别：{gender}
-# - 年龄：{age}
-# - 患者类型：{persona_type}
-
-# # 当前对话主题
-# {dialogue_topic}
-
-# # 患者背景摘要
-# {background_summary}
-
-# # 故事背景（如有）
-# {story_summary}
-
-# # 最近对话记录
-# {history_text}
-
-# # 回复要求
-
-# ## 第一步：Thinking（内部思考）
-# 请先站在照护师角度，进行结构化思考：
-# - 患者当前最可能的情绪状态是什么？（焦虑/困惑/抵触/积极等）
-# - 患者的核心诉求或隐性问题是什麼？
-# - 我上一轮是否遗漏了重要信息？
-# - 本轮我应该优先解决哪个点？（安抚情绪 / 澄清问题 / 给出建议 / 追问细节）
-# - 如何用合适且专业的方式表达？
-
-# ## 第二步：Response（实际回复）
-# - 先专业判断（数值正常/波动原因/无需立即调整等，1句）
-# - 适度共情或肯定（简短，1句，不夸张）
-# - 如需行动，只给1个最关键的（1句）
-# - 如果话题已覆盖，温和收束：“咱们先按这个观察几天，有变化随时说。”
-# - 回复长度控制在30-80字
-# - 语气温暖自然，像朋友一样（常用“咱们”“试试看”“慢慢来”“别担心”）
-# - 先共情，再建议，最后鼓励
-# - 最多提1个具体可行的小行动
-# - 如需追问，最多1-2个温和问题，且仅当轮次 < 10 时；如果轮次 >= 10，且患者已表达满足（如“嗯”“好”“谢谢”），你的回复必须以鼓励结束语收尾（如“慢慢来，有问题随时说～”），而非新问题**。
-# - 绝不诊断、不开药、不吓唬患者
-# - 如果对话已进行12轮以上，且患者疑问已覆盖，优先推动收束，而不是继续追问细节。
-
-# # 输出格式（必须严格遵守！）
-# Thinking:
-# [你的内部思考过程，用中文，第一人称，2-5句话]
-
-# Response:
-# [直接输出的对话内容，不要加引号或额外说明]
-# """
-
-#         return prompt
-
-#     def _parse_response(self, response: str) -> Dict[str, str]:
-#         """
-#         解析模型输出，提取 Thinking 和 Response
-#         永远返回 dict，即使失败
-#         """
-#         result = {
-#             "thinking": "(解析失败或无思考过程)",
-#             "response": "(生成内容为空或解析失败)"
-#         }
-
-#         # 处理 None 或非字符串输入
-#         if response is None or not isinstance(response, str):
-#             return result
-
-#         response = response.strip()
-
-#         if not response:
-#             return result
-
-#         try:
-#             if "Thinking:" in response and "Response:" in response:
-#                 # 找到 Thinking 开始位置
-#                 thinking_start = response.find("Thinking:") + len("Thinking:")
-#                 # 找到 Response 开始位置（从 Thinking 后开始找）
-#                 response_start = response.find("Response:", thinking_start)
-                
-#                 if response_start > thinking_start:
-#                     thinking = response[thinking_start:response_start].strip()
-#                     resp = response[response_start + len("Response:"):].strip()
-#                     result["thinking"] = thinking
-#                     result["response"] = resp
-#                 else:
-#                     # Response 在 Thinking 前（异常顺序），回退
-#                     result["response"] = response.strip()
-#             elif "Response:" in response:
-#                 resp_part = response.split("Response:", 1)[1].strip()
-#                 result["response"] = resp_part
-#             else:
-#                 # 无格式，整个作为 response
-#                 result["response"] = response
-#         except Exception as parse_error:
-#             # 任何解析异常，都回退到完整文本作为 response
-#             print(f"解析异常: {str(parse_error)}")
-#             result["response"] = response
-#             result["thinking"] = "(解析过程中发生异常)"
-
-#         return result
-
-
-from typing import List, Dict, Optional
-from .api_client import QwenAPIClient
+"""
+健康助手（照护师）回复生成模块
+生成带 Thinking 思维链的照护师回复
+"""
+from typing import Any, Callable, List, Dict, Optional
+from .api_client import BudgetExceededError, CircuitOpenError
+from .backends import LLMBackend
+from .history_context import RollingHistory
+from .length_governor import OutputLengthGovernor
+from .prompt_templates import FragmentCache, PromptTemplate
+from .streaming import response_section_complete, trim_to_response_section
+from .structured_output import (
+    RESPONSE_FORMAT, StructuredOutputError, StructuredTurnParser, format_instructions, json_object_complete
+)
+from .token_estimator import PromptBudgetEnforcer
 import json
 
 
@@ -242,85 +22,14 @@ class HealthAssistantGenerator_thinking:
     负责生成照护师（健康助手）的回复，包含 Thinking 思维链
     """
 
-    def __init__(self, api_client: QwenAPIClient):
-        self.api_client = api_client
-
-    def generate_reply(self,
-                       persona: dict,
-                       dialogue_topic: str,
-                       background: str,
-                       dialogue_history: List[Dict[str, str]],
-                       story: str = None) -> Dict[str, str]:
-        """
-        生成健康助手的一轮回复（包含 Thinking）
-        永不返回 None
-        """
-        try:
-            prompt = self._build_prompt(persona, dialogue_topic, background, dialogue_history, story)
-            api_result = self.api_client.call(
-                prompt=prompt,
-                model="qwen-plus",
-                temperature=0.6,
-                max_tokens=2000
-            )
-            if api_result is None:
-                print("助手 API 返回 None")
-                return {"thinking": "(API 返回空)", "response": "(生成失败)"}
-            
-            parsed = self._parse_response(api_result)
-            return parsed
-        except Exception as e:
-            print(f"助手生成器整体异常: {str(e)}")
-            return {"thinking": "(异常)", "response": "(生成失败)"}
-
-    def generate_response(
-        self,
-        dialogue_topic: str,
-        dialogue_history: List[Dict[str, str]]
-    ) -> Dict[str, str]:
-        """
-        向后兼容的方法
-        """
-        return self.generate_reply(
-            persona={},
-            dialogue_topic=dialogue_topic,
-            background="",
-            dialogue_history=dialogue_history,
-            story=None
-        )
-
-    def _build_prompt(
-        self,
-        persona: dict,
-        dialogue_topic: str,
-        background: str,
-        dialogue_history: List[Dict[str, str]],
-        story: str = None
-    ) -> str:
-        """
-        构建健康助手的提示词（要求先 Thinking 后 Response）
-        """
-        # 安全获取患者信息
-        basic_info = persona.get("基本信息", {})
-        gender = basic_info.get('性别', '未知') if isinstance(basic_info, dict) else '未知'
-        age = basic_info.get('年龄', '未知') if isinstance(basic_info, dict) else '未知'
-        persona_type = persona.get('人物底色', '未知')
+    # 同步/异步调用共用的模型参数
+    CALL_PARAMS = {"model": "qwen-plus", "temperature": 0.6, "max_tokens": 2000}
 
-        # 简化背景和故事
-        background_summary = background[:150] + "..." if background and len(background) > 150 else background or "无相关背景信息"
-        story_summary = story[:100] + "..." if story and len(story) > 100 else story or ""
+    # 提示词预算与输出长度控制中的角色
+    PROMPT_ROLE = "assistant"
 
-        # 构建最近对话历史（限制在最近4-6轮，避免过长）
-        history_text = ""
-        recent_history = dialogue_history[-6:] if len(dialogue_history) > 6 else dialogue_history
-        for msg in recent_history:
-            role = "患者" if msg.get("role") == "user" else "照护师"
-            content = msg.get("content", "")
-            if len(content) > 120:
-                content = content[:117] + "..."
-            history_text += f"{role}: {content}\n"
-        current_turn = len(dialogue_history) + 1
-        prompt = f"""# 角色定位
+    # 提示词模板（类定义时预编译，实例化时填入输出格式，每轮只填入轮次、历史和按对话缓存的字段）
+    PROMPT_TEMPLATE = PromptTemplate("""# 角色定位
 你是一位专业、温暖、有耐心的糖尿病照护师，拥有丰富临床经验和优秀沟通能力。
 
 ### 核心原则（优先级顺序）
@@ -415,7 +124,10 @@ class HealthAssistantGenerator_thinking:
 - 机制解释："当身体处于应激状态时，肾上腺素会促使肝脏释放更多葡萄糖"
 - 建议："建议您今晚睡前测量一次血糖，观察夜间波动情况"
 
-# 输出格式（必须严格遵守！）
+{output_format}""")
+
+    # 文本模式的输出格式
+    OUTPUT_FORMAT = """# 输出格式（必须严格遵守！）
 Thinking:
 [你的内部思考过程，用中文，第一人称，2-5句话]
 
@@ -423,7 +135,256 @@ Response:
 [直接输出的对话内容，不要加引号或额外说明]
 """
 
-        return prompt
+    def __init__(self,
+                 api_client: LLMBackend,
+                 stream: bool = False,
+                 history: Optional[RollingHistory] = None,
+                 prompt_budget: Optional[PromptBudgetEnforcer] = None,
+                 structured_output: bool = False,
+                 length_governor: Optional[OutputLengthGovernor] = None):
+        """
+        Args:
+            api_client: API客户端实例
+            stream: 是否使用流式输出，Response 段完整后立即截断
+            history: 滚动历史策略，None 时只保留最近6条消息（每条截断到120字）
+            prompt_budget: 提示词预算，超出助手侧上限时调用前裁剪故事、背景和较早的历史
+            structured_output: 是否要求模型输出 JSON（{"thinking": ..., "response": ...}），按 schema 严格解析，
+                               不合法时只对本轮修复一次，仍不合法时用原提示词重新请求本轮（次数有限）
+            length_governor: 输出长度控制，按照护师回复的真实长度设置 max_tokens 和 stop 序列，
+                             None 时使用固定的 max_tokens
+        """
+        self.api_client = api_client
+        self.stream = stream
+        self.history = history
+        self.length_governor = length_governor
+        self.prompt_budget = prompt_budget
+        self.structured_output = structured_output
+        if structured_output:
+            self._template = self.PROMPT_TEMPLATE.partial(output_format=format_instructions())
+            self._call_params = {**self.CALL_PARAMS, "response_format": RESPONSE_FORMAT}
+            self._turn_parser = StructuredTurnParser(api_client)
+        else:
+            self._template = self.PROMPT_TEMPLATE.partial(output_format=self.OUTPUT_FORMAT)
+            self._call_params = self.CALL_PARAMS
+            self._turn_parser = None
+        self._fragments = FragmentCache()
+
+    def generate_reply(self,
+                       persona: dict,
+                       dialogue_topic: str,
+                       background: str,
+                       dialogue_history: List[Dict[str, str]],
+                       story: str = None) -> Dict[str, str]:
+        """
+        生成健康助手的一轮回复（包含 Thinking）
+        永不返回 None；结构化输出模式下本轮输出修复、重新请求后仍不合法时抛出 StructuredOutputError，
+        由调用方按单轮失败处理（丢弃该轮重新生成），不返回"(生成失败)"占位回复写进对话
+
+        Raises:
+            StructuredOutputError: 结构化输出模式下本轮输出修复、重新请求后仍不合法
+        """
+        try:
+            prompt = self._prepare_prompt(persona, dialogue_topic, background, dialogue_history, story)
+            api_result = self._request(prompt)
+            if self._turn_parser is not None:
+                return self._turn_parser.parse(
+                    api_result,
+                    caller=self.__class__.__name__,
+                    regenerate=lambda attempt: self._request(prompt, seed=attempt)
+                )
+            if api_result is None:
+                print("助手 API 返回 None")
+                return {"thinking": "(API 返回空)", "response": "(生成失败)"}
+            
+            parsed = self._parse_response(api_result)
+            return parsed
+        except (CircuitOpenError, BudgetExceededError, StructuredOutputError):
+            # 接口熔断或预算耗尽时不能吞掉异常，交给批量任务暂停/停止，避免生成一整段"(生成失败)"的对话；
+            # 结构化输出的单轮失败同样交给调用方处理
+            raise
+        except Exception as e:
+            print(f"助手生成器整体异常: {str(e)}")
+            return {"thinking": "(异常)", "response": "(生成失败)"}
+
+    async def agenerate_reply(self,
+                              persona: dict,
+                              dialogue_topic: str,
+                              background: str,
+                              dialogue_history: List[Dict[str, str]],
+                              story: str = None) -> Dict[str, str]:
+        """
+        generate_reply 的异步版本（api_client 需为 AsyncQwenAPIClient）
+        与同步版本一样永不返回 None，结构化输出模式下本轮仍不合法时抛出 StructuredOutputError
+        """
+        try:
+            prompt = self._prepare_prompt(persona, dialogue_topic, background, dialogue_history, story)
+            api_result = await self._asend(self.api_client.acall, prompt=prompt)
+            if self._turn_parser is not None:
+                return await self._turn_parser.aparse(
+                    api_result,
+                    caller=self.__class__.__name__,
+                    regenerate=lambda attempt: self._asend(self.api_client.acall, prompt=prompt, seed=attempt)
+                )
+            if api_result is None:
+                print("助手 API 返回 None")
+                return {"thinking": "(API 返回空)", "response": "(生成失败)"}
+
+            return self._parse_response(api_result)
+        except (CircuitOpenError, BudgetExceededError, StructuredOutputError):
+            raise
+        except Exception as e:
+            print(f"助手生成器整体异常: {str(e)}")
+            return {"thinking": "(异常)", "response": "(生成失败)"}
+
+    def _request(self, prompt: str, **kwargs) -> str:
+        """发送本轮请求（流式时 Response 段或 JSON 对象完整后立即截断），kwargs 为额外的请求参数"""
+        if not self.stream:
+            return self._send(self.api_client.call, prompt=prompt, **kwargs)
+        api_result = self._send(
+            self.api_client.call_stream,
+            prompt=prompt,
+            stop_when=json_object_complete if self.structured_output else response_section_complete,
+            **kwargs
+        )
+        return api_result if self.structured_output else trim_to_response_section(api_result)
+
+    def _send(self, send: Callable[..., str], **kwargs) -> str:
+        """发送本轮请求，配置了 length_governor 时按照护师回复的长度设置 max_tokens 和 stop 序列，截断时放宽重试"""
+        kwargs = {"caller": self.__class__.__name__, **self._call_params, **kwargs}
+        if self.length_governor is None:
+            return send(**kwargs)
+        return self.length_governor.call(self.PROMPT_ROLE, send, **kwargs)
+
+    async def _asend(self, send: Callable[..., Any], **kwargs) -> str:
+        """_send 的异步版本"""
+        kwargs = {"caller": self.__class__.__name__, **self._call_params, **kwargs}
+        if self.length_governor is None:
+            return await send(**kwargs)
+        return await self.length_governor.acall(self.PROMPT_ROLE, send, **kwargs)
+
+    def generate_response(
+        self,
+        dialogue_topic: str,
+        dialogue_history: List[Dict[str, str]]
+    ) -> Dict[str, str]:
+        """
+        向后兼容的方法
+        """
+        return self.generate_reply(
+            persona={},
+            dialogue_topic=dialogue_topic,
+            background="",
+            dialogue_history=dialogue_history,
+            story=None
+        )
+
+    async def agenerate_response(
+        self,
+        dialogue_topic: str,
+        dialogue_history: List[Dict[str, str]]
+    ) -> Dict[str, str]:
+        """
+        generate_response 的异步版本
+        """
+        return await self.agenerate_reply(
+            persona={},
+            dialogue_topic=dialogue_topic,
+            background="",
+            dialogue_history=dialogue_history,
+            story=None
+        )
+
+    def _prepare_prompt(
+        self,
+        persona: dict,
+        dialogue_topic: str,
+        background: str,
+        dialogue_history: List[Dict[str, str]],
+        story: str = None
+    ) -> str:
+        """
+        构建本轮的提示词，配置了 prompt_budget 时裁剪到助手侧上限以内
+        """
+        if self.prompt_budget is None:
+            return self._build_prompt(persona, dialogue_topic, background, dialogue_history, story)
+        return self.prompt_budget.fit(
+            self.PROMPT_ROLE,
+            lambda story, background, max_history: self._build_prompt(
+                persona, dialogue_topic, background, dialogue_history, story, max_history
+            ),
+            story,
+            background,
+            len(dialogue_history),
+            model=self.CALL_PARAMS["model"]
+        )
+
+    def _build_prompt(
+        self,
+        persona: dict,
+        dialogue_topic: str,
+        background: str,
+        dialogue_history: List[Dict[str, str]],
+        story: str = None,
+        max_history: Optional[int] = None
+    ) -> str:
+        """
+        构建健康助手的提示词（要求先 Thinking 后 Response）
+
+        max_history 不为 None 时（超出提示词预算）最多保留最近 max_history 条消息
+        """
+        # 整段对话内不变的字段（画像、主题、故事）预先填入模板，每轮只填入轮次、生活状态和最近历史
+        template = self._fragments.get(
+            persona,
+            ("template", dialogue_topic, story),
+            lambda: self._template.partial(**self._dialogue_fields(persona, dialogue_topic, story))
+        )
+
+        if max_history is not None:
+            recent_history = dialogue_history[max(len(dialogue_history) - min(max_history, 6), 0):]
+            history_text = "".join([self._render_history_message(msg) for msg in recent_history])
+        elif self.history is not None:
+            # 最近几条原样保留，更早的折叠成摘要
+            history_text = self.history.render(
+                dialogue_history, lambda msg: self._render_history_message(msg, max_chars=None)
+            )
+        else:
+            # 构建最近对话历史（限制在最近4-6轮，避免过长）
+            recent_history = dialogue_history[-6:] if len(dialogue_history) > 6 else dialogue_history
+            history_text = "".join([self._render_history_message(msg) for msg in recent_history])
+        current_turn = len(dialogue_history) + 1
+        # 简化背景（生活状态每轮都可能更新，不进入缓存的模板）
+        background_summary = background[:150] + "..." if background and len(background) > 150 else background or "无相关背景信息"
+        return template.render(
+            current_turn=current_turn, background_summary=background_summary, history_text=history_text
+        )
+
+    @staticmethod
+    def _dialogue_fields(persona: dict, dialogue_topic: str, story: str = None) -> Dict[str, str]:
+        """提示词中整段对话内不变的字段（按对话缓存）"""
+        # 安全获取患者信息
+        basic_info = persona.get("基本信息", {})
+        gender = basic_info.get('性别', '未知') if isinstance(basic_info, dict) else '未知'
+        age = basic_info.get('年龄', '未知') if isinstance(basic_info, dict) else '未知'
+        persona_type = persona.get('人物底色', '未知')
+
+        # 简化故事
+        story_summary = story[:100] + "..." if story and len(story) > 100 else story or ""
+        return {
+            "gender": gender,
+            "age": age,
+            "persona_type": persona_type,
+            "dialogue_topic": dialogue_topic,
+            "story_summary": story_summary
+        }
+
+    @staticmethod
+    def _render_history_message(msg: Dict[str, str], max_chars: Optional[int] = 120) -> str:
+        """最近对话记录中的一条消息，超过 max_chars 的内容截断"""
+        role = "患者" if msg.get("role") == "user" else "照护师"
+        content = msg.get("content", "")
+        if max_chars is not None and len(content) > max_chars:
+            content = content[:max_chars - 3] + "..."
+        return f"{role}: {content}\n"
 
     def _parse_response(self, response) -> Dict[str, str]:
         """
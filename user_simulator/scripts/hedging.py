@@ -0,0 +1,91 @@
+"""
+对冲请求（hedged requests）
+一次调用超过近期延迟的某个分位数仍未返回时，再发一个相同的请求，先返回的结果胜出，
+用少量额外调用削掉长尾延迟。对话是一串前后依赖的调用，单次慢响应会拖住整段对话
+"""
+import threading
+from collections import deque
+from typing import Any, Dict, Optional
+
+from .metrics import percentile
+
+
+class HedgePolicy:
+    """
+    对冲策略（线程安全，可在多个客户端之间共享）
+
+    - 触发时间：按模型统计最近 window 个成功请求的延迟，取 quantile 分位数，并限制在 [min_delay, max_delay] 之间；
+      样本数不足 min_samples 时不对冲
+    - 额外负载上限：对冲请求数不超过主请求数的 max_extra_ratio 倍
+    """
+
+    def __init__(self,
+                 quantile: float = 0.95,
+                 min_delay: float = 1.0,
+                 max_delay: Optional[float] = None,
+                 max_extra_ratio: float = 0.05,
+                 min_samples: int = 20,
+                 window: int = 500):
+        """
+        Args:
+            quantile: 触发对冲的延迟分位（0~1）
+            min_delay: 触发对冲的最短等待（秒），避免延迟很低时频繁对冲
+            max_delay: 触发对冲的最长等待（秒），None 表示不限制
+            max_extra_ratio: 对冲请求占主请求的最大比例
+            min_samples: 开始对冲前需要的延迟样本数
+            window: 每个模型保留的延迟样本数
+        """
+        self.quantile = quantile
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.max_extra_ratio = max_extra_ratio
+        self.min_samples = min_samples
+        self.window = window
+        self.requests = 0
+        self.hedges = 0
+        self._latencies: Dict[str, deque] = {}
+        self._lock = threading.Lock()
+
+    def record_latency(self, model: str, latency: float):
+        """记录一次成功请求的延迟（秒）"""
+        with self._lock:
+            if model not in self._latencies:
+                self._latencies[model] = deque(maxlen=self.window)
+            self._latencies[model].append(latency)
+
+    def hedge_delay(self, model: str) -> Optional[float]:
+        """
+        主请求发出后多少秒仍未返回时对冲
+
+        Returns:
+            等待秒数，样本不足时返回 None（不对冲）
+        """
+        with self._lock:
+            samples = sorted(self._latencies.get(model, ()))
+        if len(samples) < self.min_samples:
+            return None
+        delay = max(self.min_delay, percentile(samples, self.quantile))
+        if self.max_delay is not None:
+            delay = min(delay, self.max_delay)
+        return delay
+
+    def record_request(self):
+        """记录一次主请求"""
+        with self._lock:
+            self.requests += 1
+
+    def try_hedge(self) -> bool:
+        """额外负载未超过上限时占用一个对冲名额并返回 True"""
+        with self._lock:
+            if self.hedges + 1 > self.requests * self.max_extra_ratio:
+                return False
+            self.hedges += 1
+            return True
+
+    def stats(self) -> Dict[str, Any]:
+        """主请求数、对冲数与各模型当前的触发时间"""
+        with self._lock:
+            models = list(self._latencies)
+            stats = {"requests": self.requests, "hedges": self.hedges}
+        stats["hedge_delays"] = {model: self.hedge_delay(model) for model in models}
+        return stats
@@ -0,0 +1,258 @@
+"""
+对话历史的上下文管理
+最近几条消息原样保留，更早的消息折叠成滚动摘要，历史部分的长度有硬上限，
+对话越长提示词也不会越来越长、越来越贵。患者侧和助手侧共用同一个策略。
+"""
+import re
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from .api_client import BudgetExceededError, CircuitOpenError
+from .prompt_templates import FragmentCache
+
+
+# 摘要中每条消息保留的最长字符数
+SUMMARY_LINE_CHARS = 40
+
+_CLAUSE_SPLIT = re.compile(r"[。！？!?；;\n]")
+_HAS_NUMBER = re.compile(r"\d")
+
+
+def _role_name(msg: Dict[str, str]) -> str:
+    return "患者" if msg.get("role") == "user" else "照护师"
+
+
+def compress_message(msg: Dict[str, str], max_chars: int = SUMMARY_LINE_CHARS) -> str:
+    """
+    把一条消息压缩成一行摘要（不调用模型）
+
+    优先保留带数字的分句（血糖值、时间、剂量等），否则保留第一个分句。
+    """
+    content = str(msg.get("content", "")).strip()
+    clauses = [clause.strip() for clause in _CLAUSE_SPLIT.split(content) if clause.strip()]
+    if not clauses:
+        return ""
+    clause = next((c for c in clauses if _HAS_NUMBER.search(c)), clauses[0])
+    if len(clause) > max_chars:
+        clause = clause[:max_chars - 1] + "…"
+    return f"{_role_name(msg)}: {clause}"
+
+
+class LLMSummarizer:
+    """
+    用便宜的模型维护滚动摘要：每次有消息移出窗口时，把它们并入已有摘要
+
+    temperature=0 的调用可以被响应缓存和请求合并复用。
+    """
+
+    PROMPT = """请把下面的对话摘要和新增的对话合并成一段新的摘要。
+要求：保留患者提到的数值、症状、已经给出的建议和患者的决定，去掉寒暄；不超过{max_chars}字；直接输出摘要。
+
+### 已有摘要
+{summary}
+
+### 新增对话
+{messages}
+"""
+
+    def __init__(self, api_client: Any, model: str = "qwen-turbo", max_chars: int = 200):
+        """
+        Args:
+            api_client: API客户端（LLMBackend）
+            model: 摘要使用的模型
+            max_chars: 摘要的最长字数
+        """
+        self.api_client = api_client
+        self.model = model
+        self.max_chars = max_chars
+
+    def __call__(self, summary: str, messages: List[Dict[str, str]]) -> str:
+        prompt = self.PROMPT.format(
+            max_chars=self.max_chars,
+            summary=summary or "（无）",
+            messages="\n".join(f"{_role_name(msg)}: {msg.get('content', '')}" for msg in messages)
+        )
+        return self.api_client.call(
+            prompt=prompt,
+            model=self.model,
+            temperature=0,
+            max_tokens=self.max_chars * 2,
+            caller=self.__class__.__name__
+        ).strip()
+
+
+class RollingHistory:
+    """
+    滚动历史窗口（线程安全，可在多个生成器之间共享）
+
+    - 最近 keep_last 条消息原样保留；窗口超出 keep_last + evict_batch - 1 条时，一次移出 evict_batch 条，
+      两次移出之间提示词前缀保持不变（便于命中前缀缓存）
+    - 移出的消息并入滚动摘要，每条消息只处理一次；默认逐条抽取要点，不调用模型，
+      传入 summarizer（如 LLMSummarizer）时用模型合并摘要
+    - 摘要不超过 summary_max_tokens，摘要加原样消息不超过 max_tokens：超出时继续把最早的原样消息并入摘要，
+      最后截断摘要和单条过长的消息
+    长度默认按字符数估算（与客户端限流预估一致），可通过 count_tokens 替换（如 TokenEstimator().count）；
+    max_tokens / summary_max_tokens 及最后的截断都按 count_tokens 计，max_message_chars 按字符计。
+    """
+
+    def __init__(self,
+                 keep_last: int = 6,
+                 evict_batch: int = 4,
+                 max_tokens: int = 1500,
+                 summary_max_tokens: int = 300,
+                 max_message_chars: Optional[int] = None,
+                 summarizer: Optional[Callable[[str, List[Dict[str, str]]], str]] = None,
+                 count_tokens: Callable[[str], int] = len):
+        """
+        Args:
+            keep_last: 至少原样保留的最近消息条数
+            evict_batch: 每次移出窗口的消息条数
+            max_tokens: 历史部分（摘要 + 原样消息）的硬上限
+            summary_max_tokens: 摘要的上限
+            max_message_chars: 单条原样消息的最长字符数，None 表示不截断
+            summarizer: 摘要函数 (已有摘要, 移出的消息) -> 新摘要，None 时使用抽取式摘要
+            count_tokens: 文本长度估算函数
+        """
+        if keep_last < 1 or evict_batch < 1:
+            raise ValueError("keep_last 和 evict_batch 必须大于 0")
+        self.keep_last = keep_last
+        self.evict_batch = evict_batch
+        self.max_tokens = max_tokens
+        self.summary_max_tokens = summary_max_tokens
+        self.max_message_chars = max_message_chars
+        self.summarizer = summarizer
+        self.count_tokens = count_tokens
+        self._states = FragmentCache()
+
+    def _split_index(self, count: int) -> int:
+        """原样保留部分的起始下标，只取决于消息条数，同一段对话的两个生成器得到相同的窗口"""
+        if count < self.keep_last + self.evict_batch:
+            return 0
+        return (count - self.keep_last) // self.evict_batch * self.evict_batch
+
+    def _clip_summary(self, summary: str, limit: int) -> str:
+        """摘要超出上限时丢弃最早的部分"""
+        if limit <= 0:
+            return ""
+        if self.count_tokens(summary) <= limit:
+            return summary
+        lines = summary.split("\n")
+        while len(lines) > 1 and self.count_tokens("……\n" + "\n".join(lines)) > limit:
+            lines.pop(0)
+        clipped = "……\n" + "\n".join(lines)
+        if self.count_tokens(clipped) > limit:
+            clipped = "……" + self._clip_tokens(lines[-1], limit - self.count_tokens("……"), from_end=True)
+        return clipped
+
+    def _clip_tokens(self, text: str, limit: int, from_end: bool = False) -> str:
+        """不超过 limit 的最长前缀（from_end 时为最长后缀），按 count_tokens 二分查找截断位置"""
+        low, high = 0, len(text)
+        while low < high:
+            mid = (low + high + 1) // 2
+            part = text[len(text) - mid:] if from_end else text[:mid]
+            if self.count_tokens(part) <= limit:
+                low = mid
+            else:
+                high = mid - 1
+        return text[len(text) - low:] if from_end else text[:low]
+
+    def _merge(self, summary: str, messages: List[Dict[str, str]]) -> str:
+        """把移出窗口的消息并入摘要"""
+        if not messages:
+            return summary
+        merged = None
+        if self.summarizer is not None:
+            try:
+                merged = self.summarizer(summary, messages)
+            except (CircuitOpenError, BudgetExceededError):
+                raise
+            except Exception as e:
+                print(f"历史摘要生成失败，改用抽取式摘要: {str(e)[:100]}")
+        if not merged:
+            lines = [line for line in (compress_message(msg) for msg in messages) if line]
+            merged = "\n".join(([summary] if summary else []) + lines)
+        return self._clip_summary(merged, self.summary_max_tokens)
+
+    def _summary(self, dialogue_history: List[Dict[str, str]], split: int) -> str:
+        """前 split 条消息的滚动摘要，按对话缓存并增量更新"""
+        if split == 0:
+            return ""
+        # 每段对话一个状态：已摘要的条数、最后一条已摘要的消息、摘要；按对话加锁，不同对话的摘要互不阻塞
+        state = self._states.get(
+            dialogue_history, "state", lambda: {"lock": threading.Lock(), "count": 0, "last": None, "summary": ""}
+        )
+        with state["lock"]:
+            summarized, summary = state["count"], state["summary"]
+            if summarized > split or (summarized and dialogue_history[summarized - 1] is not state["last"]):
+                # 历史被截断或改写，重新摘要
+                summarized, summary = 0, ""
+            if summarized < split:
+                summary = self._merge(summary, dialogue_history[summarized:split])
+                state.update(count=split, last=dialogue_history[split - 1], summary=summary)
+            return summary
+
+    @staticmethod
+    def _truncate_chars(msg: Dict[str, str], max_chars: Optional[int]) -> Dict[str, str]:
+        """单条消息超过 max_chars 个字符时截断（max_message_chars）"""
+        if max_chars is None or len(msg.get("content", "")) <= max_chars:
+            return msg
+        return {**msg, "content": msg["content"][:max(max_chars - 3, 0)] + "..."}
+
+    def _truncate_tokens(self, msg: Dict[str, str], limit: int) -> Dict[str, str]:
+        """单条消息超过 limit 个 token（按 count_tokens）时截断，省略号计入上限"""
+        content = msg.get("content", "")
+        if self.count_tokens(content) <= limit:
+            return msg
+        budget = limit - self.count_tokens("...")
+        return {**msg, "content": self._clip_tokens(content, budget) + "..." if budget > 0 else ""}
+
+    def window(self, dialogue_history: List[Dict[str, str]]) -> Tuple[str, List[Dict[str, str]]]:
+        """
+        计算本轮提示词中的历史
+
+        Args:
+            dialogue_history: 完整的对话历史
+
+        Returns:
+            (更早消息的摘要，无则为空字符串, 原样保留的最近消息)
+        """
+        split = self._split_index(len(dialogue_history))
+        summary = self._summary(dialogue_history, split)
+        recent = [self._truncate_chars(msg, self.max_message_chars) for msg in dialogue_history[split:]]
+
+        def cost(text: str) -> int:
+            return self.count_tokens(text)
+
+        recent_cost = sum(cost(msg.get("content", "")) for msg in recent)
+        if cost(summary) + recent_cost <= self.max_tokens:
+            return summary, recent
+
+        # 超出硬上限：把最早的原样消息抽取式并入摘要（只对本轮生效，不写回缓存）
+        while len(recent) > 1 and cost(summary) + recent_cost > self.max_tokens:
+            dropped = recent.pop(0)
+            recent_cost -= cost(dropped.get("content", ""))
+            line = compress_message(dropped)
+            summary = f"{summary}\n{line}" if summary else line
+        summary = self._clip_summary(summary, min(self.summary_max_tokens, self.max_tokens - recent_cost))
+        if recent and cost(summary) + recent_cost > self.max_tokens:
+            recent[-1] = self._truncate_tokens(recent[-1], max(self.max_tokens - cost(summary), 0))
+        return summary, recent
+
+    def render(self,
+               dialogue_history: List[Dict[str, str]],
+               render_message: Callable[[Dict[str, str]], str],
+               summary_title: str = "（更早的对话摘要）") -> str:
+        """
+        把窗口渲染成提示词中的历史文本
+
+        Args:
+            dialogue_history: 完整的对话历史
+            render_message: 把一条原样消息渲染成文本的函数
+            summary_title: 摘要前的标题行
+
+        Returns:
+            摘要 + 原样消息的文本
+        """
+        summary, recent = self.window(dialogue_history)
+        text = f"{summary_title}\n{summary}\n" if summary else ""
+        return text + "".join(render_message(msg) for msg in recent)
@@ -0,0 +1,211 @@
+"""
+多 key / 多接入点负载均衡
+每个 key 有独立的限流配额和健康状态，调用路由到负载最低的健康 key，配额错误的 key 临时摘除
+"""
+import asyncio
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from .rate_limiter import RateLimiter
+
+
+# 遇到即摘除的状态码：429 为配额/限流，401/403 为 key 失效或欠费
+QUOTA_STATUS_CODES = {429}
+AUTH_STATUS_CODES = {401, 403}
+
+
+class APIEndpoint:
+    """一个 (API key, 接入点) 组合"""
+
+    def __init__(self,
+                 api_key: str,
+                 base_url: str,
+                 rate_limits: Optional[Dict[str, Dict[str, float]]] = None):
+        """
+        Args:
+            api_key: API密钥
+            base_url: 接入点URL
+            rate_limits: 该 key 的按模型配额，格式同 config.MODEL_RATE_LIMITS，None 表示不限流
+        """
+        self.api_key = api_key
+        self.base_url = base_url
+        self.rate_limiter = RateLimiter(rate_limits) if rate_limits else None
+        self.headers = {"Authorization": f"Bearer {api_key}"}
+        self.in_flight = 0
+        self.calls = 0
+        self.errors = 0
+        self.consecutive_failures = 0
+        self.ejections = 0
+        self.ejection_streak = 0
+        self.ejected_until = 0.0
+
+    @property
+    def name(self) -> str:
+        """日志中使用的脱敏名称"""
+        return f"{self.api_key[:3]}...{self.api_key[-4:]}" if len(self.api_key) > 8 else "***"
+
+    def is_healthy(self, now: float) -> bool:
+        return now >= self.ejected_until
+
+
+class KeyPool:
+    """
+    API key 池（线程安全，也可在协程中使用）
+
+    选择策略：在健康的 key 中按在途请求数从少到多尝试扣减各自的配额，取第一个可以立即发出的；
+    所有 key 都需要等待时，等待最短的那个时间后再选。
+    摘除策略：429 立即摘除（时长取 Retry-After 与指数退避的较大值），401/403 按最长时长摘除，
+    其他瞬时错误连续 failure_threshold 次后摘除。全部 key 都被摘除时，选最早恢复的那个继续调用。
+    """
+
+    def __init__(self,
+                 endpoints: List[APIEndpoint],
+                 eject_seconds: float = 30.0,
+                 max_eject_seconds: float = 600.0,
+                 failure_threshold: int = 3):
+        """
+        Args:
+            endpoints: key 列表
+            eject_seconds: 首次摘除的时长（秒），连续摘除（中间没有成功调用）时翻倍
+            max_eject_seconds: 单次摘除的最长时长（秒）
+            failure_threshold: 非配额类瞬时错误连续多少次后摘除
+        """
+        if not endpoints:
+            raise ValueError("KeyPool 至少需要一个 key")
+        self.endpoints = endpoints
+        self.eject_seconds = eject_seconds
+        self.max_eject_seconds = max_eject_seconds
+        self.failure_threshold = failure_threshold
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_specs(cls,
+                   specs: List[str],
+                   default_base_url: str,
+                   rate_limits: Optional[Dict[str, Dict[str, float]]] = None,
+                   **kwargs) -> "KeyPool":
+        """
+        从 "key" 或 "key@base_url" 形式的配置创建
+
+        Args:
+            specs: key 配置列表
+            default_base_url: 未指定接入点时使用的URL
+            rate_limits: 每个 key 各自的按模型配额
+        """
+        endpoints = []
+        for spec in specs:
+            api_key, _, base_url = spec.partition("@")
+            endpoints.append(APIEndpoint(api_key.strip(), base_url.strip() or default_base_url, rate_limits))
+        return cls(endpoints, **kwargs)
+
+    def _try_select(self, model: str, tokens: float) -> Tuple[Optional[APIEndpoint], float]:
+        """
+        尝试选出一个可以立即发出请求的 key（已扣减其配额）
+
+        Returns:
+            (选中的 key, 0)；没有可立即使用的 key 时返回 (None, 需要等待的秒数)
+        """
+        with self._lock:
+            now = time.monotonic()
+            healthy = [ep for ep in self.endpoints if ep.is_healthy(now)]
+            if not healthy:
+                healthy = [min(self.endpoints, key=lambda ep: ep.ejected_until)]
+            healthy.sort(key=lambda ep: (ep.in_flight, ep.calls))
+            min_wait = None
+            for endpoint in healthy:
+                wait = endpoint.rate_limiter.try_acquire(model, tokens) if endpoint.rate_limiter else 0.0
+                if wait <= 0:
+                    endpoint.in_flight += 1
+                    endpoint.calls += 1
+                    return endpoint, 0.0
+                min_wait = wait if min_wait is None else min(min_wait, wait)
+            return None, min_wait
+
+    def acquire(self, model: str, tokens: float = 0) -> APIEndpoint:
+        """
+        选出负载最低、配额允许的健康 key，必要时阻塞等待
+
+        Args:
+            model: 模型名称
+            tokens: 本次请求预估消耗的token数
+
+        Returns:
+            选中的 key，调用结束后必须调用 release
+        """
+        while True:
+            endpoint, wait = self._try_select(model, tokens)
+            if endpoint is not None:
+                return endpoint
+            time.sleep(wait)
+
+    async def aacquire(self, model: str, tokens: float = 0) -> APIEndpoint:
+        """acquire 的协程版本"""
+        while True:
+            endpoint, wait = self._try_select(model, tokens)
+            if endpoint is not None:
+                return endpoint
+            await asyncio.sleep(wait)
+
+    def release(self,
+                endpoint: APIEndpoint,
+                status_code: Optional[int] = None,
+                retry_after: Optional[float] = None,
+                transient: bool = False,
+                failed: bool = False,
+                cancelled: bool = False):
+        """
+        归还 key，并根据调用结果更新健康状态
+
+        Args:
+            endpoint: acquire 返回的 key
+            status_code: 失败时的HTTP状态码
+            retry_after: 服务端要求的等待秒数
+            transient: 失败是否为瞬时错误
+            failed: 调用是否失败
+            cancelled: 调用被调用方取消（如对冲落败），只归还 key，不更新健康状态
+        """
+        with self._lock:
+            endpoint.in_flight -= 1
+            if cancelled:
+                return
+            if not failed:
+                endpoint.consecutive_failures = 0
+                endpoint.ejection_streak = 0
+                return
+            endpoint.errors += 1
+            endpoint.consecutive_failures += 1
+            backoff = min(self.max_eject_seconds, self.eject_seconds * (2 ** min(endpoint.ejection_streak, 10)))
+            if status_code in AUTH_STATUS_CODES:
+                duration = self.max_eject_seconds
+            elif status_code in QUOTA_STATUS_CODES:
+                duration = min(self.max_eject_seconds, max(backoff, retry_after or 0.0))
+            elif transient and endpoint.consecutive_failures >= self.failure_threshold:
+                duration = backoff
+            else:
+                return
+            endpoint.ejected_until = time.monotonic() + duration
+            endpoint.ejections += 1
+            endpoint.ejection_streak += 1
+            endpoint.consecutive_failures = 0
+        print(f"API key {endpoint.name} 暂时摘除 {duration:.0f} 秒（状态码 {status_code}）")
+
+    def has_healthy(self) -> bool:
+        """是否还有未被摘除的 key"""
+        with self._lock:
+            now = time.monotonic()
+            return any(ep.is_healthy(now) for ep in self.endpoints)
+
+    def stats(self) -> List[Dict[str, Any]]:
+        """每个 key 的调用统计与健康状态"""
+        with self._lock:
+            now = time.monotonic()
+            return [{
+                "key": ep.name,
+                "base_url": ep.base_url,
+                "calls": ep.calls,
+                "errors": ep.errors,
+                "in_flight": ep.in_flight,
+                "ejections": ep.ejections,
+                "healthy": ep.is_healthy(now)
+            } for ep in self.endpoints]
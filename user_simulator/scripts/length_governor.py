@@ -0,0 +1,206 @@
+"""
+按角色的输出长度控制
+从已生成的对话语料（by_topic_and_risk/<主题>/<风险>.jsonl）学习各角色回复的真实长度分布，
+据此设置 max_tokens 和 stop 序列：正常长度的回复不受影响，跑偏（续写对方台词、长篇大论）的回复尽早结束。
+只有回复确实被截断（finish_reason 为 length）时才放宽上限重试，每轮的最坏延迟有界。
+"""
+import json
+import math
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional, Sequence
+
+from .budget import track_usage
+from .metrics import percentile
+from .token_estimator import TokenEstimator
+
+
+# 各角色跑偏时的典型续写：开始替对方说话（写法与提示词中的对话历史一致），query 只有一段
+STOP_SEQUENCES = {
+    "patient": ["\n照护师:", "\n照护师："],
+    "assistant": ["\n患者:", "\n患者："],
+    "baseline_patient": ["\n助手:", "\n助手："],
+    "topic_query": ["\n\n"]
+}
+
+
+def iter_corpus_records(corpus_dir: str) -> Iterator[Dict[str, Any]]:
+    """逐条读取语料目录下所有 .jsonl 文件中的对话记录（跳过无法解析的行），目录不存在时为空"""
+    for path in sorted(Path(corpus_dir).glob("**/*.jsonl")):
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+
+def render_output(msg: Dict[str, Any]) -> str:
+    """按生成器的文本格式还原一条消息对应的模型输出（患者只有 Response，照护师先 Thinking 后 Response）"""
+    content = msg.get("content") or ""
+    if msg.get("role") == "assistant":
+        return f"Thinking:\n{msg.get('thinking') or ''}\n\nResponse:\n{content}"
+    return f"Response:\n{content}"
+
+
+def corpus_output_lengths(corpus_dir: str, estimator: Optional[TokenEstimator] = None) -> Dict[str, List[int]]:
+    """
+    从对话语料中还原各角色每次输出的 token 数（离线预估）
+
+    输出按生成器的文本格式还原：患者为 "Response:\\n<回复>"，照护师为 "Thinking:\\n<思考>\\n\\nResponse:\\n<回复>"，
+    基线患者只有回复；主题 query 取记录 metadata.topic 中的真实主题（多段对话共用同一主题时只计一次），
+    与查询时的角色是同一类输出。
+
+    Args:
+        corpus_dir: 语料目录，读取其下所有 .jsonl 文件
+        estimator: token 预估器
+
+    Returns:
+        {角色: [token 数, ...]}，目录不存在时各角色为空
+    """
+    estimator = estimator or TokenEstimator()
+    samples = {role: [] for role in STOP_SEQUENCES}
+    topics = set()
+    for record in iter_corpus_records(corpus_dir):
+        topic = (record.get("metadata") or {}).get("topic")
+        if isinstance(topic, str) and topic.strip() and topic not in topics:
+            topics.add(topic)
+            samples["topic_query"].append(estimator.count(topic.strip()))
+        for msg in record.get("dialogue_history") or []:
+            if msg.get("role") == "user":
+                samples["patient"].append(estimator.count(render_output(msg)))
+                samples["baseline_patient"].append(estimator.count(msg.get("content") or ""))
+            elif msg.get("role") == "assistant":
+                samples["assistant"].append(estimator.count(render_output(msg)))
+    return samples
+
+
+class OutputLengthGovernor:
+    """
+    按角色设置 max_tokens 与 stop 序列，截断时逐级放宽（线程安全，可在多个生成器之间共享）
+
+    max_tokens = 语料中该角色输出长度的 quantile 分位数 × headroom（不低于 min_tokens），
+    调用方原来的固定 max_tokens 作为上限。回复被截断时翻倍重试，最多 max_escalations 次，
+    因此一轮最多 max_escalations + 1 次调用，每次的生成长度都不超过上限。
+    """
+
+    def __init__(self,
+                 samples: Dict[str, Sequence[int]],
+                 quantile: float = 0.99,
+                 headroom: float = 1.5,
+                 min_tokens: int = 64,
+                 max_escalations: int = 2,
+                 stop_sequences: Optional[Dict[str, List[str]]] = None):
+        """
+        Args:
+            samples: 角色 -> 输出 token 数样本，没有样本的角色沿用调用方的 max_tokens
+            quantile: 取样本的分位数
+            headroom: 分位数之上预留的余量倍数（结构化输出的 JSON 外壳、与语料的风格差异）
+            min_tokens: max_tokens 下限
+            max_escalations: 截断后最多放宽几次
+            stop_sequences: 角色 -> stop 序列，None 时使用 STOP_SEQUENCES
+        """
+        self.quantile = quantile
+        self.headroom = headroom
+        self.min_tokens = min_tokens
+        self.max_escalations = max_escalations
+        self.stop_sequences = STOP_SEQUENCES if stop_sequences is None else stop_sequences
+        self.limits: Dict[str, int] = {}
+        for role, values in samples.items():
+            value = percentile(sorted(values), quantile)
+            if value is not None:
+                self.limits[role] = max(min_tokens, int(math.ceil(value * headroom)))
+
+    @classmethod
+    def from_corpus(cls, corpus_dir: str, estimator: Optional[TokenEstimator] = None, **kwargs) -> "OutputLengthGovernor":
+        """
+        从对话语料学习各角色的输出长度
+
+        Args:
+            corpus_dir: 语料目录
+            estimator: token 预估器
+            **kwargs: 其余参数同 __init__
+
+        Returns:
+            OutputLengthGovernor
+        """
+        samples = corpus_output_lengths(corpus_dir, estimator)
+        governor = cls(samples, **kwargs)
+        learned = "，".join(f"{role} {limit}（{len(samples[role])} 条）" for role, limit in governor.limits.items())
+        print(f"输出长度上限（语料 {corpus_dir}）: {learned or '无样本，沿用固定 max_tokens'}")
+        return governor
+
+    def max_tokens(self, role: str, ceiling: Optional[int] = None, replies: int = 1) -> Optional[int]:
+        """
+        某角色首次调用的 max_tokens
+
+        Args:
+            role: 角色（"patient" / "assistant" / "baseline_patient" / "topic_query"）
+            ceiling: 调用方原来的固定 max_tokens，作为上限
+            replies: 一次输出的回复条数（多候选）
+
+        Returns:
+            max_tokens，没有样本时返回 ceiling
+        """
+        limit = self.limits.get(role)
+        if limit is None:
+            return ceiling
+        limit *= replies
+        return limit if ceiling is None else min(limit, ceiling)
+
+    def _plan(self, role: str, kwargs: Dict[str, Any]) -> Optional[int]:
+        """填入 stop 序列，返回调用方原来的 max_tokens（放宽的上限）"""
+        ceiling = kwargs.pop("max_tokens", None)
+        if self.stop_sequences.get(role) and "stop" not in kwargs:
+            kwargs["stop"] = self.stop_sequences[role]
+        return ceiling
+
+    def _escalate(self, role: str, max_tokens: Optional[int], ceiling: Optional[int], escalation: int) -> Optional[int]:
+        """截断后的下一个 max_tokens，不再放宽时返回 None"""
+        if max_tokens is None or escalation >= self.max_escalations or (ceiling is not None and max_tokens >= ceiling):
+            print(f"{role} 回复被截断（max_tokens={max_tokens}），已达放宽上限")
+            return None
+        escalated = max_tokens * 2 if ceiling is None else min(max_tokens * 2, ceiling)
+        print(f"{role} 回复被截断（max_tokens={max_tokens}），放宽到 {escalated} 重试")
+        return escalated
+
+    def call(self, role: str, send: Callable[..., str], *args, replies: int = 1, **kwargs) -> str:
+        """
+        按角色的长度上限调用，截断时逐级放宽重试
+
+        Args:
+            role: 角色
+            send: 调用函数，如 api_client.call / call_with_messages / call_stream
+            *args: 传给 send 的位置参数
+            replies: 一次输出的回复条数（多候选）
+            **kwargs: 传给 send 的参数，其中 max_tokens 作为放宽的上限
+
+        Returns:
+            生成的文本（放宽到上限后仍被截断时返回截断的文本）
+        """
+        ceiling = self._plan(role, kwargs)
+        max_tokens = self.max_tokens(role, ceiling, replies)
+        escalation = 0
+        while True:
+            with track_usage() as usage:
+                text = send(*args, max_tokens=max_tokens, **kwargs)
+            if not usage.truncated_calls:
+                return text
+            max_tokens = self._escalate(role, max_tokens, ceiling, escalation)
+            if max_tokens is None:
+                return text
+            escalation += 1
+
+    async def acall(self, role: str, send: Callable[..., Awaitable[str]], *args, replies: int = 1, **kwargs) -> str:
+        """call 的异步版本（send 为 api_client.acall / acall_with_messages）"""
+        ceiling = self._plan(role, kwargs)
+        max_tokens = self.max_tokens(role, ceiling, replies)
+        escalation = 0
+        while True:
+            with track_usage() as usage:
+                text = await send(*args, max_tokens=max_tokens, **kwargs)
+            if not usage.truncated_calls:
+                return text
+            max_tokens = self._escalate(role, max_tokens, ceiling, escalation)
+            if max_tokens is None:
+                return text
+            escalation += 1
@@ -0,0 +1,383 @@
+"""
+API调用指标
+按 (模型, 调用方) 统计延迟分布、token用量、错误与重试次数，可导出为 JSON 快照或 Prometheus 文本格式
+"""
+import json
+import os
+import threading
+from collections import deque
+from typing import Any, Dict, List, Optional, Tuple
+
+
+LATENCY_QUANTILES = (0.5, 0.95, 0.99)
+
+
+def percentile(sorted_samples: List[float], q: float) -> Optional[float]:
+    """
+    最近秩法求分位数
+
+    Args:
+        sorted_samples: 已排序的样本
+        q: 分位（0~1）
+
+    Returns:
+        分位数，样本为空时返回 None
+    """
+    if not sorted_samples:
+        return None
+    return sorted_samples[int(q * (len(sorted_samples) - 1))]
+
+
+class _SeriesStats:
+    """单个 (模型, 调用方) 的累计统计"""
+
+    def __init__(self, max_samples: int):
+        self.calls = 0
+        self.errors: Dict[str, int] = {}
+        self.retries = 0
+        self.cache_hits = 0
+        self.coalesced = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.estimated_input_tokens = 0
+        self.estimated_actual_tokens = 0
+        self.latency_sum = 0.0
+        self.latencies = deque(maxlen=max_samples)
+        self.stream_calls = 0
+        self.early_stops = 0
+        self.ttfts = deque(maxlen=max_samples)
+
+
+class APIMetrics:
+    """
+    API调用指标收集器（线程安全）
+
+    延迟只统计真正发出的调用（含重试等待），缓存命中和合并到在途请求上的调用单独计数。
+    分位数基于最近 max_samples 个样本计算，计数和总和是全量累计值。
+    """
+
+    def __init__(self, max_samples: int = 10000):
+        """
+        Args:
+            max_samples: 每个 (模型, 调用方) 保留的延迟样本数
+        """
+        self.max_samples = max_samples
+        self._series: Dict[Tuple[str, str], _SeriesStats] = {}
+        self._gauges: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def _get(self, model: str, caller: Optional[str]) -> _SeriesStats:
+        """取出对应的统计项，调用方需持有锁"""
+        key = (model, caller or "unknown")
+        if key not in self._series:
+            self._series[key] = _SeriesStats(self.max_samples)
+        return self._series[key]
+
+    def record_call(self,
+                    model: str,
+                    caller: Optional[str],
+                    latency: float,
+                    usage: Optional[Dict[str, int]] = None,
+                    error: Optional[str] = None,
+                    estimated_input_tokens: Optional[int] = None):
+        """
+        记录一次调用（一次逻辑调用，重试不重复计数）
+
+        Args:
+            model: 模型名称
+            caller: 调用方（生成器类名等）
+            latency: 从发起到返回/放弃的秒数
+            usage: 接口返回的token用量
+            error: 失败原因（HTTP状态码或异常类型），成功时为 None
+            estimated_input_tokens: 调用前离线预估的输入 token 数，与真实输入 token 数成对累计
+        """
+        with self._lock:
+            stats = self._get(model, caller)
+            stats.calls += 1
+            stats.latency_sum += latency
+            stats.latencies.append(latency)
+            if usage:
+                stats.input_tokens += usage.get("input_tokens", 0)
+                stats.output_tokens += usage.get("output_tokens", 0)
+                if estimated_input_tokens is not None and usage.get("input_tokens"):
+                    stats.estimated_input_tokens += estimated_input_tokens
+                    stats.estimated_actual_tokens += usage["input_tokens"]
+            if error is not None:
+                stats.errors[error] = stats.errors.get(error, 0) + 1
+
+    def record_retry(self, model: str, caller: Optional[str]):
+        """记录一次重试"""
+        with self._lock:
+            self._get(model, caller).retries += 1
+
+    def record_cache_hit(self, model: str, caller: Optional[str]):
+        """记录一次缓存命中"""
+        with self._lock:
+            self._get(model, caller).cache_hits += 1
+
+    def record_coalesced(self, model: str, caller: Optional[str]):
+        """记录一次被合并到在途请求上的调用"""
+        with self._lock:
+            self._get(model, caller).coalesced += 1
+
+    def record_hedge(self, model: str, caller: Optional[str], won: bool = False):
+        """
+        记录一次对冲
+
+        Args:
+            won: False 表示发出了一个对冲请求，True 表示对冲请求先于主请求返回
+        """
+        with self._lock:
+            stats = self._get(model, caller)
+            if won:
+                stats.hedge_wins += 1
+            else:
+                stats.hedges += 1
+
+    def record_usage(self, model: str, caller: Optional[str], usage: Dict[str, int]):
+        """记录不对应逻辑调用的token用量（如落败的对冲请求）"""
+        with self._lock:
+            stats = self._get(model, caller)
+            stats.input_tokens += usage.get("input_tokens", 0)
+            stats.output_tokens += usage.get("output_tokens", 0)
+
+    def record_stream(self, model: str, caller: Optional[str], ttft: Optional[float], early_stop: bool):
+        """
+        记录一次流式调用
+
+        Args:
+            ttft: 首token延迟（秒），没有收到任何内容时为 None
+            early_stop: 是否被调用方提前截断
+        """
+        with self._lock:
+            stats = self._get(model, caller)
+            stats.stream_calls += 1
+            if early_stop:
+                stats.early_stops += 1
+            if ttft is not None:
+                stats.ttfts.append(ttft)
+
+    def set_gauge(self, name: str, value: float):
+        """
+        设置瞬时值指标（如当前并发上限）
+
+        Args:
+            name: 指标名（导出为 Prometheus 时加前缀）
+            value: 当前值
+        """
+        with self._lock:
+            self._gauges[name] = value
+
+    def total_calls(self) -> int:
+        """所有模型、调用方的调用总数"""
+        with self._lock:
+            return sum(stats.calls for stats in self._series.values())
+
+    def stream_summary(self) -> Dict[str, Any]:
+        """
+        流式调用汇总
+
+        Returns:
+            {"stream_calls", "early_stops", "ttft_avg", "ttft_p50", "ttft_p95"}，时间单位为秒
+        """
+        with self._lock:
+            samples = sorted(t for stats in self._series.values() for t in stats.ttfts)
+            calls = sum(stats.stream_calls for stats in self._series.values())
+            early_stops = sum(stats.early_stops for stats in self._series.values())
+        return {
+            "stream_calls": calls,
+            "early_stops": early_stops,
+            "ttft_avg": sum(samples) / len(samples) if samples else None,
+            "ttft_p50": percentile(samples, 0.5),
+            "ttft_p95": percentile(samples, 0.95)
+        }
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        导出 JSON 快照
+
+        Returns:
+            {"series": [每个 (模型, 调用方) 的统计], "totals": 汇总, "gauges": 瞬时值指标}
+        """
+        series = []
+        totals = {"calls": 0, "errors": 0, "retries": 0, "cache_hits": 0, "coalesced": 0,
+                  "hedges": 0, "hedge_wins": 0, "input_tokens": 0, "output_tokens": 0,
+                  "estimated_input_tokens": 0, "estimated_actual_tokens": 0, "latency_sum": 0.0}
+        with self._lock:
+            items = sorted(self._series.items())
+            for (model, caller), stats in items:
+                latencies = sorted(stats.latencies)
+                ttfts = sorted(stats.ttfts)
+                error_count = sum(stats.errors.values())
+                series.append({
+                    "model": model,
+                    "caller": caller,
+                    "calls": stats.calls,
+                    "errors": error_count,
+                    "errors_by_reason": dict(stats.errors),
+                    "retries": stats.retries,
+                    "cache_hits": stats.cache_hits,
+                    "coalesced": stats.coalesced,
+                    "hedges": stats.hedges,
+                    "hedge_wins": stats.hedge_wins,
+                    "input_tokens": stats.input_tokens,
+                    "output_tokens": stats.output_tokens,
+                    "estimated_input_tokens": stats.estimated_input_tokens,
+                    "estimated_actual_tokens": stats.estimated_actual_tokens,
+                    "estimate_error": _relative_error(stats.estimated_input_tokens, stats.estimated_actual_tokens),
+                    "latency_sum": stats.latency_sum,
+                    "latency_avg": stats.latency_sum / stats.calls if stats.calls else None,
+                    "latency_p50": percentile(latencies, 0.5),
+                    "latency_p95": percentile(latencies, 0.95),
+                    "latency_p99": percentile(latencies, 0.99),
+                    "stream_calls": stats.stream_calls,
+                    "early_stops": stats.early_stops,
+                    "ttft_p50": percentile(ttfts, 0.5),
+                    "ttft_p95": percentile(ttfts, 0.95)
+                })
+                totals["calls"] += stats.calls
+                totals["errors"] += error_count
+                totals["retries"] += stats.retries
+                totals["cache_hits"] += stats.cache_hits
+                totals["coalesced"] += stats.coalesced
+                totals["hedges"] += stats.hedges
+                totals["hedge_wins"] += stats.hedge_wins
+                totals["input_tokens"] += stats.input_tokens
+                totals["output_tokens"] += stats.output_tokens
+                totals["estimated_input_tokens"] += stats.estimated_input_tokens
+                totals["estimated_actual_tokens"] += stats.estimated_actual_tokens
+                totals["latency_sum"] += stats.latency_sum
+            gauges = dict(self._gauges)
+        totals["estimate_error"] = _relative_error(totals["estimated_input_tokens"], totals["estimated_actual_tokens"])
+        return {"series": series, "totals": totals, "gauges": gauges}
+
+    def to_prometheus(self, prefix: str = "qwen_api") -> str:
+        """
+        导出 Prometheus 文本格式（延迟以 summary 形式给出分位数）
+
+        Args:
+            prefix: 指标名前缀
+
+        Returns:
+            Prometheus exposition 文本
+        """
+        with self._lock:
+            items = sorted(self._series.items())
+            rows = []
+            for (model, caller), stats in items:
+                rows.append((model, caller, stats.calls, dict(stats.errors), stats.retries, stats.cache_hits,
+                             stats.input_tokens, stats.output_tokens, stats.latency_sum,
+                             sorted(stats.latencies), stats.stream_calls, stats.early_stops, stats.coalesced,
+                             stats.hedges, stats.hedge_wins, stats.estimated_input_tokens))
+            gauges = dict(self._gauges)
+
+        def labels(model: str, caller: str, **extra) -> str:
+            pairs = {"model": model, "caller": caller, **extra}
+            return ",".join(f'{key}="{_escape_label(str(value))}"' for key, value in pairs.items())
+
+        lines = [
+            f"# HELP {prefix}_calls_total API调用次数（不含缓存命中，重试不重复计数）",
+            f"# TYPE {prefix}_calls_total counter"
+        ]
+        lines += [f"{prefix}_calls_total{{{labels(r[0], r[1])}}} {r[2]}" for r in rows]
+
+        lines += [f"# HELP {prefix}_errors_total 最终失败的调用次数", f"# TYPE {prefix}_errors_total counter"]
+        for r in rows:
+            for reason, count in sorted(r[3].items()):
+                lines.append(f"{prefix}_errors_total{{{labels(r[0], r[1], reason=reason)}}} {count}")
+
+        lines += [f"# HELP {prefix}_retries_total 重试次数", f"# TYPE {prefix}_retries_total counter"]
+        lines += [f"{prefix}_retries_total{{{labels(r[0], r[1])}}} {r[4]}" for r in rows]
+
+        lines += [f"# HELP {prefix}_cache_hits_total 响应缓存命中次数", f"# TYPE {prefix}_cache_hits_total counter"]
+        lines += [f"{prefix}_cache_hits_total{{{labels(r[0], r[1])}}} {r[5]}" for r in rows]
+
+        lines += [f"# HELP {prefix}_coalesced_total 合并到相同在途请求上的调用次数",
+                  f"# TYPE {prefix}_coalesced_total counter"]
+        lines += [f"{prefix}_coalesced_total{{{labels(r[0], r[1])}}} {r[12]}" for r in rows]
+
+        lines += [f"# HELP {prefix}_hedges_total 发出的对冲请求数", f"# TYPE {prefix}_hedges_total counter"]
+        lines += [f"{prefix}_hedges_total{{{labels(r[0], r[1])}}} {r[13]}" for r in rows if r[13]]
+        lines += [f"# HELP {prefix}_hedge_wins_total 对冲请求先于主请求返回的次数",
+                  f"# TYPE {prefix}_hedge_wins_total counter"]
+        lines += [f"{prefix}_hedge_wins_total{{{labels(r[0], r[1])}}} {r[14]}" for r in rows if r[13]]
+
+        lines += [f"# HELP {prefix}_tokens_total 接口返回的token用量", f"# TYPE {prefix}_tokens_total counter"]
+        for r in rows:
+            lines.append(f"{prefix}_tokens_total{{{labels(r[0], r[1], direction='input')}}} {r[6]}")
+            lines.append(f"{prefix}_tokens_total{{{labels(r[0], r[1], direction='output')}}} {r[7]}")
+            if r[15]:
+                lines.append(f"{prefix}_tokens_total{{{labels(r[0], r[1], direction='input_estimated')}}} {r[15]}")
+
+        lines += [f"# HELP {prefix}_latency_seconds 调用延迟（含重试等待）", f"# TYPE {prefix}_latency_seconds summary"]
+        for r in rows:
+            for q in LATENCY_QUANTILES:
+                value = percentile(r[9], q)
+                if value is not None:
+                    lines.append(f"{prefix}_latency_seconds{{{labels(r[0], r[1], quantile=q)}}} {value:.6f}")
+            lines.append(f"{prefix}_latency_seconds_sum{{{labels(r[0], r[1])}}} {r[8]:.6f}")
+            lines.append(f"{prefix}_latency_seconds_count{{{labels(r[0], r[1])}}} {r[2]}")
+
+        lines += [f"# HELP {prefix}_stream_early_stops_total 流式调用被提前截断的次数",
+                  f"# TYPE {prefix}_stream_early_stops_total counter"]
+        lines += [f"{prefix}_stream_early_stops_total{{{labels(r[0], r[1])}}} {r[11]}" for r in rows if r[10]]
+
+        for name, value in sorted(gauges.items()):
+            lines += [f"# TYPE {prefix}_{name} gauge", f"{prefix}_{name} {value}"]
+        return "\n".join(lines) + "\n"
+
+    def save(self, json_path: Optional[str] = None, prometheus_path: Optional[str] = None):
+        """
+        把指标写入文件
+
+        Args:
+            json_path: JSON 快照路径
+            prometheus_path: Prometheus 文本路径（可供 node_exporter textfile collector 读取）
+        """
+        if json_path:
+            os.makedirs(os.path.dirname(os.path.abspath(json_path)), exist_ok=True)
+            with open(json_path, 'w', encoding='utf-8') as f:
+                json.dump(self.snapshot(), f, ensure_ascii=False, indent=2)
+        if prometheus_path:
+            os.makedirs(os.path.dirname(os.path.abspath(prometheus_path)), exist_ok=True)
+            with open(prometheus_path, 'w', encoding='utf-8') as f:
+                f.write(self.to_prometheus())
+
+    def print_summary(self):
+        """打印按 (模型, 调用方) 分组的简要统计"""
+        snapshot = self.snapshot()
+        print("\nAPI调用统计:")
+        for row in snapshot["series"]:
+            p50 = f"{row['latency_p50']:.2f}s" if row["latency_p50"] is not None else "N/A"
+            p95 = f"{row['latency_p95']:.2f}s" if row["latency_p95"] is not None else "N/A"
+            p99 = f"{row['latency_p99']:.2f}s" if row["latency_p99"] is not None else "N/A"
+            print(f"  [{row['model']}] {row['caller']}: {row['calls']} 次调用, "
+                  f"p50/p95/p99 {p50}/{p95}/{p99}, "
+                  f"token 输入 {row['input_tokens']} / 输出 {row['output_tokens']}, "
+                  f"错误 {row['errors']}, 重试 {row['retries']}, 缓存命中 {row['cache_hits']}, 合并 {row['coalesced']}"
+                  + (f", 对冲 {row['hedges']}（胜出 {row['hedge_wins']}）" if row["hedges"] else "")
+                  + _format_estimate(row))
+        totals = snapshot["totals"]
+        print(f"  合计: {totals['calls']} 次调用, 耗时 {totals['latency_sum']:.1f}s, "
+              f"token 输入 {totals['input_tokens']} / 输出 {totals['output_tokens']}" + _format_estimate(totals))
+        for name, value in sorted(snapshot["gauges"].items()):
+            print(f"  {name}: {value}")
+
+
+def _relative_error(estimated: int, actual: int) -> Optional[float]:
+    """预估相对真实值的偏差（正数表示高估），没有成对数据时为 None"""
+    return estimated / actual - 1 if actual else None
+
+
+def _format_estimate(row: Dict[str, Any]) -> str:
+    """print_summary 中预估输入 token 的部分"""
+    if row["estimate_error"] is None:
+        return ""
+    return f", 预估输入 {row['estimated_input_tokens']}（偏差 {row['estimate_error']:+.1%}）"
+
+
+def _escape_label(value: str) -> str:
+    """转义 Prometheus 标签值"""
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
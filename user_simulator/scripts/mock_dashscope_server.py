@@ -0,0 +1,406 @@
+"""
+本地 DashScope 模拟服务
+模拟文本生成接口的响应结构，用于离线压测和回归测试，不消耗真实配额
+
+用法（在 user_simulator 目录下）:
+    python -m scripts.mock_dashscope_server --port 8765 --latency-dist lognormal --latency-mean 1.5 --rate-limit-rate 0.05
+    API_BASE_URL=http://127.0.0.1:8765/api/v1/services/aigc/text-generation/generation python main_random_topic.py
+
+路径以 /chat/completions 结尾的请求按 OpenAI 兼容格式处理，可用于测试 openai 后端:
+    LLM_BACKEND=openai OPENAI_BASE_URL=http://127.0.0.1:8765/v1 python main_random_topic.py
+"""
+import argparse
+import json
+import math
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+
+from .mock_responder import MockResponder, apply_generation_limits
+
+
+class LatencyModel:
+    """响应延迟分布"""
+
+    def __init__(self,
+                 dist: str = "fixed",
+                 mean: float = 0.5,
+                 std: float = 0.2,
+                 minimum: float = 0.0,
+                 maximum: float = 60.0):
+        """
+        Args:
+            dist: 分布类型：fixed / uniform / normal / lognormal
+            mean: 均值（秒）；uniform 时取 [mean - std, mean + std]
+            std: 标准差（秒）
+            minimum: 延迟下限（秒）
+            maximum: 延迟上限（秒）
+        """
+        if dist not in ("fixed", "uniform", "normal", "lognormal"):
+            raise ValueError(f"不支持的延迟分布: {dist}")
+        self.dist = dist
+        self.mean = mean
+        self.std = std
+        self.minimum = minimum
+        self.maximum = maximum
+
+    def sample(self, rng: random.Random) -> float:
+        """采样一次延迟（秒）"""
+        if self.dist == "fixed":
+            value = self.mean
+        elif self.dist == "uniform":
+            value = rng.uniform(self.mean - self.std, self.mean + self.std)
+        elif self.dist == "normal":
+            value = rng.gauss(self.mean, self.std)
+        else:
+            # 按给定均值和标准差换算对数正态参数，长尾更接近真实接口
+            if self.mean <= 0:
+                value = 0.0
+            else:
+                sigma2 = math.log(1 + (self.std / self.mean) ** 2)
+                mu = math.log(self.mean) - sigma2 / 2
+                value = rng.lognormvariate(mu, math.sqrt(sigma2))
+        return min(self.maximum, max(self.minimum, value))
+
+
+class MockDashScopeServer:
+    """
+    本地模拟服务
+
+    可在进程内通过 start() / stop() 使用，也可以通过命令行独立运行。
+    """
+
+    def __init__(self,
+                 host: str = "127.0.0.1",
+                 port: int = 8765,
+                 latency: Optional[LatencyModel] = None,
+                 error_rate: float = 0.0,
+                 rate_limit_rate: float = 0.0,
+                 retry_after: float = 1.0,
+                 response_format: str = "text",
+                 responder: Optional[MockResponder] = None,
+                 stream_chunk_chars: int = 4,
+                 stream_interval: float = 0.02,
+                 seed: Optional[int] = None):
+        """
+        Args:
+            host: 监听地址
+            port: 监听端口（0 表示随机端口）
+            latency: 延迟分布，默认固定 0.5 秒
+            error_rate: 返回 500 的概率
+            rate_limit_rate: 返回 429 的概率
+            retry_after: 429 响应携带的 Retry-After 秒数
+            response_format: "text" 返回 output.text；"choices" 返回 output.choices[].message.content
+            responder: 回复生成器
+            stream_chunk_chars: 流式（SSE）响应中每个事件携带的字符数
+            stream_interval: 流式响应相邻事件之间的间隔秒数（首个事件前的等待由 latency 决定）
+            seed: 随机种子，便于复现
+        """
+        if response_format not in ("text", "choices"):
+            raise ValueError(f"不支持的 response_format: {response_format}")
+        self.latency = latency or LatencyModel()
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.response_format = response_format
+        self.responder = responder or MockResponder()
+        self.stream_chunk_chars = max(1, stream_chunk_chars)
+        self.stream_interval = stream_interval
+        self.rng = random.Random(seed)
+        self.stats = {"requests": 0, "ok": 0, "errors": 0, "rate_limited": 0, "streamed": 0, "stream_aborted": 0}
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self.httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self.httpd.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        """文本生成接口地址，可直接作为 API_BASE_URL"""
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/api/v1/services/aigc/text-generation/generation"
+
+    def start(self) -> "MockDashScopeServer":
+        """在后台线程中启动服务"""
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """停止服务"""
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def handle_generation(self, request: Dict[str, Any]) -> Tuple[int, Dict[str, Any], Dict[str, str]]:
+        """
+        处理一次生成请求
+
+        Returns:
+            (状态码, 响应体, 额外响应头)
+        """
+        with self._lock:
+            self.stats["requests"] += 1
+            delay = self.latency.sample(self.rng)
+            roll = self.rng.random()
+            request_id = f"mock-{self.stats['requests']}"
+        time.sleep(delay)
+
+        if roll < self.rate_limit_rate:
+            with self._lock:
+                self.stats["rate_limited"] += 1
+            return 429, {
+                "code": "Throttling.RateQuota",
+                "message": "Requests rate limit exceeded (mock).",
+                "request_id": request_id
+            }, {"Retry-After": str(self.retry_after)}
+        if roll < self.rate_limit_rate + self.error_rate:
+            with self._lock:
+                self.stats["errors"] += 1
+            return 500, {
+                "code": "InternalError",
+                "message": "Injected server error (mock).",
+                "request_id": request_id
+            }, {}
+
+        messages = request.get("input", {}).get("messages", [])
+        with self._lock:
+            text = self.responder.respond(messages, self.rng)
+            self.stats["ok"] += 1
+        text, finish_reason = apply_generation_limits(text, request.get("parameters") or {})
+        input_tokens = sum(len(str(msg.get("content", ""))) for msg in messages)
+        output_tokens = len(text)
+        if self.response_format == "choices":
+            output = {"choices": [{"finish_reason": finish_reason, "message": {"role": "assistant", "content": text}}]}
+        else:
+            output = {"text": text, "finish_reason": finish_reason}
+        return 200, {
+            "output": output,
+            "usage": {
+                "input_tokens": input_tokens,
+                "output_tokens": output_tokens,
+                "total_tokens": input_tokens + output_tokens
+            },
+            "request_id": request_id
+        }, {}
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                try:
+                    request = json.loads(self.rfile.read(length) or b"{}")
+                except ValueError:
+                    self._send_json(400, {"code": "InvalidParameter", "message": "Invalid JSON body."})
+                    return
+                if self.path.rstrip("/").endswith("/chat/completions"):
+                    self._handle_openai(request)
+                    return
+                status, body, headers = server.handle_generation(request)
+                wants_stream = (
+                    self.headers.get("X-DashScope-SSE", "").lower() == "enable"
+                    or "text/event-stream" in self.headers.get("Accept", "")
+                )
+                if status == 200 and wants_stream:
+                    incremental = bool(request.get("parameters", {}).get("incremental_output"))
+                    self._send_stream(body, incremental)
+                else:
+                    self._send_json(status, body, headers)
+
+            def _handle_openai(self, request: Dict[str, Any]):
+                """OpenAI 兼容的 Chat Completions 接口，生成逻辑与百炼格式共用"""
+                status, body, headers = server.handle_generation({
+                    "model": request.get("model"),
+                    "input": {"messages": request.get("messages", [])},
+                    "parameters": {name: request[name] for name in ("max_tokens", "stop") if name in request}
+                })
+                if status != 200:
+                    self._send_json(status, {"error": {"code": body.get("code"), "message": body.get("message")}}, headers)
+                    return
+                text, usage, chunks = self._split_chunks(body)
+                finish_reason = self._finish_reason(body)
+                if not request.get("stream"):
+                    self._send_json(200, {
+                        "id": body["request_id"],
+                        "object": "chat.completion",
+                        "model": request.get("model"),
+                        "choices": [{"index": 0, "finish_reason": finish_reason,
+                                     "message": {"role": "assistant", "content": text}}],
+                        "usage": {"prompt_tokens": usage["input_tokens"], "completion_tokens": usage["output_tokens"],
+                                  "total_tokens": usage["total_tokens"]}
+                    })
+                    return
+
+                self._start_stream()
+                try:
+                    for index, chunk in enumerate(chunks):
+                        if index > 0 and server.stream_interval > 0:
+                            time.sleep(server.stream_interval)
+                        event = {"id": body["request_id"], "object": "chat.completion.chunk",
+                                 "choices": [{"index": 0, "delta": {"content": chunk},
+                                              "finish_reason": finish_reason if index == len(chunks) - 1 else None}]}
+                        self.wfile.write(f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode("utf-8"))
+                        self.wfile.flush()
+                    if (request.get("stream_options") or {}).get("include_usage"):
+                        event = {"id": body["request_id"], "object": "chat.completion.chunk", "choices": [],
+                                 "usage": {"prompt_tokens": usage["input_tokens"],
+                                           "completion_tokens": usage["output_tokens"],
+                                           "total_tokens": usage["total_tokens"]}}
+                        self.wfile.write(f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode("utf-8"))
+                    self.wfile.write(b"data: [DONE]\n\n")
+                    self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    with server._lock:
+                        server.stats["stream_aborted"] += 1
+                    return
+                with server._lock:
+                    server.stats["streamed"] += 1
+
+            @staticmethod
+            def _split_chunks(body: Dict[str, Any]) -> Tuple[str, Dict[str, int], List[str]]:
+                """取出回复文本、用量，并按 stream_chunk_chars 切成流式片段"""
+                output = body["output"]
+                if "choices" in output:
+                    text = output["choices"][0]["message"]["content"]
+                else:
+                    text = output["text"]
+                step = server.stream_chunk_chars
+                chunks = [text[i:i + step] for i in range(0, len(text), step)] or [""]
+                return text, body["usage"], chunks
+
+            @staticmethod
+            def _finish_reason(body: Dict[str, Any]) -> str:
+                output = body["output"]
+                return (output["choices"][0] if "choices" in output else output)["finish_reason"]
+
+            def _start_stream(self):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream;charset=UTF-8")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                self.close_connection = True
+
+            def do_GET(self):
+                # GET /stats 查看累计统计
+                with server._lock:
+                    stats = dict(server.stats)
+                self._send_json(200, stats)
+
+            def _send_json(self, status: int, body: Dict[str, Any], headers: Optional[Dict[str, str]] = None):
+                data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _send_stream(self, body: Dict[str, Any], incremental: bool):
+                """按 DashScope SSE 格式逐段发送，客户端提前断开时停止"""
+                text, usage, chunks = self._split_chunks(body)
+                last_finish_reason = self._finish_reason(body)
+                self._start_stream()
+                sent = ""
+                try:
+                    for index, chunk in enumerate(chunks):
+                        if index > 0 and server.stream_interval > 0:
+                            time.sleep(server.stream_interval)
+                        sent += chunk
+                        piece = chunk if incremental else sent
+                        finish_reason = last_finish_reason if index == len(chunks) - 1 else "null"
+                        if server.response_format == "choices":
+                            event_output = {"choices": [{
+                                "finish_reason": finish_reason,
+                                "message": {"role": "assistant", "content": piece}
+                            }]}
+                        else:
+                            event_output = {"text": piece, "finish_reason": finish_reason}
+                        event = {
+                            "output": event_output,
+                            "usage": {
+                                "input_tokens": usage["input_tokens"],
+                                "output_tokens": len(sent),
+                                "total_tokens": usage["input_tokens"] + len(sent)
+                            },
+                            "request_id": body["request_id"]
+                        }
+                        data = f"id:{index + 1}\nevent:result\n:HTTP_STATUS/200\ndata:{json.dumps(event, ensure_ascii=False)}\n\n"
+                        self.wfile.write(data.encode("utf-8"))
+                        self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    with server._lock:
+                        server.stats["stream_aborted"] += 1
+                    return
+                with server._lock:
+                    server.stats["streamed"] += 1
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def load_canned_responses(path: str) -> List[str]:
+    """从 JSON（字符串数组）或纯文本（空行分隔）文件加载固定回复"""
+    with open(path, 'r', encoding='utf-8') as f:
+        content = f.read()
+    if path.endswith(".json"):
+        return [str(item) for item in json.loads(content)]
+    return [block.strip() for block in content.split("\n\n") if block.strip()]
+
+
+def main():
+    """主函数"""
+    parser = argparse.ArgumentParser(description="本地 DashScope 模拟服务")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency-dist", type=str, choices=["fixed", "uniform", "normal", "lognormal"], default="fixed")
+    parser.add_argument("--latency-mean", type=float, default=0.5, help="平均延迟（秒）")
+    parser.add_argument("--latency-std", type=float, default=0.2, help="延迟标准差（秒）")
+    parser.add_argument("--latency-max", type=float, default=60.0, help="延迟上限（秒）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="返回 500 的概率")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="返回 429 的概率")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="429 响应的 Retry-After 秒数")
+    parser.add_argument("--response-format", type=str, choices=["text", "choices"], default="text")
+    parser.add_argument("--responses-file", type=str, default=None,
+                        help="固定回复文件（JSON 字符串数组，或空行分隔的纯文本），不指定则按提示词生成模板回复")
+    parser.add_argument("--stream-chunk-chars", type=int, default=4, help="流式响应每个事件的字符数")
+    parser.add_argument("--stream-interval", type=float, default=0.02, help="流式响应事件间隔（秒）")
+    parser.add_argument("--seed", type=int, default=None)
+
+    args = parser.parse_args()
+
+    canned = load_canned_responses(args.responses_file) if args.responses_file else None
+    server = MockDashScopeServer(
+        host=args.host,
+        port=args.port,
+        latency=LatencyModel(args.latency_dist, args.latency_mean, args.latency_std, maximum=args.latency_max),
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        retry_after=args.retry_after,
+        response_format=args.response_format,
+        responder=MockResponder(canned),
+        stream_chunk_chars=args.stream_chunk_chars,
+        stream_interval=args.stream_interval,
+        seed=args.seed
+    )
+    print(f"模拟服务已启动: {server.url}")
+    print(f"设置 API_BASE_URL={server.url} 即可让生成脚本指向本服务")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+        print(f"累计统计: {server.stats}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""
+模拟后端的回复生成
+根据提示词内容生成与各生成器输出格式一致的模板回复，并按请求参数中的 stop / max_tokens 截断。
+本地模拟服务（mock_dashscope_server）、进程内模拟后端（backends.MockLLMClient）和批量任务模拟结果共用。
+"""
+import json
+import random
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+
+PATIENT_REPLIES = [
+    "今天早上空腹测了7.8，比平时高一点，有点担心。",
+    "昨晚聚餐吃多了，这是不是原因？",
+    "我平时都按时吃药的，怎么还会这样？",
+    "那我明天早上再测一次看看。",
+    "嗯，明白了，先照着做几天。",
+    "行，先这样吧，谢谢你。",
+]
+
+ASSISTANT_REPLIES = [
+    "空腹7.8确实略高于理想范围，可能和前一晚的饮食有关，咱们先别太担心。",
+    "聚餐时主食和油脂偏多，第二天空腹血糖偏高很常见，明早再测一次对比看看。",
+    "按时吃药很好，偶尔的波动多和饮食、睡眠有关，咱们一起找找原因。",
+    "这个值不算危险，先把晚餐主食减一点，观察三天的变化。",
+    "好，先按这个观察几天，有变化随时说。",
+]
+
+ASSISTANT_THOUGHTS = [
+    "患者对偏高的数值有些焦虑，需要先解释数值意义，再给一个可执行的小建议。",
+    "患者已经理解了原因，本轮以确认和鼓励为主，不再推新的行动。",
+    "患者提到了具体的饮食细节，可以把波动和饮食联系起来解释。",
+]
+
+PRIMARY_CLASSES = ["HYPERGLYCEMIA", "DIET_MANAGEMENT", "GLUCOSE_MONITORING", "MEDICATION_ADHERENCE"]
+SECONDARY_CLASSES = ["POSTPRANDIAL", "FASTING_RELATED", "GENERAL"]
+RISK_LEVELS = ["LOW", "MEDIUM"]
+
+
+def apply_generation_limits(text: str, parameters: Dict[str, Any]) -> Tuple[str, str]:
+    """
+    按请求参数中的 stop 与 max_tokens（按字符计）截断回复，模拟服务端的结束方式
+
+    Args:
+        text: 完整的回复文本
+        parameters: 请求参数
+
+    Returns:
+        (截断后的文本, finish_reason)：超过 max_tokens 时为 "length"，否则为 "stop"
+    """
+    stop = parameters.get("stop") or []
+    for sequence in [stop] if isinstance(stop, str) else stop:
+        index = text.find(sequence) if sequence else -1
+        if index >= 0:
+            text = text[:index]
+    max_tokens = parameters.get("max_tokens")
+    if max_tokens and len(text) > max_tokens:
+        return text[:max_tokens], "length"
+    return text, "stop"
+
+
+class MockResponder:
+    """根据提示词内容生成模板回复，或从固定回复中随机挑选"""
+
+    def __init__(self, canned_responses: Optional[List[str]] = None):
+        """
+        Args:
+            canned_responses: 固定回复列表，非空时每次随机返回其中一条
+        """
+        self.canned_responses = canned_responses or []
+
+    def respond(self, messages: List[Dict[str, str]], rng: random.Random) -> str:
+        """生成一条回复文本"""
+        if self.canned_responses:
+            return rng.choice(self.canned_responses)
+
+        prompt = "\n".join(str(msg.get("content", "")) for msg in messages)
+        if "primary_class" in prompt:
+            return json.dumps({
+                "primary_class": rng.choice(PRIMARY_CLASSES),
+                "secondary_class": rng.choice(SECONDARY_CLASSES),
+                "supporting_classes": [],
+                "risk_level": rng.choice(RISK_LEVELS)
+            }, ensure_ascii=False)
+
+        topic_match = re.search(r"生成\s*(\d+)\s*个", prompt)
+        if topic_match and "主题" in prompt:
+            count = min(int(topic_match.group(1)), 500)
+            return "\n".join(
+                f"{i}. 最近{rng.choice(['加班多', '聚餐', '睡眠不好', '开始运动'])}，"
+                f"血糖{rng.uniform(6.5, 13.5):.1f}mmol/L，有点担心，想知道原因和怎么调整（{i}）。"
+                for i in range(1, count + 1)
+            )
+
+        if '"dialogue"' in prompt and "JSON" in prompt:
+            # 整段对话一次生成（scripts.one_shot_dialogue）
+            dialogue = []
+            for _ in range(rng.randint(3, 5)):
+                dialogue.append({"role": "user", "content": rng.choice(PATIENT_REPLIES)})
+                dialogue.append({
+                    "role": "assistant",
+                    "thinking": rng.choice(ASSISTANT_THOUGHTS),
+                    "content": rng.choice(ASSISTANT_REPLIES)
+                })
+            return json.dumps({"dialogue": dialogue}, ensure_ascii=False)
+
+        if '"candidates"' in prompt and "JSON" in prompt:
+            # 多候选模式（scripts.candidate_selection）
+            count_match = re.search(r"请给出\s*(\d+)\s*条", prompt)
+            count = min(int(count_match.group(1)) if count_match else 3, len(PATIENT_REPLIES))
+            return json.dumps({"candidates": rng.sample(PATIENT_REPLIES, count)}, ensure_ascii=False)
+
+        if "JSON schema" in prompt and '"response"' in prompt:
+            # 结构化输出模式（scripts.structured_output）
+            if '"thinking"' in prompt:
+                reply = {"thinking": rng.choice(ASSISTANT_THOUGHTS), "response": rng.choice(ASSISTANT_REPLIES)}
+            else:
+                reply = {"response": rng.choice(PATIENT_REPLIES)}
+            return json.dumps(reply, ensure_ascii=False)
+
+        if "Thinking:" in prompt:
+            return f"Thinking:\n{rng.choice(ASSISTANT_THOUGHTS)}\n\nResponse:\n{rng.choice(ASSISTANT_REPLIES)}"
+        return f"Response:\n{rng.choice(PATIENT_REPLIES)}"
@@ -0,0 +1,123 @@
+"""
+整段对话一次生成（低成本档）
+逐轮生成一段对话需要二十多次前后依赖的调用；这里用同样的画像和主题，一次调用写出完整的多轮对话
+（含照护师的 thinking），按 schema 严格解析为与逐轮生成相同格式的 dialogue_history。
+不合格时带上错误原因重新生成一次，每段对话最多两次调用。
+"""
+import json
+from typing import Any, Dict, List
+
+from .backends import LLMBackend
+from .prompt_templates import PromptTemplate
+from .structured_output import RESPONSE_FORMAT, StructuredOutputError, parse_dialogue
+
+
+class OneShotDialogueGenerator:
+    """一次调用生成整段患者-照护师对话"""
+
+    # 整段对话的输出约为 每轮 200 token × 轮数，留足余量避免截断成不完整的 JSON
+    CALL_PARAMS = {"model": "qwen-plus", "temperature": 0.8, "max_tokens": 4000}
+
+    # 规则摘自逐轮生成的患者/照护师提示词（类定义时预编译，实例化时填入轮数）
+    PROMPT_TEMPLATE = PromptTemplate("""# 任务
+请一次写出一段完整的糖尿病患者与照护师的多轮对话。
+
+### 对话主题（患者的第一句话围绕它展开）
+{dialogue_topic}
+
+### 患者画像
+{persona_json}
+
+### 患者的说话规则
+- 第一人称，口语化，语气符合画像中的年龄、性别和职业
+- 每次只做1件事：表达感受、补充细节、确认理解或说出打算，**最多1个问题**，优先用陈述句
+- 每次8~40字，不重复之前说过的话
+- 问题得到解答、心里有底后自然收束（如"好，我先按这个试试"），至少互动3轮后再收束
+
+### 照护师的说话规则
+- thinking：内部思考过程，中文，第一人称，2-5句话：判断患者当前的诉求、数值是否正常、是否需要继续干预
+- content：先给1-2句专业判断或解释，再给情感支持；只在必要时给1个具体、可执行的小建议；40~100字
+- 适度共情，不要每轮都夸赞；引用医学常识，但不诊断、不开药
+- 患者表示要收束时，礼貌收尾，不再推新的行动
+
+### 输出格式（必须严格遵守）
+一共 {min_turns}~{max_turns} 轮（患者和照护师各说一次为一轮），患者先开口，两人严格交替，最后一条是照护师。
+只输出一个 JSON 对象，不要输出 JSON 以外的任何内容：
+{{"dialogue": [
+  {{"role": "user", "content": "患者的话"}},
+  {{"role": "assistant", "thinking": "照护师的内部思考", "content": "照护师的回复"}}
+]}}
+""")
+
+    RETRY_NOTE = """
+### 上一次的输出不符合要求（{error}）
+请按输出格式重新写出完整的对话。
+"""
+
+    def __init__(self, api_client: LLMBackend, min_turns: int = 3, max_turns: int = 8, max_calls: int = 2):
+        """
+        Args:
+            api_client: API客户端实例
+            min_turns: 最少轮数（患者和照护师各说一次为一轮）
+            max_turns: 最多轮数
+            max_calls: 每段对话最多调用次数（第一次不合格时带上错误原因重新生成）
+        """
+        self.api_client = api_client
+        self.min_turns = min_turns
+        self.max_turns = max_turns
+        self.max_calls = max_calls
+        self._template = self.PROMPT_TEMPLATE.partial(min_turns=min_turns, max_turns=max_turns)
+        self._call_params = {**self.CALL_PARAMS, "response_format": RESPONSE_FORMAT}
+
+    def generate_dialogue(self, persona: Dict[str, Any], dialogue_topic: str) -> List[Dict[str, str]]:
+        """
+        生成整段对话
+
+        Args:
+            persona: 患者画像（background_story）
+            dialogue_topic: 对话主题
+
+        Returns:
+            dialogue_history
+
+        Raises:
+            StructuredOutputError: max_calls 次调用的输出都不合格
+        """
+        prompt = self._build_prompt(persona, dialogue_topic)
+        error = None
+        for _ in range(self.max_calls):
+            result = self.api_client.call(
+                prompt=prompt if error is None else prompt + self.RETRY_NOTE.format(error=error),
+                caller=self.__class__.__name__,
+                **self._call_params
+            )
+            try:
+                return parse_dialogue(result, self.min_turns, self.max_turns)
+            except StructuredOutputError as e:
+                print(f"整段对话不符合格式（{e}）")
+                error = e
+        raise error
+
+    async def agenerate_dialogue(self, persona: Dict[str, Any], dialogue_topic: str) -> List[Dict[str, str]]:
+        """generate_dialogue 的异步版本（api_client 需为 AsyncQwenAPIClient）"""
+        prompt = self._build_prompt(persona, dialogue_topic)
+        error = None
+        for _ in range(self.max_calls):
+            result = await self.api_client.acall(
+                prompt=prompt if error is None else prompt + self.RETRY_NOTE.format(error=error),
+                caller=self.__class__.__name__,
+                **self._call_params
+            )
+            try:
+                return parse_dialogue(result, self.min_turns, self.max_turns)
+            except StructuredOutputError as e:
+                print(f"整段对话不符合格式（{e}）")
+                error = e
+        raise error
+
+    def _build_prompt(self, persona: Dict[str, Any], dialogue_topic: str) -> str:
+        """构建整段对话的提示词"""
+        return self._template.render(
+            dialogue_topic=dialogue_topic,
+            persona_json=json.dumps(persona, ensure_ascii=False, indent=2)
+        )
@@ -3,13 +3,17 @@
 根据规则拼接生成的用户画像进行重写和扩写
 """
 from typing import Dict, Any
-from .api_client import QwenAPIClient
+from .backends import LLMBackend
+from .batch_job import BatchJobWriter
 
 
 class PersonaGenerator:
     """患者画像生成器"""
+
+    # 同步/异步调用共用的模型参数
+    CALL_PARAMS = {"model": "qwen-plus", "temperature": 0.7, "max_tokens": 3000}
     
-    def __init__(self, api_client: QwenAPIClient):
+    def __init__(self, api_client: LLMBackend):
         """
         初始化画像生成器
         
@@ -32,14 +36,29 @@ class PersonaGenerator:
         prompt = self._build_persona_prompt(raw_persona)
         
         # 调用API生成
-        result = self.api_client.call(
-            prompt=prompt,
-            model="qwen-plus",
-            temperature=0.7,
-            max_tokens=3000
-        )
+        result = self.api_client.call(prompt=prompt, caller=self.__class__.__name__, **self.CALL_PARAMS)
         
         return result
+
+    async def agenerate_persona(self, raw_persona: Dict[str, Any]) -> str:
+        """
+        generate_persona 的异步版本（api_client 需为 AsyncQwenAPIClient）
+        """
+        prompt = self._build_persona_prompt(raw_persona)
+        return await self.api_client.acall(prompt=prompt, caller=self.__class__.__name__, **self.CALL_PARAMS)
+
+    def add_to_batch(self, writer: BatchJobWriter, custom_id: str, raw_persona: Dict[str, Any]):
+        """
+        把画像重写请求写入批量任务文件（离线批量模式），不实时调用接口
+
+        结果文件用 load_batch_results 读取，custom_id 对应结果的 text 即重写后的画像。
+
+        Args:
+            writer: 批量任务文件写入器
+            custom_id: 请求标识（如患者ID）
+            raw_persona: 原始用户画像
+        """
+        writer.add_prompt(custom_id, self._build_persona_prompt(raw_persona), **self.CALL_PARAMS)
     
     def _build_persona_prompt(self, raw_persona: Dict[str, Any]) -> str:
         """构建患者画像生成的提示词"""
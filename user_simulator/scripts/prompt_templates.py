@@ -0,0 +1,156 @@
+"""
+提示词模板与按对话的片段缓存
+生成器的提示词大部分是固定的规则文本，每轮变化的只有轮次和对话历史：
+- PromptTemplate 在类定义时把模板预先拆成静态片段和字段，渲染时只做一次拼接
+- FragmentCache 按对话缓存不随轮次变化的片段（画像 JSON、主题、故事等；每轮更新的生活状态不进入缓存），
+  并对逐轮增长的对话历史只渲染新增的消息
+渲染结果与原先的 f-string 逐字节一致，响应缓存键不受影响。
+"""
+import string
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List, Tuple
+
+
+class PromptTemplate:
+    """
+    预编译的提示词模板，字段写法同 str.format（只支持简单字段名，如 {current_turn}）
+
+    用法:
+        TEMPLATE = PromptTemplate("当前是第 {current_turn} 轮")
+        TEMPLATE.render(current_turn=3)
+    """
+
+    def __init__(self, template: str):
+        """
+        Args:
+            template: 模板文本，字面的花括号需写成 {{ }}
+        """
+        literals: List[str] = []
+        fields: List[str] = []
+        for literal, field, format_spec, conversion in string.Formatter().parse(template):
+            if field is not None and (format_spec or conversion or not field.isidentifier()):
+                raise ValueError(f"模板只支持简单字段名: {{{field}}}")
+            if len(literals) > len(fields):
+                # 转义的花括号会把字面文本拆成多段，接到上一段后面
+                literals[-1] += literal
+            else:
+                literals.append(literal)
+            if field is not None:
+                fields.append(field)
+        if len(literals) == len(fields):
+            literals.append("")
+        self._set_parts(literals, fields)
+
+    def _set_parts(self, literals: List[str], fields: List[str]):
+        """literals 比 fields 多一个：literals[0] field[0] literals[1] ... field[-1] literals[-1]"""
+        self._head = literals[0]
+        self._pairs = list(zip(fields, literals[1:]))
+        self.fields = frozenset(fields)
+
+    def render(self, **values: Any) -> str:
+        """填入字段并返回完整文本，缺少字段时抛出 KeyError"""
+        parts = [self._head]
+        for field, literal in self._pairs:
+            parts.append(str(values[field]))
+            parts.append(literal)
+        return "".join(parts)
+
+    def partial(self, **values: Any) -> "PromptTemplate":
+        """
+        填入部分字段，返回只剩其余字段的模板
+
+        用于按对话预先填好不变的字段（画像、主题、故事等），之后每轮只填入轮次和历史。
+        """
+        literals = [self._head]
+        fields = []
+        for field, literal in self._pairs:
+            if field in values:
+                literals[-1] += str(values[field]) + literal
+            else:
+                fields.append(field)
+                literals.append(literal)
+        template = PromptTemplate.__new__(PromptTemplate)
+        template._set_parts(literals, fields)
+        return template
+
+
+class FragmentCache:
+    """
+    按对话缓存的提示词片段（线程安全，按 LRU 淘汰）
+
+    画像等不可哈希的对象按身份区分：同一段对话的各轮传入的是同一个 persona 字典，
+    缓存中保留对象引用，对象被回收后 id 复用也不会误命中。对话进行中不应修改这些对象。
+    """
+
+    def __init__(self, max_entries: int = 1024):
+        """
+        Args:
+            max_entries: 最多缓存的条目数（约为同时进行的对话数的若干倍）
+        """
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple, Tuple[Any, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _lookup(self, cache_key: Tuple, owner: Any):
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is None or entry[0] is not owner:
+                return None
+            self._entries.move_to_end(cache_key)
+            return entry[1]
+
+    def _store(self, cache_key: Tuple, owner: Any, value: Any):
+        with self._lock:
+            self._entries[cache_key] = (owner, value)
+            self._entries.move_to_end(cache_key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get(self, owner: Any, key: Hashable, build: Callable[[], Any]) -> Any:
+        """
+        取出（或构建并缓存）一段对话的片段
+
+        Args:
+            owner: 按身份区分的对象（如 persona 字典）
+            key: 其余按值区分的参数（如 (片段名, 主题)）
+            build: 未命中时构建片段的函数
+
+        Returns:
+            片段
+        """
+        cache_key = ("fragment", id(owner), key)
+        value = self._lookup(cache_key, owner)
+        if value is None:
+            value = build()
+            self._store(cache_key, owner, value)
+        return value
+
+    def history(self,
+                dialogue_history: List[Dict[str, str]],
+                render_message: Callable[[Dict[str, str]], str]) -> str:
+        """
+        渲染完整的对话历史，同一段对话的历史列表只渲染上一轮之后新增的消息
+
+        Args:
+            dialogue_history: 对话历史（逐轮追加的同一个列表）
+            render_message: 把一条消息渲染成文本的函数
+
+        Returns:
+            各条消息渲染结果的拼接
+        """
+        cache_key = ("history", id(dialogue_history))
+        cached = self._lookup(cache_key, dialogue_history)
+        count = len(dialogue_history)
+        if cached is not None:
+            rendered_count, last_message, text = cached
+            # 历史只会追加；被截断或改写时重新渲染
+            if rendered_count == count and (count == 0 or dialogue_history[-1] is last_message):
+                return text
+            if 0 < rendered_count < count and dialogue_history[rendered_count - 1] is last_message:
+                text += "".join(render_message(msg) for msg in dialogue_history[rendered_count:])
+                self._store(cache_key, dialogue_history, (count, dialogue_history[-1], text))
+                return text
+        text = "".join(render_message(msg) for msg in dialogue_history)
+        self._store(cache_key, dialogue_history, (count, dialogue_history[-1] if count else None, text))
+        return text
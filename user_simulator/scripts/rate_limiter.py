@@ -0,0 +1,122 @@
+"""
+按模型的令牌桶限流器
+同时约束每分钟请求数（RPM）和每分钟token数（TPM），替代固定的 time.sleep 延迟
+"""
+import asyncio
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+
+class TokenBucket:
+    """令牌桶：容量为每分钟配额，按秒匀速补充"""
+
+    def __init__(self, per_minute: float):
+        """
+        Args:
+            per_minute: 每分钟配额（同时作为桶容量）
+        """
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    def refill(self, now: float):
+        """按流逝的时间补充令牌"""
+        elapsed = now - self.updated_at
+        if elapsed > 0:
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+            self.updated_at = now
+
+    def wait_time(self, amount: float) -> float:
+        """取出 amount 个令牌还需要等待的秒数（0 表示可以立即取出）"""
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def clamp(self, amount: float) -> float:
+        """单次请求的消耗不能超过桶容量，否则永远取不出来"""
+        return min(amount, self.capacity)
+
+
+class RateLimiter:
+    """
+    多模型共享的限流器（线程安全，也可在协程中使用）
+
+    每个模型有独立的请求桶和token桶。调用前按预估token数扣减，
+    调用结束后用接口返回的真实用量修正差额。未配置的模型不限流。
+    """
+
+    def __init__(self, limits: Dict[str, Dict[str, float]]):
+        """
+        Args:
+            limits: 模型配额，格式: {"qwen-plus": {"rpm": 600, "tpm": 1000000}, ...}
+        """
+        self._lock = threading.Lock()
+        self._buckets: Dict[str, Tuple[Optional[TokenBucket], Optional[TokenBucket]]] = {}
+        for model, quota in limits.items():
+            rpm = quota.get("rpm")
+            tpm = quota.get("tpm")
+            self._buckets[model] = (
+                TokenBucket(rpm) if rpm else None,
+                TokenBucket(tpm) if tpm else None
+            )
+
+    def try_acquire(self, model: str, tokens: float) -> float:
+        """尝试扣减配额，成功返回 0，否则返回需要等待的秒数"""
+        request_bucket, token_bucket = self._buckets.get(model, (None, None))
+        with self._lock:
+            now = time.monotonic()
+            wait = 0.0
+            if request_bucket is not None:
+                request_bucket.refill(now)
+                wait = max(wait, request_bucket.wait_time(1))
+            if token_bucket is not None:
+                token_bucket.refill(now)
+                wait = max(wait, token_bucket.wait_time(token_bucket.clamp(tokens)))
+            if wait > 0:
+                return wait
+            if request_bucket is not None:
+                request_bucket.tokens -= 1
+            if token_bucket is not None:
+                token_bucket.tokens -= token_bucket.clamp(tokens)
+            return 0.0
+
+    def acquire(self, model: str, tokens: float = 0):
+        """
+        阻塞直到模型配额允许发出一次请求
+
+        Args:
+            model: 模型名称
+            tokens: 本次请求预估消耗的token数
+        """
+        while True:
+            wait = self.try_acquire(model, tokens)
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    async def aacquire(self, model: str, tokens: float = 0):
+        """acquire 的协程版本，等待期间不阻塞事件循环"""
+        while True:
+            wait = self.try_acquire(model, tokens)
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+    def reconcile(self, model: str, estimated_tokens: float, actual_tokens: float):
+        """
+        用真实用量修正预扣的token数（多扣的退回，少扣的补扣）
+
+        Args:
+            model: 模型名称
+            estimated_tokens: 调用前预扣的token数
+            actual_tokens: 接口返回的真实token数
+        """
+        _, token_bucket = self._buckets.get(model, (None, None))
+        if token_bucket is None:
+            return
+        with self._lock:
+            token_bucket.refill(time.monotonic())
+            delta = token_bucket.clamp(estimated_tokens) - actual_tokens
+            token_bucket.tokens = min(token_bucket.capacity, token_bucket.tokens + delta)
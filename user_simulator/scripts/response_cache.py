@@ -0,0 +1,143 @@
+"""
+基于内容寻址的磁盘响应缓存
+以 (模型, 参数, 消息哈希) 为键把生成结果存进 SQLite，确定性调用和有意的重放直接命中磁盘
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Optional
+
+
+def make_request_key(payload: Dict[str, Any]) -> str:
+    """
+    计算请求的内容地址
+
+    Args:
+        payload: 客户端构建的请求体（包含 model / input.messages / parameters）
+
+    Returns:
+        sha256 十六进制字符串
+    """
+    messages_hash = hashlib.sha256(
+        json.dumps(payload["input"]["messages"], ensure_ascii=False, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+    key_material = json.dumps({
+        "model": payload["model"],
+        "parameters": payload.get("parameters", {}),
+        "messages": messages_hash
+    }, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(key_material.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    SQLite 响应缓存（线程安全）
+
+    超过 max_bytes 时按最近访问时间淘汰最旧的条目，直到降到上限的 90%。
+    总字节数在打开时统计一次，之后随写入和淘汰增量维护，每次写入不再扫描全表；
+    超出上限时先重新统计一次再淘汰（同一文件被其他进程写入时以实际总量为准）。
+    """
+
+    def __init__(self, path: str, max_bytes: int = 512 * 1024 * 1024):
+        """
+        Args:
+            path: SQLite 文件路径，目录不存在时自动创建
+            max_bytes: 缓存内容的总字节数上限
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                response TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_last_access ON responses(last_access)")
+        self._conn.commit()
+        self._total_bytes = self._count_bytes()
+
+    def _count_bytes(self) -> int:
+        """统计缓存内容的总字节数（全表扫描）"""
+        return self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def get(self, key: str) -> Optional[str]:
+        """查询缓存，命中时刷新访问时间"""
+        with self._lock:
+            row = self._conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+            return row[0]
+
+    def put(self, key: str, model: str, response: str):
+        """写入缓存，必要时淘汰旧条目"""
+        size = len(response.encode("utf-8"))
+        now = time.time()
+        with self._lock:
+            # 覆盖已有条目时先扣掉旧内容的大小（按主键查询）
+            row = self._conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self._total_bytes += size - (row[0] if row is not None else 0)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, model, response, size, created_at, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model, response, size, now, now)
+            )
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        """按最近访问时间淘汰，调用方需持有锁"""
+        if self._total_bytes <= self.max_bytes:
+            return
+        total = self._count_bytes()
+        if total <= self.max_bytes:
+            self._total_bytes = total
+            return
+        target = int(self.max_bytes * 0.9)
+        # 按访问时间索引逐行读取，够数即停，不把整张表读进内存
+        evicted = []
+        for key, size in self._conn.execute("SELECT key, size FROM responses ORDER BY last_access ASC"):
+            if total <= target:
+                break
+            evicted.append((key,))
+            total -= size
+        self._conn.executemany("DELETE FROM responses WHERE key = ?", evicted)
+        self._total_bytes = total
+
+    def stats(self) -> Dict[str, Any]:
+        """命中统计与占用情况"""
+        with self._lock:
+            entries, size = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": entries,
+            "size_bytes": size
+        }
+
+    def close(self):
+        """关闭数据库连接"""
+        with self._lock:
+            self._conn.close()
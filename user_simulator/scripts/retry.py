@@ -0,0 +1,105 @@
+"""
+API调用重试策略
+对可重试的瞬时错误（429、5xx、连接重置、读超时）做指数退避 + 随机抖动，并遵守服务端的 Retry-After
+"""
+import random
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+
+# 可重试的HTTP状态码：限流 + 服务端错误
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+def is_retryable_status(status_code: Optional[int]) -> bool:
+    """判断HTTP状态码是否属于瞬时错误"""
+    if status_code is None:
+        return False
+    return status_code in RETRYABLE_STATUS_CODES or 500 <= status_code < 600
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    解析 Retry-After 响应头
+
+    Args:
+        value: 头部原始值，可以是秒数，也可以是HTTP日期
+
+    Returns:
+        需要等待的秒数，无法解析时返回 None
+    """
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+class RetryPolicy:
+    """
+    单次调用的重试策略
+
+    退避时间 = random(0, min(max_delay, base_delay * 2^attempt))（full jitter），
+    若服务端给出 Retry-After，则至少等待该时长。
+    每次调用的重试受两个预算约束：最大重试次数、重试累计耗时上限。
+    """
+
+    def __init__(self,
+                 max_retries: int = 4,
+                 base_delay: float = 1.0,
+                 max_delay: float = 30.0,
+                 max_elapsed: float = 120.0):
+        """
+        Args:
+            max_retries: 单次调用最多重试的次数（0 表示不重试）
+            base_delay: 首次退避的基准秒数
+            max_delay: 单次退避的上限秒数
+            max_elapsed: 单次调用从首次请求开始允许消耗在重试上的总秒数
+        """
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_elapsed = max_elapsed
+
+    def compute_delay(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """
+        计算第 attempt 次重试（从0开始）前的等待秒数
+
+        Args:
+            attempt: 已经重试的次数
+            retry_after: 服务端要求的最短等待秒数
+        """
+        backoff = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+        if retry_after is not None:
+            return max(backoff, retry_after)
+        return backoff
+
+    def next_delay(self, error: Exception, attempt: int, started_at: float) -> Optional[float]:
+        """
+        判断是否还能重试
+
+        Args:
+            error: 本次调用抛出的异常
+            attempt: 已经重试的次数
+            started_at: 首次请求的 time.monotonic() 时间
+
+        Returns:
+            下一次重试前的等待秒数；不可重试或预算耗尽时返回 None
+        """
+        if not getattr(error, "transient", False) or attempt >= self.max_retries:
+            return None
+        delay = self.compute_delay(attempt, getattr(error, "retry_after", None))
+        if time.monotonic() - started_at + delay > self.max_elapsed:
+            return None
+        return delay
@@ -3,13 +3,16 @@
 根据主题和患者特点生成故事背景
 """
 from typing import Dict, Any
-from .api_client import QwenAPIClient
+from .backends import LLMBackend
 
 
 class StoryGenerator:
     """故事生成器"""
+
+    # 同步/异步调用共用的模型参数
+    CALL_PARAMS = {"model": "qwen-plus", "temperature": 0.8, "max_tokens": 800}
     
-    def __init__(self, api_client: QwenAPIClient):
+    def __init__(self, api_client: LLMBackend):
         """
         初始化故事生成器
         
@@ -33,14 +36,16 @@ class StoryGenerator:
         prompt = self._build_story_prompt(persona, topic)
         
         # 调用API生成
-        result = self.api_client.call(
-            prompt=prompt,
-            model="qwen-plus",
-            temperature=0.8,      
-            max_tokens=800
-        )
+        result = self.api_client.call(prompt=prompt, caller=self.__class__.__name__, **self.CALL_PARAMS)
         
         return result
+
+    async def agenerate_story(self, persona: Dict[str, Any], topic: str) -> str:
+        """
+        generate_story 的异步版本（api_client 需为 AsyncQwenAPIClient）
+        """
+        prompt = self._build_story_prompt(persona, topic)
+        return await self.api_client.acall(prompt=prompt, caller=self.__class__.__name__, **self.CALL_PARAMS)
     
     def _build_story_prompt(self, persona: Dict[str, Any], topic: str) -> str:
         """构建故事生成的提示词（优化版，已修复缩进）"""
@@ -0,0 +1,78 @@
+"""
+流式（SSE）输出的解析与提前截断工具
+"""
+import json
+from typing import Any, Dict, Iterable, Iterator
+
+
+def iter_sse_events(lines: Iterable[str]) -> Iterator[Dict[str, Any]]:
+    """
+    把 SSE 文本行解析成事件JSON
+
+    百炼的流式响应格式为多行一组的事件，只有 data: 行携带JSON：
+        id:1
+        event:result
+        :HTTP_STATUS/200
+        data:{"output":{"text":"...","finish_reason":"null"},"usage":{...}}
+
+    Args:
+        lines: 逐行的响应文本（已解码）
+
+    Yields:
+        每个 data 行解析出的JSON
+    """
+    for line in lines:
+        if not line or not line.startswith("data:"):
+            continue
+        data = line[len("data:"):].strip()
+        if not data or data == "[DONE]":
+            continue
+        try:
+            yield json.loads(data)
+        except ValueError:
+            continue
+
+
+def response_section_complete(text: str) -> bool:
+    """
+    判断 "Response:" 段是否已经完整
+
+    提示词要求回复只有一句话，所以 Response: 之后出现第一个完整的非空行即可截断，
+    不必等模型生成完剩余的内容。
+
+    Args:
+        text: 目前为止累计的输出
+
+    Returns:
+        是否可以停止接收
+    """
+    marker = text.find("Response:")
+    if marker < 0:
+        return False
+    tail = text[marker + len("Response:"):].lstrip()
+    return "\n" in tail
+
+
+def trim_to_response_section(text: str) -> str:
+    """
+    去掉 Response 段完整之后多收到的片段
+
+    截断发生在收到某个增量之后，最后一个增量可能跨过换行带出下一行的开头，
+    这里只保留到 Response 段第一行结束为止。
+
+    Args:
+        text: 流式调用返回的文本
+
+    Returns:
+        截取后的文本；Response 段尚不完整时原样返回
+    """
+    marker = text.find("Response:")
+    if marker < 0:
+        return text
+    body_start = marker + len("Response:")
+    tail = text[body_start:]
+    offset = len(tail) - len(tail.lstrip())
+    newline = tail.find("\n", offset)
+    if newline < 0:
+        return text
+    return text[:body_start + newline]
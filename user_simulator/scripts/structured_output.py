@@ -0,0 +1,319 @@
+"""
+结构化（JSON）输出
+生成器要求模型只输出一个符合 schema 的 JSON 对象，按 schema 严格解析。
+解析失败时只针对这一轮做一次便宜的修复：把出错的输出交给小模型改写成合法 JSON，
+修复后仍不合法时用原提示词重新请求这一轮（次数有限），仍不合法才抛出 StructuredOutputError，
+不再用"最后一行""(解析失败)"之类的兜底把坏数据写进对话，也不会因为一轮出错而重新生成整段对话。
+"""
+import json
+import re
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence
+
+from .backends import LLMBackend
+
+
+# 请求参数：要求模型输出 JSON 对象（百炼和 OpenAI 兼容接口都支持，提示词中需要出现 "JSON"）
+RESPONSE_FORMAT = {"type": "json_object"}
+
+# 修复使用的模型：只做格式改写，输入只有出错的那一轮输出
+REPAIR_MODEL = "qwen-turbo"
+
+# 修复失败后用原提示词重新请求本轮的最多次数
+MAX_REGENERATIONS = 2
+
+# 各字段的说明，用于生成提示词中的输出格式
+FIELD_DESCRIPTIONS = {
+    "thinking": "你的内部思考过程，用中文，第一人称",
+    "response": "直接输出的对话内容，不要加引号或额外说明"
+}
+
+_CODE_FENCE = re.compile(r"^```(?:json)?\s*\n?(.*?)\n?```$", re.S)
+
+
+class StructuredOutputError(ValueError):
+    """
+    模型输出不符合 JSON schema
+
+    Attributes:
+        raw: 模型的原始输出
+    """
+
+    def __init__(self, message: str, raw: Optional[str] = None):
+        super().__init__(message)
+        self.raw = raw
+
+
+def turn_schema(fields: Sequence[str] = ("thinking", "response")) -> Dict[str, Any]:
+    """
+    一轮对话输出的 JSON schema：给定字段都是必填的非空字符串
+
+    Args:
+        fields: 字段名（"thinking" / "response"）
+
+    Returns:
+        JSON schema
+    """
+    return {
+        "type": "object",
+        "properties": {field: {"type": "string", "minLength": 1} for field in fields},
+        "required": list(fields)
+    }
+
+
+def format_instructions(fields: Sequence[str] = ("thinking", "response")) -> str:
+    """
+    提示词中的输出格式段落
+
+    Args:
+        fields: 字段名
+
+    Returns:
+        输出格式说明文本
+    """
+    example = json.dumps({field: f"[{FIELD_DESCRIPTIONS[field]}]" for field in fields}, ensure_ascii=False, indent=2)
+    schema = json.dumps(turn_schema(fields), ensure_ascii=False)
+    return f"""### 输出格式（必须严格遵守）
+只输出一个 JSON 对象，不要输出 JSON 以外的任何内容（包括解释说明和代码块标记）：
+{example}
+JSON schema: {schema}
+"""
+
+
+def parse_turn(text: Optional[str], fields: Sequence[str] = ("thinking", "response")) -> Dict[str, str]:
+    """
+    严格解析一轮对话的 JSON 输出
+
+    整段输出必须是一个 JSON 对象（允许外面包一层 ```json 代码块），给定字段都必须是非空字符串，
+    其余字段忽略。
+
+    Args:
+        text: 模型输出
+        fields: 必填字段
+
+    Returns:
+        {字段: 去掉首尾空白的内容}
+
+    Raises:
+        StructuredOutputError: 输出不符合 schema
+    """
+    data = _load_object(text)
+    result = {}
+    for field in fields:
+        value = data.get(field)
+        if not isinstance(value, str) or not value.strip():
+            raise StructuredOutputError(f"字段 {field} 缺失或不是非空字符串", text)
+        result[field] = value.strip()
+    return result
+
+
+def parse_candidates(text: Optional[str]) -> List[str]:
+    """
+    严格解析多候选输出 {"candidates": ["...", ...]}
+
+    Args:
+        text: 模型输出
+
+    Returns:
+        去掉首尾空白后的候选（按原顺序，去掉重复的候选）
+
+    Raises:
+        StructuredOutputError: 输出不符合格式或没有非空候选
+    """
+    data = _load_object(text)
+    candidates = data.get("candidates")
+    if not isinstance(candidates, list):
+        raise StructuredOutputError("字段 candidates 缺失或不是数组", text)
+    result = []
+    for candidate in candidates:
+        if isinstance(candidate, str) and candidate.strip() and candidate.strip() not in result:
+            result.append(candidate.strip())
+    if not result:
+        raise StructuredOutputError("candidates 中没有非空字符串", text)
+    return result
+
+
+def parse_dialogue(text: Optional[str], min_turns: int = 2, max_turns: Optional[int] = None) -> List[Dict[str, str]]:
+    """
+    严格解析整段对话输出 {"dialogue": [{"role": "user", "content": ...},
+    {"role": "assistant", "thinking": ..., "content": ...}, ...]}
+
+    患者先开口、两个角色严格交替、以照护师结尾；content 都是非空字符串，照护师的 thinking 也是非空字符串。
+
+    Args:
+        text: 模型输出
+        min_turns: 最少轮数（患者和照护师各说一次为一轮）
+        max_turns: 最多轮数，None 时不限制
+
+    Returns:
+        与逐轮生成相同格式的 dialogue_history（患者消息只有 role / content，照护师消息另有 thinking）
+
+    Raises:
+        StructuredOutputError: 输出不符合格式
+    """
+    data = _load_object(text)
+    messages = data.get("dialogue")
+    if not isinstance(messages, list):
+        raise StructuredOutputError("字段 dialogue 缺失或不是数组", text)
+    dialogue_history = []
+    for index, msg in enumerate(messages):
+        expected = "user" if index % 2 == 0 else "assistant"
+        if not isinstance(msg, dict) or msg.get("role") != expected:
+            raise StructuredOutputError(f"第 {index + 1} 条消息应为 {expected}", text)
+        fields = ("content", "thinking") if expected == "assistant" else ("content",)
+        for field in fields:
+            value = msg.get(field)
+            if not isinstance(value, str) or not value.strip():
+                raise StructuredOutputError(f"第 {index + 1} 条消息的 {field} 缺失或不是非空字符串", text)
+        entry = {"role": expected, "content": msg["content"].strip()}
+        if expected == "assistant":
+            entry["thinking"] = msg["thinking"].strip()
+        dialogue_history.append(entry)
+    if len(dialogue_history) % 2:
+        raise StructuredOutputError("对话应以照护师的回复结尾", text)
+    turns = len(dialogue_history) // 2
+    if turns < min_turns or (max_turns is not None and turns > max_turns):
+        raise StructuredOutputError(f"对话轮数 {turns} 不在 {min_turns}~{max_turns or '不限'} 之间", text)
+    return dialogue_history
+
+
+def _load_object(text: Optional[str]) -> Dict[str, Any]:
+    """把整段输出解析为 JSON 对象（允许外面包一层 ```json 代码块）"""
+    if not isinstance(text, str) or not text.strip():
+        raise StructuredOutputError("输出为空", text)
+    body = text.strip()
+    fenced = _CODE_FENCE.match(body)
+    if fenced:
+        body = fenced.group(1).strip()
+    try:
+        data = json.loads(body)
+    except json.JSONDecodeError as e:
+        raise StructuredOutputError(f"不是合法的 JSON: {e}", text)
+    if not isinstance(data, dict):
+        raise StructuredOutputError(f"应为 JSON 对象，实际为 {type(data).__name__}", text)
+    return data
+
+
+def json_object_complete(text: str) -> bool:
+    """流式调用的截断判断：已经收到一个完整的 JSON 对象"""
+    body = text.strip()
+    if not body.endswith(("}", "```")):
+        return False
+    try:
+        parse_turn(body, ())
+    except StructuredOutputError:
+        return False
+    return True
+
+
+class StructuredTurnParser:
+    """
+    严格解析 + 一次修复 + 有限次重新请求本轮
+
+    修复只发送出错的那一轮输出和错误原因（不含原提示词），用小模型、temperature=0 改写成合法 JSON。
+    修复后仍不合法时，调用方提供的 regenerate(attempt) 用原提示词重新请求这一轮，最多 max_regenerations 次
+    （attempt 从 1 开始，作为 seed 传入，使请求与缓存键都与原请求不同）。整个过程不影响对话中已经生成的其他轮次。
+    """
+
+    REPAIR_PROMPT = """下面是一段应当为 JSON 对象的模型输出，但它不符合格式要求（{error}）。
+请把它改写成符合要求的 JSON 对象：保留原有内容，不要增删信息；缺失的字段根据原文补全。
+只输出 JSON 对象。
+
+{instructions}
+### 原始输出
+{raw}
+"""
+
+    def __init__(self,
+                 api_client: LLMBackend,
+                 fields: Sequence[str] = ("thinking", "response"),
+                 repair_model: str = REPAIR_MODEL,
+                 max_regenerations: int = MAX_REGENERATIONS):
+        """
+        Args:
+            api_client: API客户端（LLMBackend）
+            fields: 必填字段
+            repair_model: 修复使用的模型
+            max_regenerations: 修复失败后重新请求本轮的最多次数
+        """
+        self.api_client = api_client
+        self.fields = tuple(fields)
+        self.repair_model = repair_model
+        self.max_regenerations = max_regenerations
+        self.instructions = format_instructions(self.fields)
+
+    def _repair_kwargs(self, raw: str, error: StructuredOutputError, caller: Optional[str]) -> Dict[str, Any]:
+        print(f"{caller or '生成器'} 输出不符合 JSON 格式（{error}），修复一次")
+        return {
+            "prompt": self.REPAIR_PROMPT.format(error=error, instructions=self.instructions, raw=raw.strip()),
+            "model": self.repair_model,
+            "temperature": 0,
+            "max_tokens": max(200, len(raw) * 2),
+            "caller": f"{caller}_repair" if caller else "structured_output_repair",
+            "response_format": RESPONSE_FORMAT
+        }
+
+    def _regenerations(self, regenerate: Optional[Callable[[int], Any]]) -> range:
+        return range(1, self.max_regenerations + 1) if regenerate is not None else range(0)
+
+    @staticmethod
+    def _log_regenerate(caller: Optional[str], error: StructuredOutputError, attempt: int):
+        print(f"{caller or '生成器'} 输出仍不合法（{error}），用原提示词重新请求本轮（第 {attempt} 次）")
+
+    def parse(self,
+              raw: Optional[str],
+              caller: Optional[str] = None,
+              regenerate: Optional[Callable[[int], str]] = None) -> Dict[str, str]:
+        """
+        解析一轮输出，不合法时修复一次，仍不合法时重新请求本轮
+
+        Args:
+            raw: 模型输出
+            caller: 调用方名称（修复调用记为 "{caller}_repair"）
+            regenerate: 用原提示词重新请求本轮的函数 regenerate(attempt) -> 模型输出，None 时不重新请求
+
+        Returns:
+            {字段: 内容}
+
+        Raises:
+            StructuredOutputError: 重新请求的次数用完后仍不合法
+        """
+        try:
+            return parse_turn(raw, self.fields)
+        except StructuredOutputError as e:
+            error = e
+        if isinstance(raw, str) and raw.strip():
+            repaired = self.api_client.call(**self._repair_kwargs(raw, error, caller))
+            try:
+                return parse_turn(repaired, self.fields)
+            except StructuredOutputError as e:
+                error = e
+        for attempt in self._regenerations(regenerate):
+            self._log_regenerate(caller, error, attempt)
+            try:
+                return parse_turn(regenerate(attempt), self.fields)
+            except StructuredOutputError as e:
+                error = e
+        raise error
+
+    async def aparse(self,
+                     raw: Optional[str],
+                     caller: Optional[str] = None,
+                     regenerate: Optional[Callable[[int], Awaitable[str]]] = None) -> Dict[str, str]:
+        """parse 的异步版本（api_client 需为 AsyncQwenAPIClient，regenerate 为协程函数）"""
+        try:
+            return parse_turn(raw, self.fields)
+        except StructuredOutputError as e:
+            error = e
+        if isinstance(raw, str) and raw.strip():
+            repaired = await self.api_client.acall(**self._repair_kwargs(raw, error, caller))
+            try:
+                return parse_turn(repaired, self.fields)
+            except StructuredOutputError as e:
+                error = e
+        for attempt in self._regenerations(regenerate):
+            self._log_regenerate(caller, error, attempt)
+            try:
+                return parse_turn(await regenerate(attempt), self.fields)
+            except StructuredOutputError as e:
+                error = e
+        raise error
@@ -0,0 +1,202 @@
+"""
+离线 token 数预估与提示词预算
+不联网、不依赖分词器词表：按字符类别加权估算 Qwen 分词后的 token 数，
+调用前即可知道提示词大概多长，超出按角色设定的上限时裁剪可选段落（故事、背景、较早的历史）。
+"""
+import re
+import threading
+from typing import Any, Callable, Dict, List, Optional, Union
+
+
+# 各字符类别的 token 权重，用 Qwen 分词器（qwen.tiktoken）在 by_topic_and_risk 语料
+# 和生成器提示词上最小二乘拟合得到：200 token 以上的文本平均误差约 1%
+TOKEN_WEIGHTS = {
+    "cjk": 0.59,          # 汉字（常用词组合并为一个 token）
+    "cjk_punct": 1.04,    # 中文标点、全角符号
+    "word": 0.29,         # 每个连续的英文字母串
+    "word_char": 0.063,   # 英文字母串中的每个字母
+    "digit": 1.0,         # 数字逐位切分
+    "space": 1.54,        # 连续的空白（换行、缩进）
+    "punct": 0.29,        # 英文标点（常与相邻字符合并）
+    "other": 2.75         # 其他字符（emoji 等按字节切分）
+}
+
+# 对话模板中每条消息的额外 token：<|im_start|>角色\n ... <|im_end|>\n
+MESSAGE_OVERHEAD = 5
+# 回复开头的 <|im_start|>assistant\n
+REPLY_OVERHEAD = 3
+
+_CHAR_CLASSES = re.compile(
+    r"(?P<cjk>[一-鿿㐀-䶿豈-﫿])"
+    r"|(?P<cjk_punct>[　-〿＀-￯‘-‟…—])"
+    r"|(?P<word>[A-Za-z]+)"
+    r"|(?P<digit>\d)"
+    r"|(?P<space>\s+)"
+    r"|(?P<punct>[!-/:-@\[-`{-~])"
+    r"|(?P<other>.)",
+    re.S
+)
+
+
+class TokenEstimator:
+    """
+    离线 token 数预估器（线程安全）
+
+    count / count_messages 返回按字符类别加权的原始预估；
+    客户端每次调用后用接口返回的真实输入 token 数调用 observe，按模型维护一个修正系数，
+    estimate_messages 返回修正后的预估（服务端额外注入的 system 提示等由修正系数吸收）。
+    """
+
+    def __init__(self, smoothing: float = 0.1, weights: Optional[Dict[str, float]] = None):
+        """
+        Args:
+            smoothing: 修正系数的指数滑动平均权重
+            weights: 字符类别权重，None 时使用 TOKEN_WEIGHTS
+        """
+        self.smoothing = smoothing
+        self.weights = weights or TOKEN_WEIGHTS
+        self._scales: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def count(self, text: str) -> int:
+        """预估一段文本的 token 数"""
+        weights = self.weights
+        total = 0.0
+        for match in _CHAR_CLASSES.finditer(text):
+            kind = match.lastgroup
+            total += weights[kind]
+            if kind == "word":
+                total += weights["word_char"] * (match.end() - match.start())
+        return int(round(total))
+
+    def count_messages(self, messages: List[Dict[str, Any]]) -> int:
+        """预估一次对话请求的输入 token 数（含对话模板的开销）"""
+        return REPLY_OVERHEAD + sum(
+            MESSAGE_OVERHEAD + self.count(str(msg.get("content", ""))) for msg in messages
+        )
+
+    def scale(self, model: str) -> float:
+        """某个模型当前的修正系数（真实 / 预估），没有观测值时为 1"""
+        with self._lock:
+            return self._scales.get(model, 1.0)
+
+    def estimate_messages(self, messages: List[Dict[str, Any]], model: Optional[str] = None) -> int:
+        """
+        按模型修正后的输入 token 预估
+
+        Args:
+            messages: 消息列表
+            model: 模型名称，None 时不修正
+
+        Returns:
+            预估的输入 token 数
+        """
+        raw = self.count_messages(messages)
+        return raw if model is None else int(round(raw * self.scale(model)))
+
+    def observe(self, model: str, estimated: int, actual: int):
+        """
+        用一次调用的真实输入 token 数更新修正系数
+
+        Args:
+            model: 模型名称
+            estimated: 调用前的原始预估（count_messages 的结果）
+            actual: 接口返回的输入 token 数
+        """
+        if estimated <= 0 or actual <= 0:
+            return
+        ratio = min(max(actual / estimated, 0.5), 2.0)
+        with self._lock:
+            previous = self._scales.get(model)
+            self._scales[model] = ratio if previous is None else previous + self.smoothing * (ratio - previous)
+
+
+class PromptBudgetEnforcer:
+    """
+    按角色的提示词 token 上限，调用前裁剪可选段落
+
+    裁剪顺序：去掉故事背景 → 截短生活状态 → 去掉生活状态 → 从最早的消息开始每次去掉两条历史
+    （至少保留 min_history 条）。每一步都重新构建提示词并预估，一旦不超过上限立即停止；
+    裁剪到底仍超出时返回最短的提示词，不阻止调用。
+    """
+
+    def __init__(self,
+                 limits: Dict[str, int],
+                 estimator: Optional[TokenEstimator] = None,
+                 min_history: int = 2,
+                 background_chars: int = 200):
+        """
+        Args:
+            limits: 角色 -> 输入 token 上限，如 {"patient": 3000, "assistant": 2500}，未列出的角色不限制
+            estimator: token 预估器，可与客户端共享（共享时使用客户端学到的修正系数）
+            min_history: 至少保留的最近历史消息条数
+            background_chars: 截短生活状态时保留的字符数
+        """
+        self.limits = limits
+        self.estimator = estimator or TokenEstimator()
+        self.min_history = min_history
+        self.background_chars = background_chars
+
+    def estimate(self, prompt: Union[str, List[Dict[str, Any]]], model: Optional[str] = None) -> int:
+        """预估提示词（字符串或消息列表）的输入 token 数"""
+        messages = [{"role": "user", "content": prompt}] if isinstance(prompt, str) else prompt
+        return self.estimator.estimate_messages(messages, model)
+
+    def fit(self,
+            role: str,
+            build: Callable[..., Union[str, List[Dict[str, Any]]]],
+            story: Optional[str],
+            background: str,
+            history_len: int,
+            model: Optional[str] = None) -> Union[str, List[Dict[str, Any]]]:
+        """
+        构建不超过该角色上限的提示词
+
+        Args:
+            role: 角色（"patient" / "assistant"）
+            build: 构建函数 build(story=..., background=..., max_history=...)，
+                   max_history 为 None 时保留完整历史，返回提示词字符串或消息列表
+            story: 故事背景
+            background: 24小时生活状态
+            history_len: 对话历史的条数
+            model: 模型名称，用于按模型修正预估
+
+        Returns:
+            提示词字符串或消息列表
+        """
+        sections = {"story": story, "background": background, "max_history": None}
+        prompt = build(**sections)
+        limit = self.limits.get(role)
+        if limit is None:
+            return prompt
+        original = estimated = self.estimate(prompt, model)
+        if estimated <= limit:
+            return prompt
+
+        steps = []
+        if story:
+            steps.append(("去掉故事背景", {"story": None}))
+        if background and len(background) > self.background_chars:
+            steps.append(("截短生活状态", {"background": background[:self.background_chars] + "..."}))
+        if background:
+            steps.append(("去掉生活状态", {"background": ""}))
+        for keep in range(history_len - 2, self.min_history - 1, -2):
+            steps.append(("历史", {"max_history": keep}))
+        if history_len > self.min_history and (history_len - self.min_history) % 2:
+            steps.append(("历史", {"max_history": self.min_history}))
+
+        applied = []
+        for description, change in steps:
+            sections.update(change)
+            prompt = build(**sections)
+            estimated = self.estimate(prompt, model)
+            if description not in applied:
+                applied.append(description)
+            if estimated <= limit:
+                break
+        if sections["max_history"] is not None:
+            applied[-1] = f"历史 {history_len} → {sections['max_history']} 条"
+        status = "已裁剪" if estimated <= limit else "裁剪后仍超出"
+        print(f"提示词超出预算（{role}: 预估 {original} > {limit} tokens），{status}: "
+              f"{'，'.join(applied) or '无可裁剪段落'}，预估 {estimated} tokens")
+        return prompt
@@ -0,0 +1,36 @@
+"""
+单元测试的公共配置：把 user_simulator 目录加入导入路径，测试以 scripts.xxx 的方式导入模块
+所有测试都使用 MockLLMClient / MockResponder 或本地构造的错误，不访问网络。
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# 入口脚本（main_random_topic 等）导入时检查 API key；测试只使用模拟后端，给一个占位值
+os.environ.setdefault("QWEN_API_KEY", "sk-test")
+
+
+class FakeClock:
+    """替换模块里的 time：monotonic() 返回手动推进的时间，sleep() 只推进时间"""
+
+    def __init__(self, start: float = 1000.0):
+        self.now = start
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def time(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.now += seconds
+
+    def advance(self, seconds: float):
+        self.now += seconds
+
+
+@pytest.fixture
+def fake_clock():
+    return FakeClock()
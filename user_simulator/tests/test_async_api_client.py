@@ -0,0 +1,163 @@
+"""异步客户端：请求与错误转换、信号量与限流 / key / 并发名额的获取顺序"""
+import asyncio
+
+import pytest
+
+from scripts.api_client import QwenAPIClient, QwenAPIError
+from scripts.async_api_client import AsyncQwenAPIClient
+from scripts.concurrency import AdaptiveConcurrencyLimiter
+from scripts.key_pool import KeyPool
+from scripts.rate_limiter import RateLimiter
+from scripts.retry import RetryPolicy
+
+
+class FakeAioResponse:
+    def __init__(self, status, body, headers=None):
+        self.status = status
+        self.reason = "Too Many Requests" if status == 429 else "OK"
+        self.url = "https://example.invalid"
+        self.headers = headers or {}
+        self._body = body
+
+    async def text(self):
+        return self._body
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+class FakeAioSession:
+    """模拟 aiohttp.ClientSession.post，每次请求前调用 on_post() 记录当时的状态"""
+
+    def __init__(self, status=200, body=None, headers=None, delay=0.0, on_post=None):
+        self.closed = False
+        self.status = status
+        self.body = body or '{"output": {"text": "回复"}, "usage": {"input_tokens": 3, "output_tokens": 2}}'
+        self.headers = headers
+        self.delay = delay
+        self.on_post = on_post
+        self.posts = 0
+
+    def post(self, url, json=None, headers=None, timeout=None):
+        self.posts += 1
+        if self.on_post is not None:
+            self.on_post()
+        return _DelayedResponse(self.delay, FakeAioResponse(self.status, self.body, self.headers))
+
+    async def close(self):
+        self.closed = True
+
+
+class _DelayedResponse:
+    def __init__(self, delay, response):
+        self.delay = delay
+        self.response = response
+
+    async def __aenter__(self):
+        await asyncio.sleep(self.delay)
+        return self.response
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+def _client(session, **kwargs):
+    client = AsyncQwenAPIClient("sk-test", "https://example.invalid", **kwargs)
+    client._aio_session = session
+    return client
+
+
+def test_acall_returns_text_and_records_usage():
+    async def main():
+        client = _client(FakeAioSession())
+        text = await client.acall("你好", caller="Test")
+        await client.aclose()
+        return client, text
+
+    client, text = asyncio.run(main())
+    assert text == "回复"
+    totals = client.metrics.snapshot()["totals"]
+    assert (totals["calls"], totals["input_tokens"], totals["output_tokens"]) == (1, 3, 2)
+
+
+def test_error_status_becomes_qwen_api_error():
+    async def main():
+        session = FakeAioSession(status=429, body='{"code": "Throttling"}', headers={"Retry-After": "3"})
+        client = _client(session, retry_policy=RetryPolicy(max_retries=0))
+        try:
+            await client.acall("你好")
+        finally:
+            await client.aclose()
+
+    with pytest.raises(QwenAPIError) as excinfo:
+        asyncio.run(main())
+    assert excinfo.value.status_code == 429
+    assert excinfo.value.retry_after == 3.0
+    assert excinfo.value.transient
+
+
+def test_queued_requests_hold_no_slot_key_or_quota():
+    pool = KeyPool.from_specs(["sk-test-key-0"], "https://example.invalid", {"qwen-plus": {"rpm": 600}})
+    endpoint = pool.endpoints[0]
+    request_bucket, _ = endpoint.rate_limiter._buckets["qwen-plus"]
+    concurrency = AdaptiveConcurrencyLimiter(initial_limit=8)
+    observed = []
+
+    def on_post():
+        observed.append((endpoint.in_flight, concurrency.in_flight, request_bucket.tokens))
+
+    async def main():
+        client = _client(FakeAioSession(delay=0.02, on_post=on_post), max_concurrency=1,
+                         key_pool=pool, concurrency=concurrency)
+        await asyncio.gather(*(client.acall(f"问题{i}") for i in range(3)))
+        await client.aclose()
+
+    asyncio.run(main())
+    # 信号量只放行一个请求：在信号量上排队的请求不占 key、不占 AIMD 名额、不提前扣减 RPM
+    assert [(key_in_flight, slots) for key_in_flight, slots, _ in observed] == [(1, 1)] * 3
+    # 每个请求发出时 RPM 桶只扣了已发出的请求（期间按 10 个/秒补充少量令牌）
+    assert 599 <= observed[0][2] < 599.5
+    assert 598 <= observed[1][2] < 598.8
+    assert endpoint.in_flight == 0 and concurrency.in_flight == 0
+
+
+def test_cancelled_while_queued_leaves_nothing_behind():
+    pool = KeyPool.from_specs(["sk-test-key-0"], "https://example.invalid")
+    endpoint = pool.endpoints[0]
+
+    async def main():
+        client = _client(FakeAioSession(delay=0.05), max_concurrency=1, key_pool=pool)
+        first = asyncio.ensure_future(client.acall("问题1"))
+        second = asyncio.ensure_future(client.acall("问题2"))
+        await asyncio.sleep(0.01)
+        second.cancel()
+        await first
+        with pytest.raises(asyncio.CancelledError):
+            await second
+        await client.aclose()
+        return client
+
+    client = asyncio.run(main())
+    assert client._aio_session is None
+    assert endpoint.in_flight == 0
+    assert endpoint.calls == 1
+
+
+class FailingLimiter(AdaptiveConcurrencyLimiter):
+    def acquire(self):
+        raise RuntimeError("占用名额失败")
+
+
+def test_sync_send_releases_key_when_slot_acquire_fails():
+    pool = KeyPool.from_specs(["sk-test-key-0"], "https://example.invalid", failure_threshold=1)
+    endpoint = pool.endpoints[0]
+    client = QwenAPIClient("sk-test", "https://example.invalid", key_pool=pool, concurrency=FailingLimiter())
+    with pytest.raises(RuntimeError):
+        client.call("你好")
+    # key 已归还，且请求没有发出，不计入 key 的健康状态
+    assert endpoint.in_flight == 0
+    assert endpoint.errors == 0
+    assert pool.has_healthy()
@@ -0,0 +1,116 @@
+"""可替换的后端：按名称创建，OpenAI 兼容接口的请求/响应转换，模拟后端的确定性与截断"""
+import asyncio
+
+import pytest
+
+from scripts.api_client import QwenAPIClient
+from scripts.async_api_client import AsyncQwenAPIClient
+from scripts.backends import (
+    AsyncMockLLMClient, AsyncOpenAICompatibleClient, LLMBackend, MockLLMClient, OpenAICompatibleClient,
+    create_client, openai_chat_url
+)
+from scripts.budget import track_usage
+from scripts.mock_responder import MockResponder
+
+
+@pytest.mark.parametrize("backend, sync_cls, async_cls", [
+    ("dashscope", QwenAPIClient, AsyncQwenAPIClient),
+    ("openai", OpenAICompatibleClient, AsyncOpenAICompatibleClient),
+    ("mock", MockLLMClient, AsyncMockLLMClient),
+])
+def test_create_client_by_name(backend, sync_cls, async_cls):
+    client = create_client(backend, api_key="sk-test")
+    assert type(client) is sync_cls and isinstance(client, LLMBackend)
+    assert type(create_client(backend, async_client=True, api_key="sk-test")) is async_cls
+
+
+def test_create_client_rejects_unknown_backend():
+    with pytest.raises(ValueError):
+        create_client("azure")
+
+
+def test_openai_chat_url():
+    assert openai_chat_url("http://127.0.0.1:8000/v1/") == "http://127.0.0.1:8000/v1/chat/completions"
+    assert openai_chat_url("http://h/v1/chat/completions") == "http://h/v1/chat/completions"
+
+
+class RecordingResponse:
+    status_code = 200
+
+    def __init__(self, result):
+        self._result = result
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self._result
+
+
+class RecordingSession:
+    def __init__(self, result):
+        self.result = result
+        self.requests = []
+
+    def post(self, url, json=None, headers=None, timeout=None, stream=False):
+        self.requests.append({"url": url, "json": json})
+        return RecordingResponse(self.result)
+
+
+def test_openai_client_converts_request_and_response():
+    client = OpenAICompatibleClient(base_url="http://127.0.0.1:8000/v1", model_override="Qwen2.5-7B-Instruct")
+    client._session = RecordingSession({
+        "choices": [{"message": {"content": "你好"}, "finish_reason": "length"}],
+        "usage": {"prompt_tokens": 12, "completion_tokens": 3}
+    })
+    with track_usage() as usage:
+        text = client.call("hi", model="qwen-plus", max_tokens=3, caller="Test", enable_search=True)
+    assert text == "你好"
+    request = client._session.requests[0]
+    assert request["url"] == "http://127.0.0.1:8000/v1/chat/completions"
+    body = request["json"]
+    assert body["model"] == "Qwen2.5-7B-Instruct"
+    assert body["messages"] == [{"role": "user", "content": "hi"}]
+    assert body["max_tokens"] == 3
+    assert "enable_search" not in body and "result_format" not in body and "stream" not in body
+    # 用量换算为统一字段，指标和预算仍按调用方的模型名统计
+    assert usage.input_tokens == 12 and usage.output_tokens == 3 and usage.truncated_calls == 1
+    assert client.metrics.snapshot()["series"][0]["model"] == "qwen-plus"
+
+
+def test_openai_stream_payload_requests_usage():
+    client = OpenAICompatibleClient()
+    body = client._wire_payload({
+        "model": "qwen-plus",
+        "input": {"messages": [{"role": "user", "content": "hi"}]},
+        "parameters": {"temperature": 0.7, "incremental_output": True, "result_format": "message"}
+    })
+    assert body["stream"] is True and body["stream_options"] == {"include_usage": True}
+    assert "incremental_output" not in body and "result_format" not in body
+
+
+def test_mock_client_is_deterministic_per_seed():
+    prompt = "请生成 3 个不同的患者咨询主题"
+    assert MockLLMClient(seed=1).call(prompt) == MockLLMClient(seed=1).call(prompt)
+    texts = {MockLLMClient(seed=seed).call(prompt) for seed in range(5)}
+    assert len(texts) > 1
+
+
+def test_mock_client_applies_stop_and_max_tokens():
+    client = MockLLMClient(responder=MockResponder(["患者: 你好\n照护师: 不该出现"]))
+    assert client.call("hi", stop=["\n照护师:"]) == "患者: 你好"
+    with track_usage() as usage:
+        assert client.call("hi", max_tokens=5) == "患者: 你"
+    assert usage.truncated_calls == 1 and usage.output_tokens == 5
+
+
+def test_mock_stream_stops_early():
+    client = MockLLMClient(responder=MockResponder(["一二三四五六七八九十"]), stream_chunk_chars=2)
+    text = client.call_stream("hi", stop_when=lambda text: "四" in text)
+    assert text == "一二三四"
+    assert client.metrics.stream_summary()["early_stops"] == 1
+
+
+def test_async_mock_matches_sync():
+    prompt = "请生成 3 个不同的患者咨询主题"
+    assert asyncio.run(AsyncMockLLMClient(seed=2).acall(prompt)) == MockLLMClient(seed=2).call(prompt)
@@ -0,0 +1,67 @@
+"""离线批量推理：任务文件格式、结果文件按 custom_id 合并（OpenAI 兼容 / DashScope 原生格式、错误行）"""
+import json
+
+import pytest
+
+from scripts.batch_job import BATCH_ENDPOINT, BatchJobWriter, load_batch_results, write_fake_batch_results
+
+
+def _read_jsonl(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def test_writer_emits_one_request_per_line(tmp_path):
+    path = tmp_path / "batch_input.jsonl"
+    with BatchJobWriter(str(path)) as writer:
+        writer.add("line-0", [{"role": "user", "content": "分类"}], model="qwen-plus", temperature=0.0)
+        writer.add_prompt("line-1", "你好", max_tokens=100, stop=["\n"])
+    assert writer.count == 2
+    rows = _read_jsonl(path)
+    assert rows[0]["custom_id"] == "line-0" and rows[0]["method"] == "POST" and rows[0]["url"] == BATCH_ENDPOINT
+    assert rows[0]["body"]["temperature"] == 0.0
+    assert rows[1]["body"]["messages"] == [{"role": "user", "content": "你好"}]
+    assert rows[1]["body"]["max_tokens"] == 100 and rows[1]["body"]["stop"] == ["\n"]
+
+
+def test_writer_rejects_duplicate_custom_id(tmp_path):
+    with BatchJobWriter(str(tmp_path / "batch_input.jsonl")) as writer:
+        writer.add_prompt("a", "你好")
+        with pytest.raises(ValueError):
+            writer.add_prompt("a", "再见")
+
+
+def test_load_results_handles_formats_and_errors(tmp_path):
+    path = tmp_path / "batch_output.jsonl"
+    rows = [
+        {"custom_id": "openai", "response": {"status_code": 200, "body": {
+            "choices": [{"message": {"content": "甲"}}], "usage": {"prompt_tokens": 10, "completion_tokens": 2}}}},
+        {"custom_id": "dashscope", "response": {"status_code": 200, "body": {
+            "output": {"text": "乙"}, "usage": {"input_tokens": 7, "output_tokens": 1}}}},
+        {"custom_id": "error", "response": {"status_code": 500, "body": {}},
+         "error": {"code": "InternalError", "message": "服务内部错误"}},
+        {"custom_id": "http", "response": {"status_code": 429, "body": {"message": "限流"}}},
+        {"custom_id": "bad", "response": {"status_code": 200, "body": {"output": {}}}},
+    ]
+    path.write_text("\n".join(json.dumps(row, ensure_ascii=False) for row in rows) + "\n\n", encoding="utf-8")
+    results = load_batch_results(str(path))
+    assert results["openai"] == {"text": "甲", "error": None, "usage": {"input_tokens": 10, "output_tokens": 2}}
+    assert results["dashscope"]["text"] == "乙" and results["dashscope"]["usage"]["input_tokens"] == 7
+    assert results["error"]["text"] is None and results["error"]["error"] == "服务内部错误"
+    assert results["http"]["error"].startswith("HTTP 429")
+    assert results["bad"]["text"] is None and "无法解析" in results["bad"]["error"]
+
+
+def test_fake_results_round_trip(tmp_path):
+    input_path, output_path = tmp_path / "in.jsonl", tmp_path / "out.jsonl"
+    with BatchJobWriter(str(input_path)) as writer:
+        for i in range(20):
+            writer.add_prompt(f"line-{i}", "请按 primary_class 分类")
+    assert write_fake_batch_results(str(input_path), str(output_path), error_rate=0.3, seed=1) == 20
+    results = load_batch_results(str(output_path))
+    assert set(results) == {f"line-{i}" for i in range(20)}
+    failed = [item for item in results.values() if item["error"]]
+    assert 0 < len(failed) < 20
+    succeeded = [item for item in results.values() if not item["error"]]
+    assert all("primary_class" in json.loads(item["text"]) for item in succeeded)
+    assert all(item["usage"]["output_tokens"] == len(item["text"]) for item in succeeded)
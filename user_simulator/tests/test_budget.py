@@ -0,0 +1,119 @@
+import json
+
+import pytest
+
+import config
+from main_random_topic import ConsolidatedDialogueGenerator
+from scripts.api_client import BudgetExceededError
+from scripts.backends import MockLLMClient
+from scripts.budget import TokenBudget, estimate_cost, track_usage
+from scripts.dialogue_generator import DialogueGenerator
+from scripts.health_assistant_generator_thinking import HealthAssistantGenerator_thinking
+from scripts.one_shot_dialogue import OneShotDialogueGenerator
+from scripts.token_estimator import TokenEstimator
+
+PRICES = {"qwen-plus": {"input": 0.0008, "output": 0.002}}
+
+
+def test_estimate_cost_uses_per_thousand_prices_and_ignores_unknown_models():
+    assert estimate_cost("qwen-plus", 1000, 500, PRICES) == pytest.approx(0.0018)
+    assert estimate_cost("unknown", 1000, 500, PRICES) == 0.0
+    assert estimate_cost("qwen-plus", 1000, 500, None) == 0.0
+
+
+def test_nested_usage_trackers_count_into_outer():
+    with track_usage(PRICES) as outer:
+        outer.add("qwen-plus", {"input_tokens": 10, "output_tokens": 5})
+        with track_usage(PRICES) as inner:
+            inner.add("qwen-plus", {"input_tokens": 100, "output_tokens": 50, "truncated": 1})
+    assert inner.summary()["total_tokens"] == 150
+    assert inner.truncated_calls == 1
+    assert outer.summary()["api_calls"] == 2
+    assert outer.summary()["total_tokens"] == 165
+
+
+def test_soft_then_hard_limit():
+    budget = TokenBudget(max_tokens=300, soft_max_tokens=100, prices=PRICES)
+    budget.record("qwen-plus", {"input_tokens": 60, "output_tokens": 30})
+    assert not budget.soft_exceeded()
+    budget.record("qwen-plus", {"input_tokens": 10, "output_tokens": 0})
+    assert budget.soft_exceeded() and not budget.hard_exceeded()
+    budget.record("qwen-plus", {"input_tokens": 200, "output_tokens": 0})
+    assert budget.hard_exceeded()
+    summary = budget.summary()
+    assert summary["status"] == "hard"
+    assert summary["by_model"]["qwen-plus"]["input_tokens"] == 270
+
+
+def test_client_refuses_new_requests_after_hard_limit():
+    budget = TokenBudget(max_tokens=1)
+    client = MockLLMClient(budget=budget)
+    client.call(prompt="你好")
+    with pytest.raises(BudgetExceededError):
+        client.call(prompt="你好")
+
+
+CORPUS_DIALOGUE = {
+    "metadata": {"topic": "空腹血糖偏高，想知道原因"},
+    "dialogue_history": [
+        {"role": "user", "content": "我空腹7.8，有点担心。"},
+        {"role": "assistant", "thinking": "数值偏高但不危险。", "content": "7.8略高于正常，先别紧张，明早再测一次。"},
+        {"role": "user", "content": "好，我明早再测。"},
+        {"role": "assistant", "thinking": "患者准备收束。", "content": "好的，有变化随时告诉我。"}
+    ]
+}
+
+
+@pytest.fixture
+def corpus(tmp_path, monkeypatch):
+    with open(tmp_path / "dialogues.jsonl", "w", encoding="utf-8") as f:
+        f.write(json.dumps(CORPUS_DIALOGUE, ensure_ascii=False) + "\n")
+    monkeypatch.setattr(config, "OUTPUT_LENGTH_CORPUS", str(tmp_path))
+    return tmp_path
+
+
+def _generator(one_shot=False):
+    client = MockLLMClient()
+    generator = ConsolidatedDialogueGenerator.__new__(ConsolidatedDialogueGenerator)
+    generator.all_dialogues = []
+    generator.token_estimator = TokenEstimator()
+    generator.patient_generator = DialogueGenerator(client)
+    generator.assistant_generator = HealthAssistantGenerator_thinking(client)
+    generator.one_shot_generator = OneShotDialogueGenerator(client) if one_shot else None
+    return generator, client
+
+
+def test_first_run_prints_a_priori_estimate_without_calls(corpus, capsys):
+    generator, client = _generator()
+    generator._print_cost_estimate(10, {"基础信息": {}})
+    output = capsys.readouterr().out
+    assert "先验估算" in output
+    assert client.metrics.total_calls() == 0
+    usage = generator._estimate_dialogue_usage(generator._extract_background_story({}))
+    # 4 次调用：每次至少包含提示词模板，历史随轮次增长
+    assert usage["total_tokens"] > 4 * 100
+    assert usage["estimated_cost"] > 0
+    assert f"约 ¥{usage['estimated_cost'] * 10:.2f}" in output
+
+
+def test_one_shot_estimate_is_a_single_call(corpus):
+    turn_by_turn, _ = _generator()
+    one_shot, _ = _generator(one_shot=True)
+    persona = one_shot._extract_background_story({})
+    usage = one_shot._estimate_dialogue_usage(persona)
+    assert 0 < usage["total_tokens"] < turn_by_turn._estimate_dialogue_usage(persona)["total_tokens"]
+
+
+def test_no_corpus_and_no_history_falls_back_to_notice(tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(config, "OUTPUT_LENGTH_CORPUS", str(tmp_path / "missing"))
+    generator, _ = _generator()
+    generator._print_cost_estimate(10, {"基础信息": {}})
+    assert "无法预估" in capsys.readouterr().out
+
+
+def test_history_usage_takes_precedence(corpus, capsys):
+    generator, _ = _generator()
+    generator.all_dialogues = [{"metadata": {"usage": {"total_tokens": 1000, "estimated_cost": 0.01}}}]
+    generator._print_cost_estimate(10, {"基础信息": {}})
+    output = capsys.readouterr().out
+    assert "按已有 1 个对话" in output and "约 ¥0.10" in output
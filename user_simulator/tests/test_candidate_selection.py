@@ -0,0 +1,59 @@
+"""多候选挑选：排除与历史重复的候选，按差异、长度和问题数评分"""
+from scripts.backends import MockLLMClient
+from scripts.candidate_selection import choose_candidate, is_repetitive, score_candidate, similarity
+from scripts.dialogue_generator import DialogueGenerator
+from scripts.mock_responder import PATIENT_REPLIES
+
+HISTORY = [
+    {"role": "user", "content": "今天早上空腹测了7.8，比平时高一点，有点担心。"},
+    {"role": "assistant", "content": "空腹7.8确实略高于理想范围，咱们先别太担心。"},
+]
+
+
+def test_similarity():
+    assert similarity("abc", "abc") == 1.0
+    assert similarity("abcd", "ab") == 0.5
+    assert similarity("", "abc") == 0.0
+
+
+def test_is_repetitive_only_checks_patient_turns():
+    assert is_repetitive(" 今天早上空腹测了7.8，比平时高一点，有点担心。 ", HISTORY)
+    assert is_repetitive("今天早上空腹测了7.8，比平时高一点，有点担心啊", HISTORY)
+    assert not is_repetitive("空腹7.8确实略高于理想范围，咱们先别太担心。", HISTORY)
+    # 10 字以内只看完全相同
+    assert not is_repetitive("有点担心。", [{"role": "user", "content": "有点担心啊"}])
+
+
+def test_score_penalises_length_and_extra_questions():
+    fresh = "那我明天早上再测一次看看。"
+    assert score_candidate(fresh, []) == 1.0
+    assert score_candidate("好", []) == 0.5
+    assert score_candidate("是饮食吗？还是药？要复查吗？", []) == 1.0 - 0.6
+    assert score_candidate(fresh, HISTORY) < 1.0
+
+
+def test_choose_excludes_repeats_and_prefers_novel_candidates():
+    candidates = [
+        HISTORY[0]["content"],
+        "今天早上空腹还是7.8，有点担心。",
+        "昨晚聚餐吃多了，这是不是原因？",
+    ]
+    assert choose_candidate(candidates, HISTORY) == "昨晚聚餐吃多了，这是不是原因？"
+
+
+def test_choose_returns_first_when_all_repeat():
+    candidates = [HISTORY[0]["content"], HISTORY[0]["content"] + " "]
+    assert choose_candidate(candidates, HISTORY) == HISTORY[0]["content"]
+
+
+def test_patient_generator_picks_a_fresh_candidate_in_one_call():
+    client = MockLLMClient()
+    generator = DialogueGenerator(client, num_candidates=3)
+    # 模拟后端从 6 条回复中抽 3 条候选，历史中只有 2 条，至少有一条候选不重复
+    history = [{"role": "user", "content": reply} for reply in PATIENT_REPLIES[:2]]
+    result = generator.generate_response(
+        persona={"基本信息": {"年龄": 60}}, dialogue_topic="空腹血糖偏高", background="", dialogue_history=history
+    )
+    assert result["response"] in PATIENT_REPLIES
+    assert not is_repetitive(result["response"], history)
+    assert client.metrics.total_calls() == 1
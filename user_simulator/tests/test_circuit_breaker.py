@@ -0,0 +1,127 @@
+"""熔断器的状态转换，以及客户端按错误类型反馈熔断器"""
+import pytest
+
+from scripts import circuit_breaker
+from scripts.api_client import CircuitOpenError, QwenAPIError
+from scripts.backends import MockLLMClient
+from scripts.circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker
+from scripts.retry import RetryPolicy
+
+
+@pytest.fixture
+def clock(monkeypatch, fake_clock):
+    monkeypatch.setattr(circuit_breaker, "time", fake_clock)
+    return fake_clock
+
+
+def test_opens_after_consecutive_failures(clock):
+    breaker = CircuitBreaker(failure_threshold=3, recovery_timeout=30)
+    for _ in range(2):
+        assert breaker.allow_request()
+        breaker.record_failure()
+    assert breaker.state == CLOSED
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    assert not breaker.allow_request()
+    assert breaker.remaining_open_time() == pytest.approx(30)
+    assert breaker.stats()["rejected"] == 1
+
+
+def test_success_resets_failure_count(clock):
+    breaker = CircuitBreaker(failure_threshold=2)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == CLOSED
+
+
+def test_half_open_probe_success_closes(clock):
+    breaker = CircuitBreaker(failure_threshold=1, recovery_timeout=30, half_open_max_calls=1)
+    breaker.record_failure()
+    clock.advance(30)
+    assert breaker.allow_request()
+    assert breaker.state == HALF_OPEN
+    # 探测名额用完，其余请求仍被拒绝
+    assert not breaker.allow_request()
+    breaker.record_success()
+    assert breaker.state == CLOSED
+    assert breaker.allow_request()
+
+
+def test_half_open_probe_failure_reopens(clock):
+    breaker = CircuitBreaker(failure_threshold=1, recovery_timeout=30)
+    breaker.record_failure()
+    clock.advance(30)
+    assert breaker.allow_request()
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    assert breaker.stats()["open_count"] == 2
+    assert not breaker.allow_request()
+
+
+def test_ignored_result_returns_probe_slot(clock):
+    breaker = CircuitBreaker(failure_threshold=1, recovery_timeout=30)
+    breaker.record_failure()
+    clock.advance(30)
+    assert breaker.allow_request()
+    breaker.record_ignored()
+    assert breaker.state == HALF_OPEN
+    assert breaker.allow_request()
+
+
+def test_stuck_probe_expires(clock):
+    breaker = CircuitBreaker(failure_threshold=1, recovery_timeout=30)
+    breaker.record_failure()
+    clock.advance(30)
+    assert breaker.allow_request()
+    clock.advance(30)
+    assert breaker.allow_request()
+
+
+class ScriptedMockClient(MockLLMClient):
+    """按顺序抛出给定的错误（None 表示正常回复）"""
+
+    def __init__(self, outcomes, **kwargs):
+        super().__init__(**kwargs)
+        self.outcomes = list(outcomes)
+
+    def _send_once(self, payload, timeout):
+        outcome = self.outcomes.pop(0) if self.outcomes else None
+        if outcome is not None:
+            raise outcome
+        return super()._send_once(payload, timeout)
+
+
+def _call_ignoring_errors(client, times):
+    for _ in range(times):
+        try:
+            client.call("你好")
+        except QwenAPIError:
+            pass
+
+
+@pytest.mark.parametrize("error, state", [
+    (QwenAPIError("rate limited", status_code=429, transient=True), CLOSED),
+    (QwenAPIError("bad request", status_code=400), CLOSED),
+    (QwenAPIError("server error", status_code=500, transient=True), OPEN),
+    (QwenAPIError("timeout", transient=True), OPEN),
+])
+def test_client_feeds_breaker_by_error_type(error, state):
+    breaker = CircuitBreaker(failure_threshold=3)
+    client = ScriptedMockClient([error] * 3, circuit_breaker=breaker, retry_policy=RetryPolicy(max_retries=0))
+    _call_ignoring_errors(client, 3)
+    assert breaker.state == state
+
+
+def test_429_does_not_reset_failure_count():
+    breaker = CircuitBreaker(failure_threshold=2)
+    server_error = QwenAPIError("server error", status_code=503, transient=True)
+    rate_limited = QwenAPIError("rate limited", status_code=429, transient=True)
+    client = ScriptedMockClient(
+        [server_error, rate_limited, server_error], circuit_breaker=breaker, retry_policy=RetryPolicy(max_retries=0)
+    )
+    _call_ignoring_errors(client, 3)
+    assert breaker.state == OPEN
+    with pytest.raises(CircuitOpenError) as excinfo:
+        client.call("你好")
+    assert excinfo.value.retry_after > 0
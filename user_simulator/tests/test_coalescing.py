@@ -0,0 +1,132 @@
+"""在途请求合并（线程版本与协程版本）"""
+import asyncio
+import threading
+import time
+
+import pytest
+
+from scripts.coalescing import RequestCoalescer
+
+
+def test_concurrent_calls_share_one_result():
+    coalescer = RequestCoalescer()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def fn():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return "结果"
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(coalescer.run("k", fn)))
+    leader.start()
+    started.wait(5)
+    waiters = [threading.Thread(target=lambda: results.append(coalescer.run("k", fn))) for _ in range(3)]
+    for waiter in waiters:
+        waiter.start()
+    # 等待者加入在途调用后再让 leader 返回
+    time.sleep(0.1)
+    release.set()
+    for thread in [leader] + waiters:
+        thread.join(5)
+    assert len(calls) == 1
+    assert sorted(results) == [("结果", False)] + [("结果", True)] * 3
+    assert coalescer._inflight == {}
+
+
+def test_sequential_calls_are_not_coalesced():
+    coalescer = RequestCoalescer()
+    assert coalescer.run("k", lambda: 1) == (1, False)
+    assert coalescer.run("k", lambda: 2) == (2, False)
+
+
+def test_leader_error_propagates_and_clears_key():
+    coalescer = RequestCoalescer()
+
+    def fail():
+        raise RuntimeError("boom")
+
+    with pytest.raises(RuntimeError):
+        coalescer.run("k", fail)
+    assert coalescer._inflight == {}
+
+
+def test_async_calls_share_one_result():
+    calls = []
+
+    async def fn():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "结果"
+
+    async def main():
+        coalescer = RequestCoalescer()
+        results = await asyncio.gather(*(coalescer.arun("k", fn) for _ in range(4)))
+        return coalescer, results
+
+    coalescer, results = asyncio.run(main())
+    assert len(calls) == 1
+    assert results == [("结果", False)] + [("结果", True)] * 3
+    assert coalescer._async_inflight == {}
+
+
+def test_async_leader_error_reaches_waiters():
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise RuntimeError("boom")
+
+    async def main():
+        coalescer = RequestCoalescer()
+        return await asyncio.gather(*(coalescer.arun("k", fail) for _ in range(3)), return_exceptions=True)
+
+    results = asyncio.run(main())
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+
+def test_async_cancelled_leader_promotes_waiter():
+    calls = []
+
+    async def fn(tag):
+        calls.append(tag)
+        await asyncio.sleep(0.05)
+        return f"r-{tag}"
+
+    async def main():
+        coalescer = RequestCoalescer()
+        leader = asyncio.ensure_future(coalescer.arun("k", lambda: fn("A")))
+        await asyncio.sleep(0.01)
+        waiters = [asyncio.ensure_future(coalescer.arun("k", lambda tag=tag: fn(tag))) for tag in ("B", "C")]
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        results = await asyncio.gather(*waiters)
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return coalescer, results
+
+    coalescer, results = asyncio.run(main())
+    # 等待者不会随 leader 一起取消：第一个等待者重新发起调用，另一个共享它的结果
+    assert calls == ["A", "B"]
+    assert results == [("r-B", False), ("r-B", True)]
+    assert coalescer._async_inflight == {}
+
+
+def test_async_cancelled_waiter_does_not_affect_leader():
+    async def fn():
+        await asyncio.sleep(0.03)
+        return "结果"
+
+    async def main():
+        coalescer = RequestCoalescer()
+        leader = asyncio.ensure_future(coalescer.arun("k", fn))
+        await asyncio.sleep(0.01)
+        waiter = asyncio.ensure_future(coalescer.arun("k", fn))
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+        return await leader, waiter
+
+    result, waiter = asyncio.run(main())
+    assert result == ("结果", False)
+    assert waiter.cancelled()
@@ -0,0 +1,97 @@
+"""对冲请求：触发时间、额外负载上限，以及同步客户端对落败请求的处理"""
+import threading
+import time
+
+from scripts.api_client import QwenAPIClient
+from scripts.concurrency import AdaptiveConcurrencyLimiter
+from scripts.hedging import HedgePolicy
+
+
+class FakeResponse:
+    def __init__(self, text, output_tokens):
+        self.status_code = 200
+        self._result = {
+            "output": {"text": text, "finish_reason": "stop"},
+            "usage": {"input_tokens": 10, "output_tokens": output_tokens}
+        }
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self._result
+
+
+class FakeSession:
+    """按调用顺序返回 (延迟秒数, 文本, 输出token数)，不访问网络"""
+
+    def __init__(self, replies):
+        self.replies = list(replies)
+        self._lock = threading.Lock()
+
+    def post(self, url, json=None, headers=None, timeout=None, stream=False):
+        with self._lock:
+            delay, text, output_tokens = self.replies.pop(0)
+        time.sleep(delay)
+        return FakeResponse(text, output_tokens)
+
+
+class RecordingLimiter(AdaptiveConcurrencyLimiter):
+    """记录每次归还名额时的参数"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.releases = []
+
+    def release(self, key, latency=None, congested=False, cancelled=False):
+        self.releases.append({"latency": latency, "cancelled": cancelled})
+        super().release(key, latency=latency, congested=congested, cancelled=cancelled)
+
+
+def test_no_hedge_until_enough_samples():
+    policy = HedgePolicy(min_samples=3, min_delay=0.1)
+    policy.record_latency("qwen-plus", 1.0)
+    assert policy.hedge_delay("qwen-plus") is None
+    for latency in (2.0, 3.0):
+        policy.record_latency("qwen-plus", latency)
+    assert policy.hedge_delay("qwen-plus") is not None
+    assert policy.hedge_delay("qwen-max") is None
+
+
+def test_hedge_delay_is_clamped():
+    policy = HedgePolicy(quantile=1.0, min_delay=0.5, max_delay=2.0, min_samples=1)
+    policy.record_latency("qwen-plus", 0.1)
+    assert policy.hedge_delay("qwen-plus") == 0.5
+    policy.record_latency("qwen-plus", 10.0)
+    assert policy.hedge_delay("qwen-plus") == 2.0
+
+
+def test_extra_load_is_bounded():
+    policy = HedgePolicy(max_extra_ratio=0.1)
+    for _ in range(20):
+        policy.record_request()
+    assert [policy.try_hedge() for _ in range(3)] == [True, True, False]
+    assert policy.stats()["hedges"] == 2
+
+
+def test_sync_hedge_loser_only_releases_its_slot():
+    policy = HedgePolicy(quantile=1.0, min_delay=0.05, max_delay=0.05, max_extra_ratio=1.0, min_samples=1)
+    policy.record_latency("qwen-plus", 0.05)
+    limiter = RecordingLimiter(initial_limit=8)
+    client = QwenAPIClient("sk-test", "https://example.invalid", hedge=policy, concurrency=limiter)
+    client._session = FakeSession([(0.3, "慢的主请求", 7), (0.0, "对冲请求", 5)])
+
+    assert client.call("你好", caller="Test") == "对冲请求"
+    client._get_hedge_executor().shutdown(wait=True)
+
+    # 胜出的请求按成功计入 AIMD；落败的请求只归还名额，不计入 AIMD 和延迟基线
+    assert len(limiter.releases) == 2
+    assert sorted(release["cancelled"] for release in limiter.releases) == [False, True]
+    winner = next(release for release in limiter.releases if not release["cancelled"])
+    assert winner["latency"] is not None
+    assert limiter.in_flight == 0
+    assert len(policy._latencies["qwen-plus"]) == 2
+    # 落败请求的 token 用量照常计入
+    totals = client.metrics.snapshot()["totals"]
+    assert totals["output_tokens"] == 12
+    assert totals["hedges"] == 1 and totals["hedge_wins"] == 1
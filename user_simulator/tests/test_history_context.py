@@ -0,0 +1,98 @@
+"""滚动历史窗口：窗口只随消息条数变化，摘要增量更新，历史部分按 count_tokens 不超过上限"""
+import pytest
+
+from scripts.api_client import CircuitOpenError
+from scripts.history_context import RollingHistory, compress_message
+from scripts.token_estimator import TokenEstimator
+
+
+def _dialogue(n, content="血糖{i}还好"):
+    return [
+        {"role": "user" if i % 2 == 0 else "assistant", "content": content.format(i=i)}
+        for i in range(n)
+    ]
+
+
+def test_compress_message_prefers_clause_with_number():
+    msg = {"role": "user", "content": "最近有点累。空腹7.8mmol/L！想问问"}
+    assert compress_message(msg) == "患者: 空腹7.8mmol/L"
+    assert compress_message({"role": "assistant", "content": "别担心。先观察"}) == "照护师: 别担心"
+    assert compress_message({"role": "user", "content": "  "}) == ""
+
+
+def test_short_history_is_kept_verbatim():
+    history = RollingHistory(keep_last=4, evict_batch=2)
+    dialogue = _dialogue(5)
+    summary, recent = history.window(dialogue)
+    assert summary == "" and recent == dialogue
+
+
+def test_window_evicts_in_batches():
+    history = RollingHistory(keep_last=4, evict_batch=2)
+    splits = []
+    for n in range(1, 11):
+        summary, recent = history.window(_dialogue(n))
+        splits.append(n - len(recent))
+    # 窗口在 keep_last + evict_batch 条时第一次移出，之后每 evict_batch 条移出一批
+    assert splits == [0, 0, 0, 0, 0, 2, 2, 4, 4, 6]
+
+
+def test_summary_is_updated_incrementally():
+    calls = []
+
+    def summarizer(summary, messages):
+        calls.append(len(messages))
+        return (summary + "|" if summary else "") + ",".join(m["content"] for m in messages)
+
+    history = RollingHistory(keep_last=2, evict_batch=2, summarizer=summarizer)
+    dialogue = []
+    for msg in _dialogue(8):
+        dialogue.append(msg)
+        history.window(dialogue)
+    summary, recent = history.window(dialogue)
+    assert calls == [2, 2, 2]
+    assert summary == "血糖0还好,血糖1还好|血糖2还好,血糖3还好|血糖4还好,血糖5还好"
+    assert [m["content"] for m in recent] == ["血糖6还好", "血糖7还好"]
+
+
+def test_summarizer_failure_falls_back_to_extractive_but_circuit_errors_propagate():
+    def failing(summary, messages):
+        raise RuntimeError("boom")
+
+    summary, _ = RollingHistory(keep_last=2, evict_batch=2, summarizer=failing).window(_dialogue(4))
+    assert summary == "患者: 血糖0还好\n照护师: 血糖1还好"
+
+    def open_circuit(summary, messages):
+        raise CircuitOpenError("熔断")
+
+    with pytest.raises(CircuitOpenError):
+        RollingHistory(keep_last=2, evict_batch=2, summarizer=open_circuit).window(_dialogue(4))
+
+
+def test_max_message_chars_counts_characters():
+    history = RollingHistory(max_message_chars=10)
+    _, recent = history.window([{"role": "user", "content": "血" * 30}])
+    assert recent[0]["content"] == "血" * 7 + "..."
+
+
+@pytest.mark.parametrize("max_tokens", [40, 80, 200])
+def test_history_stays_within_token_limit(max_tokens):
+    estimator = TokenEstimator()
+    history = RollingHistory(keep_last=4, evict_batch=2, max_tokens=max_tokens, summary_max_tokens=30,
+                             count_tokens=estimator.count)
+    dialogue = _dialogue(9, content="第{i}次测空腹血糖7.8mmol/L，" + "感觉有点头晕乏力，" * 12)
+    summary, recent = history.window(dialogue)
+    total = estimator.count(summary) + sum(estimator.count(m["content"]) for m in recent)
+    assert total <= max_tokens
+    assert recent and recent[-1]["content"].startswith("第8次")
+
+
+def test_last_message_truncated_in_tokens_not_characters():
+    # 汉字约 0.59 token/字：按 token 截断后保留的字符数明显多于上限本身
+    estimator = TokenEstimator()
+    history = RollingHistory(keep_last=1, evict_batch=1, max_tokens=60, count_tokens=estimator.count)
+    _, recent = history.window([{"role": "user", "content": "血糖偏高" * 50}])
+    content = recent[0]["content"]
+    assert content.endswith("...")
+    assert estimator.count(content) <= 60
+    assert len(content) > 60
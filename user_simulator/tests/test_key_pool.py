@@ -0,0 +1,124 @@
+"""多 key 负载均衡：选择、摘除与恢复"""
+import pytest
+
+from scripts import key_pool, rate_limiter
+from scripts.key_pool import APIEndpoint, KeyPool
+
+
+@pytest.fixture
+def clock(monkeypatch, fake_clock):
+    monkeypatch.setattr(key_pool, "time", fake_clock)
+    monkeypatch.setattr(rate_limiter, "time", fake_clock)
+    return fake_clock
+
+
+def _pool(count=2, rate_limits=None, **kwargs):
+    specs = [f"sk-test-key-{i}" for i in range(count)]
+    return KeyPool.from_specs(specs, "https://example.invalid/api/v1", rate_limits, **kwargs)
+
+
+def test_from_specs_parses_base_url():
+    pool = KeyPool.from_specs(["sk-a", " sk-b @ https://b.invalid "], "https://default.invalid")
+    assert [(ep.api_key, ep.base_url) for ep in pool.endpoints] == [
+        ("sk-a", "https://default.invalid"), ("sk-b", "https://b.invalid")
+    ]
+    with pytest.raises(ValueError):
+        KeyPool([])
+
+
+def test_routes_to_least_loaded_key(clock):
+    pool = _pool(2)
+    first = pool.acquire("qwen-plus")
+    second = pool.acquire("qwen-plus")
+    assert first is not second
+    pool.release(first)
+    assert pool.acquire("qwen-plus") is first
+
+
+def test_skips_key_without_quota(clock):
+    pool = _pool(2, rate_limits={"qwen-plus": {"rpm": 1}})
+    first = pool.acquire("qwen-plus")
+    pool.release(first)
+    second = pool.acquire("qwen-plus")
+    pool.release(second)
+    assert second is not first
+    # 两个 key 的配额都用完时等待最短的那个
+    started = clock.now
+    pool.acquire("qwen-plus")
+    assert clock.now - started == pytest.approx(60.0)
+
+
+def test_429_ejects_for_retry_after(clock):
+    pool = _pool(2, eject_seconds=10)
+    endpoint = pool.acquire("qwen-plus")
+    pool.release(endpoint, status_code=429, retry_after=45, transient=True, failed=True)
+    assert not endpoint.is_healthy(clock.now)
+    assert endpoint.ejected_until - clock.now == pytest.approx(45)
+    for _ in range(3):
+        other = pool.acquire("qwen-plus")
+        assert other is not endpoint
+        pool.release(other)
+    clock.advance(45)
+    assert endpoint.is_healthy(clock.now)
+
+
+def test_consecutive_429_backoff_doubles(clock):
+    pool = _pool(1, eject_seconds=10, max_eject_seconds=25)
+    endpoint = pool.endpoints[0]
+    durations = []
+    for _ in range(3):
+        pool.acquire("qwen-plus")
+        pool.release(endpoint, status_code=429, transient=True, failed=True)
+        durations.append(endpoint.ejected_until - clock.now)
+    assert durations == [10, 20, 25]
+
+
+def test_auth_error_ejects_for_max_duration(clock):
+    pool = _pool(2, max_eject_seconds=600)
+    endpoint = pool.acquire("qwen-plus")
+    pool.release(endpoint, status_code=401, failed=True)
+    assert endpoint.ejected_until - clock.now == pytest.approx(600)
+    assert pool.has_healthy()
+
+
+def test_transient_errors_eject_after_threshold(clock):
+    pool = _pool(1, eject_seconds=10, failure_threshold=3)
+    endpoint = pool.endpoints[0]
+    for _ in range(2):
+        pool.acquire("qwen-plus")
+        pool.release(endpoint, status_code=503, transient=True, failed=True)
+    assert endpoint.is_healthy(clock.now)
+    pool.acquire("qwen-plus")
+    pool.release(endpoint, status_code=503, transient=True, failed=True)
+    assert not pool.has_healthy()
+    # 全部摘除时仍选最早恢复的 key 继续调用
+    assert pool.acquire("qwen-plus") is endpoint
+
+
+def test_success_resets_failures(clock):
+    pool = _pool(1, failure_threshold=2)
+    endpoint = pool.endpoints[0]
+    pool.acquire("qwen-plus")
+    pool.release(endpoint, status_code=503, transient=True, failed=True)
+    pool.acquire("qwen-plus")
+    pool.release(endpoint)
+    pool.acquire("qwen-plus")
+    pool.release(endpoint, status_code=503, transient=True, failed=True)
+    assert endpoint.is_healthy(clock.now)
+
+
+def test_cancelled_release_keeps_health_state(clock):
+    pool = _pool(1, failure_threshold=2)
+    endpoint = pool.endpoints[0]
+    pool.acquire("qwen-plus")
+    pool.release(endpoint, status_code=503, transient=True, failed=True)
+    pool.acquire("qwen-plus")
+    pool.release(endpoint, cancelled=True)
+    assert endpoint.in_flight == 0
+    assert endpoint.consecutive_failures == 1
+    assert pool.stats()[0]["errors"] == 1
+
+
+def test_endpoint_name_is_masked():
+    assert APIEndpoint("sk-1234567890abcd", "https://example.invalid").name == "sk-...abcd"
+    assert APIEndpoint("short", "https://example.invalid").name == "***"
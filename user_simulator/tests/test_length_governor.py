@@ -0,0 +1,103 @@
+"""按角色的输出长度控制：从语料学习上限、stop 序列与截断后逐级放宽"""
+import asyncio
+import json
+
+from scripts.backends import AsyncMockLLMClient, MockLLMClient
+from scripts.length_governor import OutputLengthGovernor, corpus_output_lengths
+from scripts.mock_responder import MockResponder
+from scripts.token_estimator import TokenEstimator
+
+
+class RecordingMockClient(MockLLMClient):
+    """记录每次请求的 max_tokens 与 stop"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.requests = []
+
+    def _send_once(self, payload, timeout):
+        self.requests.append((payload["parameters"].get("max_tokens"), payload["parameters"].get("stop")))
+        return super()._send_once(payload, timeout)
+
+
+def test_max_tokens_from_quantile_with_headroom():
+    governor = OutputLengthGovernor({"patient": [10, 20, 30, 40], "assistant": []},
+                                    quantile=1.0, headroom=1.5, min_tokens=8)
+    assert governor.limits == {"patient": 60}
+    assert governor.max_tokens("patient") == 60
+    assert governor.max_tokens("patient", ceiling=50) == 50
+    assert governor.max_tokens("patient", replies=3) == 180
+    # 没有样本的角色沿用调用方的 max_tokens
+    assert governor.max_tokens("assistant", ceiling=2000) == 2000
+
+
+def test_min_tokens_floor():
+    governor = OutputLengthGovernor({"patient": [1, 2, 3]}, min_tokens=64)
+    assert governor.limits["patient"] == 64
+
+
+def test_short_reply_uses_learned_limit_and_stop():
+    client = RecordingMockClient(responder=MockResponder(["Response:\n好的。\n照护师：我替你说了"]))
+    governor = OutputLengthGovernor({"patient": [20]}, quantile=1.0, headroom=1.0, min_tokens=1)
+    text = governor.call("patient", client.call, "你好", max_tokens=2000)
+    assert text == "Response:\n好的。"
+    assert client.requests == [(20, ["\n照护师:", "\n照护师："])]
+
+
+def test_truncated_reply_escalates_up_to_ceiling():
+    client = RecordingMockClient(responder=MockResponder(["x" * 100]))
+    governor = OutputLengthGovernor({"patient": [10]}, quantile=1.0, headroom=1.0, min_tokens=1, max_escalations=5)
+    text = governor.call("patient", client.call, "你好", max_tokens=30)
+    assert [max_tokens for max_tokens, _ in client.requests] == [10, 20, 30]
+    # 放宽到调用方的上限后仍被截断时返回截断的文本
+    assert text == "x" * 30
+
+
+def test_escalations_are_bounded():
+    client = RecordingMockClient(responder=MockResponder(["x" * 100]))
+    governor = OutputLengthGovernor({"patient": [10]}, quantile=1.0, headroom=1.0, min_tokens=1, max_escalations=2)
+    governor.call("patient", client.call, "你好", max_tokens=2000)
+    assert [max_tokens for max_tokens, _ in client.requests] == [10, 20, 40]
+
+
+def test_caller_stop_is_kept():
+    client = RecordingMockClient(responder=MockResponder(["短回复"]))
+    governor = OutputLengthGovernor({"patient": [10]})
+    governor.call("patient", client.call, "你好", stop=["END"])
+    assert client.requests[0][1] == ["END"]
+
+
+def test_acall_escalates():
+    async def main():
+        async with AsyncMockLLMClient(responder=MockResponder(["x" * 50])) as client:
+            governor = OutputLengthGovernor({"assistant": [10]}, quantile=1.0, headroom=1.0, min_tokens=1)
+            return await governor.acall("assistant", client.acall, "你好", max_tokens=100)
+
+    # 10 -> 20 -> 40 仍被截断，放宽次数用完
+    assert asyncio.run(main()) == "x" * 40
+
+
+def test_corpus_output_lengths(tmp_path):
+    records = [
+        {"metadata": {"topic": "空腹血糖偏高"}, "dialogue_history": [
+            {"role": "user", "content": "我空腹7.8"},
+            {"role": "assistant", "thinking": "数值略高", "content": "先别担心"}
+        ]},
+        {"metadata": {"topic": "空腹血糖偏高"}, "dialogue_history": [{"role": "user", "content": "又高了"}]},
+    ]
+    corpus = tmp_path / "糖尿病" / "LOW.jsonl"
+    corpus.parent.mkdir()
+    corpus.write_text("\n".join(json.dumps(r, ensure_ascii=False) for r in records) + "\n坏行\n", encoding="utf-8")
+    estimator = TokenEstimator()
+    samples = corpus_output_lengths(str(tmp_path), estimator)
+    assert len(samples["patient"]) == len(samples["baseline_patient"]) == 2
+    assert len(samples["assistant"]) == 1
+    # 同一主题只计一次
+    assert samples["topic_query"] == [estimator.count("空腹血糖偏高")]
+    assert samples["baseline_patient"][0] == estimator.count("我空腹7.8")
+
+
+def test_from_corpus_without_samples(tmp_path):
+    governor = OutputLengthGovernor.from_corpus(str(tmp_path / "missing"))
+    assert governor.limits == {}
+    assert governor.max_tokens("patient", ceiling=2000) == 2000
@@ -0,0 +1,95 @@
+"""main.py：背景与故事并行生成"""
+import threading
+import time
+
+import pytest
+
+from main import UserSimulator
+from scripts.budget import current_usage_tracker, track_usage
+
+
+def test_stages_run_in_parallel():
+    # 两个步骤互相等待对方到达，串行执行时会超时
+    barrier = threading.Barrier(2, timeout=2)
+
+    def stage(value):
+        barrier.wait()
+        return value
+
+    result = UserSimulator._run_concurrently({
+        "background": lambda: stage("背景"),
+        "story": lambda: stage("故事")
+    })
+
+    assert result == {"background": "背景", "story": "故事"}
+
+
+def test_failure_is_raised_without_waiting_for_other_stages():
+    release = threading.Event()
+
+    def slow():
+        release.wait(5)
+        return "慢"
+
+    def failing():
+        raise ValueError("生成失败")
+
+    start = time.monotonic()
+    try:
+        with pytest.raises(ValueError, match="生成失败"):
+            UserSimulator._run_concurrently({"slow": slow, "failing": failing})
+        assert time.monotonic() - start < 2
+    finally:
+        release.set()
+
+
+def test_stages_inherit_usage_tracker():
+    with track_usage() as usage:
+        def stage():
+            current_usage_tracker().add("qwen-plus", {"input_tokens": 10, "output_tokens": 5})
+            return current_usage_tracker()
+
+        result = UserSimulator._run_concurrently({"background": stage, "story": stage})
+
+    assert result["background"] is usage
+    assert result["story"] is usage
+    assert usage.api_calls == 2
+    assert usage.input_tokens == 20
+    assert usage.output_tokens == 10
+
+
+def test_simulate_conversation_uses_parallel_setup():
+    simulator = UserSimulator.__new__(UserSimulator)
+    threads = {}
+    seen = []
+
+    def background(persona, topic):
+        threads["background"] = threading.get_ident()
+        return "背景"
+
+    def story(persona, topic):
+        threads["story"] = threading.get_ident()
+        return "故事"
+
+    def patient_turn(persona, dialogue_topic, background, dialogue_history, story):
+        seen.append((background, story))
+        return {"response": "我最近睡不好", "thinking": ""}
+
+    def assistant_turn(persona, dialogue_topic, background, dialogue_history, story):
+        seen.append((background, story))
+        return "可以说说具体情况吗？"
+
+    simulator.generate_background = background
+    simulator.generate_story = story
+    simulator.generate_dialogue_turn = patient_turn
+    simulator.generate_health_assistant_turn = assistant_turn
+
+    data = simulator.simulate_conversation({"name": "张三"}, "睡眠", max_turns=1,
+                                           return_full_data=True)
+
+    assert data["background"] == "背景"
+    assert data["story"] == "故事"
+    assert seen == [("背景", "故事"), ("背景", "故事")]
+    assert [m["role"] for m in data["dialogue_history"]] == ["user", "assistant"]
+    # 两个准备步骤都不在调用线程中执行
+    assert threading.get_ident() not in threads.values()
@@ -0,0 +1,84 @@
+"""调用指标：按 (模型, 调用方) 累计，快照与 Prometheus 导出一致，客户端调用后记入指标"""
+import json
+
+from scripts.backends import MockLLMClient
+from scripts.metrics import APIMetrics, percentile
+
+
+def test_percentile_nearest_rank():
+    samples = sorted(float(i) for i in range(1, 101))
+    assert percentile(samples, 0.5) == 50.0
+    assert percentile(samples, 0.99) == 99.0
+    assert percentile(samples, 1.0) == 100.0
+    assert percentile([], 0.5) is None
+
+
+def test_snapshot_groups_by_model_and_caller():
+    metrics = APIMetrics()
+    metrics.record_call("qwen-plus", "patient", 1.0, usage={"input_tokens": 100, "output_tokens": 20},
+                        estimated_input_tokens=110)
+    metrics.record_call("qwen-plus", "patient", 3.0, error="500")
+    metrics.record_retry("qwen-plus", "patient")
+    metrics.record_cache_hit("qwen-turbo", None)
+    metrics.record_usage("qwen-plus", "patient", {"input_tokens": 5, "output_tokens": 1})
+    snapshot = metrics.snapshot()
+    rows = {(row["model"], row["caller"]): row for row in snapshot["series"]}
+    patient = rows[("qwen-plus", "patient")]
+    assert patient["calls"] == 2
+    assert patient["errors_by_reason"] == {"500": 1}
+    assert patient["retries"] == 1
+    assert patient["input_tokens"] == 105 and patient["output_tokens"] == 21
+    assert patient["latency_avg"] == 2.0 and patient["latency_p99"] == 1.0
+    assert abs(patient["estimate_error"] - 0.1) < 1e-9
+    assert rows[("qwen-turbo", "unknown")]["cache_hits"] == 1
+    totals = snapshot["totals"]
+    assert totals["calls"] == 2 and totals["errors"] == 1 and totals["cache_hits"] == 1
+    assert metrics.total_calls() == 2
+
+
+def test_latency_samples_are_bounded_but_counts_are_cumulative():
+    metrics = APIMetrics(max_samples=3)
+    for latency in [10.0, 1.0, 2.0, 3.0]:
+        metrics.record_call("qwen-plus", "c", latency)
+    row = metrics.snapshot()["series"][0]
+    assert row["calls"] == 4 and row["latency_sum"] == 16.0
+    assert row["latency_p99"] == 2.0
+
+
+def test_stream_summary():
+    metrics = APIMetrics()
+    metrics.record_stream("qwen-plus", "c", 0.2, early_stop=True)
+    metrics.record_stream("qwen-plus", "c", None, early_stop=False)
+    summary = metrics.stream_summary()
+    assert summary["stream_calls"] == 2 and summary["early_stops"] == 1
+    assert summary["ttft_p50"] == 0.2
+
+
+def test_prometheus_export_escapes_labels_and_includes_gauges():
+    metrics = APIMetrics()
+    metrics.record_call("qwen-plus", 'a"b', 0.5, usage={"input_tokens": 3, "output_tokens": 4}, error="timeout")
+    metrics.set_gauge("concurrency_limit", 8)
+    text = metrics.to_prometheus()
+    assert 'qwen_api_calls_total{model="qwen-plus",caller="a\\"b"} 1' in text
+    assert 'qwen_api_errors_total{model="qwen-plus",caller="a\\"b",reason="timeout"} 1' in text
+    assert 'qwen_api_tokens_total{model="qwen-plus",caller="a\\"b",direction="output"} 4' in text
+    assert 'qwen_api_latency_seconds_count{model="qwen-plus",caller="a\\"b"} 1' in text
+    assert "qwen_api_concurrency_limit 8" in text
+
+
+def test_save_writes_json_and_prometheus(tmp_path):
+    metrics = APIMetrics()
+    metrics.record_call("qwen-plus", "c", 0.1)
+    json_path, prom_path = tmp_path / "m" / "metrics.json", tmp_path / "m" / "metrics.prom"
+    metrics.save(json_path=str(json_path), prometheus_path=str(prom_path))
+    assert json.loads(json_path.read_text(encoding="utf-8"))["totals"]["calls"] == 1
+    assert "qwen_api_calls_total" in prom_path.read_text(encoding="utf-8")
+
+
+def test_client_records_calls_with_caller():
+    client = MockLLMClient()
+    client.call(prompt="你好", caller="topic_generation")
+    client.call(prompt="你好", caller="topic_generation", model="qwen-turbo")
+    rows = {(row["model"], row["caller"]): row for row in client.metrics.snapshot()["series"]}
+    assert rows[("qwen-plus", "topic_generation")]["calls"] == 1
+    assert rows[("qwen-turbo", "topic_generation")]["output_tokens"] > 0
@@ -0,0 +1,79 @@
+"""整段对话一次生成：不合格时带上错误原因重新生成，调用次数有上限；批量生成按 one_shot 模式保存"""
+import asyncio
+import json
+
+import pytest
+
+from main_random_topic import ConsolidatedDialogueGenerator
+from scripts.backends import AsyncMockLLMClient, MockLLMClient
+from scripts.one_shot_dialogue import OneShotDialogueGenerator
+from scripts.structured_output import StructuredOutputError
+
+PERSONA = {"基本信息": {"性别": "女", "年龄": 58}, "现病史": {"糖尿病类型": "2型"}}
+TOPIC = "空腹血糖7.8，有点担心"
+
+
+def _dialogue_json(turns):
+    dialogue = []
+    for i in range(turns):
+        dialogue.append({"role": "user", "content": f"患者第{i}句"})
+        dialogue.append({"role": "assistant", "thinking": "判断数值", "content": f"照护师第{i}句"})
+    return json.dumps({"dialogue": dialogue}, ensure_ascii=False)
+
+
+class ScriptedClient:
+    """按顺序返回固定输出，并记录每次的提示词"""
+
+    def __init__(self, outputs):
+        self.outputs = list(outputs)
+        self.prompts = []
+
+    def call(self, prompt, **kwargs):
+        self.prompts.append(prompt)
+        return self.outputs.pop(0)
+
+
+def test_mock_backend_produces_valid_dialogue():
+    history = OneShotDialogueGenerator(MockLLMClient(), min_turns=3, max_turns=8).generate_dialogue(PERSONA, TOPIC)
+    assert 6 <= len(history) <= 16
+    assert [msg["role"] for msg in history] == ["user", "assistant"] * (len(history) // 2)
+    assert all(msg["thinking"] for msg in history if msg["role"] == "assistant")
+
+
+def test_prompt_contains_persona_topic_and_turn_range():
+    client = ScriptedClient([_dialogue_json(3)])
+    OneShotDialogueGenerator(client, min_turns=3, max_turns=6).generate_dialogue(PERSONA, TOPIC)
+    prompt = client.prompts[0]
+    assert TOPIC in prompt and '"年龄": 58' in prompt and "一共 3~6 轮" in prompt
+
+
+def test_invalid_output_is_regenerated_with_reason():
+    client = ScriptedClient(["不是 JSON", _dialogue_json(4)])
+    history = OneShotDialogueGenerator(client, min_turns=3, max_turns=8).generate_dialogue(PERSONA, TOPIC)
+    assert len(history) == 8
+    assert "上一次的输出不符合要求" not in client.prompts[0]
+    assert "上一次的输出不符合要求" in client.prompts[1]
+
+
+def test_gives_up_after_max_calls():
+    client = ScriptedClient([_dialogue_json(1), _dialogue_json(9), _dialogue_json(3)])
+    with pytest.raises(StructuredOutputError, match="轮数"):
+        OneShotDialogueGenerator(client, min_turns=3, max_turns=8, max_calls=2).generate_dialogue(PERSONA, TOPIC)
+    assert len(client.prompts) == 2
+
+
+def test_async_matches_sync():
+    sync = OneShotDialogueGenerator(MockLLMClient(seed=3)).generate_dialogue(PERSONA, TOPIC)
+    generator = OneShotDialogueGenerator(AsyncMockLLMClient(seed=3))
+    assert asyncio.run(generator.agenerate_dialogue(PERSONA, TOPIC)) == sync
+
+
+def test_batch_generator_saves_one_shot_dialogue():
+    generator = ConsolidatedDialogueGenerator.__new__(ConsolidatedDialogueGenerator)
+    generator.one_shot_generator = OneShotDialogueGenerator(ScriptedClient([_dialogue_json(4)]))
+    generator._select_topic = lambda patient_index: TOPIC
+    result = generator.generate_for_patient({}, 0, "patient_0000")
+    assert result["success"]
+    data = result["data"]
+    assert len(data["dialogue_history"]) == 8
+    assert data["metadata"]["generation_mode"] == "one_shot"
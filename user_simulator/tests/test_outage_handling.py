@@ -0,0 +1,76 @@
+"""批量生成遇到熔断：辅助调用不吞掉熔断/预算异常，连续熔断的暂停有总时长上限"""
+import pytest
+
+import config
+import main_random_topic
+from main_random_topic import ConsolidatedDialogueGenerator
+from scripts.api_client import BudgetExceededError, CircuitOpenError, QwenAPIError
+
+
+class FailingClient:
+    def __init__(self, error):
+        self.error = error
+
+    def call(self, **kwargs):
+        raise self.error
+
+
+def _generator(client=None):
+    generator = ConsolidatedDialogueGenerator.__new__(ConsolidatedDialogueGenerator)
+    generator.api_client = client
+    generator.length_governor = None
+    generator._outage_started = None
+    return generator
+
+
+@pytest.mark.parametrize("error", [CircuitOpenError("熔断", retry_after=30), BudgetExceededError("预算耗尽")])
+def test_topic_generation_propagates_circuit_and_budget_errors(error):
+    generator = _generator(FailingClient(error))
+    with pytest.raises(type(error)):
+        generator._generate_topics(5)
+    generator.patients = [{}]
+    with pytest.raises(type(error)):
+        generator._select_topic(0)
+
+
+def test_topic_generation_falls_back_on_other_errors():
+    generator = _generator(FailingClient(QwenAPIError("500", status_code=500)))
+    assert len(generator._generate_topics(3)) == 3
+
+
+@pytest.fixture
+def clock(monkeypatch, fake_clock):
+    monkeypatch.setattr(main_random_topic, "time", fake_clock)
+    monkeypatch.setattr(config, "CIRCUIT_MAX_OUTAGE", 100.0)
+    return fake_clock
+
+
+def test_pauses_until_outage_deadline(clock):
+    generator = _generator()
+    error = CircuitOpenError("熔断", retry_after=30)
+    start = clock.now
+    pauses = 0
+    while generator._wait_for_circuit(error):
+        pauses += 1
+    # 暂停到半开共 30 秒一次，连续 100 秒后停止
+    assert pauses == 4
+    assert clock.now - start == 120
+    assert generator._outage_exceeded()
+
+
+def test_success_resets_outage(clock):
+    generator = _generator()
+    error = CircuitOpenError("熔断", retry_after=60)
+    assert generator._wait_for_circuit(error)
+    assert generator._wait_for_circuit(error)
+    # 期间有对话成功生成，重新计时
+    generator._outage_started = None
+    assert generator._wait_for_circuit(error)
+    assert not generator._outage_exceeded()
+
+
+def test_pause_is_at_least_one_second(clock):
+    generator = _generator()
+    start = clock.now
+    assert generator._wait_for_circuit(CircuitOpenError("熔断"))
+    assert clock.now - start == 1
@@ -0,0 +1,113 @@
+"""预编译提示词模板与片段缓存：渲染结果与 str.format 逐字节一致"""
+import pytest
+
+from scripts.health_assistant_generator_thinking import HealthAssistantGenerator_thinking
+from scripts.prompt_templates import FragmentCache, PromptTemplate
+
+
+TEMPLATES = [
+    "当前是第 {current_turn} 轮",
+    "{head}中间{tail}",
+    "无字段的纯文本",
+    # 转义的花括号会把字面文本拆成多段，字段不能错位
+    '只输出 JSON：{{"response": "{example}"}}',
+    '{{"dialogue": [\n  {{"role": "user", "content": "{content}"}}\n]}}\n共 {turns} 轮',
+    "{{}}{a}{{{b}}}{{",
+    "{a}{a}{{a}}",
+]
+
+VALUES = {
+    "current_turn": 3, "head": "开头", "tail": "结尾", "example": "回复", "content": "血糖 7.8",
+    "turns": 5, "a": "甲", "b": "{不是字段}"
+}
+
+
+@pytest.mark.parametrize("text", TEMPLATES)
+def test_render_matches_str_format(text):
+    template = PromptTemplate(text)
+    fields = {name: VALUES[name] for name in template.fields}
+    assert template.render(**fields).encode("utf-8") == text.format(**fields).encode("utf-8")
+
+
+@pytest.mark.parametrize("text", TEMPLATES)
+def test_partial_matches_str_format(text):
+    template = PromptTemplate(text)
+    fields = {name: VALUES[name] for name in template.fields}
+    for name in template.fields:
+        partial = template.partial(**{name: fields[name]})
+        assert partial.fields == template.fields - {name}
+        rest = {key: value for key, value in fields.items() if key != name}
+        assert partial.render(**rest) == text.format(**fields)
+
+
+def test_escaped_braces_keep_fields_aligned():
+    template = PromptTemplate('{{"candidates": ["{first}", "{second}"]}}')
+    assert template.fields == {"first", "second"}
+    assert template.render(first="甲", second="乙") == '{"candidates": ["甲", "乙"]}'
+
+
+def test_missing_field_raises_key_error():
+    with pytest.raises(KeyError):
+        PromptTemplate("第 {current_turn} 轮").render()
+
+
+@pytest.mark.parametrize("text", ["{0}", "{}", "{value!r}", "{value:>4}", "{value.attr}", "{value[0]}"])
+def test_rejects_non_simple_fields(text):
+    with pytest.raises(ValueError):
+        PromptTemplate(text)
+
+
+def test_fragment_cache_builds_once_per_owner():
+    cache = FragmentCache()
+    persona = {"name": "张三"}
+    builds = []
+
+    def build():
+        builds.append(1)
+        return "片段"
+
+    assert cache.get(persona, ("context", "主题"), build) == "片段"
+    assert cache.get(persona, ("context", "主题"), build) == "片段"
+    assert len(builds) == 1
+    cache.get(persona, ("context", "另一个主题"), build)
+    cache.get({"name": "张三"}, ("context", "主题"), build)
+    assert len(builds) == 3
+
+
+def test_fragment_cache_evicts_lru():
+    cache = FragmentCache(max_entries=2)
+    owners = [{"i": i} for i in range(3)]
+    for owner in owners:
+        cache.get(owner, "k", lambda owner=owner: owner["i"])
+    rebuilt = []
+    cache.get(owners[0], "k", lambda: rebuilt.append(1) or 0)
+    assert rebuilt == [1]
+
+
+def test_history_renders_only_new_messages():
+    cache = FragmentCache()
+    rendered = []
+
+    def render_message(msg):
+        rendered.append(msg["content"])
+        return f"{msg['role']}: {msg['content']}\n"
+
+    history = [{"role": "user", "content": "一"}, {"role": "assistant", "content": "二"}]
+    assert cache.history(history, render_message) == "user: 一\nassistant: 二\n"
+    history.append({"role": "user", "content": "三"})
+    assert cache.history(history, render_message) == "user: 一\nassistant: 二\nuser: 三\n"
+    assert rendered == ["一", "二", "三"]
+    # 历史被改写时整段重新渲染
+    history[-1] = {"role": "user", "content": "四"}
+    assert cache.history(history, render_message).endswith("user: 四\n")
+    assert cache.history([], render_message) == ""
+
+
+@pytest.mark.parametrize("max_chars", [20, 120])
+def test_history_message_truncates_to_max_chars(max_chars):
+    render = HealthAssistantGenerator_thinking._render_history_message
+    msg = {"role": "user", "content": "血" * 200}
+    content = render(msg, max_chars=max_chars)[len("患者: "):-1]
+    assert len(content) == max_chars and content.endswith("...")
+    assert render({"role": "assistant", "content": "血" * max_chars}, max_chars=max_chars) == f"照护师: {'血' * max_chars}\n"
+    assert render(msg, max_chars=None) == f"患者: {'血' * 200}\n"
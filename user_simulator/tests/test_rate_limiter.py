@@ -0,0 +1,75 @@
+"""令牌桶与按模型的限流器"""
+import pytest
+
+from scripts import rate_limiter
+from scripts.rate_limiter import RateLimiter, TokenBucket
+
+
+@pytest.fixture
+def clock(monkeypatch, fake_clock):
+    monkeypatch.setattr(rate_limiter, "time", fake_clock)
+    return fake_clock
+
+
+def test_bucket_starts_full_and_refills_at_rate(clock):
+    bucket = TokenBucket(60)
+    assert bucket.tokens == 60
+    assert bucket.rate == 1.0
+    bucket.tokens = 0
+    bucket.refill(clock.now + 10)
+    assert bucket.tokens == 10
+    bucket.refill(clock.now + 1000)
+    assert bucket.tokens == 60
+
+
+def test_bucket_wait_time_and_clamp(clock):
+    bucket = TokenBucket(120)
+    bucket.tokens = 10
+    assert bucket.wait_time(5) == 0
+    assert bucket.wait_time(30) == pytest.approx(10.0)
+    assert bucket.clamp(500) == 120
+
+
+def test_try_acquire_limits_requests(clock):
+    limiter = RateLimiter({"qwen-plus": {"rpm": 2}})
+    assert limiter.try_acquire("qwen-plus", 0) == 0
+    assert limiter.try_acquire("qwen-plus", 0) == 0
+    assert limiter.try_acquire("qwen-plus", 0) == pytest.approx(30.0)
+    clock.advance(30)
+    assert limiter.try_acquire("qwen-plus", 0) == 0
+
+
+def test_try_acquire_limits_tokens(clock):
+    limiter = RateLimiter({"qwen-plus": {"rpm": 600, "tpm": 6000}})
+    assert limiter.try_acquire("qwen-plus", 5000) == 0
+    assert limiter.try_acquire("qwen-plus", 2000) == pytest.approx(10.0)
+    # 超过桶容量的请求按容量扣减，等桶满后可以发出，不会永远等待
+    clock.advance(60)
+    assert limiter.try_acquire("qwen-plus", 100000) == 0
+
+
+def test_unconfigured_model_is_not_limited(clock):
+    limiter = RateLimiter({"qwen-plus": {"rpm": 1}})
+    for _ in range(10):
+        assert limiter.try_acquire("qwen-max", 10 ** 6) == 0
+
+
+def test_acquire_sleeps_until_quota_allows(clock):
+    limiter = RateLimiter({"qwen-plus": {"rpm": 1}})
+    limiter.acquire("qwen-plus")
+    started = clock.now
+    limiter.acquire("qwen-plus")
+    assert clock.now - started == pytest.approx(60.0)
+
+
+def test_reconcile_returns_and_charges_difference(clock):
+    limiter = RateLimiter({"qwen-plus": {"tpm": 6000}})
+    limiter.try_acquire("qwen-plus", 3000)
+    _, token_bucket = limiter._buckets["qwen-plus"]
+    limiter.reconcile("qwen-plus", 3000, 1000)
+    assert token_bucket.tokens == 5000
+    limiter.reconcile("qwen-plus", 1000, 4000)
+    assert token_bucket.tokens == 2000
+    # 退回不超过桶容量
+    limiter.reconcile("qwen-plus", 6000, 0)
+    assert token_bucket.tokens == 6000
@@ -0,0 +1,76 @@
+"""SQLite 响应缓存：读写、覆盖、淘汰与运行中的字节总数"""
+import pytest
+
+from scripts import response_cache
+from scripts.response_cache import ResponseCache, make_request_key
+
+
+def _payload(content, temperature=0.0):
+    return {
+        "model": "qwen-plus",
+        "input": {"messages": [{"role": "user", "content": content}]},
+        "parameters": {"temperature": temperature, "max_tokens": 100}
+    }
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = ResponseCache(str(tmp_path / "cache" / "responses.sqlite"), max_bytes=100)
+    yield cache
+    cache.close()
+
+
+def test_request_key_depends_on_content_and_parameters():
+    assert make_request_key(_payload("你好")) == make_request_key(_payload("你好"))
+    assert make_request_key(_payload("你好")) != make_request_key(_payload("您好"))
+    assert make_request_key(_payload("你好")) != make_request_key(_payload("你好", temperature=0.7))
+
+
+def test_get_put_and_stats(cache):
+    assert cache.get("a") is None
+    cache.put("a", "qwen-plus", "回复")
+    assert cache.get("a") == "回复"
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (1, 1, 1)
+    assert stats["size_bytes"] == len("回复".encode("utf-8"))
+
+
+def test_replace_adjusts_running_total(cache):
+    cache.put("a", "qwen-plus", "x" * 30)
+    cache.put("a", "qwen-plus", "y" * 10)
+    assert cache._total_bytes == 10
+    assert cache._total_bytes == cache._count_bytes()
+    assert cache.get("a") == "y" * 10
+
+
+def test_evicts_least_recently_accessed(cache, monkeypatch, fake_clock):
+    monkeypatch.setattr(response_cache, "time", fake_clock)
+    for key in ("a", "b", "c"):
+        cache.put(key, "qwen-plus", "x" * 30)
+        fake_clock.advance(1)
+    cache.get("a")
+    fake_clock.advance(1)
+    cache.put("d", "qwen-plus", "x" * 30)
+    # 超过 100 字节后淘汰到 90 字节以内：最久未访问的 b 被淘汰，刚读过的 a 保留
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert cache._total_bytes == cache._count_bytes() <= 90
+
+
+def test_running_total_survives_reopen(tmp_path):
+    path = str(tmp_path / "responses.sqlite")
+    first = ResponseCache(path, max_bytes=1000)
+    first.put("a", "qwen-plus", "x" * 40)
+    first.close()
+    reopened = ResponseCache(path, max_bytes=1000)
+    assert reopened._total_bytes == 40
+    reopened.close()
+
+
+def test_evict_recounts_before_deleting(cache):
+    # 同一文件被其他连接清空后，运行中的总数偏大：淘汰前重新统计，不误删
+    cache.put("a", "qwen-plus", "x" * 50)
+    cache._conn.execute("DELETE FROM responses")
+    cache.put("b", "qwen-plus", "x" * 60)
+    assert cache.get("b") is not None
+    assert cache._total_bytes == 60
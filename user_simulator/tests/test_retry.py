@@ -0,0 +1,116 @@
+"""重试策略、Retry-After 解析与客户端内的重试"""
+import time
+from email.utils import format_datetime
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from scripts.api_client import QwenAPIError
+from scripts.backends import MockLLMClient
+from scripts.retry import RetryPolicy, is_retryable_status, parse_retry_after
+
+
+class FlakyMockClient(MockLLMClient):
+    """前几次请求依次抛出给定的错误，之后由 MockLLMClient 正常回复"""
+
+    def __init__(self, errors, **kwargs):
+        super().__init__(**kwargs)
+        self.errors = list(errors)
+        self.attempts = 0
+
+    def _send_once(self, payload, timeout):
+        self.attempts += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return super()._send_once(payload, timeout)
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """记录重试前的等待秒数，不真正等待"""
+    recorded = []
+    monkeypatch.setattr(time, "sleep", recorded.append)
+    return recorded
+
+
+def test_retryable_status():
+    for status in (429, 500, 502, 503, 504, 599):
+        assert is_retryable_status(status)
+    for status in (None, 200, 400, 401, 403, 404):
+        assert not is_retryable_status(status)
+
+
+def test_parse_retry_after_seconds():
+    assert parse_retry_after("7") == 7.0
+    assert parse_retry_after(" 1.5 ") == 1.5
+    assert parse_retry_after("-3") == 0.0
+
+
+def test_parse_retry_after_http_date():
+    retry_at = datetime.now(timezone.utc) + timedelta(seconds=30)
+    assert 25 <= parse_retry_after(format_datetime(retry_at, usegmt=True)) <= 30
+    past = datetime.now(timezone.utc) - timedelta(seconds=30)
+    assert parse_retry_after(format_datetime(past, usegmt=True)) == 0.0
+
+
+def test_parse_retry_after_invalid():
+    assert parse_retry_after(None) is None
+    assert parse_retry_after("") is None
+    assert parse_retry_after("soon") is None
+
+
+def test_compute_delay_full_jitter_with_cap():
+    policy = RetryPolicy(base_delay=1.0, max_delay=5.0)
+    for attempt in range(8):
+        delay = policy.compute_delay(attempt)
+        assert 0 <= delay <= min(5.0, 2 ** attempt)
+
+
+def test_compute_delay_respects_retry_after():
+    policy = RetryPolicy(base_delay=0.1, max_delay=0.2)
+    assert policy.compute_delay(0, retry_after=12.0) == 12.0
+
+
+def test_next_delay_budgets():
+    policy = RetryPolicy(max_retries=2, max_elapsed=10.0)
+    transient = QwenAPIError("busy", status_code=503, transient=True)
+    now = time.monotonic()
+    assert policy.next_delay(transient, 0, now) is not None
+    assert policy.next_delay(transient, 2, now) is None
+    assert policy.next_delay(QwenAPIError("bad request", status_code=400), 0, now) is None
+    # Retry-After 超出剩余的重试耗时预算时不再重试
+    too_long = QwenAPIError("rate limited", status_code=429, retry_after=60.0, transient=True)
+    assert policy.next_delay(too_long, 0, now) is None
+
+
+def test_client_retries_transient_errors(sleeps):
+    client = FlakyMockClient(
+        [QwenAPIError("busy", status_code=503, transient=True),
+         QwenAPIError("rate limited", status_code=429, retry_after=2.5, transient=True)],
+        retry_policy=RetryPolicy(max_retries=3, base_delay=0.01, max_delay=0.01)
+    )
+    text = client.call("你好")
+    assert text.startswith("Response:")
+    assert client.attempts == 3
+    assert len(sleeps) == 2
+    assert sleeps[0] <= 0.01
+    assert sleeps[1] == 2.5
+    assert client.metrics.snapshot()["totals"]["retries"] == 2
+
+
+def test_client_does_not_retry_permanent_errors(sleeps):
+    client = FlakyMockClient([QwenAPIError("unauthorized", status_code=401)], retry_policy=RetryPolicy())
+    with pytest.raises(QwenAPIError):
+        client.call("你好")
+    assert client.attempts == 1
+    assert sleeps == []
+
+
+def test_client_gives_up_after_max_retries(sleeps):
+    errors = [QwenAPIError("busy", status_code=500, transient=True) for _ in range(5)]
+    client = FlakyMockClient(errors, retry_policy=RetryPolicy(max_retries=2, base_delay=0.01))
+    with pytest.raises(QwenAPIError) as excinfo:
+        client.call("你好")
+    assert excinfo.value.status_code == 500
+    assert client.attempts == 3
+    assert len(sleeps) == 2
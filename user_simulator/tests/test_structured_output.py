@@ -0,0 +1,140 @@
+"""结构化输出：严格解析、整段对话解析，以及修复与重新请求本轮"""
+import asyncio
+import json
+
+import pytest
+
+from scripts.backends import AsyncMockLLMClient, MockLLMClient
+from scripts.mock_responder import MockResponder
+from scripts.structured_output import (
+    StructuredOutputError, StructuredTurnParser, json_object_complete, parse_candidates, parse_dialogue, parse_turn
+)
+
+
+VALID_TURN = json.dumps({"thinking": "先解释数值", "response": "空腹7.8略高，先别担心。"}, ensure_ascii=False)
+
+
+def _dialogue(turns, overrides=None):
+    messages = []
+    for i in range(turns):
+        messages.append({"role": "user", "content": f"患者第{i + 1}句"})
+        messages.append({"role": "assistant", "thinking": f"思考{i + 1}", "content": f"照护师第{i + 1}句"})
+    for index, message in (overrides or {}).items():
+        messages[index] = message
+    return json.dumps({"dialogue": messages}, ensure_ascii=False)
+
+
+def _calls_by_caller(client):
+    return {row["caller"]: row["calls"] for row in client.metrics.snapshot()["series"]}
+
+
+def test_parse_turn_strips_fields_and_code_fence():
+    fenced = "```json\n" + json.dumps({"thinking": " 想 ", "response": " 说 ", "extra": 1}) + "\n```"
+    assert parse_turn(fenced) == {"thinking": "想", "response": "说"}
+
+
+@pytest.mark.parametrize("text", [None, "", "   ", "not json", "[1, 2]", '{"thinking": "想"}',
+                                  '{"thinking": "想", "response": "  "}', '{"thinking": 1, "response": "说"}'])
+def test_parse_turn_rejects_invalid(text):
+    with pytest.raises(StructuredOutputError):
+        parse_turn(text)
+
+
+def test_parse_candidates_deduplicates():
+    assert parse_candidates('{"candidates": [" 甲 ", "乙", "甲", "", 3]}') == ["甲", "乙"]
+    with pytest.raises(StructuredOutputError):
+        parse_candidates('{"candidates": ["", " "]}')
+
+
+def test_parse_dialogue_valid():
+    history = parse_dialogue(_dialogue(3), min_turns=3, max_turns=5)
+    assert len(history) == 6
+    assert history[0] == {"role": "user", "content": "患者第1句"}
+    assert history[1] == {"role": "assistant", "content": "照护师第1句", "thinking": "思考1"}
+
+
+@pytest.mark.parametrize("text, message", [
+    (_dialogue(2), "轮数"),
+    (_dialogue(6), "轮数"),
+    (_dialogue(3, {0: {"role": "assistant", "thinking": "想", "content": "说"}}), "应为 user"),
+    (_dialogue(3, {3: {"role": "assistant", "content": "没有思考"}}), "thinking"),
+    (_dialogue(3, {4: {"role": "user", "content": ""}}), "content"),
+    (json.dumps({"dialogue": [{"role": "user", "content": "只有患者"}]}, ensure_ascii=False), "结尾"),
+    ('{"messages": []}', "dialogue"),
+])
+def test_parse_dialogue_rejects_invalid(text, message):
+    with pytest.raises(StructuredOutputError, match=message):
+        parse_dialogue(text, min_turns=3, max_turns=5)
+
+
+def test_json_object_complete():
+    assert json_object_complete(VALID_TURN)
+    assert not json_object_complete(VALID_TURN[:-5])
+    assert not json_object_complete('{"a": "}')
+
+
+def test_valid_output_needs_no_extra_calls():
+    client = MockLLMClient()
+    parser = StructuredTurnParser(client)
+    assert parser.parse(VALID_TURN, caller="Test")["response"] == "空腹7.8略高，先别担心。"
+    assert _calls_by_caller(client) == {}
+
+
+def test_repair_fixes_malformed_output():
+    # 修复提示词中带有 JSON schema，模拟后端按 schema 返回合法的 JSON
+    client = MockLLMClient()
+    parser = StructuredTurnParser(client)
+    regenerations = []
+    result = parser.parse("Thinking: 想\nResponse: 说", caller="Test", regenerate=regenerations.append)
+    assert set(result) == {"thinking", "response"}
+    assert _calls_by_caller(client) == {"Test_repair": 1}
+    assert regenerations == []
+
+
+def test_failed_repair_regenerates_turn():
+    client = MockLLMClient(responder=MockResponder(["仍然不是 JSON"]))
+    parser = StructuredTurnParser(client, max_regenerations=2)
+    attempts = []
+
+    def regenerate(attempt):
+        attempts.append(attempt)
+        return VALID_TURN if attempt == 2 else "还是不对"
+
+    assert parser.parse("坏输出", caller="Test", regenerate=regenerate)["thinking"] == "先解释数值"
+    assert attempts == [1, 2]
+    assert _calls_by_caller(client) == {"Test_repair": 1}
+
+
+def test_empty_output_skips_repair():
+    client = MockLLMClient()
+    parser = StructuredTurnParser(client)
+    assert parser.parse("", caller="Test", regenerate=lambda attempt: VALID_TURN)["response"]
+    assert _calls_by_caller(client) == {}
+
+
+def test_raises_after_regenerations_exhausted():
+    client = MockLLMClient(responder=MockResponder(["仍然不是 JSON"]))
+    parser = StructuredTurnParser(client, max_regenerations=2)
+    attempts = []
+    with pytest.raises(StructuredOutputError):
+        parser.parse("坏输出", regenerate=lambda attempt: attempts.append(attempt) or "还是不对")
+    assert attempts == [1, 2]
+    with pytest.raises(StructuredOutputError):
+        parser.parse("坏输出")
+
+
+def test_aparse_repairs_and_regenerates():
+    async def main():
+        async with AsyncMockLLMClient(responder=MockResponder(["仍然不是 JSON"])) as client:
+            parser = StructuredTurnParser(client, fields=("response",))
+            attempts = []
+
+            async def regenerate(attempt):
+                attempts.append(attempt)
+                return '{"response": "重新生成"}'
+
+            return await parser.aparse("坏输出", caller="Test", regenerate=regenerate), attempts
+
+    result, attempts = asyncio.run(main())
+    assert result == {"response": "重新生成"}
+    assert attempts == [1]
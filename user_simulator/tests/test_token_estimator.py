@@ -0,0 +1,93 @@
+"""离线 token 预估：按字符类别加权、按模型修正；提示词预算按顺序裁剪可选段落"""
+import pytest
+
+from scripts.backends import MockLLMClient
+from scripts.token_estimator import MESSAGE_OVERHEAD, REPLY_OVERHEAD, PromptBudgetEnforcer, TokenEstimator
+
+
+def test_count_weights_character_classes():
+    estimator = TokenEstimator(weights={
+        "cjk": 1.0, "cjk_punct": 10.0, "word": 100.0, "word_char": 0.0, "digit": 1000.0,
+        "space": 0.0, "punct": 0.0, "other": 0.0
+    })
+    assert estimator.count("血糖") == 2
+    assert estimator.count("。") == 10
+    assert estimator.count("glucose mmol") == 200
+    assert estimator.count("7.8") == 2000
+    assert estimator.count("") == 0
+
+
+def test_count_messages_adds_template_overhead():
+    estimator = TokenEstimator()
+    messages = [{"role": "system", "content": "规则"}, {"role": "user", "content": "空腹7.8"}]
+    expected = REPLY_OVERHEAD + sum(MESSAGE_OVERHEAD + estimator.count(m["content"]) for m in messages)
+    assert estimator.count_messages(messages) == expected
+
+
+def test_observe_learns_per_model_scale():
+    estimator = TokenEstimator(smoothing=0.5)
+    assert estimator.scale("qwen-plus") == 1.0
+    estimator.observe("qwen-plus", 100, 120)
+    assert estimator.scale("qwen-plus") == pytest.approx(1.2)
+    estimator.observe("qwen-plus", 100, 140)
+    assert estimator.scale("qwen-plus") == pytest.approx(1.3)
+    # 异常比例被限制在 [0.5, 2]，无效观测忽略
+    estimator.observe("qwen-turbo", 100, 1000)
+    assert estimator.scale("qwen-turbo") == 2.0
+    estimator.observe("qwen-turbo", 0, 100)
+    assert estimator.scale("qwen-turbo") == 2.0
+    messages = [{"role": "user", "content": "血糖" * 50}]
+    raw = estimator.count_messages(messages)
+    assert estimator.estimate_messages(messages, "qwen-plus") == round(raw * 1.3)
+    assert estimator.estimate_messages(messages) == raw
+
+
+def test_client_records_estimate_next_to_actual_usage():
+    estimator = TokenEstimator()
+    client = MockLLMClient(token_estimator=estimator)
+    client.call("空腹血糖7.8mmol/L，有点担心" * 10, caller="Test")
+    totals = client.metrics.snapshot()["totals"]
+    assert totals["estimated_input_tokens"] > 0 and totals["estimated_actual_tokens"] > 0
+    # 模拟后端按字符计 token，修正系数随之更新
+    assert estimator.scale("qwen-plus") != 1.0
+
+
+def _builder(history_len):
+    calls = []
+
+    def build(story, background, max_history):
+        calls.append({"story": story, "background": background, "max_history": max_history})
+        history = history_len if max_history is None else max_history
+        return f"{story or ''}|{background}|" + "历史消息" * 10 * history
+
+    return build, calls
+
+
+def test_prompt_within_limit_is_untouched():
+    enforcer = PromptBudgetEnforcer({"patient": 10000})
+    build, calls = _builder(6)
+    assert enforcer.fit("patient", build, "故事", "状态", 6) == "故事|状态|" + "历史消息" * 60
+    assert len(calls) == 1
+    assert PromptBudgetEnforcer({}).fit("assistant", build, "故事", "状态", 6).startswith("故事")
+
+
+def test_trims_story_then_background_then_history():
+    estimator = TokenEstimator()
+    build, calls = _builder(8)
+    background = "生活状态" * 100
+    limit = estimator.count_messages([{"role": "user", "content": "||" + "历史消息" * 40}])
+    prompt = PromptBudgetEnforcer({"patient": limit}, estimator, background_chars=50).fit(
+        "patient", build, "故事" * 100, background, 8
+    )
+    assert prompt == "||" + "历史消息" * 40
+    assert [c["story"] is None for c in calls[1:]] == [True] * (len(calls) - 1)
+    assert calls[2]["background"] == background[:50] + "..."
+    assert calls[3]["background"] == ""
+    assert [c["max_history"] for c in calls[4:]] == [6, 4]
+
+
+def test_returns_shortest_prompt_when_still_over_limit():
+    build, calls = _builder(5)
+    prompt = PromptBudgetEnforcer({"patient": 1}, min_history=2).fit("patient", build, None, "", 5)
+    assert prompt == "||" + "历史消息" * 20
+    assert [c["max_history"] for c in calls] == [None, 3, 2]
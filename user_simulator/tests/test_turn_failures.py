@@ -0,0 +1,99 @@
+"""结构化输出的单轮失败：照护师侧抛出而不是写入占位回复，主流程只丢弃并重新生成出错的那一轮"""
+import pytest
+
+from main_random_topic import ConsolidatedDialogueGenerator
+from scripts.backends import MockLLMClient
+from scripts.health_assistant_generator_thinking import HealthAssistantGenerator_thinking
+from scripts.mock_responder import MockResponder
+from scripts.structured_output import StructuredOutputError
+
+
+class ScriptedGenerator:
+    """按顺序返回回复；脚本中的 None 表示这一轮修复、重新请求后仍不合法"""
+
+    def __init__(self, script, default):
+        self.script = list(script)
+        self.default = default
+        self.calls = 0
+
+    def _next(self):
+        self.calls += 1
+        reply = self.script.pop(0) if self.script else f"{self.default}{self.calls}"
+        if reply is None:
+            raise StructuredOutputError("字段 response 缺失或不是非空字符串", "坏输出")
+        return reply
+
+    def generate_response(self, **kwargs):
+        return {"thinking": "(无思考过程)", "response": self._next()}
+
+    def generate_reply(self, **kwargs):
+        return {"thinking": "思考", "response": self._next()}
+
+
+def _generator(patient_script, assistant_script):
+    generator = ConsolidatedDialogueGenerator.__new__(ConsolidatedDialogueGenerator)
+    generator.one_shot_generator = None
+    generator.delay = 0
+    generator.patient_generator = ScriptedGenerator(patient_script, "空腹血糖有点高，第")
+    generator.assistant_generator = ScriptedGenerator(assistant_script, "数值略高，可以再观察，第")
+    generator._select_topic = lambda patient_index: "空腹血糖偏高"
+    return generator
+
+
+def _run(generator):
+    return generator.generate_for_patient({}, 0, "patient_0")
+
+
+def test_failed_turn_is_regenerated_and_earlier_turns_kept():
+    generator = _generator(["我空腹7.8，有点担心。", None], [])
+    result = _run(generator)
+    assert result["success"]
+    data = result["data"]
+    contents = [msg["content"] for msg in data["dialogue_history"]]
+    assert contents[0] == "我空腹7.8，有点担心。"
+    assert "(生成失败)" not in contents
+    assert data["metadata"]["failed_turns"] == 1
+    roles = [msg["role"] for msg in data["dialogue_history"]]
+    assert all(a != b for a, b in zip(roles, roles[1:]))
+
+
+def test_too_many_failed_turns_end_dialogue_keeping_generated_turns():
+    limit = ConsolidatedDialogueGenerator.MAX_FAILED_TURNS
+    generator = _generator(["我空腹7.8，有点担心。", "那我明天再测一次看看。"], ["先别担心，明早再测一次。"] + [None] * (limit + 1))
+    result = _run(generator)
+    assert result["success"]
+    history = result["data"]["dialogue_history"]
+    # 没有得到回复的患者消息被去掉，之前的轮次保留
+    assert [msg["content"] for msg in history] == ["我空腹7.8，有点担心。", "先别担心，明早再测一次。"]
+    assert result["data"]["metadata"]["failed_turns"] == limit + 1
+    assert generator.assistant_generator.calls == limit + 2
+
+
+def test_no_turns_generated_is_reported_as_failure():
+    limit = ConsolidatedDialogueGenerator.MAX_FAILED_TURNS
+    result = _run(_generator([None] * (limit + 1), []))
+    assert not result["success"]
+    assert "输出不合法" in result["error"]
+
+
+def test_structured_assistant_raises_instead_of_placeholder():
+    client = MockLLMClient(responder=MockResponder(["不是 JSON"]))
+    generator = HealthAssistantGenerator_thinking(client, structured_output=True)
+    with pytest.raises(StructuredOutputError):
+        generator.generate_reply(
+            persona={"基本信息": {"年龄": 60}},
+            dialogue_topic="空腹血糖偏高",
+            background="",
+            dialogue_history=[{"role": "user", "content": "我空腹7.8，有点担心。"}]
+        )
+
+
+def test_plain_assistant_still_returns_reply():
+    generator = HealthAssistantGenerator_thinking(MockLLMClient())
+    reply = generator.generate_reply(
+        persona={"基本信息": {"年龄": 60}},
+        dialogue_topic="空腹血糖偏高",
+        background="",
+        dialogue_history=[{"role": "user", "content": "我空腹7.8，有点担心。"}]
+    )
+    assert reply["response"] and reply["response"] != "(生成失败)"